@@ -1,14 +1,26 @@
 """
 Хранилище для управления конфигурацией агентов.
-Поддерживает CRUD операции с персистентностью в JSON файл.
+Поддерживает CRUD операции с персистентностью в JSON файл или SQLite
+(см. storage_backends). Изменения, сделанные другими процессами,
+подхватываются при следующем обращении к хранилищу.
 """
 
-import json
-from pathlib import Path
-from typing import Dict, List, Optional
+import hashlib
+import os
+import threading
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Callable, Dict, Iterable, List, Mapping, Optional, Set, Tuple
 from datetime import datetime
 from loguru import logger
 
+from storage_backends import AgentsBackend, StorageConflictError, create_backend
+
+__all__ = [
+    "Agent", "AgentsSnapshot", "AgentsStorage", "StorageConflictError",
+    "get_storage", "render_routing_menu",
+]
+
 
 class Agent:
     """Модель агента"""
@@ -45,33 +57,217 @@ class Agent:
     def from_dict(cls, data: dict) -> 'Agent':
         return cls(**data)
 
+    @property
+    def prompt_version(self) -> str:
+        """Версия промпта — хэш его текста (меняется только при правке промпта)"""
+        return hashlib.sha256(self.prompt.encode("utf-8")).hexdigest()[:16]
+
+
+def render_routing_menu(agents: Iterable[Mapping[str, str]]) -> str:
+    """Список агентов для промпта маршрутизатора"""
+    return "\n".join(
+        f"- {agent['id']}: {agent['name']} - {agent['description']}"
+        for agent in agents
+    )
+
+
+@dataclass(frozen=True)
+class AgentsSnapshot:
+    """
+    Неизменяемый срез хранилища для горячего пути оркестратора.
+
+    Собирается один раз на версию хранилища; узлы графа читают готовые
+    словари вместо обхода Agent-объектов на каждом вызове.
+    """
+    version: int
+    agent_ids: Tuple[str, ...]
+    # Публичные поля агентов (id, name, description) для маршрутизаторов
+    agents: Tuple[Mapping[str, str], ...]
+    prompts: Mapping[str, str]
+    prompt_versions: Mapping[str, str]
+    names: Mapping[str, str]
+    descriptions: Mapping[str, str]
+    routing_menu: str
+
+    @classmethod
+    def build(cls, version: int, agents: Mapping[str, Agent]) -> "AgentsSnapshot":
+        routing_agents = tuple(
+            MappingProxyType({"id": a.id, "name": a.name, "description": a.description})
+            for a in agents.values()
+        )
+        return cls(
+            version=version,
+            agent_ids=tuple(agents),
+            agents=routing_agents,
+            prompts=MappingProxyType({i: a.prompt for i, a in agents.items()}),
+            prompt_versions=MappingProxyType({i: a.prompt_version for i, a in agents.items()}),
+            names=MappingProxyType({i: a.name for i, a in agents.items()}),
+            descriptions=MappingProxyType(
+                {i: f"{a.name} - {a.description}" for i, a in agents.items()}
+            ),
+            routing_menu=render_routing_menu(routing_agents),
+        )
+
+
+class _VersionedAgents(dict):
+    """Словарь агентов, увеличивающий версию хранилища при любом изменении"""
+
+    def __init__(self, data: Mapping[str, Agent], on_change: Callable[[], None]):
+        super().__init__(data)
+        self._on_change = on_change
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._on_change()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._on_change()
+
+    def pop(self, *args):
+        value = super().pop(*args)
+        self._on_change()
+        return value
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._on_change()
+
+    def clear(self):
+        super().clear()
+        self._on_change()
+
 
 class AgentsStorage:
-    """Хранилище агентов с персистентностью в JSON"""
+    """Хранилище агентов с персистентностью в JSON или SQLite"""
 
-    def __init__(self, file_path: str = "agents_config.json"):
-        self.file_path = Path(file_path)
-        self.agents: Dict[str, Agent] = {}
+    def __init__(self, file_path: str = "agents_config.json", backend: Optional[AgentsBackend] = None):
+        self.file_path = file_path
+        self._backend = backend or create_backend(file_path)
+        self._agents: Dict[str, Agent] = _VersionedAgents({}, self._bump_version)
+        # Счётчик изменений набора агентов и закэшированный срез для него
+        self._version = 0
+        self._snapshot: Optional[AgentsSnapshot] = None
+        # Состояние бэкенда, соответствующее self._agents
+        self._change_token = None
+        # Файл не удалось прочитать: при первом обновлении пишем весь набор
+        self._needs_full_save = False
+        self._lock = threading.RLock()
+        # Подписчики на изменение промпта агента (например, кэш ответов)
+        self._prompt_listeners: List[Callable[[str], None]] = []
+        # Агенты, чей промпт изменил другой процесс; подписчики узнают о них
+        # только в refresh(), get_all(), get_by_id() и update()
+        self._pending_prompt_changes: Set[str] = set()
         self._load()
 
+    @property
+    def agents(self) -> Dict[str, Agent]:
+        """Агенты; перед чтением проверяет, не изменил ли хранилище другой процесс"""
+        self._reload()
+        return self._agents
+
+    @agents.setter
+    def agents(self, value: Dict[str, Agent]):
+        self._agents = _VersionedAgents(value, self._bump_version)
+        self._bump_version()
+
+    def _bump_version(self):
+        self._version += 1
+
+    @property
+    def version(self) -> int:
+        """Счётчик изменений: растёт при каждой правке или перечитывании агентов"""
+        self._reload()
+        return self._version
+
+    def snapshot(self) -> AgentsSnapshot:
+        """Неизменяемый срез агентов; пересобирается только при смене версии"""
+        self._reload()
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version == self._version:
+            return snapshot
+
+        with self._lock:
+            if self._snapshot is None or self._snapshot.version != self._version:
+                self._snapshot = AgentsSnapshot.build(self._version, self._agents)
+            return self._snapshot
+
+    def close(self):
+        """Закрывает соединение бэкенда (остановка процесса)"""
+        self._backend.close()
+
     def _load(self):
-        """Загружает агентов из файла или создает дефолтную конфигурацию"""
-        if self.file_path.exists():
-            try:
-                with open(self.file_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    self.agents = {
-                        agent_id: Agent.from_dict(agent_data)
-                        for agent_id, agent_data in data.items()
-                    }
-                logger.info(f"Loaded {len(self.agents)} agents from {self.file_path}")
-            except Exception as e:
-                logger.warning(f"Error loading agents: {e}. Using default configuration.")
-                self._create_default_agents()
-        else:
-            logger.info(f"File {self.file_path} not found. Creating default configuration.")
+        """Загружает агентов из бэкенда или создает дефолтную конфигурацию"""
+        token = self._backend.change_token()
+        try:
+            data = self._backend.load_all()
+        except Exception as e:
+            logger.warning(f"Error loading agents: {e}. Using default configuration.")
+            self._create_default_agents()
+            self._needs_full_save = True
+            self._change_token = token
+            return
+
+        if data is None:
+            logger.info(f"Storage {self.file_path} not found. Creating default configuration.")
             self._create_default_agents()
             self._save()
+            return
+
+        self.agents = {
+            agent_id: Agent.from_dict(agent_data)
+            for agent_id, agent_data in data.items()
+        }
+        self._change_token = token
+        logger.info(f"Loaded {len(self._agents)} agents from {self.file_path}")
+
+    def refresh(self) -> bool:
+        """
+        Перечитывает агентов, если хранилище изменил другой процесс.
+
+        Возвращает True, если данные были перечитаны. Подписчики уведомляются
+        об агентах, у которых изменился промпт. Подписчики (кэши) сами читают
+        хранилище под своими блокировками, поэтому refresh() вызывается только
+        на верхнем уровне, не из snapshot()/get_prompt_version().
+        """
+        reloaded = self._reload()
+        self._flush_prompt_changes()
+        return reloaded
+
+    def _reload(self) -> bool:
+        """Перечитывание без уведомлений: изменённые промпты копятся до refresh()"""
+        if self._backend.change_token() == self._change_token:
+            return False
+
+        with self._lock:
+            token = self._backend.change_token()
+            if token == self._change_token:
+                return False
+            try:
+                data = self._backend.load_all()
+            except Exception as e:
+                # Например, файл правят вручную — оставляем прежние данные
+                # до следующего изменения
+                logger.warning(f"Error reloading agents: {e}")
+                self._change_token = token
+                return False
+            if data is None:
+                return False
+
+            previous = self._agents
+            self.agents = {
+                agent_id: Agent.from_dict(agent_data)
+                for agent_id, agent_data in data.items()
+            }
+            self._change_token = token
+            self._needs_full_save = False
+            self._pending_prompt_changes.update(
+                agent_id for agent_id, agent in self._agents.items()
+                if agent_id in previous and previous[agent_id].prompt != agent.prompt
+            )
+
+        logger.debug(f"Reloaded {len(self._agents)} agents from {self.file_path}")
+        return True
 
     def _create_default_agents(self):
         """Создает дефолтную конфигурацию агентов"""
@@ -164,64 +360,122 @@ class AgentsStorage:
         }
 
     def _save(self):
-        """Сохраняет агентов в файл"""
+        """Полностью записывает текущий набор агентов в бэкенд"""
         try:
             data = {
                 agent_id: agent.to_dict()
-                for agent_id, agent in self.agents.items()
+                for agent_id, agent in self._agents.items()
             }
-            with open(self.file_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
-            logger.debug(f"Saved {len(self.agents)} agents to {self.file_path}")
+            self._backend.save_all(data)
+            self._change_token = self._backend.change_token()
+            self._needs_full_save = False
+            logger.debug(f"Saved {len(self._agents)} agents to {self.file_path}")
         except Exception as e:
             logger.error(f"Error saving agents: {e}")
             raise
 
     def get_all(self) -> List[dict]:
         """Возвращает список всех агентов"""
+        self.refresh()
         return [agent.to_dict() for agent in self.agents.values()]
 
     def get_by_id(self, agent_id: str) -> Optional[dict]:
         """Возвращает агента по ID"""
-        agent = self.agents.get(agent_id)
+        self.refresh()
+        agent = self._agents.get(agent_id)
         return agent.to_dict() if agent else None
 
-    def update(self, agent_id: str, name: str, description: str, prompt: str, color: str) -> dict:
-        """Обновляет агента"""
-        if agent_id not in self.agents:
-            raise ValueError(f"Агент {agent_id} не найден")
+    def update(
+        self,
+        agent_id: str,
+        name: str,
+        description: str,
+        prompt: str,
+        color: str,
+        expected_updated_at: Optional[str] = None
+    ) -> dict:
+        """
+        Обновляет агента.
+
+        expected_updated_at — updated_at, который видел клиент; если агент с тех
+        пор изменён (в том числе другим процессом), бросает StorageConflictError.
+        """
+        with self._lock:
+            if agent_id not in self.agents:
+                raise ValueError(f"Агент {agent_id} не найден")
+
+            agent = self._agents[agent_id]
+            prompt_changed = agent.prompt != prompt
+            updated = Agent(
+                id=agent_id,
+                name=name,
+                description=description,
+                prompt=prompt,
+                color=color,
+                created_at=agent.created_at,
+                updated_at=datetime.now().isoformat()
+            )
+
+            if self._needs_full_save:
+                if expected_updated_at is not None and agent.updated_at != expected_updated_at:
+                    raise StorageConflictError(f"Агент {agent_id} был изменён ({agent.updated_at})")
+                self._agents[agent_id] = updated
+                self._save()
+            else:
+                # Пишется только одна запись; остальные агенты перечитываются,
+                # чтобы не потерять правки других процессов
+                self._backend.save_agent(updated.to_dict(), expected_updated_at)
+                self._agents[agent_id] = updated
+                self._reload()
+
+        if prompt_changed:
+            self._notify_prompt_changed(agent_id)
+        self._flush_prompt_changes()
+
+        return updated.to_dict()
 
-        agent = self.agents[agent_id]
-        agent.name = name
-        agent.description = description
-        agent.prompt = prompt
-        agent.color = color
-        agent.updated_at = datetime.now().isoformat()
+    def _notify_prompt_changed(self, agent_id: str):
+        for listener in self._prompt_listeners:
+            listener(agent_id)
 
-        self._save()
-        return agent.to_dict()
+    def _flush_prompt_changes(self):
+        """Уведомляет подписчиков о промптах, изменённых другими процессами"""
+        with self._lock:
+            changed, self._pending_prompt_changes = self._pending_prompt_changes, set()
+        for agent_id in sorted(changed):
+            self._notify_prompt_changed(agent_id)
+
+    def subscribe_prompt_changes(self, listener: Callable[[str], None]):
+        """Регистрирует callback(agent_id), вызываемый при изменении промпта"""
+        self._prompt_listeners.append(listener)
+
+    def get_prompt_version(self, agent_id: str) -> Optional[str]:
+        """Возвращает версию промпта агента или None, если агента нет"""
+        return self.snapshot().prompt_versions.get(agent_id)
 
     def get_prompts_dict(self) -> Dict[str, str]:
         """Возвращает словарь промптов для использования в orchestrator"""
-        return {
-            agent_id: agent.prompt
-            for agent_id, agent in self.agents.items()
-        }
+        return dict(self.snapshot().prompts)
 
     def get_descriptions_dict(self) -> Dict[str, str]:
         """Возвращает словарь описаний агентов для routing"""
-        return {
-            agent_id: f"{agent.name} - {agent.description}"
-            for agent_id, agent in self.agents.items()
-        }
+        return dict(self.snapshot().descriptions)
 
 
 # Глобальный инстанс хранилища
 _storage = None
 
 def get_storage() -> AgentsStorage:
-    """Возвращает singleton инстанс хранилища"""
+    """
+    Возвращает singleton инстанс хранилища.
+
+    Путь задаётся AGENTS_STORAGE_PATH (по умолчанию agents_config.json), тип
+    бэкенда — AGENTS_STORAGE_BACKEND (json / sqlite) или расширением файла.
+    """
     global _storage
     if _storage is None:
-        _storage = AgentsStorage()
+        path = os.getenv("AGENTS_STORAGE_PATH", "agents_config.json")
+        _storage = AgentsStorage(
+            path, backend=create_backend(path, os.getenv("AGENTS_STORAGE_BACKEND") or None)
+        )
     return _storage
@@ -0,0 +1,130 @@
+"""
+Пакетный прогон запросов через оркестратор из командной строки.
+
+Входной файл — по запросу на строку или JSONL с полем "query" ("-" — stdin).
+Результаты печатаются в NDJSON по мере готовности в том же формате, что
+отдаёт POST /query/batch; сводка пишется в stderr.
+
+По умолчанию пайплайн выполняется в этом процессе (нужен .env с ключом
+провайдера). С --url запросы отправляются на запущенный сервер, ключ API
+берётся из переменной API_KEY.
+
+Запуск из каталога backend:
+    python batch_cli.py backlog.txt [--concurrency 4] [--chunk-size 20]
+    python batch_cli.py backlog.jsonl --url http://localhost:8000 > results.ndjson
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from typing import AsyncIterator, List, TextIO
+
+
+def read_queries(source: TextIO) -> List[str]:
+    """Запросы из текстового файла или JSONL (пустые строки пропускаются)"""
+    queries = []
+    for line in source:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("{"):
+            line = json.loads(line)["query"].strip()
+        queries.append(line)
+    return queries
+
+
+async def run_local(
+    queries: List[str], concurrency: int, chunk_size: int, verbosity: str
+) -> AsyncIterator[dict]:
+    """События пачки при выполнении пайплайна в текущем процессе"""
+    from llm_client import close_llm_factory
+    from orchestrator import process_batch
+    from pipeline_trace import apply_verbosity
+
+    try:
+        async for item in process_batch(queries, concurrency=concurrency, chunk_size=chunk_size):
+            if "error" in item:
+                yield {"event": "error", "index": item["index"],
+                       "detail": f"Error processing query: {item['error']}"}
+            else:
+                yield {"event": "result", "index": item["index"],
+                       "result": apply_verbosity(item["result"], verbosity)}
+    finally:
+        await close_llm_factory()
+
+
+async def run_remote(
+    queries: List[str], url: str, concurrency: int, verbosity: str
+) -> AsyncIterator[dict]:
+    """События пачки из POST /query/batch запущенного сервера"""
+    import httpx
+
+    headers = {"X-API-Key": os.environ["API_KEY"]} if os.getenv("API_KEY") else {}
+    payload = {"queries": queries, "verbosity": verbosity, "concurrency": concurrency}
+    async with httpx.AsyncClient(timeout=None) as client:
+        async with client.stream(
+            "POST", f"{url.rstrip('/')}/query/batch", json=payload, headers=headers
+        ) as response:
+            if response.status_code != 200:
+                await response.aread()
+                raise SystemExit(f"HTTP {response.status_code}: {response.text}")
+            async for line in response.aiter_lines():
+                if line:
+                    event = json.loads(line)
+                    # Сводку сервера не печатаем — CLI пишет свою
+                    if event["event"] != "done":
+                        yield event
+
+
+async def run(args) -> int:
+    with (sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")) as source:
+        queries = read_queries(source)
+    if not queries:
+        print("No queries found", file=sys.stderr)
+        return 1
+
+    output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    if args.url:
+        events = run_remote(queries, args.url, args.concurrency, args.verbosity)
+    else:
+        events = run_local(queries, args.concurrency, args.chunk_size, args.verbosity)
+
+    started = time.perf_counter()
+    failed = 0
+    try:
+        async for event in events:
+            if event["event"] == "error":
+                failed += 1
+            output.write(json.dumps(event, ensure_ascii=False) + "\n")
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    elapsed = time.perf_counter() - started
+    print(
+        f"{len(queries)} queries, {failed} failed, {elapsed:.1f} s "
+        f"({elapsed / len(queries):.2f} s/query)",
+        file=sys.stderr
+    )
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("input", help="файл с запросами (текст или JSONL), '-' — stdin")
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("BATCH_CONCURRENCY", 4)))
+    parser.add_argument("--chunk-size", type=int, default=int(os.getenv("BATCH_ROUTING_CHUNK", 20)),
+                        help="запросов на один вызов маршрутизатора")
+    parser.add_argument("--verbosity", choices=["compact", "full", "trace"], default="compact")
+    parser.add_argument("--url", help="адрес сервера (иначе пайплайн выполняется локально)")
+    parser.add_argument("--output", help="файл для NDJSON (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""
+Бенчмарк стоимости подготовки графа на один запрос.
+
+Сравнивает сборку графа на каждый запрос (create_workflow, как было раньше)
+с закэшированным скомпилированным графом (get_workflow).
+
+Запуск из каталога backend:
+    python benchmarks/bench_graph_setup.py [--iterations 200]
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import orchestrator  # noqa: E402
+
+
+def measure(func, iterations: int) -> float:
+    """Среднее время одного вызова в миллисекундах"""
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - started) * 1000 / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    # Прогрев: первая компиляция и импорт ленивых зависимостей LangGraph
+    orchestrator.get_workflow()
+
+    before = measure(orchestrator.create_workflow, args.iterations)
+    after = measure(orchestrator.get_workflow, args.iterations)
+
+    print(f"iterations:                      {args.iterations}")
+    print(f"create_workflow() per request:   {before:.3f} ms")
+    print(f"get_workflow() per request:      {after:.4f} ms")
+    print(f"speedup:                         {before / after:.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Холодный старт процесса API: время импорта по `python -X importtime`.
+
+Каждый замер — отдельный процесс интерпретатора (без прогретого кэша модулей
+в памяти), берётся медиана по --runs запускам:
+
+- `import main` — то, что платит воркер до ответа на /health;
+- `import main` + orchestrator.warm_up() — загрузка LLM-стека (langchain,
+  langgraph, openai) и компиляция графа, как при LLM_WARMUP=true или первом
+  запросе;
+- `pytest --collect-only` — сбор тестов.
+
+Для `import main` выводятся самые тяжёлые модули (накопительное время) и
+признак, загружены ли langchain/langgraph/openai.
+
+Запуск из каталога backend:
+    python benchmarks/bench_import_time.py [--runs 5] [--top 10]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+HEAVY_MODULES = ("langchain_core", "langgraph", "langchain_openai", "openai", "httpx")
+
+
+def import_profile(code: str, env: dict) -> dict:
+    """Накопительное время импорта (мкс) по -X importtime: {(глубина, модуль): время}"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True, check=True,
+    )
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative_us, name = line.split("|")
+        if cumulative_us.strip().isdigit():
+            # Вложенность импорта — отступ по два пробела на уровень
+            depth = (len(name) - len(name.lstrip()) - 1) // 2
+            cumulative[(depth, name.strip())] = int(cumulative_us)
+    return cumulative
+
+
+def wall_time(command: list, env: dict) -> float:
+    started = time.perf_counter()
+    subprocess.run(command, cwd=BACKEND_DIR, env=env, capture_output=True, check=True)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(
+            os.environ,
+            AGENTS_STORAGE_PATH=str(Path(tmp) / "agents.json"),
+            OPENROUTER_API_KEY="bench",
+        )
+        check_heavy = (
+            "import main, sys; "
+            f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+        )
+        loaded = subprocess.run(
+            [sys.executable, "-c", check_heavy], cwd=BACKEND_DIR, env=env,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+
+        profiles = [import_profile("import main", env) for _ in range(args.runs)]
+        import_main = statistics.median(p[(0, "main")] for p in profiles) / 1e6
+        warm = statistics.median(
+            wall_time([sys.executable, "-c", "import main, orchestrator; orchestrator.warm_up()"], env)
+            for _ in range(args.runs)
+        )
+        collect = statistics.median(
+            wall_time([sys.executable, "-m", "pytest", "--collect-only", "-q", "--no-cov",
+                       "-p", "no:cacheprovider", "tests"], env)
+            for _ in range(args.runs)
+        )
+
+    print(f"import main (importtime):         {import_main:.3f} s")
+    print(f"import main + warm_up (wall):     {warm:.3f} s")
+    print(f"pytest --collect-only (wall):     {collect:.3f} s")
+    print(f"LLM stack loaded by import main:  {loaded or 'none'}")
+    print(f"\nHeaviest modules under `import main` (cumulative, median of {args.runs}):")
+    # Прямые импорты main
+    keys = [key for key in profiles[0] if key[0] == 1]
+    ranked = sorted(
+        keys, key=lambda key: statistics.median(p.get(key, 0) for p in profiles), reverse=True
+    )
+    for depth, name in ranked[:args.top]:
+        median_ms = statistics.median(p.get((depth, name), 0) for p in profiles) / 1000
+        print(f"  {name:30}{median_ms:>9.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
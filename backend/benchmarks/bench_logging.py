@@ -0,0 +1,179 @@
+"""
+Накладные расходы логирования на пути запроса.
+
+1. Стоимость log_payload с ответом агента (--payload-kb КБ) в вызывающем
+   потоке: без файлового синка, синхронный файловый синк (как было в
+   main.py), фоновый (LOG_ENQUEUE) и фоновый в JSON, а также синк, каждая
+   запись в который ждёт --stall-ms (медленный диск, полный pipe stderr) —
+   синхронно и в фоне.
+2. Полный граф под нагрузкой (LLM_TRANSPORT=stub, --concurrency клиентов):
+   пропускная способность и p50/p95 запроса для тех же синков.
+
+Каждая конфигурация — с записью всех ответов целиком и с выборкой
+LOG_PAYLOAD_SAMPLE_RATE=0.1 и обрезкой до 500 символов. Логи пишутся во
+временный каталог.
+
+Запуск из каталога backend:
+    python benchmarks/bench_logging.py [--calls 5000] [--queries 500] [--concurrency 50]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from loguru import logger  # noqa: E402
+
+from logging_setup import (  # noqa: E402
+    FILE_FORMAT, LogSettings, background_sink, configure_logging, flush_logs, log_payload, request_context
+)
+
+# Без файла и с stderr только для CRITICAL — точка отсчёта
+QUIET = dict(level="CRITICAL", file=None)
+PAYLOADS = (
+    ("all, full", dict(payload_limit=10 ** 6)),
+    ("10%, 500 chars", dict(payload_sample_rate=0.1, payload_limit=500)),
+)
+
+
+class StalledFile:
+    """Файл, каждая запись в который ждёт stall секунд (медленный диск, полный pipe stderr)"""
+
+    def __init__(self, path: str, stall: float):
+        self.file = open(path, "a", encoding="utf-8")
+        self.stall = stall
+
+    def write(self, text: str):
+        time.sleep(self.stall)
+        self.file.write(text)
+
+    def flush(self):
+        self.file.flush()
+
+
+def sinks(log_dir: str, stall_ms: float) -> list:
+    """(название, функция настройки логирования по настройкам payload)"""
+    log_file = os.path.join(log_dir, "app.log")
+    stalled = os.path.join(log_dir, "stalled.log")
+
+    def quiet(payloads):
+        configure_logging(LogSettings(**QUIET, **payloads))
+
+    def file(enqueue):
+        return lambda payloads: configure_logging(
+            LogSettings(level="CRITICAL", file=log_file, enqueue=enqueue, **payloads)
+        )
+
+    def stall(enqueue):
+        def setup(payloads):
+            quiet(payloads)
+            stream = StalledFile(stalled, stall_ms / 1000)
+            sink = background_sink(logging.StreamHandler(stream)) if enqueue else stream
+            logger.add(sink, level="DEBUG", format=FILE_FORMAT, colorize=False)
+        return setup
+
+    return [
+        ("no file sink", quiet),
+        ("sync file", file(False)),
+        ("enqueued file", file(True)),
+        ("enqueued json", lambda payloads: configure_logging(
+            LogSettings(level="CRITICAL", file=log_file, json=True, **payloads)
+        )),
+        (f"sync, {stall_ms:g} ms stall", stall(False)),
+        (f"enqueued, {stall_ms:g} ms stall", stall(True)),
+    ]
+
+
+def flush() -> float:
+    """Время дописывания очередей фоновых синков после прогона"""
+    started = time.perf_counter()
+    flush_logs(timeout=600)
+    return time.perf_counter() - started
+
+
+def per_call(payload: str, calls: int) -> dict:
+    timings = []
+    for _ in range(calls):
+        # Решение о выборке принимается на запрос
+        with request_context():
+            started = time.perf_counter_ns()
+            log_payload("Agent agent1 response", payload)
+            timings.append((time.perf_counter_ns() - started) / 1000)
+    flushed = flush()
+    timings.sort()
+    return {"mean": statistics.mean(timings), "p99": timings[int(len(timings) * 0.99)], "flush": flushed}
+
+
+async def under_load(queries: int, concurrency: int) -> dict:
+    import orchestrator
+
+    semaphore = asyncio.Semaphore(concurrency)
+    timings = []
+
+    async def one(index: int):
+        async with semaphore:
+            with request_context():
+                started = time.perf_counter()
+                await orchestrator.process_query(f"Собери требования к CRM (проект {index})")
+                timings.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(index) for index in range(queries)))
+    elapsed = time.perf_counter() - started
+    timings.sort()
+    return {"rps": queries / elapsed, "p50": statistics.median(timings), "p95": timings[int(len(timings) * 0.95)]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--calls", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--payload-kb", type=int, default=8)
+    parser.add_argument("--stub-latency-ms", type=float, default=20)
+    parser.add_argument("--stall-ms", type=float, default=1, help="задержка записи медленного синка")
+    args = parser.parse_args()
+
+    payload = ("Требование: система должна хранить историю заявок. " * 200)[: args.payload_kb * 1024]
+    os.environ.update({
+        "LLM_TRANSPORT": "stub",
+        "LLM_STUB_LATENCY_MS": str(args.stub_latency_ms),
+        "LLM_STUB_RESPONSES": f'{{"agent": {payload!r}}}'.replace("'", '"'),
+        "RESPONSE_CACHE_ENABLED": "false",
+        "SEMANTIC_CACHE_ENABLED": "false",
+        "METRICS_ENABLED": "false",
+        "OPENROUTER_API_KEY": os.getenv("OPENROUTER_API_KEY", "offline"),
+    })
+
+    with tempfile.TemporaryDirectory() as log_dir:
+        print(f"per call on the request path, {args.payload_kb} KB agent response, {args.calls} calls")
+        print(f"{'sink':<24}{'payloads':<18}{'mean us':>10}{'p99 us':>10}{'flush s':>10}")
+        for name, setup in sinks(log_dir, args.stall_ms):
+            for label, payloads in PAYLOADS:
+                setup(payloads)
+                r = per_call(payload, args.calls)
+                print(f"{name:<24}{label:<18}{r['mean']:>10.1f}{r['p99']:>10.1f}{r['flush']:>10.3f}")
+
+        print(f"\nfull graph, {args.queries} queries, concurrency {args.concurrency}, "
+              f"stub LLM {args.stub_latency_ms:g} ms/call")
+        print(f"{'sink':<24}{'payloads':<18}{'req/s':>8}{'p50 ms':>10}{'p95 ms':>10}")
+        # Прогрев: граф, маршрутизатор и клиенты
+        configure_logging(LogSettings(**QUIET))
+        asyncio.run(under_load(20, args.concurrency))
+        for name, setup in sinks(log_dir, args.stall_ms):
+            for label, payloads in PAYLOADS:
+                setup(payloads)
+                r = asyncio.run(under_load(args.queries, args.concurrency))
+                flush()
+                print(f"{name:<24}{label:<18}{r['rps']:>8.1f}{r['p50']:>10.1f}{r['p95']:>10.1f}")
+        configure_logging(LogSettings(**QUIET))
+
+
+if __name__ == "__main__":
+    main()
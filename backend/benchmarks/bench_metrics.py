@@ -0,0 +1,81 @@
+"""
+Бенчмарк накладных расходов метрик.
+
+Замеряет стоимость одного наблюдения гистограммы и время прогона пайплайна
+на фейковой LLM без задержек с включёнными и выключенными метриками
+(METRICS_ENABLED), то есть чистую стоимость инструментации узлов и вызовов LLM.
+
+Запуск из каталога backend:
+    python benchmarks/bench_metrics.py [--queries 300]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import agents_storage  # noqa: E402
+import metrics  # noqa: E402
+import orchestrator  # noqa: E402
+from tests.conftest import ScriptedChatModel  # noqa: E402
+
+
+def observe_cost_ns(iterations: int) -> float:
+    """Среднее время NODE_DURATION.observe в наносекундах"""
+    started = time.perf_counter_ns()
+    for i in range(iterations):
+        metrics.NODE_DURATION.observe(0.001 * (i % 100), node="review")
+    return (time.perf_counter_ns() - started) / iterations
+
+
+async def pipeline_ms(queries: int, enabled: bool) -> float:
+    """Среднее время process_query в миллисекундах"""
+    os.environ["METRICS_ENABLED"] = "true" if enabled else "false"
+    # Граф пересобирается, чтобы узлы обернулись (или нет) замером
+    orchestrator._compiled_workflow = None
+    orchestrator.get_workflow()
+
+    started = time.perf_counter()
+    for i in range(queries):
+        await orchestrator.process_query(f"Собери требования {i}")
+    return (time.perf_counter() - started) * 1000 / queries
+
+
+async def run(queries: int, rounds: int = 3):
+    """Минимум по нескольким чередующимся прогонам (после прогрева)"""
+    await pipeline_ms(queries // 10 or 1, False)
+    await pipeline_ms(queries // 10 or 1, True)
+    disabled, enabled = [], []
+    for _ in range(rounds):
+        disabled.append(await pipeline_ms(queries, False))
+        enabled.append(await pipeline_ms(queries, True))
+    return min(disabled), min(enabled)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--observations", type=int, default=200_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        agents_storage._storage = agents_storage.AgentsStorage(str(Path(tmp) / "agents.json"))
+        llm = ScriptedChatModel()
+        orchestrator.get_llm = lambda *args, **kwargs: llm
+
+        disabled, enabled = asyncio.run(run(args.queries))
+
+    observe_ns = observe_cost_ns(args.observations)
+    print(f"histogram observe:             {observe_ns:.0f} ns")
+    print(f"pipeline, metrics disabled:    {disabled:.3f} ms/query")
+    print(f"pipeline, metrics enabled:     {enabled:.3f} ms/query")
+    print(f"overhead:                      {enabled - disabled:+.3f} ms/query "
+          f"({(enabled - disabled) / disabled * 100:+.1f}%)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Пропускная способность и задержка полного графа без сети.
+
+Прогоняет process_query по --queries запросам с --concurrency параллельными
+клиентами через транспорт LLM (llm_transport): stub — заглушки с задержкой
+--stub-latency-ms на вызов, replay — ответы из кассеты, записанной с
+LLM_TRANSPORT=record (задержка — записанная, умноженная на --latency-scale).
+Выводит запросов в секунду и p50/p95 задержки запроса.
+
+Запись кассеты (нужны сеть и ключ): запустить API с LLM_TRANSPORT=record и
+отправить запросы из --queries-file; replay воспроизводит ровно их.
+
+Запуск из каталога backend:
+    python benchmarks/bench_pipeline_offline.py [--mode stub] [--queries 200] [--concurrency 1 10 50]
+    python benchmarks/bench_pipeline_offline.py --mode replay --cassette llm_cassette.jsonl \\
+        --queries-file queries.txt --latency-scale 1
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+QUERIES = [
+    "Собери требования к CRM для отдела продаж",
+    "Опиши user stories для личного кабинета клиента",
+    "Спроектируй архитектуру платёжного шлюза",
+    "Составь план тестирования складской системы",
+]
+
+
+async def run(queries: list, concurrency: int) -> dict:
+    import orchestrator
+
+    semaphore = asyncio.Semaphore(concurrency)
+    timings = []
+
+    async def one(query: str):
+        async with semaphore:
+            started = time.perf_counter()
+            await orchestrator.process_query(query)
+            timings.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(query) for query in queries))
+    elapsed = time.perf_counter() - started
+    timings.sort()
+    return {
+        "rps": len(queries) / elapsed,
+        "p50": statistics.median(timings),
+        "p95": timings[int(len(timings) * 0.95)],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--mode", choices=("stub", "replay"), default="stub")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--queries-file", help="запросы по одному на строку (для replay — записанные)")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--stub-latency-ms", type=float, default=50)
+    parser.add_argument("--cassette", default="llm_cassette.jsonl")
+    parser.add_argument("--latency-scale", type=float, default=1.0)
+    args = parser.parse_args()
+
+    os.environ.update({
+        "LLM_TRANSPORT": args.mode,
+        "LLM_CASSETTE": args.cassette,
+        "LLM_REPLAY_LATENCY": str(args.latency_scale),
+        "LLM_STUB_LATENCY_MS": str(args.stub_latency_ms),
+        # Каждый запрос должен пройти граф целиком
+        "RESPONSE_CACHE_ENABLED": "false",
+        "SEMANTIC_CACHE_ENABLED": "false",
+        "OPENROUTER_API_KEY": os.getenv("OPENROUTER_API_KEY", "offline"),
+    })
+
+    if args.queries_file:
+        queries = [line.strip() for line in open(args.queries_file, encoding="utf-8") if line.strip()]
+    else:
+        # Номер делает запросы разными, как в реальном потоке
+        queries = [f"{QUERIES[i % len(QUERIES)]} (проект {i})" for i in range(args.queries)]
+
+    if args.mode == "stub":
+        print(f"mode stub, {args.stub_latency_ms:g} ms per LLM call, {len(queries)} queries")
+    else:
+        print(f"mode replay, cassette {args.cassette}, latency x{args.latency_scale:g}, {len(queries)} queries")
+    print(f"{'concurrency':>12}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    for concurrency in args.concurrency:
+        r = asyncio.run(run(queries, concurrency))
+        print(f"{concurrency:>12}{r['rps']:>10.1f}{r['p50']:>10.1f}{r['p95']:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
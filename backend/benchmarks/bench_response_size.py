@@ -0,0 +1,95 @@
+"""
+Бенчмарк размера ответа и памяти пайплайна.
+
+Прогоняет пайплайн на фейковой LLM (агент с длинным системным промптом,
+крупный ответ, две итерации доработки) и сравнивает размер JSON-ответа:
+- legacy: прежний формат — строковый лог с полными промптом, запросом и
+  ответами на каждой итерации плюс его копия в context;
+- compact / full / trace: текущие уровни verbosity.
+
+Также замеряет пиковую память (tracemalloc) одного прогона.
+
+Запуск из каталога backend:
+    python benchmarks/bench_response_size.py [--answer-chars 6000]
+"""
+import argparse
+import asyncio
+import json
+import sys
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import agents_storage  # noqa: E402
+import orchestrator  # noqa: E402
+from pipeline_trace import apply_verbosity  # noqa: E402
+from tests.conftest import ScriptedChatModel  # noqa: E402
+
+QUERY = "Подготовь вопросы для стейкхолдеров по внедрению системы авторизации " * 5
+REVISION = "needs_revision|Добавь вопросы про метрики успеха и нефункциональные требования"
+
+
+def legacy_response(result: dict, system_prompt: str, revisions: list) -> dict:
+    """Воспроизводит прежний формат лога (полные тексты на каждой итерации)"""
+    answer = result["agent_response"]
+    route = result["route"]
+    log = [
+        "▶️ Запрос получен от пользователя",
+        f"🔹 Оркестратор: анализируем запрос и выбираем агента...\n   Входной запрос пользователя:\n   {QUERY}",
+        f"✅ Оркестратор: принял решение о маршрутизации\n   Ответ LLM (сырое значение): {route}\n   Выбранный агент: {route}",
+    ]
+    for iteration in range(len(revisions) + 1):
+        user_query = QUERY
+        if iteration:
+            user_query += f"\n\nДополнительные инструкции от ревьюера: {revisions[iteration - 1]}"
+            log.append(f"🔁 Итерация доработки: #{iteration}")
+        log.append(f"🔹 Агент {route}: получен запрос на обработку\n   Системный промпт:\n   {system_prompt}\n   Запрос пользователя (c учётом доработок, если есть):")
+        log.append(f"   Итоговый текст, отправленный агенту:\n{user_query}")
+        log.append(f"✅ Агент {route}: сформировал ответ\n   Ответ агента:\n   {answer}")
+        log.append(f"🔹 Ревьюер: проверяем качество ответа агента\n   Запрос пользователя:\n   {QUERY}\n   Ответ агента для проверки:\n   {answer}")
+        log.append("⚠️ Ревьюер: требуется доработка" if iteration < len(revisions) else "✅ Ревьюер: ответ одобрен")
+    log.append("🏁 Финальный ответ сформирован и готов к отправке пользователю")
+    return {**result, "log": log, "context": "\n".join(log), "trace": None}
+
+
+def size_kb(payload: dict) -> float:
+    return len(json.dumps(payload, ensure_ascii=False).encode("utf-8")) / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--answer-chars", type=int, default=6000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = agents_storage.AgentsStorage(str(Path(tmp) / "agents.json"))
+        agents_storage._storage = storage
+
+        model = ScriptedChatModel(
+            route="agent1",
+            answer=("Вопрос стейкхолдеру. " * args.answer_chars)[:args.answer_chars],
+            reviews=[REVISION, REVISION],
+        )
+        orchestrator.get_llm = lambda *a, **k: model
+
+        tracemalloc.start()
+        result = asyncio.run(orchestrator.process_query(QUERY))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        revisions = [REVISION.split("|", 1)[1]] * result["iteration_count"]
+        legacy = legacy_response(result, storage.agents["agent1"].prompt, revisions)
+
+    print(f"iterations:              {result['iteration_count']}")
+    print(f"system prompt:           {len(storage.agents['agent1'].prompt)} chars")
+    print(f"agent response:          {len(result['agent_response'])} chars")
+    print(f"response legacy:         {size_kb(legacy):8.1f} KiB")
+    for verbosity in ("compact", "full", "trace"):
+        print(f"response {verbosity + ':':<16}{size_kb(apply_verbosity(result, verbosity)):8.1f} KiB")
+    print(f"peak traced memory:      {peak / 1024:8.1f} KiB")
+
+
+if __name__ == "__main__":
+    main()
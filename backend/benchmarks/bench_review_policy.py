@@ -0,0 +1,111 @@
+"""
+Бенчмарк политики ревью: среднее число вызовов LLM на запрос.
+
+Прогоняет одну и ту же синтетическую нагрузку на фейковой LLM с исходным
+поведением (ревью каждого ответа вызовом LLM, доработка с нуля) и с
+настроенной политикой (review_policy): короткие ответы одобряются без LLM,
+отсутствие обязательного раздела ловится проверкой, агент без ревью
+пропускается, доработка правит предыдущий черновик.
+
+Нагрузка: запросы равномерно распределены по пяти агентам; agent1 отвечает
+коротко, остальные — развёрнуто, и часть их черновиков без раздела «## Итог»,
+который ревьюер требует дописать.
+
+Запуск из каталога backend:
+    python benchmarks/bench_review_policy.py [--queries 200]
+"""
+import argparse
+import asyncio
+import os
+import re
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import agents_storage  # noqa: E402
+import orchestrator  # noqa: E402
+from tests.conftest import ScriptedChatModel  # noqa: E402
+
+LEGACY = {"REVIEW_REVISION_MODE": "full"}
+TUNED = {
+    "REVIEW_REVISION_MODE": "delta",
+    "REVIEW_AUTO_APPROVE_CHARS": "200",
+    "REVIEW_REQUIRED_SECTIONS": '{"agent2": ["## Итог"], "agent3": ["## Итог"], "agent4": ["## Итог"]}',
+    "REVIEW_SKIP_AGENTS": "agent5",
+}
+POLICY_VARS = set(LEGACY) | set(TUNED)
+
+LONG_BODY = "Подробный разбор задачи с шагами, рисками и оценками. " * 12
+
+
+class WorkloadModel(ScriptedChatModel):
+    """Отвечает по меткам в тексте запроса: [agentN] — маршрут, [draft] — черновик без итога"""
+
+    prompt_chars: int = 0
+
+    def _reply(self, messages) -> str:
+        system = messages[0].content
+        human = messages[-1].content
+        self.prompt_chars += sum(len(message.content) for message in messages)
+        if "маршрутизатор" in system:
+            self.calls.append("route")
+            return re.search(r"\[(agent\d)\]", human).group(1)
+        if "ревьюер" in system:
+            self.calls.append("review")
+            answer = human.split("Ответ агента:", 1)[1].split("Оцените ответ:", 1)[0]
+            if len(answer.strip()) > 200 and "## Итог" not in answer:
+                return "needs_revision|Добавьте раздел ## Итог"
+            return "approved"
+        self.calls.append("agent")
+        if "агент короткий" in system:
+            return "Да, это возможно."
+        revision = "Исправьте" in human or "инструкции от ревьюера" in human
+        if "[draft]" in human and not revision:
+            return LONG_BODY
+        return f"{LONG_BODY}\n\n## Итог\nГотово."
+
+
+async def run_workload(queries: int, env: dict) -> dict:
+    for name in POLICY_VARS:
+        os.environ.pop(name, None)
+    os.environ.update(env)
+
+    model = WorkloadModel()
+    orchestrator.get_llm = lambda *args, **kwargs: model
+    for i in range(queries):
+        agent = f"agent{i % 5 + 1}"
+        draft = " [draft]" if i % 10 < 3 else ""
+        await orchestrator.process_query(f"Запрос {i} [{agent}]{draft}")
+
+    return {
+        "llm_calls": len(model.calls) / queries,
+        "review_calls": model.calls.count("review") / queries,
+        "agent_calls": model.calls.count("agent") / queries,
+        "prompt_chars": model.prompt_chars / queries,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = agents_storage.AgentsStorage(str(Path(tmp) / "agents.json"))
+        agents_storage._storage = storage
+        agent = storage.get_by_id("agent1")
+        storage.update("agent1", agent["name"], agent["description"],
+                       f"{agent['prompt']} (агент короткий)", agent["color"])
+
+        before = asyncio.run(run_workload(args.queries, LEGACY))
+        after = asyncio.run(run_workload(args.queries, TUNED))
+
+    print(f"{'':22}{'before':>10}{'after':>10}")
+    for key in ("llm_calls", "review_calls", "agent_calls", "prompt_chars"):
+        print(f"{key + ' / query':22}{before[key]:>10.2f}{after[key]:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+Маршрутизация в зависимости от размера каталога агентов.
+
+Для каталогов из --sizes синтетических агентов (роль x предметная область)
+сравнивает маршрутизацию одним вызовом LLM по всему меню агентов и
+двухэтапную (ShortlistRouter): локальный классификатор отбирает --k агентов,
+LLM выбирает среди них. Выводит:
+
+- токены промпта маршрутизатора (среднее) и превышение бюджета узла
+  orchestrator по умолчанию (DEFAULT_INPUT_BUDGETS);
+- задержку маршрутизации p50/p95: LLM — заглушка с задержкой
+  --llm-base-ms + --prefill-ms-per-1k на каждую 1000 токенов промпта;
+- CPU локального шорт-листа на запрос и recall@k (доля запросов, у которых
+  правильный агент попал в шорт-лист — верхняя граница точности LLM);
+- время сборки локального индекса и компиляции графа на этот каталог.
+
+Запуск из каталога backend:
+    python benchmarks/bench_routing_scale.py [--sizes 5 20 50 100 200] [--k 8]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from agents_storage import Agent, AgentsSnapshot  # noqa: E402
+from llm_transport import StubChatModel  # noqa: E402
+from router import LLMRouter, LocalRouter, ShortlistRouter  # noqa: E402
+from token_budget import DEFAULT_INPUT_BUDGETS, get_token_budget  # noqa: E402
+
+TOPICS = [
+    "платежей", "склада", "логистики", "кадров", "бухгалтерии", "маркетинга", "закупок", "продаж",
+    "документооборота", "страхования", "кредитования", "медицины", "образования", "ритейла",
+    "телекома", "энергетики", "госуслуг", "туризма", "недвижимости", "производства",
+]
+# (роль, описание, формулировка запроса)
+ROLES = [
+    ("Аналитик требований", "Сбор и анализ требований", "Собери требования к новой версии системы"),
+    ("Архитектор", "Проектирование архитектуры", "Спроектируй архитектуру сервисов системы"),
+    ("Тестировщик", "Планирование тестирования", "Составь план тестирования системы"),
+    ("Технический писатель", "Техническая документация", "Напиши руководство пользователя системы"),
+    ("Специалист по процессам", "Моделирование бизнес-процессов", "Опиши процесс в нотации BPMN для системы"),
+    ("Специалист по данным", "Отчёты и аналитика данных", "Подготовь отчёт с метриками системы"),
+    ("Специалист по безопасности", "Аудит информационной безопасности", "Проверь угрозы безопасности системы"),
+    ("Специалист по интеграциям", "Интеграции и API", "Опиши API интеграции с системой"),
+    ("Специалист по UX", "Пользовательские сценарии и интерфейсы", "Придумай сценарии интерфейса системы"),
+    ("Специалист по внедрению", "Внедрение и обучение пользователей", "Составь план обучения пользователей системы"),
+]
+
+
+class PromptSizedStub(StubChatModel):
+    """Заглушка LLM, задержка которой растёт с размером промпта"""
+
+    prefill_per_token: float = 0.0
+
+    def _answer(self, messages, stop, kwargs):
+        content, usage, first_token, latency = super()._answer(messages, stop, kwargs)
+        tokens = get_token_budget().counter.count_messages([message.content for message in messages])
+        return content, usage, first_token, latency + tokens * self.prefill_per_token
+
+
+def catalog(size: int):
+    """Синтетический каталог из size агентов и размеченные запросы к ним"""
+    agents, queries = {}, []
+    for index in range(size):
+        topic = TOPICS[index // len(ROLES) % len(TOPICS)]
+        role, description, task = ROLES[index % len(ROLES)]
+        agent_id = f"agent{index + 1}"
+        agents[agent_id] = Agent(
+            id=agent_id, name=f"{role} ({topic})", description=f"{description} для системы {topic}",
+            prompt=f"Вы {role.lower()} системы {topic}.",
+        )
+        queries.append((f"{task} {topic}", agent_id))
+    return AgentsSnapshot.build(0, agents), queries
+
+
+async def measure(router, queries, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    timings, tokens = [], []
+
+    async def one(query: str):
+        async with semaphore:
+            started = time.perf_counter()
+            decision = await router.route(query)
+            timings.append((time.perf_counter() - started) * 1000)
+            tokens.append(decision.estimate["prompt_tokens"])
+
+    await asyncio.gather(*(one(query) for query, _ in queries))
+    timings.sort()
+    return {
+        "tokens": statistics.mean(tokens),
+        "p50": statistics.median(timings),
+        "p95": timings[int(len(timings) * 0.95)],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[5, 20, 50, 100, 200])
+    parser.add_argument("--k", type=int, default=8, help="размер шорт-листа")
+    parser.add_argument("--queries", type=int, default=200, help="запросов на каталог")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--llm-base-ms", type=float, default=300)
+    parser.add_argument("--prefill-ms-per-1k", type=float, default=60)
+    args = parser.parse_args()
+
+    # Полное меню большого каталога не влезает в бюджет по умолчанию:
+    # снимаем его, чтобы измерить, и отмечаем превышение в выводе
+    os.environ["LLM_INPUT_BUDGETS"] = json.dumps({"orchestrator": 10 ** 6})
+    default_budget = DEFAULT_INPUT_BUDGETS["orchestrator"]
+    model = PromptSizedStub(
+        responses=["agent1"], latency=args.llm_base_ms / 1000, prefill_per_token=args.prefill_ms_per_1k / 10 ** 6
+    )
+    encoding = get_token_budget().counter.encoding_name
+
+    import orchestrator
+
+    print(f"LLM stub {args.llm_base_ms:g} ms + {args.prefill_ms_per_1k:g} ms per 1k prompt tokens, "
+          f"tokenizer {encoding}, shortlist k={args.k}, {args.queries} queries per catalog")
+    print(f"{'agents':>7}{'router':>11}{'tokens':>8}{'budget':>8}{'p50 ms':>9}{'p95 ms':>9}"
+          f"{'local us':>10}{'recall@k':>10}{'index ms':>10}{'graph ms':>10}")
+    for size in args.sizes:
+        snapshot, labeled = catalog(size)
+        queries = [labeled[index % len(labeled)] for index in range(args.queries)]
+
+        started = time.perf_counter()
+        local = LocalRouter(snapshot.agents)
+        index_ms = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        orchestrator.create_workflow(snapshot.agent_ids)
+        graph_ms = (time.perf_counter() - started) * 1000
+
+        started = time.perf_counter()
+        shortlists = [local.shortlist(query, args.k) for query, _ in queries]
+        local_us = (time.perf_counter() - started) * 10 ** 6 / len(queries)
+        recall = sum(label in shortlist for shortlist, (_, label) in zip(shortlists, queries)) / len(queries)
+
+        llm = LLMRouter(llm_factory=lambda: model, agents_provider=lambda: snapshot)
+        routers = [("full menu", llm)]
+        if size > args.k:
+            routers.append((f"top-{args.k}", ShortlistRouter(local, llm, args.k)))
+        for name, router in routers:
+            r = asyncio.run(measure(router, queries, args.concurrency))
+            budget = "over" if r["tokens"] > default_budget else "ok"
+            shortlisted = name != "full menu"
+            print(f"{size:>7}{name:>11}{r['tokens']:>8.0f}{budget:>8}{r['p50']:>9.0f}{r['p95']:>9.0f}"
+                  + (f"{local_us:>10.0f}{recall:>10.2f}" if shortlisted else f"{'':>10}{'':>10}")
+                  + f"{index_ms:>10.1f}{graph_ms:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Бенчмарк семантического кэша ответов.
+
+Заполняет SemanticCache синтетическими запросами (10k и 100k записей по
+умолчанию) и замеряет задержку поиска (векторизация запроса + умножение
+матрицы на вектор) — p50/p95 — и память матрицы векторов. Затем на наборе
+перефразированных запросов сравнивает долю попаданий точного кэша
+(response_cache) и семантического, а также долю ложных попаданий на новых
+запросах, отличающихся от сохранённых одним словом (другая система или отдел).
+
+Запуск из каталога backend:
+    python benchmarks/bench_semantic_cache.py [--sizes 10000 100000] [--lookups 1000]
+"""
+import argparse
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from response_cache import ResponseCache  # noqa: E402
+from semantic_cache import DEFAULT_THRESHOLD, SemanticCache  # noqa: E402
+
+RESULT = {"route": "agent1", "agent_response": "ответ " * 200, "review_result": "approved"}
+
+ACTIONS = ["Собери требования к", "Опиши user stories для", "Спроектируй архитектуру",
+           "Составь план тестирования для", "Оцени риски внедрения"]
+SYSTEMS = ["CRM", "ERP", "системы учёта заявок", "мобильного приложения", "портала поставщиков",
+           "складской системы", "личного кабинета клиента", "платёжного шлюза"]
+DEPARTMENTS = ["отдела продаж", "отдела закупок", "бухгалтерии", "службы поддержки",
+               "отдела кадров", "логистики"]
+
+# Правки, с которыми аналитик повторно отправляет тот же запрос
+EDITS = [
+    lambda q: q + ".",
+    lambda q: q.lower(),
+    lambda q: q.replace(" к ", ", пожалуйста, к ", 1) if " к " in q else "Пожалуйста, " + q.lower(),
+    lambda q: q + " компании",
+    lambda q: q.replace("Собери", "Собрать").replace("Опиши", "Описать").replace("Составь", "Составить"),
+]
+
+
+def versions(route):
+    return "v1"
+
+
+def synthetic_queries(count: int, rng: random.Random) -> list:
+    queries = []
+    for i in range(count):
+        queries.append(
+            f"{rng.choice(ACTIONS)} {rng.choice(SYSTEMS)} для {rng.choice(DEPARTMENTS)} "
+            f"(проект {i})"
+        )
+    return queries
+
+
+def lookup_latency(size: int, lookups: int, rng: random.Random) -> dict:
+    cache = SemanticCache(max_entries=size, max_bytes=size * 4096)
+    started = time.perf_counter()
+    for query in synthetic_queries(size, rng):
+        cache.put(query, "agent1", "v1", "gpt", RESULT)
+    fill = time.perf_counter() - started
+
+    probes = synthetic_queries(lookups, rng)
+    timings = []
+    for query in probes:
+        started = time.perf_counter_ns()
+        cache.get(query, "gpt", versions)
+        timings.append((time.perf_counter_ns() - started) / 1e6)
+    timings.sort()
+    return {
+        "fill_us": fill / size * 1e6,
+        "p50": statistics.median(timings),
+        "p95": timings[int(len(timings) * 0.95)],
+        "matrix_mb": cache.matrix_bytes / 1024 / 1024,
+    }
+
+
+def hit_rates() -> dict:
+    base = [f"{action} {system} для {department}"
+            for action in ACTIONS for system in SYSTEMS for department in DEPARTMENTS]
+    exact, semantic = ResponseCache(), SemanticCache()
+    rng = random.Random(1)
+    # Половина запросов уже была — кэш прогрет ими
+    seen = rng.sample(base, len(base) // 2)
+    for query in seen:
+        exact.put(query, "agent1", "v1", "gpt", RESULT)
+        semantic.put(query, "agent1", "v1", "gpt", RESULT)
+
+    paraphrases = [edit(query) for query in seen for edit in EDITS]
+    unseen = [query for query in base if query not in set(seen)]
+    return {
+        "paraphrases": len(paraphrases),
+        "exact": sum(exact.get(q, "gpt", versions) is not None for q in paraphrases) / len(paraphrases),
+        "semantic": sum(semantic.get(q, "gpt", versions) is not None for q in paraphrases)
+        / len(paraphrases),
+        "unseen": len(unseen),
+        "false_hits": sum(semantic.get(q, "gpt", versions) is not None for q in unseen) / len(unseen),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--lookups", type=int, default=1000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    print(f"{'entries':>10}{'put us':>10}{'p50 ms':>10}{'p95 ms':>10}{'matrix MB':>12}")
+    for size in args.sizes:
+        r = lookup_latency(size, args.lookups, rng)
+        print(f"{size:>10}{r['fill_us']:>10.1f}{r['p50']:>10.3f}{r['p95']:>10.3f}{r['matrix_mb']:>12.1f}")
+
+    rates = hit_rates()
+    print(f"\nthreshold {DEFAULT_THRESHOLD}, {rates['paraphrases']} edited repeats, "
+          f"{rates['unseen']} new requests")
+    print(f"exact cache hit rate:          {rates['exact']:.1%}")
+    print(f"semantic cache hit rate:       {rates['semantic']:.1%}")
+    print(f"semantic false hits (new):     {rates['false_hits']:.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Время запуска и память воркеров в продакшен-профиле gunicorn.
+
+Сравнивает режимы на временных БД: один процесс `uvicorn main:app` (прежний
+orchestra.service), `uvicorn --workers N` (spawn), gunicorn с N воркерами без
+предзагрузки (GUNICORN_PRELOAD=false — каждый воркер сам импортирует
+langchain/langgraph) и с предзагрузкой (preload_app, по умолчанию в
+gunicorn.conf.py). Время запуска — от старта процесса до
+готовности всех воркеров (строка "Worker ... ready" в логе lifespan). Для
+каждого процесса выводятся RSS и PSS/USS из /proc/<pid>/smaps_rollup: при
+предзагрузке страницы импортированных модулей общие с мастером, поэтому
+собственная память воркера (USS) заметно меньше RSS.
+
+Только Linux. Запуск из каталога backend:
+    python benchmarks/bench_server_startup.py [--workers 4]
+"""
+import argparse
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+READY = re.compile(r"Worker \d+ ready in")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def memory_mb(pid: int) -> dict:
+    """RSS, PSS и USS процесса в МБ"""
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as rollup:
+        for line in rollup:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                values[parts[0].rstrip(":")] = int(parts[1]) / 1024
+    return {
+        "rss": values["Rss"],
+        "pss": values["Pss"],
+        "uss": values["Private_Clean"] + values["Private_Dirty"],
+    }
+
+
+def children(pid: int) -> list:
+    with open(f"/proc/{pid}/task/{pid}/children") as f:
+        return [int(child) for child in f.read().split()]
+
+
+def run_server(command: list, env: dict, workers: int, log_path: Path) -> dict:
+    with open(log_path, "w") as log:
+        started = time.perf_counter()
+        server = subprocess.Popen(command, cwd=BACKEND_DIR, env=env, stdout=log, stderr=log)
+    try:
+        deadline = time.monotonic() + 120
+        while len(READY.findall(log_path.read_text())) < workers:
+            if server.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError(f"Server did not start, see {log_path}")
+            time.sleep(0.05)
+        startup = time.perf_counter() - started
+        # Даём воркерам закончить инициализацию после lifespan
+        time.sleep(1)
+        worker_pids = children(server.pid) or [server.pid]
+        master = memory_mb(server.pid) if worker_pids != [server.pid] else None
+        return {
+            "startup": startup,
+            "master": master,
+            "workers": [memory_mb(pid) for pid in worker_pids],
+        }
+    finally:
+        server.terminate()
+        server.wait(timeout=60)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(
+            os.environ,
+            AGENTS_STORAGE_PATH=str(Path(tmp) / "agents.json"),
+            JOBS_DB_PATH=str(Path(tmp) / "jobs.db"),
+            SESSIONS_DB_PATH=str(Path(tmp) / "sessions.db"),
+            RATE_LIMIT_DB_PATH=str(Path(tmp) / "rate_limits.db"),
+            OPENROUTER_API_KEY="bench",
+            WEB_CONCURRENCY=str(args.workers),
+            BIND=f"127.0.0.1:{free_port()}",
+        )
+        gunicorn = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "main:app"]
+        uvicorn = [sys.executable, "-m", "uvicorn", "main:app", "--port", str(free_port())]
+        single = {key: value for key, value in env.items() if key != "WEB_CONCURRENCY"}
+        modes = [
+            ("uvicorn, 1 process", uvicorn, single, 1),
+            (f"uvicorn --workers {args.workers}",
+             uvicorn + ["--workers", str(args.workers)], env, args.workers),
+            (f"gunicorn, {args.workers} workers, no preload",
+             gunicorn, dict(env, GUNICORN_PRELOAD="false"), args.workers),
+            (f"gunicorn, {args.workers} workers, preload",
+             gunicorn, env, args.workers),
+        ]
+
+        print(f"{'mode':38}{'startup s':>10}{'RSS MB':>9}{'PSS MB':>9}{'USS MB':>9}")
+        for i, (name, command, mode_env, workers) in enumerate(modes):
+            result = run_server(command, mode_env, workers, Path(tmp) / f"server{i}.log")
+            worker_avg = {
+                key: sum(w[key] for w in result["workers"]) / len(result["workers"])
+                for key in ("rss", "pss", "uss")
+            }
+            total_pss = sum(w["pss"] for w in result["workers"])
+            if result["master"]:
+                total_pss += result["master"]["pss"]
+            print(f"{name:38}{result['startup']:>10.2f}")
+            if result["master"]:
+                m = result["master"]
+                print(f"{'  master':38}{'':>10}{m['rss']:>9.0f}{m['pss']:>9.0f}{m['uss']:>9.0f}")
+            print(f"{'  per worker (avg)':38}{'':>10}{worker_avg['rss']:>9.0f}"
+                  f"{worker_avg['pss']:>9.0f}{worker_avg['uss']:>9.0f}")
+            print(f"{'  total PSS':38}{'':>10}{'':>9}{total_pss:>9.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Офлайн-оценка локального маршрутизатора против LLM-маршрутизатора.
+
+Для каждого запроса сравнивает решение LocalRouter с решением LLM и считает:
+- согласие с LLM (на всех запросах и на уверенных, где LLM бы не вызывалась);
+- долю запросов, прошедших по fast-path при заданном пороге отрыва;
+- среднюю латентность обоих маршрутизаторов и сэкономленное время на запрос.
+
+Формат входного файла — JSONL: {"query": "..."} или {"query": "...", "route": "agent2"}.
+С флагом --use-labels поле route используется как ответ LLM (без сетевых вызовов);
+с --save-labels решения LLM сохраняются в файл для повторных прогонов.
+
+Запуск из каталога backend:
+    python benchmarks/eval_router.py --queries queries.jsonl [--threshold 0.2]
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import orchestrator  # noqa: E402
+from agents_storage import get_storage  # noqa: E402
+from router import DEFAULT_MARGIN_THRESHOLD, LLMRouter, LocalRouter, load_examples  # noqa: E402
+
+SAMPLE_QUERIES = [
+    "Подготовь вопросы для стейкхолдеров по новой системе авторизации",
+    "Собери требования к модулю отчётности",
+    "Опиши API платёжного шлюза для технической документации",
+    "Смоделируй процесс согласования заявки на закупку",
+    "Проведи бизнес-анализ запуска подписки",
+]
+
+
+def load_queries(path):
+    if not path:
+        return [{"query": query} for query in SAMPLE_QUERIES]
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+async def evaluate(items, threshold, use_labels, examples_path):
+    storage = get_storage()
+    local = LocalRouter(storage.get_all(), examples=load_examples(examples_path))
+    llm = LLMRouter(llm_factory=lambda: orchestrator.get_llm(), agents_provider=storage.get_all)
+
+    rows = []
+    for item in items:
+        started = time.perf_counter()
+        decision = local.classify(item["query"])
+        local_ms = (time.perf_counter() - started) * 1000
+
+        if use_labels and "route" in item:
+            llm_route, llm_ms = item["route"], None
+        else:
+            started = time.perf_counter()
+            llm_route = (await llm.route(item["query"])).route
+            llm_ms = (time.perf_counter() - started) * 1000
+
+        rows.append({
+            "query": item["query"],
+            "local_route": decision.route,
+            "margin": decision.margin,
+            "llm_route": llm_route,
+            "confident": decision.margin >= threshold,
+            "local_ms": local_ms,
+            "llm_ms": llm_ms,
+        })
+    return rows
+
+
+def report(rows, threshold):
+    confident = [r for r in rows if r["confident"]]
+    llm_latencies = [r["llm_ms"] for r in rows if r["llm_ms"] is not None]
+    mean_local = statistics.mean(r["local_ms"] for r in rows)
+
+    def agreement(subset):
+        if not subset:
+            return float("nan")
+        return sum(r["local_route"] == r["llm_route"] for r in subset) / len(subset)
+
+    print(f"queries:                     {len(rows)}")
+    print(f"margin threshold:            {threshold}")
+    print(f"fast-path share:             {len(confident) / len(rows):.1%}")
+    print(f"agreement (all):             {agreement(rows):.1%}")
+    print(f"agreement (fast-path only):  {agreement(confident):.1%}")
+    print(f"local router latency:        {mean_local:.3f} ms")
+    if llm_latencies:
+        mean_llm = statistics.mean(llm_latencies)
+        saved = len(confident) / len(rows) * mean_llm - mean_local
+        print(f"LLM router latency:          {mean_llm:.1f} ms")
+        print(f"latency saved per query:     {saved:.1f} ms")
+
+    for r in rows:
+        if r["confident"] and r["local_route"] != r["llm_route"]:
+            print(f"  disagreement: {r['query'][:60]!r} local={r['local_route']} llm={r['llm_route']} margin={r['margin']:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--queries", help="JSONL с запросами (по умолчанию — встроенный набор)")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_MARGIN_THRESHOLD)
+    parser.add_argument("--examples", help="JSONL с размеченными примерами для LocalRouter")
+    parser.add_argument("--use-labels", action="store_true", help="брать ответ LLM из поля route")
+    parser.add_argument("--save-labels", help="сохранить решения LLM в JSONL")
+    args = parser.parse_args()
+
+    rows = asyncio.run(evaluate(load_queries(args.queries), args.threshold, args.use_labels, args.examples))
+    report(rows, args.threshold)
+
+    if args.save_labels:
+        with open(args.save_labels, 'w', encoding='utf-8') as f:
+            for r in rows:
+                f.write(json.dumps({"query": r["query"], "route": r["llm_route"]}, ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Нагрузочный тест лимита запросов на нескольких воркерах uvicorn.
+
+Поднимает `uvicorn main:app --workers N` на временных БД и отправляет
+конкурентные POST /query от одного клиента. Лимит хранится в общем SQLite,
+поэтому пропущенных запросов должно быть не больше RATE_LIMIT_QUERY, а не
+N × лимит, как было с in-memory хранилищем slowapi. LLM-провайдер указывает
+на закрытый порт: пропущенные запросы быстро завершаются ошибкой 500, что
+не мешает считать 429.
+
+Запуск из каталога backend:
+    python benchmarks/load_rate_limit.py [--workers 4] [--requests 80]
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+import httpx
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(url: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{url}/health", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("Server did not start")
+
+
+async def fire(url: str, requests: int) -> Counter:
+    async with httpx.AsyncClient(timeout=30) as client:
+        async def one(i):
+            response = await client.post(
+                f"{url}/query", json={"query": f"Запрос {i}"}, headers={"X-Forwarded-For": "10.9.9.9"}
+            )
+            return response.status_code
+
+        return Counter(await asyncio.gather(*(one(i) for i in range(requests))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=80)
+    parser.add_argument("--rate", default="10/minute")
+    args = parser.parse_args()
+
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(
+            os.environ,
+            RATE_LIMIT_QUERY=args.rate,
+            RATE_LIMIT_DB_PATH=str(Path(tmp) / "rate_limits.db"),
+            JOBS_DB_PATH=str(Path(tmp) / "jobs.db"),
+            SESSIONS_DB_PATH=str(Path(tmp) / "sessions.db"),
+            AGENTS_STORAGE_PATH=str(Path(tmp) / "agents.json"),
+            OPENROUTER_BASE_URL=f"http://127.0.0.1:{free_port()}/v1",
+            OPENROUTER_API_KEY="load-test",
+            API_KEY="",
+        )
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port),
+             "--workers", str(args.workers), "--log-level", "warning"],
+            cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_ready(url)
+            started = time.perf_counter()
+            codes = asyncio.run(fire(url, args.requests))
+            elapsed = time.perf_counter() - started
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+
+    limit = int(args.rate.split("/")[0])
+    passed = sum(count for code, count in codes.items() if code != 429)
+    print(f"workers:            {args.workers}")
+    print(f"requests:           {args.requests} in {elapsed:.2f} s")
+    print(f"status codes:       {dict(sorted(codes.items()))}")
+    print(f"passed the limiter: {passed} (limit {args.rate}, "
+          f"per-worker in-memory limit would allow up to {limit * args.workers})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Продакшен-профиль сервера: gunicorn с uvicorn-воркерами.
+
+    gunicorn -c gunicorn.conf.py main:app
+
+- WEB_CONCURRENCY воркеров (по умолчанию 4) на BIND (0.0.0.0:8000);
+- preload_app: main (langchain, langgraph, FastAPI) импортируется один раз в
+  мастере, хранилище агентов и граф прогреваются до fork — воркеры стартуют
+  быстрее и делят эти страницы памяти через copy-on-write;
+- при SIGTERM воркер перестаёт принимать соединения и ждёт выполняющиеся
+  запросы до DRAIN_TIMEOUT секунд (по умолчанию 90), затем lifespan
+  закрывает клиенты и хранилища; gunicorn убивает воркер только после
+  graceful_timeout = DRAIN_TIMEOUT + запас на остановку.
+"""
+
+import os
+import sys
+import time
+
+from gunicorn.arbiter import Arbiter
+from uvicorn.server import Server
+from uvicorn.workers import UvicornWorker
+
+import lifecycle
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", 4))
+# GUNICORN_PRELOAD=false — импорт приложения в каждом воркере (для сравнения)
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() != "false"
+
+drain_timeout = lifecycle.get_drain_timeout()
+# Запас на остановку очереди задач и закрытие хранилищ после drain
+graceful_timeout = int(drain_timeout) + 15
+# Heartbeat воркера (uvicorn отправляет его из event loop, длинные запросы не мешают)
+timeout = int(os.getenv("WORKER_TIMEOUT", 60))
+keepalive = 5
+
+# Логи пишет loguru (logging_setup: stderr и LOG_FILE из фонового потока)
+accesslog = None
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+
+_master_started = time.monotonic()
+
+
+class DrainingServer(Server):
+    """uvicorn.Server, отмечающий начало остановки для lifecycle.shutdown()"""
+
+    def handle_exit(self, sig, frame):
+        lifecycle.get_inflight_tracker().begin_drain()
+        super().handle_exit(sig, frame)
+
+
+class OrchestraWorker(UvicornWorker):
+    """Uvicorn-воркер: ограниченное ожидание запросов при остановке"""
+
+    CONFIG_KWARGS = {
+        "loop": "auto",
+        "http": "auto",
+        "lifespan": "on",
+        # Дольше uvicorn не ждёт: оставшиеся запросы отменяются, но lifespan
+        # всё равно выполняется (иначе воркер убил бы gunicorn по graceful_timeout)
+        "timeout_graceful_shutdown": int(drain_timeout),
+    }
+
+    async def _serve(self) -> None:
+        # Повторяет UvicornWorker._serve с DrainingServer вместо Server
+        self.config.app = self.wsgi
+        server = DrainingServer(config=self.config)
+        self._install_sigquit_handler()
+        await server.serve(sockets=self.sockets)
+        if not server.started:
+            sys.exit(Arbiter.WORKER_BOOT_ERROR)
+
+
+worker_class = OrchestraWorker
+
+
+def when_ready(server):
+    # Приложение уже импортировано (preload_app), воркеры ещё не созданы
+    if preload_app:
+        lifecycle.preload()
+    rss = lifecycle.rss_mb()
+    server.log.info(
+        f"Master ready in {time.monotonic() - _master_started:.2f} s"
+        + (f", RSS {rss:.0f} MB" if rss is not None else "")
+        + f", spawning {workers} workers"
+    )
+
+
+def post_fork(server, worker):
+    # Время готовности воркера считаем от fork, а не от запуска мастера
+    lifecycle.mark_started()
+
+
+def worker_exit(server, worker):
+    server.log.info(f"Worker {worker.pid} exited")
@@ -0,0 +1,449 @@
+"""
+Фоновая очередь запросов к пайплайну.
+
+POST /jobs ставит запрос в очередь и сразу возвращает ID задачи; ограниченный
+пул asyncio-воркеров выполняет process_query. Задачи и их результаты хранятся
+в SQLite (WAL), поэтому клиент может переподключиться и забрать результат,
+а незавершённые задачи после перезапуска процесса выполняются заново.
+"""
+
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from loguru import logger
+
+from logging_setup import request_context
+from metrics import metered_tokens, registry
+from orchestrator import process_query
+from pipeline_trace import apply_verbosity
+from rate_limits import get_rate_limiter
+
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_QUEUE = 100
+DEFAULT_RETENTION_SECONDS = 24 * 3600
+PURGE_INTERVAL_SECONDS = 60
+
+JOB_STATUSES = ("queued", "running", "done", "failed", "cancelled")
+FINISHED_STATUSES = ("done", "failed", "cancelled")
+
+# runner(query, verbosity, session_id)
+JobRunner = Callable[[str, str, Optional[str]], Awaitable[dict]]
+
+# Колонки, добавленные после первой версии таблицы: в старых БД их создаёт ALTER TABLE
+_ADDED_COLUMNS = {"client": "TEXT", "session_id": "TEXT"}
+
+
+class QueueFullError(Exception):
+    """В очереди уже max_queue задач"""
+
+
+class JobStore:
+    """Таблица задач в SQLite"""
+
+    def __init__(self, db_path: str, busy_timeout_ms: int = 5000):
+        self.db_path = str(db_path)
+        self.busy_timeout_ms = busy_timeout_ms
+        self._connection: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # После fork соединение родителя использовать нельзя — открываем своё
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(
+                self.db_path, isolation_level=None, check_same_thread=False
+            )
+            connection.row_factory = sqlite3.Row
+            connection.execute(f"PRAGMA busy_timeout = {self.busy_timeout_ms}")
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            connection.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    query TEXT NOT NULL,
+                    verbosity TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    owner TEXT,
+                    client TEXT,
+                    session_id TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )"""
+            )
+            columns = {row["name"] for row in connection.execute("PRAGMA table_info(jobs)")}
+            for name, column_type in _ADDED_COLUMNS.items():
+                if name not in columns:
+                    connection.execute(f"ALTER TABLE jobs ADD COLUMN {name} {column_type}")
+            connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    def _execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._connect().execute(sql, params)
+
+    def create(
+        self,
+        query: str,
+        verbosity: str,
+        client: Optional[str] = None,
+        session_id: Optional[str] = None
+    ) -> dict:
+        job_id = uuid.uuid4().hex
+        self._execute(
+            "INSERT INTO jobs (id, status, query, verbosity, client, session_id, created_at) "
+            "VALUES (?, 'queued', ?, ?, ?, ?, ?)",
+            (job_id, query, verbosity, client, session_id, time.time()),
+        )
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        row = self._execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def claim(self, job_id: str, owner: str) -> bool:
+        """Переводит задачу queued → running; False, если её отменили или забрали"""
+        cursor = self._execute(
+            "UPDATE jobs SET status = 'running', owner = ?, started_at = ? "
+            "WHERE id = ? AND status = 'queued'",
+            (owner, time.time(), job_id),
+        )
+        return cursor.rowcount == 1
+
+    def finish(self, job_id: str, result: dict) -> bool:
+        cursor = self._execute(
+            "UPDATE jobs SET status = 'done', result = ?, finished_at = ? "
+            "WHERE id = ? AND status = 'running'",
+            (json.dumps(result, ensure_ascii=False), time.time(), job_id),
+        )
+        return cursor.rowcount == 1
+
+    def fail(self, job_id: str, error: str) -> bool:
+        cursor = self._execute(
+            "UPDATE jobs SET status = 'failed', error = ?, finished_at = ? "
+            "WHERE id = ? AND status = 'running'",
+            (error, time.time(), job_id),
+        )
+        return cursor.rowcount == 1
+
+    def cancel(self, job_id: str) -> bool:
+        """Отменяет незавершённую задачу"""
+        cursor = self._execute(
+            "UPDATE jobs SET status = 'cancelled', finished_at = ? "
+            "WHERE id = ? AND status IN ('queued', 'running')",
+            (time.time(), job_id),
+        )
+        return cursor.rowcount == 1
+
+    def requeue(self, job_id: str):
+        """Возвращает прерванную задачу в очередь (остановка воркера)"""
+        self._execute(
+            "UPDATE jobs SET status = 'queued', owner = NULL, started_at = NULL "
+            "WHERE id = ? AND status = 'running'",
+            (job_id,),
+        )
+
+    def recover(self, owner: str) -> List[str]:
+        """
+        Возвращает в очередь задачи, чей процесс-владелец на этом хосте
+        завершился, и отдаёт ID всех ожидающих задач по порядку создания.
+        """
+        host = owner.rsplit(":", 1)[0]
+        running = self._execute(
+            "SELECT id, owner FROM jobs WHERE status = 'running'"
+        ).fetchall()
+        for row in running:
+            if _is_orphaned(row["owner"], host):
+                self.requeue(row["id"])
+
+        rows = self._execute(
+            "SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at"
+        ).fetchall()
+        return [row["id"] for row in rows]
+
+    def counts(self) -> Dict[str, int]:
+        rows = self._execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        counts = {status: 0 for status in JOB_STATUSES}
+        counts.update({row["status"]: row["n"] for row in rows})
+        return counts
+
+    def purge(self, older_than: float) -> int:
+        """Удаляет завершённые задачи, закончившиеся раньше older_than"""
+        cursor = self._execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed', 'cancelled') AND finished_at < ?",
+            (older_than,),
+        )
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None and self._pid == os.getpid():
+                self._connection.close()
+            self._connection = None
+
+
+def _is_orphaned(owner: Optional[str], host: str) -> bool:
+    """Задача «висит» на процессе этого хоста, которого больше нет"""
+    if not owner:
+        return True
+    owner_host, _, pid = owner.rpartition(":")
+    if owner_host != host:
+        # Процесс на другом хосте проверить нельзя
+        return False
+    if int(pid) == os.getpid():
+        # Новая очередь в этом же процессе: прежние воркеры уже остановлены
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        return False
+    return False
+
+
+def _iso(timestamp: Optional[float]) -> Optional[str]:
+    return datetime.fromtimestamp(timestamp).isoformat() if timestamp else None
+
+
+def _ms(start: Optional[float], end: Optional[float]) -> Optional[float]:
+    return round((end - start) * 1000, 1) if start and end else None
+
+
+def job_view(job: dict) -> dict:
+    """Задача в формате ответа API (с длительностями ожидания и выполнения)"""
+    now = time.time()
+    finished_or_now = job["finished_at"] or (now if job["status"] == "running" else None)
+    return {
+        "id": job["id"],
+        "status": job["status"],
+        "query": job["query"],
+        "verbosity": job["verbosity"],
+        "session_id": job["session_id"],
+        "created_at": _iso(job["created_at"]),
+        "started_at": _iso(job["started_at"]),
+        "finished_at": _iso(job["finished_at"]),
+        # Время в очереди и время выполнения (для незавершённых — на текущий момент)
+        "queue_ms": _ms(job["created_at"], job["started_at"] or (now if job["status"] == "queued" else None)),
+        "run_ms": _ms(job["started_at"], finished_or_now),
+        "result": json.loads(job["result"]) if job["result"] else None,
+        "error": job["error"],
+    }
+
+
+async def run_query_job(query: str, verbosity: str, session_id: Optional[str] = None) -> dict:
+    """Выполнение задачи по умолчанию: прогон пайплайна (в сессии — с её историей)"""
+    return apply_verbosity(await process_query(query, session_id=session_id), verbosity)
+
+
+class JobQueue:
+    """Ограниченный пул asyncio-воркеров поверх JobStore"""
+
+    def __init__(
+        self,
+        store: JobStore,
+        runner: JobRunner = run_query_job,
+        workers: int = DEFAULT_WORKERS,
+        max_queue: int = DEFAULT_MAX_QUEUE,
+        retention_seconds: float = DEFAULT_RETENTION_SECONDS
+    ):
+        self.store = store
+        self.runner = runner
+        self.workers = workers
+        self.max_queue = max_queue
+        self.retention_seconds = retention_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._pending: Optional[asyncio.Queue] = None
+        self._worker_tasks: List[asyncio.Task] = []
+        self._running: Dict[str, asyncio.Task] = {}
+        self._stopping = False
+        self._last_purge = 0.0
+
+    @property
+    def started(self) -> bool:
+        return bool(self._worker_tasks)
+
+    @property
+    def running(self) -> int:
+        """Число задач, выполняемых воркерами этого процесса"""
+        return len(self._running)
+
+    @property
+    def depth(self) -> int:
+        """Число задач, ожидающих воркера в этом процессе"""
+        return self._pending.qsize() if self._pending is not None else 0
+
+    async def start(self):
+        """Запускает воркеры и ставит в очередь задачи, оставшиеся с прошлого запуска"""
+        if self.started:
+            return
+        self._stopping = False
+        self._pending = asyncio.Queue()
+        self._purge()
+        recovered = self.store.recover(self.owner)
+        for job_id in recovered:
+            self._pending.put_nowait(job_id)
+        self._worker_tasks = [
+            asyncio.create_task(self._worker(), name=f"job-worker-{i}")
+            for i in range(self.workers)
+        ]
+        if recovered:
+            logger.info(f"Recovered {len(recovered)} pending jobs")
+        logger.info(f"Job queue started with {self.workers} workers")
+
+    async def stop(self, drain_timeout: float = 0):
+        """
+        Останавливает воркеры. Выполняющиеся задачи получают до drain_timeout
+        секунд на завершение; прерванные и не начатые задачи возвращаются в
+        очередь и выполняются следующим запуском.
+        """
+        if not self.started:
+            return
+        self._stopping = True
+        if drain_timeout > 0 and self._running:
+            logger.info(f"Waiting for {len(self._running)} running jobs")
+            await asyncio.wait(list(self._running.values()), timeout=drain_timeout)
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        self._pending = None
+        logger.info("Job queue stopped")
+
+    async def submit(
+        self,
+        query: str,
+        verbosity: str = "full",
+        client: Optional[str] = None,
+        session_id: Optional[str] = None
+    ) -> dict:
+        """
+        Создаёт задачу и ставит её в очередь. Токены LLM, потраченные задачей,
+        списываются с суточного бюджета клиента client (ключ rate_limits);
+        задача с session_id выполняется как очередной ход этой сессии.
+        """
+        await self.start()
+        if self.depth >= self.max_queue:
+            raise QueueFullError(f"Очередь заполнена ({self.max_queue} задач)")
+        job = self.store.create(query, verbosity, client, session_id)
+        self._pending.put_nowait(job["id"])
+        if time.time() - self._last_purge > PURGE_INTERVAL_SECONDS:
+            self._purge()
+        return job
+
+    def get(self, job_id: str) -> Optional[dict]:
+        return self.store.get(job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Отменяет задачу. Ожидающая задача будет пропущена воркером, выполняемая
+        в этом процессе — прервана; результат задачи, выполняемой другим
+        процессом, будет отброшен.
+        """
+        if not self.store.cancel(job_id):
+            return False
+        task = self._running.get(job_id)
+        if task is not None:
+            task.cancel()
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.depth,
+            "running": self.running,
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "jobs": self.store.counts(),
+        }
+
+    def _purge(self):
+        self._last_purge = time.time()
+        removed = self.store.purge(self._last_purge - self.retention_seconds)
+        if removed:
+            logger.debug(f"Purged {removed} finished jobs")
+
+    async def _worker(self):
+        while True:
+            job_id = await self._pending.get()
+            try:
+                await self._execute(job_id)
+            finally:
+                self._pending.task_done()
+
+    async def _execute(self, job_id: str):
+        if self._stopping:
+            # Идёт остановка: задача остаётся в очереди до следующего запуска
+            return
+        if not self.store.claim(job_id, self.owner):
+            # Задачу отменили, пока она ждала в очереди
+            return
+
+        job = self.store.get(job_id)
+        # Логи пайплайна задачи помечаются её ID, токены LLM считает свой
+        # счётчик (задача наследует контекст)
+        with request_context(job_id), metered_tokens() as meter:
+            task = asyncio.create_task(self.runner(job["query"], job["verbosity"], job["session_id"]))
+        self._running[job_id] = task
+        try:
+            result = await task
+        except asyncio.CancelledError:
+            if self._stopping:
+                # Процесс останавливается — задачу выполнит следующий запуск
+                task.cancel()
+                self.store.requeue(job_id)
+                raise
+            logger.info(f"Job {job_id} cancelled")
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {e}")
+            self.store.fail(job_id, str(e))
+        else:
+            self.store.finish(job_id, result)
+        finally:
+            self._running.pop(job_id, None)
+            if job["client"]:
+                # Прерванная и упавшая задача тоже тратила токены
+                await get_rate_limiter().acharge(job["client"], meter.tokens)
+
+
+# Глобальный инстанс очереди
+_queue: Optional[JobQueue] = None
+
+
+registry.gauge(
+    "orchestra_jobs_queue_depth", "Задачи, ожидающие воркера",
+    lambda: _queue.depth if _queue is not None else 0
+)
+registry.gauge(
+    "orchestra_jobs_running", "Выполняющиеся задачи",
+    lambda: _queue.running if _queue is not None else 0
+)
+
+
+def get_job_queue() -> JobQueue:
+    """
+    Возвращает singleton очереди задач.
+
+    Настройки: JOBS_DB_PATH (по умолчанию jobs.db), JOBS_WORKERS,
+    JOBS_MAX_QUEUE, JOBS_RETENTION_SECONDS.
+    """
+    global _queue
+    if _queue is None:
+        _queue = JobQueue(
+            JobStore(os.getenv("JOBS_DB_PATH", "jobs.db")),
+            workers=int(os.getenv("JOBS_WORKERS", DEFAULT_WORKERS)),
+            max_queue=int(os.getenv("JOBS_MAX_QUEUE", DEFAULT_MAX_QUEUE)),
+            retention_seconds=float(os.getenv("JOBS_RETENTION_SECONDS", DEFAULT_RETENTION_SECONDS)),
+        )
+    return _queue
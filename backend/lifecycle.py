@@ -0,0 +1,213 @@
+"""
+Жизненный цикл процесса сервера.
+
+- preload() — прогрев в мастер-процессе gunicorn до fork (хранилище агентов,
+  LLM-стек, скомпилированный граф): воркеры получают их готовыми через
+  copy-on-write;
+- startup() — инициализация воркера в lifespan FastAPI; LLM-стек загружается
+  при первом запросе или сразу при LLM_WARMUP=true;
+- shutdown() — корректная остановка: дожидается выполняющихся запросов к LLM
+  и задач очереди в пределах DRAIN_TIMEOUT, затем закрывает пул соединений
+  к провайдеру и SQLite-хранилища.
+
+Запросы /query* учитываются InFlightMiddleware. При SIGTERM сервер перестаёт
+принимать соединения и ждёт выполняющиеся запросы (см. gunicorn.conf.py);
+begin_drain() отмечает начало остановки, чтобы задачи очереди получили только
+оставшуюся часть общего бюджета времени.
+"""
+
+import asyncio
+import os
+import time
+from contextlib import contextmanager
+from typing import Optional, Sequence
+
+from loguru import logger
+
+from metrics import registry
+
+DEFAULT_DRAIN_TIMEOUT = 90.0
+
+# Момент запуска процесса (после fork — момент запуска воркера)
+_process_started = time.monotonic()
+
+
+def mark_started():
+    """Отмечает запуск процесса; вызывается в воркере сразу после fork"""
+    global _process_started
+    _process_started = time.monotonic()
+
+
+def get_drain_timeout() -> float:
+    """Сколько секунд ждать выполняющиеся запросы при остановке (DRAIN_TIMEOUT)"""
+    return float(os.getenv("DRAIN_TIMEOUT", DEFAULT_DRAIN_TIMEOUT))
+
+
+def rss_mb() -> Optional[float]:
+    """Resident set size текущего процесса в МБ (None, если не определить)"""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Пиковое значение: на Linux в КБ, на macOS в байтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class InFlightTracker:
+    """Счётчик выполняющихся запросов с ожиданием их завершения"""
+
+    def __init__(self):
+        self.count = 0
+        self.draining_since: Optional[float] = None
+
+    @property
+    def draining(self) -> bool:
+        return self.draining_since is not None
+
+    def begin_drain(self):
+        """Отмечает начало остановки (повторные вызовы не сдвигают отметку)"""
+        if self.draining_since is None:
+            self.draining_since = time.monotonic()
+
+    def remaining(self, timeout: float) -> float:
+        """Сколько осталось от бюджета timeout с начала остановки"""
+        if self.draining_since is None:
+            return timeout
+        return max(0.0, timeout - (time.monotonic() - self.draining_since))
+
+    @contextmanager
+    def track(self):
+        self.count += 1
+        try:
+            yield
+        finally:
+            self.count -= 1
+
+    async def wait_idle(self, timeout: float, poll_interval: float = 0.05) -> bool:
+        """Ждёт завершения всех запросов; False, если не уложились в timeout"""
+        # Опрос счётчика вместо asyncio.Event: трекер не привязан к event loop
+        deadline = time.monotonic() + timeout
+        while self.count and time.monotonic() < deadline:
+            await asyncio.sleep(poll_interval)
+        return self.count == 0
+
+
+_tracker = InFlightTracker()
+
+
+def get_inflight_tracker() -> InFlightTracker:
+    return _tracker
+
+
+registry.gauge(
+    "orchestra_inflight_queries", "Выполняющиеся запросы /query*",
+    lambda: _tracker.count
+)
+
+
+class InFlightMiddleware:
+    """ASGI middleware: учитывает запросы с путями из prefixes до конца ответа (включая стриминг)"""
+
+    def __init__(self, app, prefixes: Sequence[str] = ("/query",)):
+        self.app = app
+        self.prefixes = tuple(prefixes)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.prefixes):
+            await self.app(scope, receive, send)
+            return
+        with get_inflight_tracker().track():
+            await self.app(scope, receive, send)
+
+
+def warmup_enabled() -> bool:
+    """Загружать LLM-стек при старте воркера, а не при первом запросе (LLM_WARMUP)"""
+    return os.getenv("LLM_WARMUP", "false").lower() == "true"
+
+
+def preload():
+    """Прогрев в мастер-процессе до fork: конфигурация агентов, LLM-стек и граф"""
+    from agents_storage import get_storage
+    from orchestrator import warm_up
+
+    started = time.perf_counter()
+    get_storage()
+    warm_up()
+    logger.info(f"Preloaded storage and workflow in {time.perf_counter() - started:.2f} s")
+
+
+async def startup():
+    """Инициализация воркера: хранилище, токенизатор, очередь задач, при LLM_WARMUP — граф"""
+    from agents_storage import get_storage
+    from job_queue import get_job_queue
+    from orchestrator import check_llm_config, warm_up
+    from token_budget import preload_tokenizer
+
+    get_inflight_tracker().draining_since = None
+    check_llm_config()
+    get_storage()
+    # Файл кодировки tiktoken скачивается без таймаута: грузим его в потоке,
+    # а не в первом запросе
+    await preload_tokenizer()
+    if warmup_enabled():
+        warm_up()
+    # Воркеры фоновой очереди; незавершённые задачи прошлого запуска продолжаются
+    await get_job_queue().start()
+
+    rss = rss_mb()
+    logger.info(
+        f"Worker {os.getpid()} ready in {time.monotonic() - _process_started:.2f} s"
+        + (f", RSS {rss:.0f} MB" if rss is not None else "")
+    )
+
+
+def close_stores():
+    """Закрывает SQLite-соединения хранилищ, открытые этим процессом"""
+    import agents_storage
+    import job_queue
+    import rate_limits
+    import sessions
+
+    if agents_storage._storage is not None:
+        agents_storage._storage.close()
+    if job_queue._queue is not None:
+        job_queue._queue.store.close()
+    if rate_limits._limiter is not None:
+        rate_limits._limiter.store.close()
+    if sessions._store is not None:
+        sessions._store.close()
+
+
+async def shutdown(drain_timeout: Optional[float] = None):
+    """
+    Корректная остановка воркера: ждёт выполняющиеся запросы и задачи
+    очереди (не дольше drain_timeout с начала остановки), затем закрывает
+    общие клиенты и хранилища.
+    """
+    from job_queue import get_job_queue
+    from llm_client import close_llm_factory
+
+    if drain_timeout is None:
+        drain_timeout = get_drain_timeout()
+    tracker = get_inflight_tracker()
+    tracker.begin_drain()
+
+    if tracker.count:
+        logger.info(f"Draining {tracker.count} in-flight queries")
+        if not await tracker.wait_idle(tracker.remaining(drain_timeout)):
+            logger.warning(f"Drain timeout exceeded, {tracker.count} queries still running")
+
+    await get_job_queue().stop(drain_timeout=tracker.remaining(drain_timeout))
+    # Закрываем общий пул соединений к LLM-провайдеру
+    await close_llm_factory()
+    close_stores()
+    logger.info(f"Worker {os.getpid()} stopped")
+    # Дописываем записи, ещё лежащие в очереди фоновых синков
+    await logger.complete()
@@ -0,0 +1,151 @@
+"""
+Фабрика LLM-клиентов с общим пулом HTTP-соединений.
+
+Клиенты ChatOpenAI кэшируются по ключу (model, temperature, base_url, ключ
+API, max_retries) и используют общий keep-alive пул httpx, поэтому
+повторные вызовы к OpenRouter не открывают новое TLS-соединение. Пул
+закрывается в lifespan FastAPI.
+
+httpx, openai и langchain_openai импортируются при создании первого клиента
+(или в load_llm_stack()), а не при импорте модуля.
+"""
+
+import os
+import threading
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+
+from loguru import logger
+
+from metrics import count_http_request, count_http_request_async
+
+DEFAULT_BASE_URL = "https://openrouter.ai/api/v1"
+DEFAULT_POOL_SIZE = 20
+DEFAULT_KEEPALIVE_EXPIRY = 60.0
+
+ClientKey = Tuple[str, float, str, Optional[str], Optional[int]]
+
+if TYPE_CHECKING:
+    import httpx
+    from langchain_openai import ChatOpenAI
+
+
+def load_llm_stack():
+    """Импортирует тяжёлые зависимости LLM-клиента (прогрев до первого запроса)"""
+    import httpx  # noqa: F401
+    import openai  # noqa: F401
+    import langchain_openai  # noqa: F401
+
+
+class LLMClientFactory:
+    """Кэш ChatOpenAI-клиентов поверх общего пула соединений"""
+
+    def __init__(
+        self,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        keepalive_expiry: float = DEFAULT_KEEPALIVE_EXPIRY
+    ):
+        self.pool_size = pool_size
+        self.keepalive_expiry = keepalive_expiry
+        self._clients: Dict[ClientKey, "ChatOpenAI"] = {}
+        self._http_client: Optional["httpx.Client"] = None
+        self._http_async_client: Optional["httpx.AsyncClient"] = None
+        self._lock = threading.Lock()
+
+    def _limits(self) -> "httpx.Limits":
+        import httpx
+
+        return httpx.Limits(
+            max_connections=self.pool_size,
+            max_keepalive_connections=self.pool_size,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+    def _ensure_http_clients(self):
+        """Лениво создаёт общие HTTP-клиенты (вызывается под блокировкой)"""
+        import openai
+
+        # event hooks считают HTTP-попытки (ретраи openai-клиента) для метрик
+        if self._http_client is None:
+            self._http_client = openai.DefaultHttpxClient(
+                limits=self._limits(), event_hooks={"request": [count_http_request]}
+            )
+        if self._http_async_client is None:
+            self._http_async_client = openai.DefaultAsyncHttpxClient(
+                limits=self._limits(), event_hooks={"request": [count_http_request_async]}
+            )
+
+    def get(
+        self,
+        model: str,
+        temperature: float,
+        base_url: str,
+        api_key: Optional[str] = None,
+        max_retries: Optional[int] = None
+    ) -> "ChatOpenAI":
+        """
+        Возвращает закэшированный клиент для (model, temperature, base_url).
+
+        api_key по умолчанию — OPENROUTER_API_KEY; max_retries=None оставляет
+        повторы openai-клиента по умолчанию.
+        """
+        key = (model, temperature, base_url, api_key, max_retries)
+        client = self._clients.get(key)
+        if client is not None:
+            return client
+
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                from langchain_openai import ChatOpenAI
+
+                self._ensure_http_clients()
+                options = {} if max_retries is None else {"max_retries": max_retries}
+                client = ChatOpenAI(
+                    api_key=api_key or os.getenv("OPENROUTER_API_KEY"),
+                    base_url=base_url,
+                    model=model,
+                    temperature=temperature,
+                    # usage в потоковых ответах (квоты токенов, метрики)
+                    stream_usage=True,
+                    http_client=self._http_client,
+                    http_async_client=self._http_async_client,
+                    **options,
+                )
+                self._clients[key] = client
+                logger.debug(f"Created LLM client for {model} (t={temperature}) at {base_url}")
+            return client
+
+    async def aclose(self):
+        """Закрывает пул соединений и сбрасывает кэш клиентов"""
+        with self._lock:
+            http_client, self._http_client = self._http_client, None
+            http_async_client, self._http_async_client = self._http_async_client, None
+            self._clients.clear()
+
+        if http_async_client is not None:
+            await http_async_client.aclose()
+        if http_client is not None:
+            http_client.close()
+
+
+# Глобальный инстанс фабрики
+_factory: Optional[LLMClientFactory] = None
+
+
+def get_llm_factory() -> LLMClientFactory:
+    """Возвращает singleton фабрики; размер пула берётся из LLM_POOL_SIZE"""
+    global _factory
+    if _factory is None:
+        _factory = LLMClientFactory(
+            pool_size=int(os.getenv("LLM_POOL_SIZE", DEFAULT_POOL_SIZE))
+        )
+    return _factory
+
+
+async def close_llm_factory():
+    """Закрывает глобальную фабрику (shutdown в lifespan FastAPI)"""
+    global _factory
+    factory, _factory = _factory, None
+    if factory is not None:
+        await factory.aclose()
+        logger.info("LLM connection pool closed")
@@ -0,0 +1,315 @@
+"""
+Цепочка LLM-провайдеров: резервные модели и эндпоинты, таймауты узлов,
+повторы с джиттером и hedged-запросы.
+
+Без настройки цепочка состоит из одного провайдера — MODEL_NAME на
+OPENROUTER_BASE_URL. Вызов узла графа ограничен его таймаутом
+(LLM_TIMEOUTS, по умолчанию маршрутизатор 30 с, агент 120 с, ревьюер 60 с):
+это общий бюджет на все попытки, поэтому медленный провайдер не держит
+запрос до таймаута nginx. Бюджет делится между провайдерами поровну (от
+оставшегося времени), так что зависший основной оставляет время резервным.
+
+- Повторяемые ошибки (таймаут соединения, 408/409/429, 5xx) повторяются
+  на том же провайдере до LLM_MAX_RETRIES раз с паузой full jitter
+  (случайная в пределах LLM_RETRY_BACKOFF · 2^попытка, не больше 8 с);
+- остальные ошибки и исчерпанные повторы переключают на следующего
+  провайдера из LLM_FALLBACKS;
+- при LLM_HEDGE_DELAY_MS первый вызов идёт потоково: если основной
+  провайдер не прислал ни одного токена за это время, параллельно
+  запускается первый резервный, и ответ берётся у того, кто первым начал
+  отвечать (второй запрос отменяется).
+
+Повторы делает цепочка, а не openai-клиент: у клиентов цепочки
+max_retries=0, чтобы паузы укладывались в бюджет узла.
+"""
+
+import asyncio
+import json
+import os
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+DEFAULT_TIMEOUTS = {"orchestrator": 30.0, "agent": 120.0, "review": 60.0}
+DEFAULT_TIMEOUT = 120.0
+DEFAULT_MAX_RETRIES = 2
+DEFAULT_RETRY_BACKOFF = 0.5
+MAX_RETRY_DELAY = 8.0
+RETRYABLE_STATUS = frozenset({408, 409, 429})
+
+_ENV_VARS = (
+    "MODEL_NAME", "OPENROUTER_BASE_URL", "LLM_FALLBACKS", "LLM_TIMEOUTS",
+    "LLM_MAX_RETRIES", "LLM_RETRY_BACKOFF", "LLM_HEDGE_DELAY_MS",
+)
+
+
+class LLMUnavailableError(RuntimeError):
+    """Ни один провайдер не ответил в пределах бюджета узла"""
+
+
+@dataclass(frozen=True)
+class Provider:
+    model: str
+    base_url: str
+    # Переменная окружения с ключом API этого эндпоинта
+    api_key_env: str = "OPENROUTER_API_KEY"
+
+    @property
+    def name(self) -> str:
+        return f"{self.model}@{self.base_url}"
+
+
+@dataclass(frozen=True)
+class ProviderSettings:
+    # Основной провайдер и резервные в порядке переключения
+    providers: Tuple[Provider, ...]
+    timeouts: Dict[str, float] = field(default_factory=lambda: dict(DEFAULT_TIMEOUTS))
+    max_retries: int = DEFAULT_MAX_RETRIES
+    retry_backoff: float = DEFAULT_RETRY_BACKOFF
+    # Секунды до hedged-запроса к первому резервному; None — выключено
+    hedge_delay: Optional[float] = None
+
+    @classmethod
+    def from_env(cls) -> "ProviderSettings":
+        from llm_client import DEFAULT_BASE_URL
+
+        base_url = os.getenv("OPENROUTER_BASE_URL", DEFAULT_BASE_URL)
+        primary = Provider(model=os.getenv("MODEL_NAME", "openai/gpt-4o"), base_url=base_url)
+        fallbacks = []
+        # Строка — другая модель на том же эндпоинте, объект — любой эндпоинт
+        for item in json.loads(os.getenv("LLM_FALLBACKS") or "[]"):
+            if isinstance(item, str):
+                item = {"model": item}
+            fallbacks.append(Provider(
+                model=item["model"],
+                base_url=item.get("base_url", base_url),
+                api_key_env=item.get("api_key_env", "OPENROUTER_API_KEY"),
+            ))
+        hedge_ms = os.getenv("LLM_HEDGE_DELAY_MS")
+        return cls(
+            providers=(primary, *fallbacks),
+            timeouts={**DEFAULT_TIMEOUTS, **json.loads(os.getenv("LLM_TIMEOUTS") or "{}")},
+            max_retries=int(os.getenv("LLM_MAX_RETRIES", DEFAULT_MAX_RETRIES)),
+            retry_backoff=float(os.getenv("LLM_RETRY_BACKOFF", DEFAULT_RETRY_BACKOFF)),
+            hedge_delay=float(hedge_ms) / 1000 if hedge_ms else None,
+        )
+
+    def timeout_for(self, node: str) -> float:
+        return float(self.timeouts.get(node, DEFAULT_TIMEOUT))
+
+
+_settings: Optional[ProviderSettings] = None
+_settings_key: Optional[tuple] = None
+
+
+def get_provider_settings() -> ProviderSettings:
+    """Настройки из переменных окружения; пересобираются при их изменении"""
+    global _settings, _settings_key
+
+    key = tuple(os.getenv(name) for name in _ENV_VARS)
+    if _settings is None or key != _settings_key:
+        _settings = ProviderSettings.from_env()
+        _settings_key = key
+    return _settings
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Имеет ли смысл повторить вызов у того же провайдера"""
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status in RETRYABLE_STATUS or status >= 500
+    # Обрыв соединения (openai.APIConnectionError, httpx.TransportError)
+    return type(error).__name__ in ("APIConnectionError", "APITimeoutError") or any(
+        cls.__module__.startswith("httpx") and cls.__name__ == "TransportError"
+        for cls in type(error).__mro__
+    )
+
+
+def retry_delay(attempt: int, backoff: float, rng: Callable[[], float] = random.random) -> float:
+    """Пауза перед повтором attempt (с 0): full jitter в пределах backoff · 2^attempt"""
+    return rng() * min(MAX_RETRY_DELAY, backoff * 2 ** attempt)
+
+
+class ProviderChain:
+    """
+    Chat-модель для одного узла графа поверх цепочки провайдеров.
+
+    Повторяет интерфейс ainvoke chat-модели langchain, поэтому узлы и
+    ainvoke_llm работают с ней так же, как с ChatOpenAI.
+    """
+
+    def __init__(
+        self,
+        settings: ProviderSettings,
+        client_for: Callable[[Provider], Any],
+        node: str = "agent",
+        clock: Callable[[], float] = time.monotonic
+    ):
+        self.settings = settings
+        self.providers = settings.providers
+        self.client_for = client_for
+        self.node = node
+        self.timeout = settings.timeout_for(node)
+        self._clock = clock
+        # Провайдер, давший последний ответ
+        self.last_provider: Optional[Provider] = None
+
+    def _remaining(self, deadline: float) -> float:
+        remaining = deadline - self._clock()
+        if remaining <= 0:
+            raise asyncio.TimeoutError()
+        return remaining
+
+    async def ainvoke(self, messages, config=None, **kwargs):
+        deadline = self._clock() + self.timeout
+        attempts = [0] * len(self.providers)
+        last_error: Optional[BaseException] = None
+
+        if self.settings.hedge_delay is not None and len(self.providers) > 1:
+            try:
+                return await self._hedged(messages, config, deadline, attempts, **kwargs)
+            except Exception as e:
+                last_error = e
+                logger.warning(f"Hedged LLM call failed for {self.node}: {e!r}")
+
+        for index, provider in enumerate(self.providers):
+            # Каждому провайдеру — равная доля оставшегося бюджета, чтобы
+            # зависший основной не съел время резервных
+            remaining = deadline - self._clock()
+            if remaining <= 0:
+                break
+            provider_deadline = self._clock() + remaining / (len(self.providers) - index)
+            while attempts[index] <= self.settings.max_retries:
+                if last_error is not None and attempts[index] and is_retryable(last_error):
+                    await self._backoff(attempts[index] - 1, provider_deadline)
+                attempts[index] += 1
+                try:
+                    timeout = self._remaining(provider_deadline)
+                    response = await asyncio.wait_for(
+                        self.client_for(provider).ainvoke(messages, config=config, **kwargs), timeout
+                    )
+                except Exception as e:
+                    last_error = e
+                    logger.warning(
+                        f"LLM call to {provider.name} failed for {self.node} "
+                        f"(attempt {attempts[index]}): {e!r}"
+                    )
+                    if not is_retryable(e) or self._clock() >= provider_deadline:
+                        break
+                    continue
+                self._record(provider, index)
+                return response
+
+        raise self._unavailable(last_error) from last_error
+
+    async def _backoff(self, attempt: int, deadline: float):
+        delay = retry_delay(attempt, self.settings.retry_backoff)
+        # Если доля провайдера кончится во время паузы, попытка сразу упадёт по таймауту
+        await asyncio.sleep(max(0.0, min(delay, deadline - self._clock())))
+
+    def _record(self, provider: Provider, index: int):
+        self.last_provider = provider
+        if index:
+            logger.info(f"LLM call for {self.node} served by fallback {provider.name}")
+
+    def _unavailable(self, error: Optional[BaseException]) -> LLMUnavailableError:
+        names = ", ".join(provider.name for provider in self.providers)
+        if error is None or isinstance(error, asyncio.TimeoutError):
+            reason = f"timed out after {self.timeout:g} s"
+        else:
+            reason = f"last error: {error!r}"
+        return LLMUnavailableError(f"LLM providers unavailable for {self.node} ({names}): {reason}")
+
+    async def _hedged(self, messages, config, deadline: float, attempts: List[int], **kwargs):
+        """
+        Потоковый вызов основного провайдера; если за hedge_delay не пришло
+        ни одного токена (или он упал), запускается первый резервный. Ответ
+        берётся у первого начавшего отвечать, второй запрос отменяется.
+
+        Токены в поток ответа (callbacks из config, stream_mode="messages"
+        графа) отдаёт только основной запрос. Резервный, запущенный рядом с
+        ещё живым основным, идёт без callbacks: токены двух моделей не
+        смешиваются, а если он победит, ответ придёт целиком в итоговом
+        результате. Проигравший отменяется в момент первого токена
+        победителя, до того как успеет отдать свой следующий.
+        """
+        signals: asyncio.Queue = asyncio.Queue()
+        winner: List[int] = []
+        silent = dict(config or {}, callbacks=[])
+
+        def claim(index: int):
+            if not winner:
+                winner.append(index)
+                for other, task in tasks.items():
+                    if other != index:
+                        task.cancel()
+            signals.put_nowait(("token", index))
+
+        async def stream(index: int, stream_config):
+            message = None
+            try:
+                async for chunk in self.client_for(self.providers[index]).astream(
+                    messages, config=stream_config, **kwargs
+                ):
+                    if message is None and chunk.content:
+                        claim(index)
+                    message = chunk if message is None else message + chunk
+            except Exception as e:
+                signals.put_nowait(("error", index, e))
+                raise
+            # Пустой ответ тоже ответ
+            claim(index)
+            return message
+
+        def start(index: int) -> asyncio.Task:
+            attempts[index] += 1
+            # Резервный отдаёт токены клиенту, только если основной уже упал
+            live = index == 0 or 0 in failed
+            return asyncio.create_task(stream(index, config if live else silent))
+
+        tasks: Dict[int, asyncio.Task] = {}
+        failed: Dict[int, BaseException] = {}
+        tasks[0] = start(0)
+        hedge_at = self._clock() + self.settings.hedge_delay
+        try:
+            while True:
+                wait = self._remaining(deadline)
+                if 1 not in tasks:
+                    wait = min(wait, max(0.0, hedge_at - self._clock()))
+                try:
+                    signal = await asyncio.wait_for(signals.get(), wait)
+                except asyncio.TimeoutError:
+                    if 1 in tasks:
+                        raise
+                    logger.info(
+                        f"No first token from {self.providers[0].name} in "
+                        f"{self.settings.hedge_delay * 1000:.0f} ms, hedging to {self.providers[1].name}"
+                    )
+                    tasks[1] = start(1)
+                    continue
+
+                if signal[0] == "token":
+                    break
+                index = signal[1]
+                failed[index] = signal[2]
+                if 1 not in tasks:
+                    tasks[1] = start(1)
+                elif len(failed) == len(tasks):
+                    raise failed[index]
+
+            # Победитель — первый начавший отвечать; второй запрос уже отменён
+            index = winner[0]
+            response = await asyncio.wait_for(tasks[index], self._remaining(deadline))
+            self._record(self.providers[index], index)
+            return response
+        finally:
+            for task in tasks.values():
+                if not task.done():
+                    task.cancel()
+            # Ошибки проигравших задач уже учтены в failed
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
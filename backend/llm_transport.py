@@ -0,0 +1,359 @@
+"""
+Транспорт вызовов LLM: живые запросы, запись, воспроизведение и заглушки.
+
+Режим задаёт LLM_TRANSPORT:
+
+- live (по умолчанию) — запросы к провайдерам как обычно;
+- record — то же, но каждый ответ вместе с задержкой дописывается в кассету
+  (LLM_CASSETTE, по умолчанию llm_cassette.jsonl);
+- replay — ответы берутся из кассеты по хэшу промпта, сеть не нужна;
+  LLM_REPLAY_LATENCY — множитель записанной задержки (0 — мгновенно,
+  1 — как при записи);
+- stub — заранее заданные ответы по узлам графа (LLM_STUB_RESPONSES) с
+  задержкой LLM_STUB_LATENCY_MS.
+
+Транспорт подменяет клиента провайдера внутри цепочки (llm_providers),
+поэтому таймауты, повторы и потоковая выдача токенов работают во всех
+режимах. Кассета — JSON lines: одна строка на ответ, в ней хэш промпта,
+текст ответа, usage и задержки; сами промпты не сохраняются. Одинаковые
+промпты, записанные несколько раз, воспроизводятся по очереди.
+
+Модуль импортирует langchain_core, поэтому оркестратор загружает его, только
+если LLM_TRANSPORT не live.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from loguru import logger
+from pydantic import PrivateAttr
+
+from llm_providers import LLMUnavailableError, Provider
+from token_budget import count_tokens
+
+MODES = ("live", "record", "replay", "stub")
+DEFAULT_CASSETTE = "llm_cassette.jsonl"
+DEFAULT_STUB_RESPONSES = {
+    "orchestrator": ["agent1"],
+    "agent": ["Ответ агента (LLM_TRANSPORT=stub)"],
+    "review": ["approved"],
+}
+# Параметры вызова, от которых зависит ответ (входят в ключ кассеты)
+KEY_PARAMS = ("max_tokens", "stop")
+
+_ENV_VARS = (
+    "LLM_TRANSPORT", "LLM_CASSETTE", "LLM_REPLAY_LATENCY", "LLM_STUB_RESPONSES", "LLM_STUB_LATENCY_MS",
+)
+
+
+class CassetteMissError(LLMUnavailableError):
+    """В кассете нет ответа на промпт"""
+
+
+def prompt_key(model: str, temperature: float, messages: Sequence[Any], params: Optional[dict] = None) -> str:
+    """Ключ кассеты: хэш модели, температуры, сообщений и параметров ответа"""
+    params = params or {}
+    payload = {
+        "model": model,
+        "temperature": temperature,
+        "messages": [[message.type, message.content] for message in messages],
+        "params": {name: params[name] for name in KEY_PARAMS if params.get(name) is not None},
+    }
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()[:32]
+
+
+class CassetteStore:
+    """Кассета ответов LLM в JSON lines"""
+
+    def __init__(self, path: str = DEFAULT_CASSETTE):
+        self.path = Path(path)
+        self._entries: Optional[Dict[str, List[dict]]] = None
+        # Сколько раз воспроизведён каждый ключ
+        self._cursors: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[str, List[dict]]:
+        entries: Dict[str, List[dict]] = {}
+        if self.path.exists():
+            with open(self.path, encoding="utf-8") as f:
+                for number, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        logger.warning(f"Skipping malformed line {number} in cassette {self.path}")
+                        continue
+                    entries.setdefault(entry["key"], []).append(entry)
+        logger.info(f"Loaded {sum(map(len, entries.values()))} LLM responses from {self.path}")
+        return entries
+
+    def __len__(self) -> int:
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._load()
+            return sum(map(len, self._entries.values()))
+
+    def record(self, entry: dict):
+        """Дописывает ответ в кассету (одной строкой, чтобы записи воркеров не перемешивались)"""
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+            if self._entries is not None:
+                self._entries.setdefault(entry["key"], []).append(entry)
+
+    def replay(self, key: str) -> Optional[dict]:
+        """Следующий записанный ответ на промпт key (по кругу); None — промпта нет"""
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._load()
+            entries = self._entries.get(key)
+            if not entries:
+                return None
+            cursor = self._cursors.get(key, 0)
+            self._cursors[key] = cursor + 1
+            return entries[cursor % len(entries)]
+
+
+def _usage_metadata(usage: Optional[Dict[str, int]]) -> Optional[Dict[str, int]]:
+    if not usage:
+        return None
+    usage = {name: usage.get(name, 0) for name in ("input_tokens", "output_tokens")}
+    return dict(usage, total_tokens=usage["input_tokens"] + usage["output_tokens"])
+
+
+def _words(content: str) -> List[str]:
+    """Ответ по словам для потоковой выдачи (как у провайдера — по фрагментам)"""
+    words = content.split(" ")
+    return [word if index == 0 else f" {word}" for index, word in enumerate(words)]
+
+
+class _ScriptedReply(BaseChatModel):
+    """Общая часть replay и stub: ответ с задержкой, в том числе потоковый"""
+
+    def _answer(self, messages, stop, kwargs) -> Tuple[str, Optional[Dict[str, int]], float, float]:
+        """(текст, usage_metadata, задержка первого токена, полная задержка) в секундах"""
+        raise NotImplementedError
+
+    def _message(self, content: str, usage) -> AIMessage:
+        return AIMessage(content=content, usage_metadata=usage) if usage else AIMessage(content=content)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        content, usage, _, latency = self._answer(messages, stop, kwargs)
+        time.sleep(latency)
+        return ChatResult(generations=[ChatGeneration(message=self._message(content, usage))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        content, usage, _, latency = self._answer(messages, stop, kwargs)
+        await asyncio.sleep(latency)
+        return ChatResult(generations=[ChatGeneration(message=self._message(content, usage))])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        content, usage, first_token, latency = self._answer(messages, stop, kwargs)
+        await asyncio.sleep(first_token)
+        words = _words(content)
+        # Остаток задержки распределяется между фрагментами
+        step = max(0.0, latency - first_token) / max(1, len(words) - 1)
+        for index, word in enumerate(words):
+            if index:
+                await asyncio.sleep(step)
+            last = index == len(words) - 1
+            chunk = ChatGenerationChunk(
+                message=AIMessageChunk(content=word, usage_metadata=usage if last else None)
+            )
+            if run_manager:
+                await run_manager.on_llm_new_token(word, chunk=chunk)
+            yield chunk
+
+
+class ReplayChatModel(_ScriptedReply):
+    """Ответы из кассеты по хэшу промпта"""
+
+    store: Any
+    model_name: str
+    temperature: float
+    # Множитель записанной задержки
+    latency_scale: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "replay"
+
+    def _answer(self, messages, stop, kwargs):
+        key = prompt_key(self.model_name, self.temperature, messages, dict(kwargs, stop=stop))
+        entry = self.store.replay(key)
+        if entry is None:
+            raise CassetteMissError(f"No recorded response for prompt {key} ({self.model_name}) in {self.store.path}")
+        latency = entry.get("latency_ms", 0.0) / 1000 * self.latency_scale
+        first_token = entry.get("first_token_ms", entry.get("latency_ms", 0.0)) / 1000 * self.latency_scale
+        return entry["content"], _usage_metadata(entry.get("usage")), min(first_token, latency), latency
+
+
+class StubChatModel(_ScriptedReply):
+    """Заранее заданные ответы узла графа по очереди"""
+
+    responses: List[str]
+    latency: float = 0.0
+    _calls: int = PrivateAttr(default=0)
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub"
+
+    def _answer(self, messages, stop, kwargs):
+        content = self.responses[self._calls % len(self.responses)]
+        self._calls += 1
+        usage = {
+            "input_tokens": sum(count_tokens(message.content) for message in messages),
+            "output_tokens": count_tokens(content),
+        }
+        return content, _usage_metadata(usage), 0.0, self.latency
+
+
+class RecordingChatModel(BaseChatModel):
+    """Живой клиент провайдера, ответы которого дописываются в кассету"""
+
+    inner: Any
+    store: Any
+    model_name: str
+    temperature: float
+
+    @property
+    def _llm_type(self) -> str:
+        return "record"
+
+    def _record(self, messages, stop, kwargs, message, started: float, first_token: Optional[float] = None):
+        entry = {
+            "key": prompt_key(self.model_name, self.temperature, messages, dict(kwargs, stop=stop)),
+            "model": self.model_name,
+            "content": message.content,
+            "latency_ms": round((time.perf_counter() - started) * 1000, 1),
+        }
+        if first_token is not None:
+            entry["first_token_ms"] = round((first_token - started) * 1000, 1)
+        usage = getattr(message, "usage_metadata", None)
+        if usage:
+            entry["usage"] = {name: usage.get(name, 0) for name in ("input_tokens", "output_tokens")}
+        self.store.record(entry)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        started = time.perf_counter()
+        result = self.inner._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        self._record(messages, stop, kwargs, result.generations[0].message, started)
+        return result
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        started = time.perf_counter()
+        result = await self.inner._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        self._record(messages, stop, kwargs, result.generations[0].message, started)
+        return result
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        started = time.perf_counter()
+        first_token, message = None, None
+        async for chunk in self.inner._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+            if first_token is None and chunk.message.content:
+                first_token = time.perf_counter()
+            message = chunk.message if message is None else message + chunk.message
+            yield chunk
+        # Прерванный поток (hedged-запрос проиграл) не записывается
+        if message is not None:
+            self._record(messages, stop, kwargs, message, started, first_token or time.perf_counter())
+
+
+class Transport:
+    """Подмена клиентов провайдеров согласно режиму транспорта"""
+
+    def __init__(
+        self,
+        mode: str = "live",
+        cassette: str = DEFAULT_CASSETTE,
+        replay_latency: float = 0.0,
+        stub_responses: Optional[Dict[str, List[str]]] = None,
+        stub_latency: float = 0.0
+    ):
+        if mode not in MODES:
+            raise ValueError(f"Unknown LLM_TRANSPORT {mode!r}, expected one of {', '.join(MODES)}")
+        self.mode = mode
+        self.store = CassetteStore(cassette)
+        self.replay_latency = replay_latency
+        self.stub_responses = dict(DEFAULT_STUB_RESPONSES if stub_responses is None else stub_responses)
+        self.stub_latency = stub_latency
+        self._models: Dict[tuple, BaseChatModel] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "Transport":
+        stub_responses = dict(DEFAULT_STUB_RESPONSES)
+        # Строка — один ответ на все вызовы узла, список — ответы по очереди
+        for node, responses in json.loads(os.getenv("LLM_STUB_RESPONSES") or "{}").items():
+            stub_responses[node] = [responses] if isinstance(responses, str) else list(responses)
+        return cls(
+            mode=os.getenv("LLM_TRANSPORT") or "live",
+            cassette=os.getenv("LLM_CASSETTE") or DEFAULT_CASSETTE,
+            replay_latency=float(os.getenv("LLM_REPLAY_LATENCY") or 0),
+            stub_responses=stub_responses,
+            stub_latency=float(os.getenv("LLM_STUB_LATENCY_MS") or 0) / 1000,
+        )
+
+    def _model(self, key: tuple, create: Callable[[], BaseChatModel]) -> BaseChatModel:
+        model = self._models.get(key)
+        if model is None:
+            with self._lock:
+                model = self._models.get(key)
+                if model is None:
+                    model = self._models[key] = create()
+        return model
+
+    def wrap(
+        self, client_for: Callable[[Provider], Any], temperature: float, node: str
+    ) -> Callable[[Provider], Any]:
+        """client_for цепочки провайдеров с учётом режима транспорта"""
+        if self.mode == "live":
+            return client_for
+
+        def transport_client_for(provider: Provider):
+            if self.mode == "stub":
+                # Узлы агентов вызываются с node="agent"
+                return self._model(("stub", node), lambda: StubChatModel(
+                    responses=self.stub_responses.get(node) or DEFAULT_STUB_RESPONSES["agent"],
+                    latency=self.stub_latency,
+                ))
+            if self.mode == "replay":
+                return self._model(("replay", provider.model, temperature), lambda: ReplayChatModel(
+                    store=self.store, model_name=provider.model, temperature=temperature,
+                    latency_scale=self.replay_latency,
+                ))
+            return RecordingChatModel(
+                inner=client_for(provider), store=self.store, model_name=provider.model, temperature=temperature
+            )
+
+        return transport_client_for
+
+
+_transport: Optional[Transport] = None
+_transport_key: Optional[tuple] = None
+
+
+def get_transport() -> Transport:
+    """Транспорт из переменных окружения; пересобирается при их изменении"""
+    global _transport, _transport_key
+
+    key = tuple(os.getenv(name) for name in _ENV_VARS)
+    if _transport is None or key != _transport_key:
+        _transport = Transport.from_env()
+        _transport_key = key
+        if _transport.mode != "live":
+            logger.info(f"LLM transport: {_transport.mode} ({_transport.store.path})")
+    return _transport
@@ -0,0 +1,279 @@
+"""
+Настройка логирования: фоновая запись, ID запроса и выборочные payload.
+
+- Синки (stderr и LOG_FILE, по умолчанию logs/app.log) пишутся из фонового
+  потока (LOG_ENQUEUE=true, BackgroundSink): event loop только форматирует
+  строку и кладёт её в очередь процесса, запись и ротацию (раз в сутки, 7
+  файлов) делает поток. Встроенный enqueue loguru для этого не подходит: он
+  передаёт каждую запись через pipe multiprocessing и на крупных записях
+  дороже синхронной записи в файл. Поток запускается в каждом процессе при
+  первой записи, поэтому переживает fork воркеров gunicorn.
+- Каждый HTTP-запрос получает ID (заголовок X-Request-ID клиента или новый),
+  он возвращается в ответе и попадает в каждую строку лога, в том числе из
+  узлов графа: ID хранится в contextvar и наследуется задачами asyncio и
+  потоками langgraph. Задачи очереди логируются с ID задачи.
+- Крупные тексты (ответы агентов, вердикты) пишутся log_payload в DEBUG
+  только для доли запросов LOG_PAYLOAD_SAMPLE_RATE и обрезаются до
+  LOG_PAYLOAD_LIMIT символов.
+- LOG_FORMAT=json — одна JSON-строка на запись (ts, level, request_id,
+  logger, message, поля logger.bind и exception) вместо текстового формата.
+"""
+
+import asyncio
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import traceback
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Iterator, List, Optional
+
+from loguru import logger
+
+from pipeline_trace import truncate
+
+DEFAULT_PAYLOAD_LIMIT = 500
+DEFAULT_LOG_FILE = "logs/app.log"
+REQUEST_ID_HEADER = "x-request-id"
+
+STDERR_FORMAT = (
+    "<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level: <8}</level> | "
+    "<magenta>{extra[request_id]}</magenta> | "
+    "<cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>"
+)
+FILE_FORMAT = "{time:YYYY-MM-DD HH:mm:ss} | {level: <8} | {extra[request_id]} | {name}:{function}:{line} - {message}"
+
+# ID клиента принимается, только если он не ломает строку лога
+_VALID_REQUEST_ID = re.compile(r"^[A-Za-z0-9._:-]{1,64}$")
+
+_request_id: ContextVar[str] = ContextVar("request_id", default="-")
+_payload_sampled: ContextVar[bool] = ContextVar("payload_sampled", default=False)
+
+
+@dataclass(frozen=True)
+class LogSettings:
+    level: str = "INFO"
+    # Файл лога; None — только stderr
+    file: Optional[str] = DEFAULT_LOG_FILE
+    file_level: str = "DEBUG"
+    json: bool = False
+    # Запись синков в фоновом потоке
+    enqueue: bool = True
+    payload_limit: int = DEFAULT_PAYLOAD_LIMIT
+    # Доля запросов, для которых пишутся крупные тексты
+    payload_sample_rate: float = 1.0
+
+    @classmethod
+    def from_env(cls) -> "LogSettings":
+        return cls(
+            level=os.getenv("LOG_LEVEL", "INFO").upper(),
+            file=os.getenv("LOG_FILE", DEFAULT_LOG_FILE) or None,
+            file_level=os.getenv("LOG_FILE_LEVEL", "DEBUG").upper(),
+            json=os.getenv("LOG_FORMAT", "text").lower() == "json",
+            enqueue=os.getenv("LOG_ENQUEUE", "true").lower() != "false",
+            payload_limit=int(os.getenv("LOG_PAYLOAD_LIMIT", DEFAULT_PAYLOAD_LIMIT)),
+            payload_sample_rate=float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", 1.0)),
+        )
+
+
+_settings = LogSettings()
+# Фоновые синки текущей конфигурации (для flush_logs)
+_background_sinks: List["BackgroundSink"] = []
+
+
+def _add_request_id(record):
+    # logger.bind(request_id=...) имеет приоритет над contextvar
+    record["extra"].setdefault("request_id", _request_id.get())
+
+
+def json_format(record) -> str:
+    """Формат синка для LOG_FORMAT=json: запись — одна JSON-строка"""
+    entry = {
+        "ts": record["time"].isoformat(),
+        "level": record["level"].name,
+        "request_id": record["extra"].get("request_id"),
+        "logger": f"{record['name']}:{record['function']}:{record['line']}",
+        "message": record["message"],
+    }
+    entry.update((key, value) for key, value in record["extra"].items() if key not in ("request_id", "json"))
+    if record["exception"] is not None:
+        entry["exception"] = "".join(traceback.format_exception(*record["exception"]))
+    record["extra"]["json"] = json.dumps(entry, ensure_ascii=False, default=str)
+    # Фигурные скобки JSON не должны попасть в шаблон loguru
+    return "{extra[json]}\n"
+
+
+class BackgroundSink:
+    """
+    Синк loguru с записью в фоновом потоке: write() кладёт готовую строку в
+    очередь, поток передаёт её обработчику logging (файл с ротацией, stderr).
+    """
+
+    def __init__(self, handler: logging.Handler):
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self.handler = handler
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _ensure_thread(self):
+        # После fork потока в дочернем процессе нет: запускаем свой
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.SimpleQueue()
+                self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if isinstance(item, threading.Event):
+                item.set()
+                continue
+            record = logging.makeLogRecord({"msg": item})
+            try:
+                self.handler.handle(record)
+            except Exception:
+                self.handler.handleError(record)
+
+    def write(self, message: str):
+        self._ensure_thread()
+        # Перевод строки добавляет обработчик
+        self._queue.put(message[:-1] if message.endswith("\n") else message)
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        """Ждёт записи всего, что уже в очереди"""
+        if self._pid != os.getpid():
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    async def complete(self):
+        """await logger.complete() дожидается записи очереди, не блокируя event loop"""
+        await asyncio.get_running_loop().run_in_executor(None, self.drain, 5.0)
+
+    def stop(self):
+        """Вызывается logger.remove(): дописывает очередь и закрывает обработчик"""
+        if self._pid == os.getpid() and self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(5.0)
+        self._pid = None
+        self.handler.close()
+
+
+def background_sink(handler: logging.Handler) -> BackgroundSink:
+    """Фоновый синк, который дожидается flush_logs()"""
+    sink = BackgroundSink(handler)
+    _background_sinks.append(sink)
+    return sink
+
+
+def flush_logs(timeout: float = 5.0):
+    """Ждёт записи очередей фоновых синков (завершение процесса, бенчмарки)"""
+    for sink in list(_background_sinks):
+        sink.drain(timeout)
+
+
+def configure_logging(settings: Optional[LogSettings] = None) -> LogSettings:
+    """Пересоздаёт синки loguru по настройкам (по умолчанию из переменных окружения)"""
+    global _settings
+
+    _settings = settings or LogSettings.from_env()
+    logger.remove()
+    _background_sinks.clear()
+    logger.configure(patcher=_add_request_id)
+    stderr = background_sink(logging.StreamHandler(sys.stderr)) if _settings.enqueue else sys.stderr
+    logger.add(
+        stderr,
+        level=_settings.level,
+        format=json_format if _settings.json else STDERR_FORMAT,
+        colorize=not _settings.json and sys.stderr.isatty(),
+    )
+    if _settings.file:
+        file_format = json_format if _settings.json else FILE_FORMAT
+        if _settings.enqueue:
+            os.makedirs(os.path.dirname(_settings.file) or ".", exist_ok=True)
+            handler = logging.handlers.TimedRotatingFileHandler(
+                _settings.file, when="midnight", backupCount=7, encoding="utf-8", delay=True
+            )
+            logger.add(background_sink(handler), level=_settings.file_level, format=file_format, colorize=False)
+        else:
+            logger.add(
+                _settings.file,
+                rotation="1 day",
+                retention="7 days",
+                level=_settings.file_level,
+                format=file_format,
+            )
+    return _settings
+
+
+def get_log_settings() -> LogSettings:
+    return _settings
+
+
+def current_request_id() -> str:
+    return _request_id.get()
+
+
+@contextmanager
+def request_context(request_id: Optional[str] = None) -> Iterator[str]:
+    """ID запроса и решение о записи крупных текстов для всего, что выполняется внутри"""
+    request_id = request_id or uuid.uuid4().hex[:16]
+    id_token = _request_id.set(request_id)
+    sampled_token = _payload_sampled.set(random.random() < _settings.payload_sample_rate)
+    try:
+        yield request_id
+    finally:
+        _payload_sampled.reset(sampled_token)
+        _request_id.reset(id_token)
+
+
+def log_payload(label: str, text: Optional[str]):
+    """Крупный текст в DEBUG: только для выбранных запросов и обрезанный до LOG_PAYLOAD_LIMIT"""
+    if text and _payload_sampled.get():
+        logger.debug(f"{label}: {truncate(text, _settings.payload_limit)}")
+
+
+class RequestIdMiddleware:
+    """ASGI middleware: ID запроса из X-Request-ID (или новый) в контекст логов и в ответ"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == REQUEST_ID_HEADER.encode():
+                value = value.decode("latin-1")
+                request_id = value if _VALID_REQUEST_ID.match(value) else None
+                break
+
+        with request_context(request_id) as request_id:
+            async def send_with_id(message):
+                if message["type"] == "http.response.start":
+                    message["headers"] = [
+                        *message.get("headers", []), (REQUEST_ID_HEADER.encode(), request_id.encode())
+                    ]
+                await send(message)
+
+            await self.app(scope, receive, send_with_id)
@@ -1,34 +1,50 @@
-from fastapi import FastAPI, HTTPException, Header, Depends
+from fastapi import FastAPI, HTTPException, Header, Depends, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel, Field, validator
-from orchestrator import process_query
-from agents_storage import get_storage
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
-from slowapi.errors import RateLimitExceeded
+from orchestrator import get_batch_concurrency, process_batch, process_query, stream_query
+from router import NoRouteError
+from pipeline_trace import apply_verbosity
+import lifecycle
+from lifecycle import InFlightMiddleware
+from logging_setup import RequestIdMiddleware, configure_logging
+from metrics import metered_tokens, record_coalesced, registry as metrics_registry
+from llm_providers import LLMUnavailableError
+from token_budget import TokenBudgetExceeded
+from job_queue import FINISHED_STATUSES, QueueFullError, get_job_queue, job_view
+from agents_storage import StorageConflictError, get_storage
+from sessions import SessionNotFoundError, get_session_store, session_view
+from rate_limits import DEFAULT_QUERY_RATE, RateLimitExceeded, client_key, get_rate_limiter
+from single_flight import (
+    IDEMPOTENCY_KEY_MAX_LENGTH, IdempotencyKeyReused, get_idempotency_store, request_fingerprint
+)
 from loguru import logger
-import traceback
-from typing import List, Optional
-import sys
+import asyncio
+import json
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import List, Literal, Optional
 import os
 from starlette.requests import Request
 
-# Настройка логирования
-logger.remove()
-logger.add(
-    sys.stderr,
-    format="<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level: <8}</level> | <cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>",
-    level="INFO"
-)
-logger.add(
-    "logs/app.log",
-    rotation="1 day",
-    retention="7 days",
-    level="DEBUG",
-    format="{time:YYYY-MM-DD HH:mm:ss} | {level: <8} | {name}:{function}:{line} - {message}"
-)
+# Настройка логирования: фоновая запись, ID запроса (см. logging_setup)
+configure_logging()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Хранилище, граф и воркеры очереди задач этого процесса
+    await lifecycle.startup()
+    yield
+    # Дожидаемся выполняющихся запросов и задач, закрываем клиенты и хранилища
+    await lifecycle.shutdown()
 
-app = FastAPI(title="Multi-Agent Orchestrator API")
+
+app = FastAPI(title="Multi-Agent Orchestrator API", lifespan=lifespan)
+# Учёт выполняющихся запросов к LLM для корректной остановки
+app.add_middleware(InFlightMiddleware, prefixes=("/query",))
+# ID запроса в логах и заголовке X-Request-ID ответа
+app.add_middleware(RequestIdMiddleware)
 
 # Custom function to get real IP behind nginx proxy
 def get_real_ip(request: Request) -> str:
@@ -45,12 +61,42 @@ def get_real_ip(request: Request) -> str:
         return real_ip
 
     # Fallback to direct connection IP
-    return get_remote_address(request)
+    return request.client.host if request.client else "127.0.0.1"
+
+
+# Rate limiting: token bucket в общем SQLite-хранилище (одинаков для всех воркеров)
+RATE_LIMIT_QUERY = os.getenv("RATE_LIMIT_QUERY", DEFAULT_QUERY_RATE)
+# ip — лимит на IP клиента (get_real_ip), api_key — на значение X-API-Key
+RATE_LIMIT_KEY_BY = os.getenv("RATE_LIMIT_KEY_BY", "ip")
+
+
+def check_rate_limit(request: Request, scope: str, rate: str, cost: int = 1) -> str:
+    """
+    Списывает cost запросов из корзины клиента для scope и проверяет его
+    суточный бюджет токенов. Возвращает ключ клиента, на который затем
+    записываются потраченные токены; при превышении — 429 с Retry-After.
+    """
+    key = client_key(request.headers.get("X-API-Key"), get_real_ip(request), RATE_LIMIT_KEY_BY)
+    limiter = get_rate_limiter()
+    try:
+        limiter.hit(scope, key, rate, cost)
+        limiter.check_budget(key)
+    except RateLimitExceeded as e:
+        logger.warning(f"Rate limit for {key} on {scope}: {e.detail}")
+        raise HTTPException(
+            status_code=429,
+            detail=e.detail,
+            headers={"Retry-After": str(math.ceil(e.retry_after))},
+        )
+    return key
+
+
+def rate_limit(scope: str, rate: str):
+    """Зависимость endpoint'а: check_rate_limit с ценой в один запрос"""
+    def dependency(request: Request) -> str:
+        return check_rate_limit(request, scope, rate)
 
-# Rate limiting with proper IP detection behind proxy
-limiter = Limiter(key_func=get_real_ip)
-app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+    return dependency
 
 # Security: API Key authentication
 API_KEY = os.getenv("API_KEY")
@@ -87,12 +133,19 @@ app.add_middleware(
     allow_origins=ALLOWED_ORIGINS,
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-    allow_headers=["Content-Type", "X-API-Key"],
+    allow_headers=["Content-Type", "X-API-Key", "X-Request-ID", "Idempotency-Key"],
+    expose_headers=["X-Request-ID", "Idempotent-Replayed"],
 )
 
 
 class QueryRequest(BaseModel):
     query: str = Field(..., min_length=1, max_length=5000, description="User query")
+    verbosity: Literal["compact", "full", "trace"] = Field(
+        "full", description="compact — без лога и контекста, trace — со структурированной трассой"
+    )
+    session_id: Optional[str] = Field(
+        None, max_length=64, description="ID сессии диалога (POST /sessions)"
+    )
 
     @validator('query')
     def query_must_not_be_empty(cls, v):
@@ -101,15 +154,54 @@ class QueryRequest(BaseModel):
         return v.strip()
 
 
+# Максимум запросов в одном POST /query/batch
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 200))
+# Лимит /query/batch считается в запросах пачки, а не в вызовах endpoint'а;
+# ёмкость корзины должна вмещать BATCH_MAX_ITEMS, иначе полная пачка не пройдёт
+RATE_LIMIT_BATCH = os.getenv("RATE_LIMIT_BATCH", f"{BATCH_MAX_ITEMS}/hour")
+
+
+class BatchQueryRequest(BaseModel):
+    queries: List[str] = Field(..., min_length=1, max_length=BATCH_MAX_ITEMS, description="User queries")
+    verbosity: Literal["compact", "full", "trace"] = Field(
+        "compact", description="Подробность результата каждого запроса"
+    )
+    concurrency: Optional[int] = Field(
+        None, ge=1, description="Сколько запросов выполнять одновременно (не больше BATCH_CONCURRENCY)"
+    )
+
+    @validator('queries')
+    def queries_must_not_be_empty(cls, v):
+        queries = [query.strip() for query in v]
+        for index, query in enumerate(queries):
+            if not query:
+                raise ValueError(f'Query #{index} cannot be empty or whitespace only')
+            if len(query) > 5000:
+                raise ValueError(f'Query #{index} is longer than 5000 characters')
+        return queries
+
+
 class QueryResponse(BaseModel):
     input: str
     route: str
+    # Все агенты, обработавшие запрос (больше одного — режим fan-out)
+    routes: Optional[List[str]] = None
     agent_response: str
     review_result: str
     context: str
     iteration_count: int
     # Подробный лог выполнения пайплайна
     log: List[str]
+    # Ответ взят из кэша без прогона пайплайна
+    cached: bool = False
+    # Ответ получен от одновременного прогона такого же запроса
+    coalesced: bool = False
+    # Структурированная трасса (только при verbosity="trace")
+    trace: Optional[List[dict]] = None
+    # Сессия диалога, в которую записан ход
+    session_id: Optional[str] = None
+    # Оценка каждого вызова LLM до отправки: токены промпта, max_tokens, сокращённые части
+    token_estimates: Optional[List[dict]] = None
 
 
 class AgentUpdate(BaseModel):
@@ -117,6 +209,9 @@ class AgentUpdate(BaseModel):
     description: str = Field(..., min_length=1, max_length=500, description="Agent description")
     prompt: str = Field(..., min_length=10, max_length=10000, description="System prompt")
     color: str = Field(..., pattern=r'^bg-\w+-\d{3}$', description="Tailwind color class")
+    expected_updated_at: Optional[str] = Field(
+        None, description="updated_at, который видел клиент (оптимистичная блокировка)"
+    )
 
     @validator('name', 'description', 'prompt')
     def fields_must_not_be_empty(cls, v):
@@ -131,6 +226,9 @@ async def root():
         "message": "Multi-Agent Orchestrator API",
         "endpoints": {
             "/query": "POST - Process a query through the orchestrator",
+            "/query/stream": "POST - Stream pipeline events (NDJSON)",
+            "/query/batch": "POST - Process many queries, results streamed as NDJSON",
+            "/sessions": "POST - Start a conversation session",
             "/health": "GET - Health check"
         }
     }
@@ -141,6 +239,14 @@ async def health_check():
     return {"status": "healthy"}
 
 
+@app.get("/metrics", response_class=PlainTextResponse, dependencies=[Depends(verify_api_key)])
+async def metrics():
+    """Метрики узлов графа и вызовов LLM в текстовом формате Prometheus"""
+    return PlainTextResponse(
+        metrics_registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 @app.get("/agents", dependencies=[Depends(verify_api_key)])
 async def get_agents():
     """Получить список всех агентов (требует аутентификацию)"""
@@ -169,49 +275,300 @@ async def update_agent(agent_id: str, agent_update: AgentUpdate):
             name=agent_update.name,
             description=agent_update.description,
             prompt=agent_update.prompt,
-            color=agent_update.color
+            color=agent_update.color,
+            expected_updated_at=agent_update.expected_updated_at
         )
         logger.info(f"Agent {agent_id} updated successfully")
         return updated_agent
+    except StorageConflictError as e:
+        logger.warning(f"Conflicting update of agent {agent_id}: {e}")
+        raise HTTPException(status_code=409, detail=str(e))
     except ValueError as e:
         logger.warning(f"Agent {agent_id} not found")
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
-        logger.error(f"Error updating agent {agent_id}: {str(e)}")
-        logger.debug(traceback.format_exc())
+        logger.opt(exception=e).error(f"Error updating agent {agent_id}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Ошибка обновления агента: {str(e)}")
 
 
 @app.post("/query", response_model=QueryResponse, dependencies=[Depends(verify_api_key)])
-@limiter.limit("10/minute")
-async def query_orchestrator(request: Request, query_request: QueryRequest):
+async def query_orchestrator(
+    query_request: QueryRequest,
+    response: Response,
+    client: str = Depends(rate_limit("query", RATE_LIMIT_QUERY)),
+    idempotency_key: Optional[str] = Header(None, min_length=1, max_length=IDEMPOTENCY_KEY_MAX_LENGTH)
+):
     logger.info(f"Processing query: {query_request.query[:100]}...")
+
+    def run():
+        return process_query(query_request.query, session_id=query_request.session_id)
+
     try:
-        result = await process_query(query_request.query)
+        with metered_tokens() as meter:
+            try:
+                if idempotency_key is None:
+                    result = await run()
+                else:
+                    # Повтор с тем же ключом ждёт исходный прогон или получает его результат;
+                    # ключи разных клиентов не пересекаются
+                    result, replayed = await get_idempotency_store().run(
+                        f"{client}\x1f{idempotency_key}",
+                        request_fingerprint(query_request.query, query_request.session_id),
+                        run,
+                    )
+                    if replayed:
+                        record_coalesced("idempotency")
+                        response.headers["Idempotent-Replayed"] = "true"
+            finally:
+                await get_rate_limiter().acharge(client, meter.tokens)
+        result = apply_verbosity(result, query_request.verbosity)
 
         logger.info(f"Query processed successfully. Route: {result.get('route')}, Iterations: {result.get('iteration_count')}")
 
         return QueryResponse(
             input=result["input"],
             route=result.get("route", "unknown"),
+            routes=result.get("routes"),
             agent_response=result.get("agent_response", ""),
             review_result=result.get("review_result", ""),
             context=result.get("context", ""),
             iteration_count=result.get("iteration_count", 0),
             log=result.get("log", []),
+            cached=result.get("cached", False),
+            coalesced=result.get("coalesced", False),
+            trace=result.get("trace"),
+            session_id=result.get("session_id"),
+            token_estimates=result.get("token_estimates"),
         )
 
+    except SessionNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except IdempotencyKeyReused as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except LLMUnavailableError as e:
+        logger.error(f"Error processing query: {e}")
+        raise HTTPException(status_code=503, detail=f"LLM недоступна: {e}")
+    except NoRouteError as e:
+        logger.error(f"Query not routed: {e}")
+        raise HTTPException(status_code=503, detail=str(e))
+    except TokenBudgetExceeded as e:
+        logger.warning(f"Query rejected: {e}")
+        raise HTTPException(status_code=413, detail=f"Промпт не укладывается в бюджет токенов: {e}")
     except Exception as e:
         error_msg = str(e)
-        full_traceback = traceback.format_exc()
-        logger.error(f"Error processing query: {error_msg}")
-        logger.error(f"Full traceback:\n{full_traceback}")
+        # Трассировку форматирует loguru одной записью, в файл её пишет фоновый поток
+        logger.opt(exception=e).error(f"Error processing query: {error_msg}")
         raise HTTPException(
             status_code=500,
             detail=f"Error processing query: {error_msg}"
         )
 
 
+@app.post("/query/stream", dependencies=[Depends(verify_api_key)])
+async def query_orchestrator_stream(
+    query_request: QueryRequest,
+    client: str = Depends(rate_limit("query_stream", RATE_LIMIT_QUERY))
+):
+    """
+    Потоковая обработка запроса: события пайплайна в формате NDJSON
+    (одна JSON-строка на событие), финальное событие — "final".
+    """
+    logger.info(f"Streaming query: {query_request.query[:100]}...")
+    session_id = query_request.session_id
+    if session_id and get_session_store().get(session_id) is None:
+        raise HTTPException(status_code=404, detail=f"Сессия {session_id} не найдена")
+
+    async def event_stream():
+        with metered_tokens() as meter:
+            try:
+                async for event in stream_query(query_request.query, session_id=session_id):
+                    if event["event"] == "final":
+                        result = apply_verbosity(event["result"], query_request.verbosity)
+                        event = {"event": "final", "result": result}
+                        logger.info(f"Stream finished. Route: {result.get('route')}, Iterations: {result.get('iteration_count')}")
+                    yield json.dumps(event, ensure_ascii=False) + "\n"
+            except Exception as e:
+                # Заголовки уже отправлены, поэтому ошибку сообщаем событием в потоке
+                logger.opt(exception=e).error(f"Error streaming query: {str(e)}")
+                yield json.dumps(
+                    {"event": "error", "detail": f"Error processing query: {str(e)}"},
+                    ensure_ascii=False
+                ) + "\n"
+            finally:
+                await get_rate_limiter().acharge(client, meter.tokens)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="application/x-ndjson",
+        # Отключаем буферизацию в nginx, чтобы токены доходили сразу
+        headers={"X-Accel-Buffering": "no", "Cache-Control": "no-cache"},
+    )
+
+
+@app.post("/query/batch", dependencies=[Depends(verify_api_key)])
+async def query_orchestrator_batch(
+    batch_request: BatchQueryRequest,
+    request: Request
+):
+    """
+    Пакетная обработка запросов с ограниченным параллелизмом.
+
+    Результаты приходят в формате NDJSON по мере готовности (поле index —
+    номер запроса в пачке), последнее событие — "done" со сводкой. Каждый
+    запрос пачки списывается из корзины RATE_LIMIT_BATCH; суточный бюджет
+    проверяется после каждого результата, и при его исчерпании пачка
+    прерывается.
+    """
+    queries = batch_request.queries
+    client = await asyncio.to_thread(
+        check_rate_limit, request, "query_batch", RATE_LIMIT_BATCH, len(queries)
+    )
+    limit = get_batch_concurrency()
+    concurrency = min(batch_request.concurrency or limit, limit)
+    logger.info(f"Processing batch of {len(queries)} queries, concurrency {concurrency}")
+
+    async def event_stream():
+        started = time.perf_counter()
+        failed = 0
+        charged = 0
+        limiter = get_rate_limiter()
+        batch = process_batch(queries, concurrency=concurrency)
+        with metered_tokens() as meter:
+            try:
+                async for item in batch:
+                    if "error" in item:
+                        failed += 1
+                        event = {
+                            "event": "error",
+                            "index": item["index"],
+                            "detail": f"Error processing query: {item['error']}",
+                        }
+                    else:
+                        event = {
+                            "event": "result",
+                            "index": item["index"],
+                            "result": apply_verbosity(item["result"], batch_request.verbosity),
+                        }
+                    yield json.dumps(event, ensure_ascii=False) + "\n"
+
+                    # Бюджет проверяется по ходу пачки: до её начала он мог
+                    # быть не исчерпан, а пачка потратить его многократно
+                    spent = meter.tokens - charged
+                    charged += spent
+                    await limiter.acharge(client, spent)
+                    try:
+                        await asyncio.to_thread(limiter.check_budget, client)
+                    except RateLimitExceeded as e:
+                        logger.warning(f"Batch for {client} stopped: {e.detail}")
+                        yield json.dumps({"event": "error", "detail": e.detail}, ensure_ascii=False) + "\n"
+                        return
+            except Exception as e:
+                logger.opt(exception=e).error(f"Error processing batch: {str(e)}")
+                yield json.dumps(
+                    {"event": "error", "detail": f"Error processing batch: {str(e)}"},
+                    ensure_ascii=False
+                ) + "\n"
+                return
+            finally:
+                # Останавливаем оставшиеся запросы до записи их токенов
+                await batch.aclose()
+                await limiter.acharge(client, meter.tokens - charged)
+
+        duration_ms = round((time.perf_counter() - started) * 1000, 1)
+        logger.info(f"Batch finished: {len(queries)} queries, {failed} failed, {duration_ms} ms")
+        yield json.dumps(
+            {"event": "done", "total": len(queries), "failed": failed, "duration_ms": duration_ms}
+        ) + "\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="application/x-ndjson",
+        headers={"X-Accel-Buffering": "no", "Cache-Control": "no-cache"},
+    )
+
+
+@app.post("/sessions", status_code=201, dependencies=[Depends(verify_api_key)])
+async def create_session():
+    """
+    Начинает сессию диалога. Её ID передаётся в session_id запросов /query
+    и /query/stream: прошлые ходы хранятся на сервере.
+    """
+    session = get_session_store().create()
+    logger.info(f"Session {session['id']} created")
+    return {"session_id": session["id"]}
+
+
+@app.get("/sessions/{session_id}", dependencies=[Depends(verify_api_key)])
+async def get_session(session_id: str):
+    """Ходы сессии, текущий маршрут и сводка вытесненных из окна ходов"""
+    store = get_session_store()
+    session = store.get(session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail=f"Сессия {session_id} не найдена")
+    return session_view(store, session)
+
+
+@app.delete("/sessions/{session_id}", status_code=204, dependencies=[Depends(verify_api_key)])
+async def delete_session(session_id: str):
+    """Удаляет сессию и её историю"""
+    if not get_session_store().delete(session_id):
+        raise HTTPException(status_code=404, detail=f"Сессия {session_id} не найдена")
+    logger.info(f"Session {session_id} deleted")
+
+
+@app.post("/jobs", status_code=202, dependencies=[Depends(verify_api_key)])
+async def submit_job(
+    query_request: QueryRequest,
+    client: str = Depends(rate_limit("jobs", RATE_LIMIT_QUERY))
+):
+    """
+    Ставит запрос в фоновую очередь и сразу возвращает ID задачи.
+    Результат забирается через GET /jobs/{job_id}.
+    """
+    session_id = query_request.session_id
+    if session_id and get_session_store().get(session_id) is None:
+        raise HTTPException(status_code=404, detail=f"Сессия {session_id} не найдена")
+
+    queue = get_job_queue()
+    try:
+        job = await queue.submit(query_request.query, query_request.verbosity, client, session_id)
+    except QueueFullError as e:
+        logger.warning(f"Job rejected: {e}")
+        raise HTTPException(status_code=503, detail=str(e))
+
+    logger.info(f"Job {job['id']} queued: {query_request.query[:100]}...")
+    return {"job_id": job["id"], "status": job["status"], "queue_depth": queue.depth}
+
+
+@app.get("/jobs", dependencies=[Depends(verify_api_key)])
+async def get_jobs_stats():
+    """Глубина очереди, занятость воркеров и число задач по статусам"""
+    return get_job_queue().stats()
+
+
+@app.get("/jobs/{job_id}", dependencies=[Depends(verify_api_key)])
+async def get_job(job_id: str):
+    """Статус, длительности и (для завершённой задачи) результат"""
+    job = get_job_queue().get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Задача {job_id} не найдена")
+    return job_view(job)
+
+
+@app.delete("/jobs/{job_id}", dependencies=[Depends(verify_api_key)])
+async def cancel_job(job_id: str):
+    """Отменяет ожидающую или выполняющуюся задачу"""
+    queue = get_job_queue()
+    job = queue.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Задача {job_id} не найдена")
+    if job["status"] in FINISHED_STATUSES or not queue.cancel(job_id):
+        raise HTTPException(status_code=409, detail=f"Задача {job_id} уже завершена")
+
+    logger.info(f"Job {job_id} cancelled")
+    return job_view(queue.get(job_id))
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
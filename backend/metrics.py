@@ -0,0 +1,397 @@
+"""
+Метрики пайплайна в формате Prometheus.
+
+Узлы графа и вызовы LLM замеряются на горячем пути: время выполнения,
+токены запроса/ответа из usage_metadata, повторные HTTP-запросы (ретраи
+openai-клиента) и обращения к кэшу ответов. Значения агрегируются в
+гистограммы и счётчики в памяти процесса и отдаются в текстовом формате
+Prometheus на /metrics.
+
+Запись одного наблюдения — поиск корзины bisect'ом и инкремент под
+блокировкой, поэтому инструментацию можно держать включённой в проде.
+METRICS_ENABLED=false отключает её полностью.
+"""
+
+import functools
+import inspect
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from pipeline_trace import token_usage
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+
+LabelValues = Tuple[str, ...]
+
+
+def metrics_enabled() -> bool:
+    return os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        # Последняя ячейка — значения больше верхней корзины (+Inf)
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+class MetricFamily:
+    """Метрика с набором меток; дочерние серии создаются по значениям меток"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+    def clear(self):
+        """Сбрасывает накопленные значения"""
+
+
+class Counter(MetricFamily):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [
+            f"{self.name}{_format_labels(self.label_names, key)} {_format_number(value)}"
+            for key, value in items
+        ]
+
+
+class Histogram(MetricFamily):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS
+    ):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[LabelValues, _Histogram] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _Histogram(self.buckets)
+            series.counts[index] += 1
+            series.sum += value
+            series.count += 1
+
+    def snapshot(self, **labels) -> Optional[Tuple[int, float]]:
+        """(count, sum) серии или None"""
+        series = self._series.get(self._key(labels))
+        return (series.count, series.sum) if series else None
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = [
+                (key, list(series.counts), series.sum, series.count)
+                for key, series in sorted(self._series.items())
+            ]
+
+        lines = []
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, float("inf")), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_number(bound)}"'
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}"
+                )
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {_format_number(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Gauge(MetricFamily):
+    """Значение, вычисляемое в момент выгрузки (например, глубина очереди)"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, getter: Callable[[], float]):
+        super().__init__(name, documentation)
+        self.getter = getter
+
+    def render(self) -> List[str]:
+        return [f"{self.name} {_format_number(self.getter())}"]
+
+
+class MetricsRegistry:
+    """Набор метрик процесса"""
+
+    def __init__(self):
+        self._metrics: Dict[str, MetricFamily] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: MetricFamily) -> MetricFamily:
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, label_names))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def gauge(self, name: str, documentation: str, getter: Callable[[], float]) -> Gauge:
+        return self.register(Gauge(name, documentation, getter))
+
+    def clear(self):
+        """Сбрасывает значения всех метрик (тесты, бенчмарки)"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            metric.clear()
+
+    def render(self) -> str:
+        """Текстовый формат Prometheus (version 0.0.4)"""
+        with self._lock:
+            metrics: Iterable[MetricFamily] = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+NODE_DURATION = registry.histogram(
+    "orchestra_node_duration_seconds", "Время выполнения узла графа", ("node",)
+)
+LLM_DURATION = registry.histogram(
+    "orchestra_llm_call_duration_seconds", "Время вызова LLM", ("node", "agent")
+)
+LLM_PROMPT_TOKENS = registry.histogram(
+    "orchestra_llm_prompt_tokens", "Токены запроса к LLM", ("node", "agent"), TOKEN_BUCKETS
+)
+LLM_COMPLETION_TOKENS = registry.histogram(
+    "orchestra_llm_completion_tokens", "Токены ответа LLM", ("node", "agent"), TOKEN_BUCKETS
+)
+LLM_RETRIES = registry.counter(
+    "orchestra_llm_retries_total", "Повторные HTTP-запросы к LLM-провайдеру", ("node", "agent")
+)
+LLM_ERRORS = registry.counter(
+    "orchestra_llm_errors_total", "Вызовы LLM, завершившиеся ошибкой", ("node", "agent")
+)
+CACHE_LOOKUPS = registry.counter(
+    "orchestra_response_cache_lookups_total", "Обращения к кэшу ответов", ("result",)
+)
+SEMANTIC_CACHE_LOOKUPS = registry.counter(
+    "orchestra_semantic_cache_lookups_total", "Обращения к семантическому кэшу ответов", ("result",)
+)
+QUERY_COALESCED = registry.counter(
+    "orchestra_query_coalesced_total",
+    "Запросы, получившие результат чужого прогона графа",
+    ("source",),
+)
+QUERY_DURATION = registry.histogram(
+    "orchestra_query_duration_seconds", "Полное время обработки запроса", ("cached",)
+)
+
+
+class _LLMCall:
+    """Состояние текущего вызова LLM (для подсчёта HTTP-попыток)"""
+    __slots__ = ("attempts",)
+
+    def __init__(self):
+        self.attempts = 0
+
+
+# Вызов LLM, выполняемый в текущей задаче asyncio
+_current_call: ContextVar[Optional[_LLMCall]] = ContextVar("llm_call", default=None)
+
+
+def count_http_request(request=None):
+    """event hook httpx: каждая HTTP-попытка внутри вызова LLM"""
+    call = _current_call.get()
+    if call is not None:
+        call.attempts += 1
+
+
+async def count_http_request_async(request=None):
+    count_http_request(request)
+
+
+class TokenMeter:
+    """Сумма токенов вызовов LLM в рамках одного запроса API (квоты rate_limits)"""
+    __slots__ = ("tokens",)
+
+    def __init__(self):
+        self.tokens = 0
+
+
+# Счётчик токенов текущего запроса API; узлы графа наследуют его через контекст
+_token_meter: ContextVar[Optional[TokenMeter]] = ContextVar("token_meter", default=None)
+
+
+@contextmanager
+def metered_tokens():
+    """Считает prompt + completion токены всех вызовов LLM внутри блока"""
+    meter = TokenMeter()
+    token = _token_meter.set(meter)
+    try:
+        yield meter
+    finally:
+        try:
+            _token_meter.reset(token)
+        except ValueError:
+            # Потоковый ответ закрыт из другого контекста (обрыв соединения)
+            _token_meter.set(None)
+
+
+def _meter_usage(usage: Dict[str, int]):
+    meter = _token_meter.get()
+    if meter is not None:
+        meter.tokens += usage.get("prompt_tokens", 0) + usage.get("completion_tokens", 0)
+
+
+async def ainvoke_llm(llm, messages, node: str, agent: str = "", **kwargs):
+    """
+    llm.ainvoke с записью метрик: время, токены и ретраи (число HTTP-попыток
+    сверх первой, если вызов шёл через общий пул llm_client).
+    """
+    if not metrics_enabled():
+        response = await llm.ainvoke(messages, **kwargs)
+        _meter_usage(token_usage(response))
+        return response
+
+    call = _LLMCall()
+    token = _current_call.set(call)
+    started = time.perf_counter()
+    try:
+        response = await llm.ainvoke(messages, **kwargs)
+    except Exception:
+        LLM_ERRORS.inc(node=node, agent=agent)
+        raise
+    finally:
+        _current_call.reset(token)
+        LLM_DURATION.observe(time.perf_counter() - started, node=node, agent=agent)
+        if call.attempts > 1:
+            LLM_RETRIES.inc(call.attempts - 1, node=node, agent=agent)
+
+    usage = token_usage(response)
+    _meter_usage(usage)
+    if "prompt_tokens" in usage:
+        LLM_PROMPT_TOKENS.observe(usage["prompt_tokens"], node=node, agent=agent)
+    if "completion_tokens" in usage:
+        LLM_COMPLETION_TOKENS.observe(usage["completion_tokens"], node=node, agent=agent)
+    return response
+
+
+def instrument_node(name: str, func: Callable) -> Callable:
+    """Оборачивает узел графа замером времени выполнения"""
+    if not metrics_enabled():
+        return func
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_node(state):
+            started = time.perf_counter()
+            try:
+                return await func(state)
+            finally:
+                NODE_DURATION.observe(time.perf_counter() - started, node=name)
+        return async_node
+
+    @functools.wraps(func)
+    def node(state):
+        started = time.perf_counter()
+        try:
+            return func(state)
+        finally:
+            NODE_DURATION.observe(time.perf_counter() - started, node=name)
+    return node
+
+
+def record_cache_lookup(hit: bool):
+    if metrics_enabled():
+        CACHE_LOOKUPS.inc(result="hit" if hit else "miss")
+
+
+def record_semantic_cache_lookup(hit: bool):
+    if metrics_enabled():
+        SEMANTIC_CACHE_LOOKUPS.inc(result="hit" if hit else "miss")
+
+
+def record_coalesced(source: str):
+    """source: inflight — одинаковый запрос уже выполнялся, idempotency — повтор по ключу"""
+    if metrics_enabled():
+        QUERY_COALESCED.inc(source=source)
+
+
+def record_query(duration_seconds: float, cached: bool):
+    if metrics_enabled():
+        QUERY_DURATION.observe(duration_seconds, cached=str(cached).lower())
@@ -1,194 +1,418 @@
+import asyncio
 import os
+import threading
+import time
+from dataclasses import replace
 from pathlib import Path
-from typing import TypedDict, Literal, Optional, List
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage, SystemMessage
-from langgraph.graph import StateGraph, END
+from typing import AsyncIterator, Dict, TypedDict, Literal, Optional, List, Sequence, Tuple
 from dotenv import load_dotenv
+import pipeline_trace as trace
+from metrics import (
+    ainvoke_llm, instrument_node, record_cache_lookup, record_coalesced, record_query,
+    record_semantic_cache_lookup
+)
 from agents_storage import get_storage
+from llm_client import get_llm_factory
+from llm_providers import Provider, ProviderChain, get_provider_settings
+from logging_setup import log_payload
+from response_cache import get_response_cache
+from semantic_cache import get_semantic_cache
+from single_flight import coalescing_key, get_single_flight
+from token_budget import get_token_budget
+from review_policy import get_review_policy
+from sessions import SessionNotFoundError, get_session_store, render_history
+from router import (
+    DEFAULT_MARGIN_THRESHOLD, DEFAULT_SHORTLIST_K, HybridRouter, LLMRouter, LocalRouter, NoRouteError,
+    RouteDecision, ShortlistRouter, load_examples
+)
 from loguru import logger
 
 # Явно указываем путь к .env файлу (работает и при запуске через systemd)
 env_path = Path(__file__).parent / ".env"
 load_dotenv(dotenv_path=env_path)
 
-# Проверяем что ключевые переменные загружены
-_openrouter_key = os.getenv("OPENROUTER_API_KEY")
-_model_name = os.getenv("MODEL_NAME", "openai/gpt-4o")
+# langchain_core, langgraph и langchain_openai импортируются при первом
+# запросе (или в warm_up()): /health, /agents и сбор тестов их не загружают
 
-if not _openrouter_key:
-    logger.error(f"❌ OPENROUTER_API_KEY not found! Checked .env at: {env_path}")
-    logger.error(f"   Current working directory: {os.getcwd()}")
-    logger.error(f"   .env file exists: {env_path.exists()}")
-else:
-    logger.info(f"✅ OpenRouter API key loaded (first 20 chars): {_openrouter_key[:20]}...")
-    logger.info(f"✅ Model: {_model_name}")
+
+def check_llm_config():
+    """Проверяет, что ключ провайдера задан (сам ключ в лог не попадает)"""
+    if not os.getenv("OPENROUTER_API_KEY"):
+        logger.error(f"❌ OPENROUTER_API_KEY not found! Checked .env at: {env_path}")
+        logger.error(f"   Current working directory: {os.getcwd()}")
+        logger.error(f"   .env file exists: {env_path.exists()}")
+    else:
+        logger.info(f"✅ OpenRouter API key configured, model: {get_model_name()}")
 
 
 class AgentState(TypedDict):
     input: str
     route: Optional[str]
+    # Все выбранные агенты; больше одного — режим fan-out
+    routes: Optional[List[str]]
     agent_response: Optional[str]
+    # Ответы отдельных агентов в режиме fan-out (до объединения)
+    agent_responses: Optional[Dict[str, str]]
     review_result: Optional[str]
     revised_instructions: Optional[str]
     context: Optional[str]
     iteration_count: int
-    # Подробные человекочитаемые шаги выполнения пайплайна
-    log: List[str]
+    # Структурированная трасса выполнения пайплайна (см. pipeline_trace)
+    trace: List[trace.TraceEvent]
+    # Маршрут, выбранный заранее (пакетная маршрутизация, продолжение сессии)
+    route_decision: Optional[RouteDecision]
+    # Сжатая история сессии диалога (см. sessions)
+    history: Optional[str]
+
+
+# Узлы параллельного вызова нескольких агентов и объединения их ответов
+FANOUT_NODE = "fanout"
+MERGE_NODE = "merge"
 
 
-def get_llm():
+def get_model_name() -> str:
+    return os.getenv("MODEL_NAME", "openai/gpt-4o")
+
+
+def get_llm(temperature: float = 0.7, model: Optional[str] = None, node: str = "agent"):
     """
-    Создаём LLM-клиент для OpenRouter с учётом новой архитектуры langchain-openai.
+    Возвращает LLM для узла графа node: цепочку провайдеров с таймаутом
+    узла, повторами и резервными моделями (см. llm_providers). model
+    заменяет основную модель (MODEL_NAME), резервные остаются из LLM_FALLBACKS.
 
-    В актуальных версиях используются аргументы api_key / base_url / model,
-    а не openai_api_key / openai_api_base / model_name.
+    Клиенты провайдеров берутся из общей фабрики: они кэшируются и разделяют
+    keep-alive пул соединений, поэтому узлы графа не открывают новое
+    соединение на каждый вызов.
     """
+    settings = get_provider_settings()
+    if model and model != settings.providers[0].model:
+        settings = replace(
+            settings, providers=(replace(settings.providers[0], model=model), *settings.providers[1:])
+        )
 
-    return ChatOpenAI(
-        api_key=os.getenv("OPENROUTER_API_KEY"),
-        base_url="https://openrouter.ai/api/v1",
-        model=os.getenv("MODEL_NAME", "openai/gpt-4o"),
-        temperature=0.7,
-    )
+    def client_for(provider: Provider):
+        return get_llm_factory().get(
+            model=provider.model,
+            temperature=temperature,
+            base_url=provider.base_url,
+            api_key=os.getenv(provider.api_key_env),
+            # Повторы с джиттером делает цепочка в пределах таймаута узла
+            max_retries=0,
+        )
 
+    # Запись, воспроизведение или заглушки вместо живых вызовов (см. llm_transport)
+    if (os.getenv("LLM_TRANSPORT") or "live") != "live":
+        from llm_transport import get_transport
 
-def get_mini_agents_prompts():
-    """Получает промпты агентов из хранилища"""
-    return get_storage().get_prompts_dict()
+        client_for = get_transport().wrap(client_for, temperature, node)
 
+    return ProviderChain(settings, client_for, node=node)
 
-# Кэш для промптов (обновляется при каждом запросе)
-MINI_AGENTS_PROMPTS = get_mini_agents_prompts()
 
+# Закэшированный маршрутизатор и параметры, из которых он собран
+_router = None
+_router_key: Optional[tuple] = None
+_local_router: Optional[LocalRouter] = None
+_local_router_key: Optional[tuple] = None
 
-def route_question(state: AgentState) -> AgentState:
-    state.setdefault("log", [])
-    state["log"].append(
-        "🔹 Оркестратор: анализируем запрос и выбираем агента...\n"
-        f"   Входной запрос пользователя:\n"
-        f"   {state['input']}"
-    )
 
-    llm = get_llm()
+def get_local_router() -> LocalRouter:
+    """
+    Локальный классификатор по текущим агентам и ROUTER_EXAMPLES_PATH.
 
-    # Динамически загружаем описания агентов из хранилища
-    storage = get_storage()
-    agents = storage.get_all()
+    Используется маршрутизатором в режимах hybrid/local и для определения
+    смены темы в сессии; пересобирается при изменении меню агентов.
+    """
+    global _local_router, _local_router_key
 
-    # Формируем список агентов для промпта
-    agents_list = "\n".join([
-        f"- {agent['id']}: {agent['name']} - {agent['description']}"
-        for agent in agents
-    ])
+    examples_path = os.getenv("ROUTER_EXAMPLES_PATH")
+    snapshot = get_storage().snapshot()
+    key = (examples_path, snapshot.routing_menu)
+    if _local_router is None or key != _local_router_key:
+        _local_router = LocalRouter(snapshot.agents, examples=load_examples(examples_path))
+        _local_router_key = key
+    return _local_router
 
-    # Формируем список ID агентов для валидации
-    valid_agent_ids = ", ".join([agent['id'] for agent in agents])
 
-    routing_prompt = f"""Вы оркестратор-маршрутизатор. Проанализируйте запрос пользователя и определите,
-к какому из следующих агентов его направить:
+def get_router():
+    """
+    Возвращает маршрутизатор согласно ROUTER_MODE:
 
-{agents_list}
+    - llm (по умолчанию): агент выбирается вызовом LLM
+    - hybrid: локальный классификатор, LLM только если отрыв лучшего агента
+      меньше ROUTER_MARGIN_THRESHOLD
+    - local: только локальный классификатор
 
-Запрос пользователя: {state["input"]}
+    ROUTER_MAX_AGENTS > 1 включает режим fan-out: LLM может направить запрос
+    нескольким агентам сразу.
 
-Ответьте только ID агента ({valid_agent_ids}) без дополнительных пояснений."""
+    Если агентов больше ROUTER_SHORTLIST_K (0 — выключено), LLM в режимах
+    llm/hybrid выбирает только среди шорт-листа локального классификатора
+    (ShortlistRouter).
+
+    Локальный классификатор пересобирается при изменении имён/описаний
+    агентов, пути к размеченным примерам (ROUTER_EXAMPLES_PATH) или порога.
+    """
+    global _router, _router_key
+
+    mode = os.getenv("ROUTER_MODE", "llm").lower()
+    threshold = float(os.getenv("ROUTER_MARGIN_THRESHOLD", DEFAULT_MARGIN_THRESHOLD))
+    examples_path = os.getenv("ROUTER_EXAMPLES_PATH")
+    max_agents = max(1, int(os.getenv("ROUTER_MAX_AGENTS", 1)))
+    shortlist_k = int(os.getenv("ROUTER_SHORTLIST_K", DEFAULT_SHORTLIST_K))
+    if shortlist_k > 0:
+        # В шорт-листе должно хватать агентов для fan-out
+        shortlist_k = max(shortlist_k, max_agents)
+    snapshot = get_storage().snapshot()
+    shortlisted = mode in ("llm", "hybrid") and 0 < shortlist_k < len(snapshot.agents)
+    # Меню агентов меняется вместе с их id, именами и описаниями
+    agents_menu = snapshot.routing_menu if mode in ("hybrid", "local") or shortlisted else ""
+
+    key = (mode, threshold, examples_path, max_agents, shortlist_k, shortlisted, agents_menu)
+    if _router is not None and key == _router_key:
+        return _router
+
+    llm_router = LLMRouter(
+        llm_factory=lambda: get_llm(node="orchestrator"),
+        agents_provider=lambda: get_storage().snapshot(),
+        max_agents=max_agents,
+    )
+    if shortlisted:
+        llm_router = ShortlistRouter(get_local_router(), llm_router, shortlist_k)
+        logger.info(f"Two-stage routing: LLM picks among top {shortlist_k} of {len(snapshot.agents)} agents")
+    if mode in ("hybrid", "local"):
+        local = get_local_router()
+        _router = local if mode == "local" else HybridRouter(local, llm_router, threshold)
+        logger.info(f"Built {mode} router for {len(snapshot.agents)} agents")
+    else:
+        _router = llm_router
+    _router_key = key
+    return _router
 
-    messages = [
-        SystemMessage(content="Вы оркестратор-маршрутизатор запросов."),
-        HumanMessage(content=routing_prompt)
-    ]
 
-    response = llm.invoke(messages)
-    raw_route = response.content.strip()
-    route = raw_route.lower()
+async def route_question(state: AgentState) -> AgentState:
+    state.setdefault("trace", [])
 
-    # Валидация: проверяем, что выбранный агент существует
-    current_prompts = get_mini_agents_prompts()
-    if route not in current_prompts:
-        # Если агент не найден, выбираем первого доступного (fallback)
-        route = list(current_prompts.keys())[0] if current_prompts else "agent1"
+    started = time.perf_counter()
+    decision = state.get("route_decision")
+    preset = decision is not None
+    if not preset:
+        decision = await get_router().route(state["input"])
+    duration_ms = (time.perf_counter() - started) * 1000
+    route = decision.route
+    if route is None:
+        # ROUTER_MODE=local без агентов: подставлять несуществующего агента нельзя
+        raise NoRouteError("Каталог агентов пуст: запрос некому направить")
 
     # Находим информацию о выбранном агенте для логирования
-    selected_agent = next((a for a in agents if a['id'] == route), None)
-    agent_info = f"{selected_agent['name']} ({route})" if selected_agent else route
+    agent_name = get_storage().snapshot().names.get(route)
+    agent_info = f"{agent_name} ({route})" if agent_name else route
+
+    if decision.source == "local":
+        message = "✅ Оркестратор: Локальный классификатор выбрал агента, LLM не вызывалась"
+    elif decision.source == "session":
+        message = "✅ Оркестратор: продолжение диалога, маршрут сессии сохранён"
+    elif preset:
+        message = "✅ Оркестратор: маршрут выбран пакетной маршрутизацией"
+    else:
+        message = "✅ Оркестратор: принял решение о маршрутизации"
 
     state["route"] = route
-    state["context"] = f"Запрос направлен к {route}"
-    state["log"].append(
-        "✅ Оркестратор: принял решение о маршрутизации\n"
-        f"   Ответ LLM (сырое значение): {raw_route}\n"
-        f"   Выбранный агент: {agent_info}"
-    )
+    state["routes"] = decision.routes
+    state["context"] = f"Запрос направлен к {', '.join(decision.routes)}"
+    state["trace"].append(trace.event(
+        "orchestrator", "route", message,
+        duration_ms=duration_ms,
+        usage=decision.usage,
+        estimate=decision.estimate,
+        agent=agent_info,
+        routes=decision.routes if len(decision.routes) > 1 else None,
+        source=decision.source,
+        batched=(preset and decision.source != "session") or None,
+        margin=decision.margin,
+        shortlist=decision.shortlist or None,
+        raw=trace.truncate(decision.raw),
+    ))
 
     return state
 
 
-def mini_agent_node(agent_name: str):
-    def node_function(state: AgentState) -> AgentState:
-        # Обновляем промпты из хранилища при каждом запросе
-        current_prompts = get_mini_agents_prompts()
-
-        state.setdefault("log", [])
-        state["log"].append(
-            f"🔹 Агент {agent_name}: получен запрос на обработку\n"
-            f"   Системный промпт:\n"
-            f"   {current_prompts[agent_name]}\n"
-            f"   Запрос пользователя (c учётом доработок, если есть):"
+def previous_draft(agent_id: str, state: AgentState) -> Optional[str]:
+    """Черновик агента для доработки в режиме REVIEW_REVISION_MODE=delta"""
+    if get_review_policy().revision_mode != "delta" or not state.get("iteration_count"):
+        return None
+    responses = state.get("agent_responses")
+    if responses:
+        return responses.get(agent_id)
+    return state.get("agent_response")
+
+
+# Порядок сокращения частей промпта, если он не влезает в бюджет узла
+AGENT_TRIM_ORDER = (
+    ("history", "oldest_lines"),
+    ("draft", "middle"),
+    ("revised_instructions", "end"),
+    ("input", "end"),
+)
+REVIEW_TRIM_ORDER = (
+    ("history", "oldest_lines"),
+    ("agent_response", "middle"),
+    ("input", "end"),
+)
+
+
+def agent_user_message(parts: Dict[str, str]) -> str:
+    """Сообщение агенту: запрос, история сессии, черновик и замечания ревьюера"""
+    user_query = parts["input"]
+
+    # В сессии агент получает сжатую историю, а не полную переписку
+    if parts["history"]:
+        user_query = f"История диалога:\n{parts['history']}\n\nТекущий запрос: {user_query}"
+
+    if parts["revised_instructions"] and parts["draft"]:
+        # Доработка по замечаниям: агент правит свой черновик, а не пишет заново
+        user_query = (
+            f"{user_query}\n\nВаш предыдущий ответ:\n{parts['draft']}\n\n"
+            f"Исправьте его по замечаниям ревьюера и верните полный исправленный ответ: "
+            f"{parts['revised_instructions']}"
         )
+    elif parts["revised_instructions"]:
+        user_query = f"{user_query}\n\nДополнительные инструкции от ревьюера: {parts['revised_instructions']}"
+    return user_query
+
+
+async def run_agent(agent_id: str, state: AgentState) -> Tuple[str, trace.TraceEvent]:
+    """Вызывает агента для текущего состояния; возвращает ответ и событие трассы"""
+    # Промпт берём из актуального среза хранилища (правки применяются сразу)
+    snapshot = get_storage().snapshot()
+    system_prompt = snapshot.prompts[agent_id]
+    draft = previous_draft(agent_id, state)
+
+    # Промпт укладывается в бюджет агента до вызова LLM (см. token_budget)
+    prompt = get_token_budget().fit(
+        "agent",
+        lambda parts: [system_prompt, agent_user_message(parts)],
+        {
+            "input": state["input"],
+            "history": state.get("history") or "",
+            "draft": draft or "",
+            "revised_instructions": state.get("revised_instructions") or "",
+        },
+        AGENT_TRIM_ORDER,
+    )
 
-        llm = get_llm()
+    from langchain_core.messages import HumanMessage, SystemMessage
 
-        system_prompt = current_prompts[agent_name]
-        user_query = state["input"]
+    messages = [
+        SystemMessage(content=system_prompt),
+        HumanMessage(content=prompt.texts[1])
+    ]
 
-        if state.get("revised_instructions"):
-            user_query = f"{user_query}\n\nДополнительные инструкции от ревьюера: {state['revised_instructions']}"
+    llm = get_llm()
 
-        messages = [
-            SystemMessage(content=system_prompt),
-            HumanMessage(content=user_query)
-        ]
+    started = time.perf_counter()
+    # metadata.agent позволяет stream_query отличить токены агентов в fan-out
+    response = await ainvoke_llm(
+        llm, messages, node="agent", agent=agent_id, config={"metadata": {"agent": agent_id}},
+        **prompt.llm_kwargs
+    )
+    duration_ms = (time.perf_counter() - started) * 1000
+    log_payload(f"Agent {agent_id} response", response.content)
+
+    event = trace.event(
+        agent_id, "agent", f"✅ Агент {agent_id}: сформировал ответ",
+        duration_ms=duration_ms,
+        usage=trace.token_usage(response),
+        estimate=prompt.estimate,
+        # Крупные тексты — ссылками на хранилище и поля состояния
+        system_prompt=trace.ref(
+            f"agents/{agent_id}/prompt", system_prompt, version=snapshot.prompt_versions[agent_id]
+        ),
+        user_query=trace.ref("input", state["input"]),
+        history=trace.ref("history", state["history"]) if state.get("history") else None,
+        revised_instructions=trace.truncate(state.get("revised_instructions")),
+        draft=trace.ref("agent_response", draft) if draft else None,
+        response=trace.truncate(response.content),
+    )
+    return response.content, event
 
-        state["log"].append(f"   Итоговый текст, отправленный агенту:\n{user_query}")
 
-        response = llm.invoke(messages)
-        state["agent_response"] = response.content
+def mini_agent_node(agent_name: str):
+    async def node_function(state: AgentState) -> AgentState:
+        state.setdefault("trace", [])
+
+        content, event = await run_agent(agent_name, state)
+
+        state["agent_response"] = content
         state["context"] = f"{state.get('context', '')}\nОтвет получен от {agent_name}"
-        state["log"].append(
-            f"✅ Агент {agent_name}: сформировал ответ\n"
-            f"   Ответ агента:\n"
-            f"   {state['agent_response']}"
-        )
+        state["trace"].append(event)
 
         return state
 
     return node_function
 
 
-def review_result(state: AgentState) -> AgentState:
-    state.setdefault("log", [])
-    state["log"].append(
-        "🔹 Ревьюер: проверяем качество ответа агента\n"
-        f"   Запрос пользователя:\n"
-        f"   {state['input']}\n"
-        "   Ответ агента для проверки:\n"
-        f"   {state.get('agent_response', '')}"
+async def fanout_agents(state: AgentState) -> AgentState:
+    """
+    Параллельно вызывает всех выбранных агентов (режим fan-out).
+
+    Время шага определяется самым медленным агентом, а не суммой.
+    """
+    state.setdefault("trace", [])
+    routes = state["routes"]
+
+    results = await asyncio.gather(*(run_agent(agent_id, state) for agent_id in routes))
+
+    state["agent_responses"] = {
+        agent_id: content for agent_id, (content, _) in zip(routes, results)
+    }
+    state["context"] = f"{state.get('context', '')}\nОтветы получены от {', '.join(routes)}"
+    state["trace"].extend(event for _, event in results)
+
+    return state
+
+
+def merge_responses(state: AgentState) -> AgentState:
+    """Объединяет ответы агентов fan-out в один ответ для ревью"""
+    state.setdefault("trace", [])
+    names = get_storage().snapshot().names
+    responses = state.get("agent_responses") or {}
+
+    state["agent_response"] = "\n\n".join(
+        f"## {names.get(agent_id, agent_id)} ({agent_id})\n\n{content}"
+        for agent_id, content in responses.items()
     )
+    state["trace"].append(trace.event(
+        MERGE_NODE, "merge", f"🧩 Ответы агентов объединены: {', '.join(responses)}",
+        response=trace.truncate(state["agent_response"]),
+    ))
 
-    llm = get_llm()
+    return state
 
-    max_iterations = 2
-    if state.get("iteration_count", 0) >= max_iterations:
-        state["review_result"] = "approved"
-        state["log"].append("ℹ️ Достигнут лимит итераций, ответ принудительно одобрен")
-        return state
 
-    review_prompt = f"""Вы ревьюер. Проверьте ответ агента на соответствие запросу пользователя.
+PRECHECK_MESSAGES = {
+    "skip": "ℹ️ Ревью для агента отключено, ответ одобрен",
+    "too_short": "⚠️ Ревьюер: ответ слишком короткий, требуется доработка",
+    "missing_sections": "⚠️ Ревьюер: нет обязательных разделов, требуется доработка",
+    "short_answer": "✅ Ревьюер: короткий ответ одобрен без проверки LLM",
+    "sampled_out": "✅ Ревьюер: ответ не попал в выборку для проверки, одобрен",
+}
+
+
+REVIEWER_SYSTEM_PROMPT = "Вы ревьюер ответов агентов."
+
+
+def review_prompt(parts: Dict[str, str]) -> str:
+    """Промпт ревьюера: запрос, ответ агента и история сессии"""
+    history = ""
+    if parts["history"]:
+        history = f"История диалога:\n{parts['history']}\n\n"
+
+    return f"""Вы ревьюер. Проверьте ответ агента на соответствие запросу пользователя.
 
-Запрос пользователя: {state["input"]}
+{history}Запрос пользователя: {parts["input"]}
 
-Ответ агента: {state["agent_response"]}
+Ответ агента: {parts["agent_response"]}
 
 Оцените ответ:
 - Если ответ полный, правильный и соответствует запросу, ответьте "approved"
@@ -196,25 +420,82 @@ def review_result(state: AgentState) -> AgentState:
 
 Формат ответа: <статус>|<комментарий если нужна доработка>"""
 
+
+async def review_result(state: AgentState) -> AgentState:
+    state.setdefault("trace", [])
+    policy = get_review_policy()
+
+    if state.get("iteration_count", 0) >= policy.max_iterations:
+        state["review_result"] = "approved"
+        state["trace"].append(trace.event(
+            "review", "review", "ℹ️ Достигнут лимит итераций, ответ принудительно одобрен",
+            verdict="approved",
+        ))
+        return state
+
+    # Дешёвые проверки до вызова LLM (см. review_policy)
+    routes = state.get("routes") or [state.get("route")]
+    verdict = policy.precheck(state["input"], routes, state.get("agent_response") or "")
+    if verdict is not None:
+        state["review_result"] = verdict.review_result
+        if verdict.revised_instructions:
+            state["revised_instructions"] = verdict.revised_instructions
+        state["context"] = f"{state.get('context', '')}\nРевью: {state['review_result']}"
+        state["trace"].append(trace.event(
+            "review", "review", PRECHECK_MESSAGES[verdict.reason],
+            verdict=verdict.review_result,
+            source="heuristic",
+            reason=verdict.reason,
+            comment=verdict.revised_instructions,
+        ))
+        return state
+
+    llm = get_llm(model=policy.model, node="review")
+
+    prompt = get_token_budget().fit(
+        "review",
+        lambda parts: [REVIEWER_SYSTEM_PROMPT, review_prompt(parts)],
+        {
+            "input": state["input"],
+            "history": state.get("history") or "",
+            "agent_response": state["agent_response"] or "",
+        },
+        REVIEW_TRIM_ORDER,
+    )
+
+    from langchain_core.messages import HumanMessage, SystemMessage
+
     messages = [
-        SystemMessage(content="Вы ревьюер ответов агентов."),
-        HumanMessage(content=review_prompt)
+        SystemMessage(content=REVIEWER_SYSTEM_PROMPT),
+        HumanMessage(content=prompt.texts[1])
     ]
 
-    response = llm.invoke(messages)
+    started = time.perf_counter()
+    response = await ainvoke_llm(llm, messages, node="review", **prompt.llm_kwargs)
+    duration_ms = (time.perf_counter() - started) * 1000
+    log_payload("Review verdict", response.content)
     result_parts = response.content.strip().split("|", 1)
 
     state["review_result"] = result_parts[0].strip().lower()
 
     if state["review_result"] == "needs_revision" and len(result_parts) > 1:
         state["revised_instructions"] = result_parts[1].strip()
-        state["log"].append(
-            f"⚠️ Ревьюер: требуется доработка — {state['revised_instructions']}"
-        )
+        message = "⚠️ Ревьюер: требуется доработка"
     else:
-        state["log"].append("✅ Ревьюер: ответ одобрен")
+        message = "✅ Ревьюер: ответ одобрен"
 
     state["context"] = f"{state.get('context', '')}\nРевью: {state['review_result']}"
+    state["trace"].append(trace.event(
+        "review", "review", message,
+        duration_ms=duration_ms,
+        usage=trace.token_usage(response),
+        estimate=prompt.estimate,
+        verdict=state["review_result"],
+        model=policy.model,
+        agent_response=trace.ref("agent_response", state["agent_response"]),
+        comment=trace.truncate(state.get("revised_instructions"))
+        if state["review_result"] == "needs_revision" else None,
+    ))
 
     return state
 
@@ -222,16 +503,18 @@ def review_result(state: AgentState) -> AgentState:
 def revise_task(state: AgentState) -> AgentState:
     state["iteration_count"] = state.get("iteration_count", 0) + 1
     state["context"] = f"{state.get('context', '')}\nИтерация доработки: {state['iteration_count']}"
-    state.setdefault("log", [])
-    state["log"].append(f"🔁 Итерация доработки: #{state['iteration_count']}")
+    state.setdefault("trace", [])
+    state["trace"].append(trace.event(
+        "revise", "revision", f"🔁 Итерация доработки: #{state['iteration_count']}"
+    ))
     return state
 
 
 def final_answer(state: AgentState) -> AgentState:
-    state.setdefault("log", [])
-    state["log"].append("🏁 Финальный ответ сформирован и готов к отправке пользователю")
-    # Дублируем полный путь запроса в context, чтобы его можно было увидеть как сырой текст
-    state["context"] = "\n".join(state["log"])
+    state.setdefault("trace", [])
+    state["trace"].append(trace.event(
+        "final", "final", "🏁 Финальный ответ сформирован и готов к отправке пользователю"
+    ))
     return state
 
 
@@ -242,38 +525,55 @@ def should_revise(state: AgentState) -> Literal["revise", "final"]:
 
 
 def route_to_agent(state: AgentState) -> str:
-    return state.get("route", "agent5")
+    if len(state.get("routes") or []) > 1:
+        return FANOUT_NODE
+    route = state.get("route")
+    if route:
+        return route
+    # Маршрут не определён — отдаём первому агенту из хранилища
+    agent_ids = get_storage().snapshot().agent_ids
+    return agent_ids[0] if agent_ids else "agent1"
+
 
+def create_workflow(agent_ids: Optional[Sequence[str]] = None):
+    """
+    Собирает и компилирует граф для заданного набора агентов.
+
+    По умолчанию набор берётся из хранилища. Промпты в граф не зашиваются —
+    узлы читают их из хранилища при выполнении, поэтому граф зависит только
+    от списка ID агентов.
+    """
+    from langgraph.graph import StateGraph, END
+
+    if agent_ids is None:
+        agent_ids = get_storage().snapshot().agent_ids
 
-def create_workflow():
     workflow = StateGraph(AgentState)
 
-    workflow.add_node("orchestrator", route_question)
-    workflow.add_node("agent1", mini_agent_node("agent1"))
-    workflow.add_node("agent2", mini_agent_node("agent2"))
-    workflow.add_node("agent3", mini_agent_node("agent3"))
-    workflow.add_node("agent4", mini_agent_node("agent4"))
-    workflow.add_node("agent5", mini_agent_node("agent5"))
-    workflow.add_node("review", review_result)
-    workflow.add_node("revise", revise_task)
-    workflow.add_node("final", final_answer)
+    # Каждый узел обёрнут замером времени (метрики /metrics)
+    nodes = {"orchestrator": route_question}
+    nodes.update({agent_id: mini_agent_node(agent_id) for agent_id in agent_ids})
+    nodes.update({
+        FANOUT_NODE: fanout_agents,
+        MERGE_NODE: merge_responses,
+        "review": review_result,
+        "revise": revise_task,
+        "final": final_answer,
+    })
+    for name, node in nodes.items():
+        workflow.add_node(name, instrument_node(name, node))
 
     workflow.set_entry_point("orchestrator")
 
-    workflow.add_conditional_edges(
-        "orchestrator",
-        route_to_agent,
-        {
-            "agent1": "agent1",
-            "agent2": "agent2",
-            "agent3": "agent3",
-            "agent4": "agent4",
-            "agent5": "agent5",
-        }
-    )
+    agent_routes = {agent_id: agent_id for agent_id in agent_ids}
+    agent_routes[FANOUT_NODE] = FANOUT_NODE
 
-    for agent in ["agent1", "agent2", "agent3", "agent4", "agent5"]:
-        workflow.add_edge(agent, "review")
+    workflow.add_conditional_edges("orchestrator", route_to_agent, agent_routes)
+
+    for agent_id in agent_ids:
+        workflow.add_edge(agent_id, "review")
+    workflow.add_edge(FANOUT_NODE, MERGE_NODE)
+    workflow.add_edge(MERGE_NODE, "review")
 
     workflow.add_conditional_edges(
         "review",
@@ -284,45 +584,396 @@ def create_workflow():
         }
     )
 
-    workflow.add_conditional_edges(
-        "revise",
-        route_to_agent,
-        {
-            "agent1": "agent1",
-            "agent2": "agent2",
-            "agent3": "agent3",
-            "agent4": "agent4",
-            "agent5": "agent5",
-        }
-    )
+    workflow.add_conditional_edges("revise", route_to_agent, agent_routes)
 
     workflow.add_edge("final", END)
 
     return workflow.compile()
 
 
-async def process_query(user_input: str) -> dict:
-    app = create_workflow()
+# Скомпилированный граф на процесс и набор агентов, из которого он собран
+_compiled_workflow = None
+_compiled_agent_ids: Tuple[str, ...] = ()
+_workflow_lock = threading.Lock()
+
+
+def get_workflow():
+    """
+    Возвращает закэшированный скомпилированный граф.
 
-    initial_state: AgentState = {
+    Граф пересобирается только при изменении набора агентов (добавление
+    или удаление); правка промпта или описания пересборки не требует.
+    """
+    global _compiled_workflow, _compiled_agent_ids
+
+    agent_ids = get_storage().snapshot().agent_ids
+    if _compiled_workflow is not None and agent_ids == _compiled_agent_ids:
+        return _compiled_workflow
+
+    with _workflow_lock:
+        if _compiled_workflow is None or agent_ids != _compiled_agent_ids:
+            logger.info(f"Compiling workflow graph for agents: {', '.join(agent_ids)}")
+            _compiled_workflow = create_workflow(agent_ids)
+            _compiled_agent_ids = agent_ids
+        return _compiled_workflow
+
+
+def warm_up():
+    """
+    Загружает LLM-стек, кодировку токенизатора и компилирует граф заранее,
+    чтобы первый запрос не платил за импорт langchain/langgraph (lifespan при
+    LLM_WARMUP=true, мастер gunicorn перед fork).
+    """
+    started = time.perf_counter()
+    import langchain_core.messages  # noqa: F401
+    from llm_client import load_llm_stack
+
+    load_llm_stack()
+    get_token_budget().counter.encoding
+    get_workflow()
+    logger.info(f"LLM stack loaded and workflow compiled in {time.perf_counter() - started:.2f} s")
+
+
+def initial_state(
+    user_input: str,
+    route_decision: Optional[RouteDecision] = None,
+    history: Optional[str] = None
+) -> AgentState:
+    """Начальное состояние графа для запроса пользователя"""
+    return {
         "input": user_input,
         "route": None,
+        "routes": None,
         "agent_response": None,
+        "agent_responses": None,
         "review_result": None,
         "revised_instructions": None,
         "context": "",
         "iteration_count": 0,
-        "log": ["▶️ Запрос получен от пользователя"],
+        "trace": [
+            trace.event(
+                "input", "received", "▶️ Запрос получен от пользователя",
+                user_query=trace.ref("input", user_input),
+            )
+        ],
+        "route_decision": route_decision,
+        "history": history,
     }
 
-    result = app.invoke(initial_state)
 
+def build_result(state: AgentState) -> dict:
+    """Формирует ответ API из финального состояния графа"""
     return {
-        "input": result["input"],
-        "route": result.get("route"),
-        "agent_response": result.get("agent_response"),
-        "review_result": result.get("review_result"),
-        "context": result.get("context"),
-        "iteration_count": result.get("iteration_count", 0),
-        "log": result.get("log", []),
+        "input": state["input"],
+        "route": state.get("route"),
+        "routes": state.get("routes"),
+        "agent_response": state.get("agent_response"),
+        "review_result": state.get("review_result"),
+        "context": state.get("context"),
+        "iteration_count": state.get("iteration_count", 0),
+        "log": trace.render_log(state.get("trace", [])),
+        "trace": state.get("trace", []),
+        "token_estimates": trace.token_estimates(state.get("trace", [])),
+        "cached": False,
     }
+
+
+def lookup_cached(user_input: str) -> Optional[dict]:
+    """
+    Ищет готовый ответ: сначала точный кэш, затем семантический (ответ на
+    близкий по формулировке запрос). Пустой результат, если оба выключены.
+    """
+    # Правки промптов из других процессов доходят до подписчиков (кэшей)
+    # здесь, вне их блокировок
+    get_storage().refresh()
+    cache = get_response_cache()
+    if cache is not None:
+        result = cache.get(user_input, get_model_name(), get_storage().get_prompt_version)
+        record_cache_lookup(result is not None)
+        if result is not None:
+            logger.info(f"Response cache hit. Route: {result.get('route')}")
+            result["cached"] = True
+            result["token_estimates"] = []
+            return result
+
+    semantic = get_semantic_cache()
+    if semantic is None:
+        return None
+    result = semantic.get(user_input, get_model_name(), get_storage().get_prompt_version)
+    record_semantic_cache_lookup(result is not None)
+    if result is None:
+        return None
+    logger.info(
+        f"Semantic cache hit (similarity {result.pop('similarity'):.3f}). Route: {result.get('route')}"
+    )
+    # Ответ на близкий запрос отдаём как ответ на текущий
+    result["input"] = user_input
+    result["cached"] = True
+    result["token_estimates"] = []
+    return result
+
+
+def store_cached(user_input: str, result: dict):
+    """Кэширует одобренный ревьюером ответ (в точный и семантический кэш, если включены)"""
+    caches = [cache for cache in (get_response_cache(), get_semantic_cache()) if cache is not None]
+    route = result.get("route")
+    if not caches or result.get("review_result") != "approved":
+        return
+    # Ответ нескольких агентов зависит от всех их промптов — не кэшируем
+    if len(result.get("routes") or []) > 1:
+        return
+    prompt_version = get_storage().get_prompt_version(route)
+    if prompt_version is not None:
+        for cache in caches:
+            cache.put(user_input, route, prompt_version, get_model_name(), result)
+
+
+async def run_pipeline(
+    user_input: str,
+    route_decision: Optional[RouteDecision] = None,
+    history: Optional[str] = None
+) -> dict:
+    """Прогон графа без обращения к кэшу; route_decision пропускает вызов маршрутизатора"""
+    started = time.perf_counter()
+    app = get_workflow()
+
+    # Асинхронный прогон графа: пока ждём ответа LLM, event loop обслуживает
+    # другие запросы (/health, /agents и параллельные /query)
+    result = build_result(await app.ainvoke(initial_state(user_input, route_decision, history)))
+
+    # Ответ с историей диалога зависит от сессии — в общий кэш не кладём
+    if not history:
+        store_cached(user_input, result)
+    record_query(time.perf_counter() - started, cached=False)
+    return result
+
+
+def session_route_decision(session: dict, user_input: str) -> Optional[RouteDecision]:
+    """
+    Маршрут прошлого хода сессии, если запрос продолжает тему.
+
+    Смена темы — локальный классификатор уверенно (отрыв не меньше
+    SESSION_TOPIC_SHIFT_MARGIN) выбирает агента не из маршрута сессии;
+    тогда запрос проходит обычную маршрутизацию. Короткие уточнения
+    («сделай короче») классификатор уверенно не относит ни к кому.
+    """
+    routes = session.get("routes")
+    if not routes:
+        return None
+
+    threshold = float(os.getenv("SESSION_TOPIC_SHIFT_MARGIN", DEFAULT_MARGIN_THRESHOLD))
+    local = get_local_router().classify(user_input)
+    if local.route is not None and local.route not in routes and local.margin >= threshold:
+        logger.info(f"Session {session['id']}: topic shift to {local.route} (margin {local.margin:.2f})")
+        return None
+    return RouteDecision(route=routes[0], source="session", margin=local.margin, routes=list(routes))
+
+
+def prepare_session(session_id: str, user_input: str) -> Tuple[Optional[RouteDecision], str]:
+    """Маршрут и сжатая история для очередного хода сессии"""
+    store = get_session_store()
+    session = store.get(session_id)
+    if session is None:
+        raise SessionNotFoundError(f"Сессия {session_id} не найдена")
+    history = render_history(session["summary"], store.turns(session_id, window_only=True))
+    return session_route_decision(session, user_input), history
+
+
+def record_session_turn(session_id: str, result: dict):
+    """Сохраняет ход в сессии (история сжимается инкрементально)"""
+    get_session_store().append(
+        session_id,
+        result["input"],
+        result.get("agent_response") or "",
+        result.get("routes") or [result["route"]],
+    )
+    result["session_id"] = session_id
+
+
+async def process_query(user_input: str, session_id: Optional[str] = None) -> dict:
+    if session_id is not None:
+        # Ответ в сессии зависит от истории, поэтому кэш ответов не используется
+        route_decision, history = prepare_session(session_id, user_input)
+        result = await run_pipeline(user_input, route_decision, history)
+        record_session_turn(session_id, result)
+        return result
+
+    started = time.perf_counter()
+    cached = lookup_cached(user_input)
+    if cached is not None:
+        record_query(time.perf_counter() - started, cached=True)
+        return cached
+
+    if os.getenv("QUERY_COALESCING_ENABLED", "true").lower() == "false":
+        return await run_pipeline(user_input)
+
+    # Одинаковые запросы, пришедшие во время прогона, ждут его результата
+    key = coalescing_key(user_input, get_model_name(), get_storage().snapshot().prompt_versions)
+    result, shared = await get_single_flight().do(key, lambda: run_pipeline(user_input))
+    if not shared:
+        return result
+    record_coalesced("inflight")
+    logger.info(f"Query coalesced with an identical in-flight query. Route: {result.get('route')}")
+    return dict(result, input=user_input, coalesced=True)
+
+
+def get_batch_concurrency() -> int:
+    return max(1, int(os.getenv("BATCH_CONCURRENCY", 4)))
+
+
+def get_batch_routing_chunk() -> int:
+    return max(1, int(os.getenv("BATCH_ROUTING_CHUNK", 20)))
+
+
+async def process_batch(
+    queries: Sequence[str],
+    concurrency: Optional[int] = None,
+    chunk_size: Optional[int] = None
+) -> AsyncIterator[dict]:
+    """
+    Прогоняет пачку запросов с ограниченным параллелизмом.
+
+    Запросы маршрутизируются пачками по chunk_size (BATCH_ROUTING_CHUNK) —
+    один вызов LLM на пачку вместо вызова на запрос; ответы из кэша
+    маршрутизацию не проходят. Одновременно в графе не больше concurrency
+    (BATCH_CONCURRENCY) запросов. Маршрутизация следующей пачки идёт, пока
+    выполняются запросы предыдущей.
+
+    Результаты отдаются по мере готовности, а не в порядке запросов:
+    {"index": i, "result": {...}} или {"index": i, "error": "..."}.
+    """
+    concurrency = concurrency or get_batch_concurrency()
+    chunk_size = chunk_size or get_batch_routing_chunk()
+    semaphore = asyncio.Semaphore(concurrency)
+    results: asyncio.Queue = asyncio.Queue()
+    tasks: List[asyncio.Task] = []
+
+    async def run_item(index: int, route_decision: Optional[RouteDecision]):
+        async with semaphore:
+            try:
+                result = await run_pipeline(queries[index], route_decision)
+            except Exception as e:
+                logger.error(f"Batch item {index} failed: {e}")
+                await results.put({"index": index, "error": str(e)})
+            else:
+                await results.put({"index": index, "result": result})
+
+    async def schedule():
+        for start in range(0, len(queries), chunk_size):
+            pending = []
+            for index in range(start, min(start + chunk_size, len(queries))):
+                cached_started = time.perf_counter()
+                cached = lookup_cached(queries[index])
+                if cached is not None:
+                    record_query(time.perf_counter() - cached_started, cached=True)
+                    await results.put({"index": index, "result": cached})
+                else:
+                    pending.append(index)
+            if not pending:
+                continue
+
+            try:
+                decisions = await get_router().route_batch([queries[i] for i in pending])
+            except Exception as e:
+                # Без пакетного решения каждый запрос маршрутизируется сам
+                logger.warning(f"Batch routing failed, routing items one by one: {e}")
+                decisions = [None] * len(pending)
+            tasks.extend(
+                asyncio.create_task(run_item(index, decision))
+                for index, decision in zip(pending, decisions)
+            )
+
+    scheduler = asyncio.create_task(schedule())
+    try:
+        for _ in range(len(queries)):
+            if not scheduler.done():
+                # Ошибка планировщика не должна оставить потребителя ждать вечно
+                getter = asyncio.ensure_future(results.get())
+                await asyncio.wait({getter, scheduler}, return_when=asyncio.FIRST_COMPLETED)
+                if getter.done():
+                    yield getter.result()
+                    continue
+                getter.cancel()
+            scheduler.result()
+            yield await results.get()
+    finally:
+        # Клиент отключился или пачка прервана — останавливаем оставшиеся запросы
+        scheduler.cancel()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(scheduler, *tasks, return_exceptions=True)
+
+
+def route_event(state: dict) -> dict:
+    """Событие выбора маршрута; список агентов добавляется только в режиме fan-out"""
+    event = {"event": "route", "route": state["route"]}
+    if len(state.get("routes") or []) > 1:
+        event["routes"] = state["routes"]
+    return event
+
+
+async def stream_query(user_input: str, session_id: Optional[str] = None) -> AsyncIterator[dict]:
+    """
+    Прогоняет граф в потоковом режиме и отдаёт события пайплайна.
+
+    События (поле "event"):
+    - route: оркестратор выбрал агента (routes — все агенты в режиме fan-out)
+    - token: очередной фрагмент ответа агента
+    - review: вердикт ревьюера
+    - revision: начата итерация доработки (ответ агента будет сгенерирован заново)
+    - final: итоговый результат в формате process_query
+
+    С session_id ход выполняется в сессии диалога (как в process_query).
+    """
+    started = time.perf_counter()
+    route_decision, history = None, None
+    if session_id is not None:
+        route_decision, history = prepare_session(session_id, user_input)
+        cached = None
+    else:
+        cached = lookup_cached(user_input)
+    if cached is not None:
+        record_query(time.perf_counter() - started, cached=True)
+        yield route_event(cached)
+        yield {"event": "final", "result": cached}
+        return
+
+    app = get_workflow()
+    agent_ids = set(get_storage().snapshot().agent_ids)
+    final_state: Optional[AgentState] = None
+
+    # updates — состояние после каждого узла, messages — токены LLM внутри узлов
+    async for mode, chunk in app.astream(
+        initial_state(user_input, route_decision, history), stream_mode=["updates", "messages"]
+    ):
+        if mode == "messages":
+            message, metadata = chunk
+            agent = metadata.get("agent")
+            # Токены маршрутизатора и ревьюера клиенту не нужны
+            if agent in agent_ids and message.content:
+                yield {"event": "token", "agent": agent, "content": message.content}
+            continue
+
+        for node, state in chunk.items():
+            if node == "orchestrator":
+                yield route_event(state)
+            elif node == "review":
+                yield {
+                    "event": "review",
+                    "review_result": state["review_result"],
+                    "revised_instructions": state.get("revised_instructions")
+                    if state["review_result"] == "needs_revision" else None,
+                }
+            elif node == "revise":
+                yield {"event": "revision", "iteration_count": state["iteration_count"]}
+            elif node == "final":
+                final_state = state
+
+    if final_state is not None:
+        result = build_result(final_state)
+        if session_id is not None:
+            record_session_turn(session_id, result)
+        else:
+            store_cached(user_input, result)
+        record_query(time.perf_counter() - started, cached=False)
+        yield {"event": "final", "result": result}
@@ -0,0 +1,145 @@
+"""
+Структурированная трасса выполнения пайплайна.
+
+Каждый узел графа добавляет в state["trace"] типизированное событие:
+время, узел, длительность, токены и компактный payload. Крупные тексты
+(системный промпт, запрос, ответ агента) не копируются в трассу целиком:
+они заменяются ссылкой на поле состояния/хранилища или обрезаются до
+TRACE_PAYLOAD_LIMIT символов.
+"""
+
+import os
+import time
+from typing import Any, Dict, List, Optional, TypedDict
+
+DEFAULT_PAYLOAD_LIMIT = 500
+
+# compact — только ответ и метаданные; full — плюс человекочитаемый лог и
+# контекст; trace — плюс структурированная трасса
+VERBOSITY_LEVELS = ("compact", "full", "trace")
+
+
+class TraceEvent(TypedDict, total=False):
+    ts: float
+    node: str
+    kind: str
+    message: str
+    duration_ms: float
+    prompt_tokens: int
+    completion_tokens: int
+    # Оценка вызова LLM до отправки: токены промпта, max_tokens, сокращённые части
+    estimate: Dict[str, Any]
+    payload: Dict[str, Any]
+
+
+def get_payload_limit() -> int:
+    return int(os.getenv("TRACE_PAYLOAD_LIMIT", DEFAULT_PAYLOAD_LIMIT))
+
+
+def truncate(text: Optional[str], limit: Optional[int] = None) -> Optional[str]:
+    """Обрезает текст до limit символов с пометкой об отброшенном хвосте"""
+    if text is None:
+        return None
+    limit = get_payload_limit() if limit is None else limit
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}… [+{len(text) - limit} симв.]"
+
+
+def ref(target: str, text: Optional[str] = None, **attrs) -> Dict[str, Any]:
+    """Ссылка на крупный payload вместо его копии"""
+    reference: Dict[str, Any] = {"ref": target, **attrs}
+    if text is not None:
+        reference["chars"] = len(text)
+    return reference
+
+
+def token_usage(message: Any) -> Dict[str, int]:
+    """Токены запроса/ответа из usage_metadata ответа LLM (если провайдер их вернул)"""
+    usage = getattr(message, "usage_metadata", None) or {}
+    result = {}
+    if usage.get("input_tokens") is not None:
+        result["prompt_tokens"] = usage["input_tokens"]
+    if usage.get("output_tokens") is not None:
+        result["completion_tokens"] = usage["output_tokens"]
+    return result
+
+
+def event(
+    node: str,
+    kind: str,
+    message: str,
+    duration_ms: Optional[float] = None,
+    usage: Optional[Dict[str, int]] = None,
+    estimate: Optional[Dict[str, Any]] = None,
+    **payload
+) -> TraceEvent:
+    """Создаёт событие трассы; None-значения payload отбрасываются"""
+    trace_event: TraceEvent = {"ts": time.time(), "node": node, "kind": kind, "message": message}
+    if duration_ms is not None:
+        trace_event["duration_ms"] = round(duration_ms, 1)
+    if usage:
+        trace_event.update(usage)
+    if estimate:
+        trace_event["estimate"] = estimate
+    payload = {key: value for key, value in payload.items() if value is not None}
+    if payload:
+        trace_event["payload"] = payload
+    return trace_event
+
+
+def _format_value(value: Any) -> str:
+    if isinstance(value, dict) and "ref" in value:
+        details = ", ".join(f"{k}={v}" for k, v in value.items() if k != "ref")
+        return f"<{value['ref']}: {details}>" if details else f"<{value['ref']}>"
+    if isinstance(value, float):
+        return f"{value:.2f}"
+    return str(value)
+
+
+def render_log(trace: List[TraceEvent]) -> List[str]:
+    """Человекочитаемый лог из трассы (формат поля log в ответе API)"""
+    lines = []
+    for trace_event in trace:
+        header = trace_event["message"]
+        stats = []
+        if "duration_ms" in trace_event:
+            stats.append(f"{trace_event['duration_ms']:.0f} мс")
+        if "prompt_tokens" in trace_event or "completion_tokens" in trace_event:
+            stats.append(
+                f"токены {trace_event.get('prompt_tokens', '?')}→{trace_event.get('completion_tokens', '?')}"
+            )
+        if "estimate" in trace_event:
+            stats.append(f"оценка промпта {trace_event['estimate']['prompt_tokens']}")
+            if trace_event["estimate"].get("trimmed"):
+                stats.append(f"сокращено: {', '.join(trace_event['estimate']['trimmed'])}")
+        if stats:
+            header = f"{header} ({', '.join(stats)})"
+
+        details = [
+            f"   {key}: {_format_value(value)}"
+            for key, value in trace_event.get("payload", {}).items()
+        ]
+        lines.append("\n".join([header, *details]))
+    return lines
+
+
+def token_estimates(trace: List[TraceEvent]) -> List[Dict[str, Any]]:
+    """Оценки всех вызовов LLM пайплайна (для поля token_estimates ответа)"""
+    return [
+        {"node": trace_event["node"], "kind": trace_event["kind"], **trace_event["estimate"]}
+        for trace_event in trace
+        if "estimate" in trace_event
+    ]
+
+
+def apply_verbosity(result: dict, verbosity: str) -> dict:
+    """Отбирает поля ответа согласно уровню подробности"""
+    shaped = dict(result)
+    if verbosity == "compact":
+        shaped["log"] = []
+        shaped["context"] = ""
+        shaped["trace"] = None
+    elif verbosity == "full":
+        shaped["trace"] = None
+    return shaped
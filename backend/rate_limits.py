@@ -0,0 +1,229 @@
+"""
+Лимиты запросов и суточные квоты токенов, общие для всех воркеров.
+
+Состояние хранится в SQLite (WAL), поэтому `uvicorn --workers N` не
+умножает лимит на число процессов:
+
+- token bucket на клиента и scope (endpoint): ёмкость N запросов,
+  пополнение N за период ("10/minute"); списание — одна транзакция
+  BEGIN IMMEDIATE, то есть атомарно между процессами;
+- суточный бюджет LLM-токенов на клиента (DAILY_TOKEN_BUDGET): учитываются
+  фактические prompt + completion токены, потраченные запросом.
+
+Клиент — IP (get_real_ip) или X-API-Key (RATE_LIMIT_KEY_BY=api_key); ключ
+хранится только в виде хэша.
+"""
+
+import asyncio
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Optional, Tuple
+
+DEFAULT_QUERY_RATE = "10/minute"
+
+_PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+_RATE = re.compile(r"^\s*(\d+)\s*/\s*(\d*)\s*(second|minute|hour|day)s?\s*$")
+
+
+class RateLimitExceeded(Exception):
+    """Лимит или квота исчерпаны; retry_after — через сколько секунд повторить"""
+
+    def __init__(self, detail: str, retry_after: float):
+        super().__init__(detail)
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+def parse_rate(rate: str) -> Tuple[int, float]:
+    """'10/minute' -> (ёмкость 10, период 60 секунд); поддерживается '100/5minutes'"""
+    match = _RATE.match(rate.lower())
+    if not match:
+        raise ValueError(f"Invalid rate limit: {rate}")
+    count, multiplier, period = match.groups()
+    return int(count), _PERIODS[period] * int(multiplier or 1)
+
+
+def client_key(api_key: Optional[str], ip: str, key_by: str = "ip") -> str:
+    """Ключ клиента для лимитов: хэш X-API-Key или IP"""
+    if key_by == "api_key" and api_key:
+        return "key:" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+    return f"ip:{ip}"
+
+
+def utc_day(timestamp: Optional[float] = None) -> str:
+    return datetime.fromtimestamp(timestamp or time.time(), tz=timezone.utc).strftime("%Y-%m-%d")
+
+
+class RateLimitStore:
+    """Состояние token bucket и расход токенов в SQLite"""
+
+    def __init__(self, db_path: str, busy_timeout_ms: int = 5000):
+        self.db_path = str(db_path)
+        self.busy_timeout_ms = busy_timeout_ms
+        self._connection: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # После fork соединение родителя использовать нельзя — открываем своё
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(
+                self.db_path, isolation_level=None, check_same_thread=False
+            )
+            connection.execute(f"PRAGMA busy_timeout = {self.busy_timeout_ms}")
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            connection.execute(
+                """CREATE TABLE IF NOT EXISTS rate_buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )"""
+            )
+            connection.execute(
+                """CREATE TABLE IF NOT EXISTS token_usage (
+                    key TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    tokens INTEGER NOT NULL,
+                    PRIMARY KEY (key, day)
+                )"""
+            )
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def take(self, key: str, capacity: int, period: float, cost: float = 1) -> float:
+        """
+        Списывает cost из корзины key. Возвращает 0, если запрос разрешён,
+        иначе — сколько секунд ждать до пополнения.
+        """
+        refill_rate = capacity / period
+        with self._transaction() as connection:
+            now = time.time()
+            row = connection.execute(
+                "SELECT tokens, updated_at FROM rate_buckets WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                tokens = float(capacity)
+            else:
+                tokens = min(float(capacity), row[0] + max(0.0, now - row[1]) * refill_rate)
+
+            if tokens >= cost:
+                tokens -= cost
+                retry_after = 0.0
+            else:
+                retry_after = (cost - tokens) / refill_rate
+
+            connection.execute(
+                "INSERT INTO rate_buckets (key, tokens, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at",
+                (key, tokens, now),
+            )
+        return retry_after
+
+    def add_usage(self, key: str, tokens: int, day: Optional[str] = None) -> int:
+        """Добавляет расход токенов за сутки; возвращает итог за сутки"""
+        day = day or utc_day()
+        with self._transaction() as connection:
+            connection.execute(
+                "INSERT INTO token_usage (key, day, tokens) VALUES (?, ?, ?) "
+                "ON CONFLICT (key, day) DO UPDATE SET tokens = tokens + excluded.tokens",
+                (key, day, tokens),
+            )
+            return connection.execute(
+                "SELECT tokens FROM token_usage WHERE key = ? AND day = ?", (key, day)
+            ).fetchone()[0]
+
+    def usage(self, key: str, day: Optional[str] = None) -> int:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT tokens FROM token_usage WHERE key = ? AND day = ?", (key, day or utc_day())
+            ).fetchone()
+        return row[0] if row else 0
+
+    def purge(self, before_day: str) -> int:
+        """Удаляет расход за дни раньше before_day"""
+        with self._transaction() as connection:
+            cursor = connection.execute("DELETE FROM token_usage WHERE day < ?", (before_day,))
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None and self._pid == os.getpid():
+                self._connection.close()
+            self._connection = None
+
+
+class RateLimiter:
+    """Лимиты запросов по scope и суточный бюджет токенов поверх RateLimitStore"""
+
+    def __init__(self, store: RateLimitStore, daily_token_budget: int = 0):
+        self.store = store
+        # 0 — бюджет не ограничен
+        self.daily_token_budget = daily_token_budget
+
+    def hit(self, scope: str, key: str, rate: str, cost: float = 1):
+        """Бросает RateLimitExceeded, если корзина клиента для scope пуста"""
+        capacity, period = parse_rate(rate)
+        retry_after = self.store.take(f"{scope}:{key}", capacity, period, cost)
+        if retry_after > 0:
+            raise RateLimitExceeded(f"Rate limit exceeded: {rate}", retry_after)
+
+    def check_budget(self, key: str):
+        """Бросает RateLimitExceeded, если суточный бюджет токенов исчерпан"""
+        if self.daily_token_budget <= 0:
+            return
+        used = self.store.usage(key)
+        if used >= self.daily_token_budget:
+            now = datetime.now(timezone.utc)
+            seconds_left = 86400 - (now.hour * 3600 + now.minute * 60 + now.second)
+            raise RateLimitExceeded(
+                f"Daily token budget exhausted: {used}/{self.daily_token_budget}", seconds_left
+            )
+
+    def charge(self, key: str, tokens: int) -> int:
+        """Записывает фактически потраченные токены"""
+        if tokens <= 0:
+            return self.store.usage(key)
+        return self.store.add_usage(key, tokens)
+
+    async def acharge(self, key: str, tokens: int):
+        """
+        charge из асинхронного кода: запись в SQLite может ждать блокировку
+        до busy_timeout, поэтому выполняется в потоке. Отмена вызывающего
+        (обрыв соединения) запись не прерывает.
+        """
+        if tokens > 0:
+            await asyncio.shield(asyncio.to_thread(self.charge, key, tokens))
+
+
+_limiter: Optional[RateLimiter] = None
+
+
+def get_rate_limiter() -> RateLimiter:
+    """Глобальный лимитер (RATE_LIMIT_DB_PATH, DAILY_TOKEN_BUDGET)"""
+    global _limiter
+    if _limiter is None:
+        _limiter = RateLimiter(
+            RateLimitStore(os.getenv("RATE_LIMIT_DB_PATH", "rate_limits.db")),
+            daily_token_budget=int(os.getenv("DAILY_TOKEN_BUDGET", 0)),
+        )
+    return _limiter
@@ -0,0 +1,182 @@
+"""
+Кэш готовых ответов пайплайна.
+
+Ключ: нормализованный текст запроса, выбранный маршрут, версия промпта
+агента (хэш промпта из AgentsStorage) и имя модели. Ограничения: TTL,
+LRU-вытеснение и суммарный размер записей в байтах.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional, Tuple
+
+from loguru import logger
+
+from agents_storage import get_storage
+
+DEFAULT_TTL_SECONDS = 3600
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_query(text: str) -> str:
+    """Приводит запрос к канонической форме: NFKC, casefold, схлопнутые пробелы"""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def make_key(normalized_query: str, route: str, prompt_version: str, model: str) -> str:
+    """Ключ записи кэша"""
+    raw = "\x1f".join([normalized_query, route, prompt_version, model])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class CacheEntry:
+    result: dict
+    query_key: Tuple[str, str]
+    route: str
+    size: int
+    expires_at: float
+
+
+class ResponseCache:
+    """LRU-кэш ответов с TTL и ограничением размера в байтах"""
+
+    def __init__(
+        self,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        ttl_seconds: float = DEFAULT_TTL_SECONDS,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        # Последний маршрут для (запрос, модель): позволяет найти запись без
+        # повторного вызова маршрутизатора
+        self._routes: Dict[Tuple[str, str], str] = {}
+        self._lock = threading.Lock()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(
+        self,
+        query: str,
+        model: str,
+        prompt_version_of: Callable[[str], Optional[str]]
+    ) -> Optional[dict]:
+        """
+        Ищет готовый ответ на запрос.
+
+        prompt_version_of возвращает текущую версию промпта агента; если промпт
+        изменился с момента записи, ключ не совпадёт и запрос считается промахом.
+        """
+        normalized = normalize_query(query)
+        with self._lock:
+            route = self._routes.get((normalized, model))
+        # Версия запрашивается вне блокировки: хранилище может уведомить
+        # подписчиков, а invalidate_route берёт ту же блокировку
+        version = prompt_version_of(route) if route else None
+
+        with self._lock:
+            if version is None:
+                self.misses += 1
+                return None
+
+            key = make_key(normalized, route, version, model)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.expires_at <= self._clock():
+                self._remove(key)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(entry.result)
+
+    def put(self, query: str, route: str, prompt_version: str, model: str, result: dict):
+        """Сохраняет ответ; записи крупнее max_bytes не кэшируются"""
+        size = len(json.dumps(result, ensure_ascii=False).encode("utf-8"))
+        if size > self.max_bytes:
+            return
+
+        normalized = normalize_query(query)
+        key = make_key(normalized, route, prompt_version, model)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = CacheEntry(
+                result=dict(result),
+                query_key=(normalized, model),
+                route=route,
+                size=size,
+                expires_at=self._clock() + self.ttl_seconds,
+            )
+            self._routes[(normalized, model)] = route
+            self.size_bytes += size
+
+            while self.size_bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+
+    def invalidate_route(self, route: str):
+        """Удаляет все записи агента (вызывается при изменении его промпта)"""
+        with self._lock:
+            stale = [key for key, entry in self._entries.items() if entry.route == route]
+            for key in stale:
+                self._remove(key)
+        if stale:
+            logger.debug(f"Invalidated {len(stale)} cached responses for {route}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._routes.clear()
+            self.size_bytes = 0
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        self.size_bytes -= entry.size
+        if self._routes.get(entry.query_key) == entry.route:
+            del self._routes[entry.query_key]
+
+
+# Глобальный инстанс кэша (None — кэш выключен)
+_cache: Optional[ResponseCache] = None
+_cache_initialized = False
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """
+    Возвращает кэш ответов, если он включён через RESPONSE_CACHE_ENABLED.
+
+    Размер и TTL настраиваются через RESPONSE_CACHE_MAX_BYTES и
+    RESPONSE_CACHE_TTL_SECONDS.
+    """
+    global _cache, _cache_initialized
+    if not _cache_initialized:
+        _cache_initialized = True
+        if os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() in ("1", "true", "yes"):
+            _cache = ResponseCache(
+                max_bytes=int(os.getenv("RESPONSE_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)),
+                ttl_seconds=float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", DEFAULT_TTL_SECONDS)),
+            )
+            get_storage().subscribe_prompt_changes(_cache.invalidate_route)
+            logger.info("✅ Response cache enabled")
+    return _cache
@@ -0,0 +1,136 @@
+"""
+Политика ревью ответов агентов.
+
+Ревьюер — полноценный вызов LLM с ответом агента в промпте, поэтому до него
+ответ проходит дешёвые проверки:
+
+- агенты из REVIEW_SKIP_AGENTS не ревьюятся вовсе;
+- ответ короче REVIEW_MIN_CHARS сразу отправляется на доработку;
+- ответ без обязательных разделов агента (REVIEW_REQUIRED_SECTIONS) сразу
+  отправляется на доработку с перечнем недостающих разделов;
+- ответ не длиннее REVIEW_AUTO_APPROVE_CHARS одобряется без LLM;
+- в LLM уходит только доля REVIEW_SAMPLE_RATE остальных ответов (выборка
+  детерминирована по тексту запроса).
+
+Ревьюер может работать на более дешёвой модели (REVIEW_MODEL_NAME), число
+доработок ограничено REVIEW_MAX_ITERATIONS. В режиме REVIEW_REVISION_MODE=delta
+доработка отправляет агенту предыдущий черновик и замечания ревьюера вместо
+генерации ответа заново.
+"""
+
+import json
+import os
+import zlib
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, List, Optional, Sequence, Tuple
+
+DEFAULT_MAX_ITERATIONS = 2
+
+REVISION_MODES = ("delta", "full")
+
+_ENV_VARS = (
+    "REVIEW_MAX_ITERATIONS", "REVIEW_SKIP_AGENTS", "REVIEW_MIN_CHARS",
+    "REVIEW_REQUIRED_SECTIONS", "REVIEW_AUTO_APPROVE_CHARS", "REVIEW_SAMPLE_RATE",
+    "REVIEW_MODEL_NAME", "REVIEW_REVISION_MODE",
+)
+
+
+@dataclass(frozen=True)
+class PrecheckVerdict:
+    """Решение ревью без вызова LLM"""
+    review_result: str
+    # Причина: skip, too_short, missing_sections, short_answer, sampled_out
+    reason: str
+    revised_instructions: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class ReviewPolicy:
+    max_iterations: int = DEFAULT_MAX_ITERATIONS
+    skip_agents: FrozenSet[str] = frozenset()
+    min_chars: int = 0
+    # Обязательные подстроки (заголовки разделов) в ответе агента
+    required_sections: Dict[str, Tuple[str, ...]] = field(default_factory=dict)
+    auto_approve_chars: int = 0
+    sample_rate: float = 1.0
+    # Модель ревьюера; None — модель агентов (MODEL_NAME)
+    model: Optional[str] = None
+    revision_mode: str = "delta"
+
+    @classmethod
+    def from_env(cls) -> "ReviewPolicy":
+        sections = json.loads(os.getenv("REVIEW_REQUIRED_SECTIONS") or "{}")
+        revision_mode = os.getenv("REVIEW_REVISION_MODE", "delta").lower()
+        if revision_mode not in REVISION_MODES:
+            raise ValueError(f"Unknown REVIEW_REVISION_MODE: {revision_mode}")
+        return cls(
+            max_iterations=int(os.getenv("REVIEW_MAX_ITERATIONS", DEFAULT_MAX_ITERATIONS)),
+            skip_agents=frozenset(
+                agent.strip() for agent in os.getenv("REVIEW_SKIP_AGENTS", "").split(",")
+                if agent.strip()
+            ),
+            min_chars=int(os.getenv("REVIEW_MIN_CHARS", 0)),
+            required_sections={agent: tuple(items) for agent, items in sections.items()},
+            auto_approve_chars=int(os.getenv("REVIEW_AUTO_APPROVE_CHARS", 0)),
+            sample_rate=float(os.getenv("REVIEW_SAMPLE_RATE", 1.0)),
+            model=os.getenv("REVIEW_MODEL_NAME") or None,
+            revision_mode=revision_mode,
+        )
+
+    def missing_sections(self, routes: Sequence[str], response: str) -> List[str]:
+        missing = []
+        for agent_id in routes:
+            missing.extend(
+                section for section in self.required_sections.get(agent_id, ())
+                if section not in response and section not in missing
+            )
+        return missing
+
+    def sampled(self, user_input: str) -> bool:
+        """Попадает ли запрос в выборку для ревью LLM"""
+        if self.sample_rate >= 1:
+            return True
+        bucket = zlib.crc32(user_input.encode("utf-8")) % 10_000
+        return bucket < self.sample_rate * 10_000
+
+    def precheck(self, user_input: str, routes: Sequence[str], response: str) -> Optional[PrecheckVerdict]:
+        """Решение без LLM или None, если ответ нужно отдать ревьюеру"""
+        if routes and all(agent_id in self.skip_agents for agent_id in routes):
+            return PrecheckVerdict("approved", "skip")
+
+        text = response.strip()
+        if len(text) < self.min_chars:
+            return PrecheckVerdict(
+                "needs_revision", "too_short",
+                f"Ответ слишком короткий: раскройте запрос подробнее (не меньше {self.min_chars} символов)",
+            )
+
+        missing = self.missing_sections(routes, text)
+        if missing:
+            return PrecheckVerdict(
+                "needs_revision", "missing_sections",
+                f"Добавьте обязательные разделы: {', '.join(missing)}",
+            )
+
+        if len(text) <= self.auto_approve_chars:
+            return PrecheckVerdict("approved", "short_answer")
+
+        if not self.sampled(user_input):
+            return PrecheckVerdict("approved", "sampled_out")
+
+        return None
+
+
+_policy: Optional[ReviewPolicy] = None
+_policy_key: Optional[tuple] = None
+
+
+def get_review_policy() -> ReviewPolicy:
+    """Политика из переменных окружения; пересобирается при их изменении"""
+    global _policy, _policy_key
+
+    key = tuple(os.getenv(name) for name in _ENV_VARS)
+    if _policy is None or key != _policy_key:
+        _policy = ReviewPolicy.from_env()
+        _policy_key = key
+    return _policy
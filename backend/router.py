@@ -0,0 +1,504 @@
+"""
+Маршрутизаторы запросов к агентам.
+
+- LLMRouter: выбор агента вызовом LLM (исходное поведение оркестратора)
+- LocalRouter: локальный классификатор на TF-IDF по символьным n-граммам
+  имени/описания агента и размеченных примеров запросов
+- HybridRouter: локальный классификатор, а при малом отрыве лучшего агента
+  от второго — fallback на LLM
+- ShortlistRouter: двухэтапный выбор для больших каталогов — локальный
+  классификатор отбирает k лучших агентов, LLM выбирает только среди них
+
+route_batch маршрутизирует пачку запросов: LLM вызывается один раз на пачку.
+"""
+
+import asyncio
+import json
+import math
+import re
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from loguru import logger
+
+from agents_storage import AgentsSnapshot, render_routing_menu
+from metrics import ainvoke_llm
+from pipeline_trace import token_usage
+from response_cache import normalize_query
+from token_budget import get_token_budget, shrink
+
+DEFAULT_NGRAM_RANGE = (3, 5)
+DEFAULT_MARGIN_THRESHOLD = 0.2
+# Сколько агентов локальный классификатор передаёт LLM в двухэтапном режиме
+DEFAULT_SHORTLIST_K = 8
+# Меню одного вызова пакетной маршрутизации — не больше стольких шорт-листов
+SHORTLIST_BATCH_MENU_FACTOR = 2
+
+ROUTER_SYSTEM_PROMPT = "Вы оркестратор-маршрутизатор запросов."
+
+_ROUTE_SEPARATOR = re.compile(r"[\s,;]+")
+# Строка ответа пакетной маршрутизации: "<номер>: <ID агента>"
+_BATCH_LINE = re.compile(r"^\s*(\d+)\s*[.):\-]?\s*(.*)$")
+
+
+@dataclass
+class RouteDecision:
+    """Результат маршрутизации"""
+    # None — агента выбрать не из чего (пустой каталог)
+    route: Optional[str]
+    # Кто принял решение: "local" или "llm"
+    source: str
+    # Отрыв лучшего агента от второго по скору локального классификатора
+    margin: Optional[float] = None
+    # Сырой ответ LLM (для лога)
+    raw: Optional[str] = None
+    scores: Dict[str, float] = field(default_factory=dict)
+    # Токены вызова LLM (prompt_tokens / completion_tokens), если он был
+    usage: Dict[str, int] = field(default_factory=dict)
+    # Все выбранные агенты (в режиме fan-out их может быть несколько);
+    # route — первый из них
+    routes: List[str] = field(default_factory=list)
+    # Оценка вызова LLM до отправки (см. token_budget.BudgetedPrompt.estimate)
+    estimate: Dict[str, Any] = field(default_factory=dict)
+    # Кандидаты, из которых выбирала LLM (двухэтапная маршрутизация)
+    shortlist: List[str] = field(default_factory=list)
+
+    def __post_init__(self):
+        if not self.routes and self.route is not None:
+            self.routes = [self.route]
+
+
+def char_ngrams(text: str, ngram_range: Tuple[int, int] = DEFAULT_NGRAM_RANGE) -> List[str]:
+    """Символьные n-граммы слов с границами (аналог char_wb)"""
+    low, high = ngram_range
+    grams = []
+    for word in normalize_query(text).split():
+        padded = f" {word} "
+        for n in range(low, high + 1):
+            if len(padded) <= n:
+                grams.append(padded)
+                break
+            grams.extend(padded[i:i + n] for i in range(len(padded) - n + 1))
+    return grams
+
+
+class NgramVectorizer:
+    """TF-IDF векторизатор по символьным n-граммам (sublinear tf, L2-нормировка)"""
+
+    def __init__(self, ngram_range: Tuple[int, int] = DEFAULT_NGRAM_RANGE):
+        self.ngram_range = ngram_range
+        self.vocabulary: Dict[str, int] = {}
+        self.idf = np.zeros(0, dtype=np.float32)
+
+    def fit(self, documents: Sequence[str]) -> "NgramVectorizer":
+        document_frequency: Counter = Counter()
+        for document in documents:
+            document_frequency.update(set(char_ngrams(document, self.ngram_range)))
+
+        self.vocabulary = {gram: index for index, gram in enumerate(sorted(document_frequency))}
+        n_documents = len(documents)
+        self.idf = np.array(
+            [
+                math.log((1 + n_documents) / (1 + document_frequency[gram])) + 1
+                for gram in self.vocabulary
+            ],
+            dtype=np.float32,
+        )
+        return self
+
+    def transform(self, texts: Sequence[str]) -> np.ndarray:
+        matrix = np.zeros((len(texts), len(self.vocabulary)), dtype=np.float32)
+        for row, text in enumerate(texts):
+            counts = Counter(
+                gram for gram in char_ngrams(text, self.ngram_range) if gram in self.vocabulary
+            )
+            if not counts:
+                continue
+            columns = np.fromiter((self.vocabulary[g] for g in counts), dtype=np.int64)
+            tf = np.fromiter((1 + math.log(c) for c in counts.values()), dtype=np.float32)
+            matrix[row, columns] = tf * self.idf[columns]
+
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return matrix / norms
+
+
+class NoRouteError(RuntimeError):
+    """Маршрутизатор не выбрал агента: каталог пуст"""
+
+
+class LocalRouter:
+    """
+    Локальный классификатор запросов.
+
+    Каждый агент представлен центроидом TF-IDF векторов своих документов:
+    "имя + описание" и (опционально) размеченных прошлых запросов.
+    Скор агента — косинусная близость запроса к центроиду.
+    """
+
+    def __init__(
+        self,
+        agents: Sequence[dict],
+        examples: Optional[Dict[str, List[str]]] = None,
+        ngram_range: Tuple[int, int] = DEFAULT_NGRAM_RANGE
+    ):
+        examples = examples or {}
+        self.agent_ids = [agent["id"] for agent in agents]
+
+        documents: List[str] = []
+        owners: List[int] = []
+        for index, agent in enumerate(agents):
+            agent_documents = [f"{agent['name']} {agent['description']}"]
+            agent_documents.extend(examples.get(agent["id"], []))
+            documents.extend(agent_documents)
+            owners.extend([index] * len(agent_documents))
+
+        self.vectorizer = NgramVectorizer(ngram_range).fit(documents)
+        vectors = self.vectorizer.transform(documents)
+
+        centroids = np.zeros((len(agents), vectors.shape[1]), dtype=np.float32)
+        np.add.at(centroids, np.array(owners, dtype=np.intp), vectors)
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        self.centroids = centroids / norms
+
+    def scores(self, query: str) -> np.ndarray:
+        """Косинусная близость запроса к каждому агенту"""
+        return self.centroids @ self.vectorizer.transform([query])[0]
+
+    def shortlist(self, query: str, k: int) -> Dict[str, float]:
+        """k агентов с наибольшим скором (по убыванию, при равенстве — по порядку в каталоге)"""
+        scores = self.scores(query)
+        order = np.argsort(-scores, kind="stable")[:k]
+        return {self.agent_ids[index]: float(scores[index]) for index in order}
+
+    def classify(self, query: str) -> RouteDecision:
+        if not self.agent_ids:
+            # Пустой каталог: агента нет, гибридный режим уйдёт в LLM
+            return RouteDecision(route=None, source="local", margin=0.0)
+        scores = self.scores(query)
+        order = np.argsort(scores)[::-1]
+        best = float(scores[order[0]])
+        second = float(scores[order[1]]) if len(order) > 1 else 0.0
+        return RouteDecision(
+            route=self.agent_ids[order[0]],
+            source="local",
+            margin=best - second,
+            scores={agent_id: float(score) for agent_id, score in zip(self.agent_ids, scores)},
+        )
+
+    async def route(self, query: str) -> RouteDecision:
+        return self.classify(query)
+
+    async def route_batch(self, queries: Sequence[str]) -> List[RouteDecision]:
+        return [self.classify(query) for query in queries]
+
+
+class LLMRouter:
+    """
+    Маршрутизация вызовом LLM по списку агентов из хранилища.
+
+    agents_provider возвращает AgentsSnapshot (готовое меню агентов) или
+    список словарей агентов. При max_agents > 1 LLM может выбрать несколько
+    агентов (режим fan-out).
+    """
+
+    def __init__(
+        self,
+        llm_factory: Callable[[], Any],
+        agents_provider: Callable[[], Union[AgentsSnapshot, Sequence[dict]]],
+        max_agents: int = 1
+    ):
+        self.llm_factory = llm_factory
+        self.agents_provider = agents_provider
+        self.max_agents = max_agents
+
+    def _menu(self, candidates: Optional[Sequence[str]] = None) -> Tuple[str, List[str]]:
+        """
+        Меню агентов для промпта и список допустимых ID.
+
+        candidates ограничивает меню этими агентами в заданном порядке
+        (шорт-лист двухэтапной маршрутизации).
+        """
+        agents = self.agents_provider()
+        if isinstance(agents, AgentsSnapshot):
+            if candidates is None:
+                return agents.routing_menu, list(agents.agent_ids)
+            agents = agents.agents
+        if candidates is not None:
+            by_id = {agent["id"]: agent for agent in agents}
+            agents = [by_id[agent_id] for agent_id in candidates if agent_id in by_id]
+        return render_routing_menu(agents), [a["id"] for a in agents]
+
+    def _parse_routes(self, raw: str, agent_ids: Sequence[str]) -> List[str]:
+        """Оставляет только существующих агентов, без повторов; fallback — первый агент"""
+        routes: List[str] = []
+        for candidate in _ROUTE_SEPARATOR.split(raw.lower()):
+            candidate = candidate.strip(".:'\"`")
+            if candidate in agent_ids and candidate not in routes:
+                routes.append(candidate)
+        routes = routes[:self.max_agents]
+        if not routes:
+            # Если агент не найден, выбираем первого доступного (fallback)
+            routes = [agent_ids[0] if agent_ids else "agent1"]
+        return routes
+
+    def _fanout_hint(self) -> str:
+        if self.max_agents <= 1:
+            return ""
+        return (
+            " Если запрос требует работы нескольких специалистов, перечислите"
+            f" до {self.max_agents} ID через запятую."
+        )
+
+    def _routing_prompt(self, agents_list: str, valid_agent_ids: str, query: str) -> str:
+        routing_prompt = f"""Вы оркестратор-маршрутизатор. Проанализируйте запрос пользователя и определите,
+к какому из следующих агентов его направить:
+
+{agents_list}
+
+Запрос пользователя: {query}
+
+Ответьте только ID агента ({valid_agent_ids}) без дополнительных пояснений."""
+        return routing_prompt + self._fanout_hint()
+
+    async def route(self, query: str, candidates: Optional[Sequence[str]] = None) -> RouteDecision:
+        agents_list, agent_ids = self._menu(candidates)
+
+        # Формируем список ID агентов для валидации
+        valid_agent_ids = ", ".join(agent_ids)
+
+        # Меню агентов не сокращается; слишком длинный запрос обрезается
+        prompt = get_token_budget().fit(
+            "orchestrator",
+            lambda parts: [
+                ROUTER_SYSTEM_PROMPT, self._routing_prompt(agents_list, valid_agent_ids, parts["input"])
+            ],
+            {"input": query},
+            (("input", "end"),),
+        )
+
+        from langchain_core.messages import HumanMessage, SystemMessage
+
+        messages = [
+            SystemMessage(content=ROUTER_SYSTEM_PROMPT),
+            HumanMessage(content=prompt.texts[1])
+        ]
+
+        response = await ainvoke_llm(self.llm_factory(), messages, node="orchestrator", **prompt.llm_kwargs)
+        raw_route = response.content.strip()
+        routes = self._parse_routes(raw_route, agent_ids)
+
+        return RouteDecision(
+            route=routes[0], source="llm", raw=raw_route, usage=token_usage(response), routes=routes,
+            estimate=prompt.estimate,
+        )
+
+    async def route_batch(
+        self, queries: Sequence[str], candidates: Optional[Sequence[Sequence[str]]] = None
+    ) -> List[RouteDecision]:
+        """
+        Маршрутизирует несколько запросов одним вызовом LLM.
+
+        Запросы нумеруются в промпте, LLM отвечает строками "<номер>: <ID>".
+        Запрос без строки в ответе получает fallback-агента. Токены вызова и
+        его оценка записываются в первое решение, чтобы не считать их повторно.
+        candidates — шорт-листы запросов; меню пачки — их объединение
+        (его размер ограничивает вызывающий, см. ShortlistRouter).
+        """
+        if not queries:
+            return []
+        if len(queries) == 1:
+            return [await self.route(queries[0], candidates[0] if candidates else None)]
+
+        merged = None
+        if candidates:
+            merged = list(dict.fromkeys(agent_id for group in candidates for agent_id in group))
+        agents_list, agent_ids = self._menu(merged)
+        valid_agent_ids = ", ".join(agent_ids)
+        names = [f"query{index}" for index in range(1, len(queries) + 1)]
+
+        def build(parts: Dict[str, str]) -> List[str]:
+            numbered = "\n".join(
+                f"{index}. {' '.join(parts[name].split())}" for index, name in enumerate(names, 1)
+            )
+            routing_prompt = f"""Вы оркестратор-маршрутизатор. Для каждого из запросов пользователей определите,
+к какому из следующих агентов его направить:
+
+{agents_list}
+
+Запросы пользователей:
+{numbered}
+
+Ответьте по одной строке на запрос в формате "<номер>: <ID агента>" ({valid_agent_ids}) без дополнительных пояснений."""
+            return [ROUTER_SYSTEM_PROMPT, routing_prompt + self._fanout_hint()]
+
+        # Каждый запрос получает равную долю бюджета: сокращаются только те,
+        # что в неё не влезают
+        budget = get_token_budget()
+        fixed = budget.counter.count_messages(build({name: "" for name in names}))
+        share = max(1, (budget.input_budget("orchestrator") - fixed) // len(queries))
+        parts = {name: shrink(budget.counter, query, share, "end") for name, query in zip(names, queries)}
+        prompt = budget.fit(
+            "orchestrator", build, parts, (),
+            max_tokens=(budget.max_tokens("orchestrator") or 0) * len(queries) or None,
+        )
+        prompt.trimmed = [name for name, query in zip(names, queries) if parts[name] != query]
+
+        from langchain_core.messages import HumanMessage, SystemMessage
+
+        messages = [
+            SystemMessage(content=ROUTER_SYSTEM_PROMPT),
+            HumanMessage(content=prompt.texts[1])
+        ]
+
+        response = await ainvoke_llm(self.llm_factory(), messages, node="orchestrator", **prompt.llm_kwargs)
+
+        answers: Dict[int, str] = {}
+        for line in response.content.strip().splitlines():
+            match = _BATCH_LINE.match(line)
+            if match:
+                answers.setdefault(int(match.group(1)), match.group(2).strip())
+
+        usage = token_usage(response)
+        decisions = []
+        for index in range(1, len(queries) + 1):
+            raw_route = answers.get(index, "")
+            routes = self._parse_routes(raw_route, agent_ids)
+            decisions.append(RouteDecision(
+                route=routes[0], source="llm", raw=raw_route,
+                usage=usage if index == 1 else {}, routes=routes,
+                estimate=prompt.estimate if index == 1 else {},
+            ))
+        return decisions
+
+
+class ShortlistRouter:
+    """
+    Двухэтапная маршрутизация для больших каталогов агентов.
+
+    Локальный классификатор отбирает k агентов с наибольшим скором, в промпт
+    LLM попадают только они: размер промпта и задержка маршрутизации зависят
+    от k, а не от числа агентов. Если ответ LLM не распознан, выбирается
+    лучший агент шорт-листа.
+
+    Пачка запросов делится на группы, объединение шорт-листов которых не
+    длиннее max_menu агентов (по умолчанию 2k); каждая группа — один вызов
+    LLM, группы маршрутизируются параллельно.
+    """
+
+    def __init__(
+        self, local: LocalRouter, llm: LLMRouter, k: int = DEFAULT_SHORTLIST_K, max_menu: Optional[int] = None
+    ):
+        self.local = local
+        self.llm = llm
+        self.k = k
+        self.max_menu = max(k, max_menu or SHORTLIST_BATCH_MENU_FACTOR * k)
+
+    @staticmethod
+    def _annotate(decision: RouteDecision, shortlist: Dict[str, float]) -> RouteDecision:
+        decision.shortlist = list(shortlist)
+        decision.scores = shortlist
+        return decision
+
+    async def route(self, query: str) -> RouteDecision:
+        shortlist = self.local.shortlist(query, self.k)
+        return self._annotate(await self.llm.route(query, candidates=list(shortlist)), shortlist)
+
+    def _groups(self, shortlists: Sequence[Dict[str, float]]) -> List[List[int]]:
+        """
+        Индексы запросов по группам: запрос попадает в первую группу, меню
+        которой с его шорт-листом не длиннее max_menu (у похожих запросов
+        шорт-листы пересекаются), иначе открывает новую.
+        """
+        groups: List[Tuple[List[int], Dict[str, None]]] = []
+        for index, shortlist in enumerate(shortlists):
+            for members, menu in groups:
+                if len(menu.keys() | shortlist.keys()) <= self.max_menu:
+                    members.append(index)
+                    menu.update(dict.fromkeys(shortlist))
+                    break
+            else:
+                groups.append(([index], dict.fromkeys(shortlist)))
+        return [members for members, _ in groups]
+
+    async def route_batch(self, queries: Sequence[str]) -> List[RouteDecision]:
+        shortlists = [self.local.shortlist(query, self.k) for query in queries]
+        groups = self._groups(shortlists)
+        results = await asyncio.gather(*(
+            self.llm.route_batch(
+                [queries[index] for index in members],
+                candidates=[list(shortlists[index]) for index in members],
+            )
+            for members in groups
+        ))
+
+        decisions: List[Optional[RouteDecision]] = [None] * len(queries)
+        for members, group_decisions in zip(groups, results):
+            for index, decision in zip(members, group_decisions):
+                decisions[index] = self._annotate(decision, shortlists[index])
+        return decisions
+
+
+class HybridRouter:
+    """Локальный классификатор с fallback на LLM при неуверенном решении"""
+
+    def __init__(
+        self, local: LocalRouter, fallback: Union[LLMRouter, ShortlistRouter], margin_threshold: float
+    ):
+        self.local = local
+        self.fallback = fallback
+        self.margin_threshold = margin_threshold
+
+    async def route(self, query: str) -> RouteDecision:
+        decision = self.local.classify(query)
+        if decision.route is not None and decision.margin >= self.margin_threshold:
+            return decision
+
+        llm_decision = await self.fallback.route(query)
+        llm_decision.margin = decision.margin
+        llm_decision.scores = decision.scores
+        return llm_decision
+
+    async def route_batch(self, queries: Sequence[str]) -> List[RouteDecision]:
+        """Неуверенные решения классификатора уточняются одним вызовом LLM"""
+        decisions = [self.local.classify(query) for query in queries]
+        uncertain = [
+            index for index, decision in enumerate(decisions)
+            if decision.route is None or decision.margin < self.margin_threshold
+        ]
+        if uncertain:
+            llm_decisions = await self.fallback.route_batch([queries[i] for i in uncertain])
+            for index, llm_decision in zip(uncertain, llm_decisions):
+                llm_decision.margin = decisions[index].margin
+                llm_decision.scores = decisions[index].scores
+                decisions[index] = llm_decision
+        return decisions
+
+
+def load_examples(path: Optional[str]) -> Dict[str, List[str]]:
+    """
+    Загружает размеченные запросы для локального классификатора.
+
+    Формат — JSONL: {"query": "...", "route": "agent2"} на строку.
+    """
+    examples: Dict[str, List[str]] = {}
+    if not path:
+        return examples
+
+    file_path = Path(path)
+    if not file_path.exists():
+        logger.warning(f"Router examples file {file_path} not found")
+        return examples
+
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                examples.setdefault(item["route"], []).append(item["query"])
+
+    logger.info(f"Loaded {sum(map(len, examples.values()))} router examples from {file_path}")
+    return examples
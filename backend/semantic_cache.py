@@ -0,0 +1,294 @@
+"""
+Семантический кэш ответов: близкие по формулировке запросы.
+
+Точный кэш (response_cache) промахивается, когда аналитик повторно
+отправляет ту же инициативу с небольшими правками текста. Этот слой хранит
+векторы прошлых запросов — хэшированные символьные n-граммы (feature hashing,
+без обучения и внешних сервисов) — в матрице NumPy и отдаёт сохранённый
+ответ, если косинусная близость к запросу не ниже порога маршрута записи, а
+маршрут, версия его промпта и модель по-прежнему совпадают.
+
+Косинус по n-граммам плохо отличает запросы, где заменено одно слово
+(«…для отдела продаж» и «…для отдела закупок» близки на ~0.75), поэтому
+кандидат дополнительно проверяется по словам: добавленные или удалённые
+слова допустимы, замена слова другим (не формой того же слова) — промах.
+
+Поиск — одно умножение матрицы N × dim на вектор запроса. Память ограничена
+числом записей (SEMANTIC_CACHE_MAX_ENTRIES) и суммарным размером ответов и
+векторов в байтах; при переполнении вытесняется давно не использованная
+запись (LRU), её строка матрицы переиспользуется.
+"""
+
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Mapping, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+from agents_storage import get_storage
+from response_cache import normalize_query
+from router import char_ngrams
+
+DEFAULT_DIM = 256
+DEFAULT_THRESHOLD = 0.8
+DEFAULT_MAX_ENTRIES = 10_000
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+DEFAULT_TTL_SECONDS = 3600
+# Сколько ближайших записей проверять, если лучшая не подходит по версии/TTL
+CANDIDATES = 8
+# Общий префикс, при котором разные слова считаются формами одного слова
+INFLECTION_PREFIX = 3
+
+_WORD = re.compile(r"\w+")
+
+
+def embed(text: str, dim: int = DEFAULT_DIM) -> np.ndarray:
+    """
+    Вектор запроса: символьные n-граммы, хэшированные в dim измерений со
+    знаком (коллизии в среднем гасят друг друга), сублинейный tf, L2-норма.
+    """
+    grams = char_ngrams(text)
+    vector = np.zeros(dim, dtype=np.float32)
+    if not grams:
+        return vector
+    hashes = np.fromiter((zlib.crc32(gram.encode("utf-8")) for gram in grams), dtype=np.uint64)
+    signs = np.where(hashes & (1 << 31), -1.0, 1.0)
+    counts = np.bincount((hashes % dim).astype(np.int64), weights=signs, minlength=dim)
+    vector[:] = np.sign(counts) * np.log1p(np.abs(counts))
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def terms(text: str) -> frozenset:
+    """Множество слов запроса после нормализации"""
+    return frozenset(_WORD.findall(normalize_query(text)))
+
+
+def _inflected(word: str, others: frozenset) -> bool:
+    return len(word) > INFLECTION_PREFIX and any(
+        other[:INFLECTION_PREFIX] == word[:INFLECTION_PREFIX] for other in others
+    )
+
+
+def same_request(query_terms: frozenset, entry_terms: frozenset) -> bool:
+    """
+    Нет ли замены слова: после отбрасывания форм одного слова (общий префикс)
+    несовпадающие слова могут остаться только с одной стороны.
+    """
+    added = query_terms - entry_terms
+    removed = entry_terms - query_terms
+    added = {word for word in added if not _inflected(word, removed)}
+    removed = {word for word in removed if not _inflected(word, added)}
+    return not (added and removed)
+
+
+@dataclass
+class SemanticEntry:
+    query: str
+    terms: frozenset
+    route: str
+    prompt_version: str
+    model: str
+    result: dict
+    size: int
+    expires_at: float
+
+
+class SemanticCache:
+    """Кэш ответов с поиском ближайшего запроса по косинусной близости"""
+
+    def __init__(
+        self,
+        threshold: float = DEFAULT_THRESHOLD,
+        route_thresholds: Optional[Mapping[str, float]] = None,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        ttl_seconds: float = DEFAULT_TTL_SECONDS,
+        dim: int = DEFAULT_DIM,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        self.threshold = threshold
+        self.route_thresholds = dict(route_thresholds or {})
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.dim = dim
+        self._clock = clock
+        # Строки матрицы растут удвоением до max_entries; пустые строки нулевые
+        self._vectors = np.zeros((min(1024, max_entries), dim), dtype=np.float32)
+        self._rows = 0
+        self._free: List[int] = []
+        # Строка матрицы -> запись, в порядке использования (LRU)
+        self._entries: "OrderedDict[int, SemanticEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def threshold_for(self, route: str) -> float:
+        return self.route_thresholds.get(route, self.threshold)
+
+    def get(
+        self,
+        query: str,
+        model: str,
+        prompt_version_of: Callable[[str], Optional[str]]
+    ) -> Optional[dict]:
+        """
+        Ответ на самый близкий сохранённый запрос или None.
+
+        Запись подходит, если близость не ниже порога её маршрута, модель
+        совпадает, версия промпта агента не изменилась, TTL не истёк и
+        в запросе не заменено ни одно слово (same_request). Результат дополняется полем similarity.
+        """
+        vector = embed(query, self.dim)
+        query_terms = terms(query)
+        matches: List[Tuple[int, SemanticEntry, float]] = []
+        with self._lock:
+            if self._entries:
+                scores = self._vectors[:self._rows] @ vector
+                k = min(CANDIDATES, self._rows)
+                candidates = np.argpartition(-scores, k - 1)[:k]
+                now = self._clock()
+                for row in candidates[np.argsort(-scores[candidates])]:
+                    row = int(row)
+                    entry = self._entries.get(row)
+                    if entry is None:
+                        continue
+                    similarity = float(scores[row])
+                    if similarity < self.threshold_for(entry.route):
+                        continue
+                    if entry.expires_at <= now:
+                        self._remove(row)
+                        continue
+                    if entry.model != model or not same_request(query_terms, entry.terms):
+                        continue
+                    matches.append((row, entry, similarity))
+
+        # Версии промптов запрашиваются вне блокировки: хранилище может
+        # уведомить подписчиков, а invalidate_route берёт ту же блокировку
+        versions = {route: prompt_version_of(route) for route in {entry.route for _, entry, _ in matches}}
+
+        with self._lock:
+            for row, entry, similarity in matches:
+                # Запись могли удалить или заменить, пока блокировка была отпущена
+                if self._entries.get(row) is not entry or versions[entry.route] != entry.prompt_version:
+                    continue
+                self._entries.move_to_end(row)
+                self.hits += 1
+                return dict(entry.result, similarity=round(similarity, 4))
+
+            self.misses += 1
+            return None
+
+    def put(self, query: str, route: str, prompt_version: str, model: str, result: dict):
+        """Сохраняет ответ; записи крупнее max_bytes не кэшируются"""
+        size = len(json.dumps(result, ensure_ascii=False).encode("utf-8")) + self.dim * 4
+        if size > self.max_bytes:
+            return
+
+        vector = embed(query, self.dim)
+        with self._lock:
+            row = self._allocate_row()
+            self._vectors[row] = vector
+            self._entries[row] = SemanticEntry(
+                query=query,
+                terms=terms(query),
+                route=route,
+                prompt_version=prompt_version,
+                model=model,
+                result=dict(result),
+                size=size,
+                expires_at=self._clock() + self.ttl_seconds,
+            )
+            self.size_bytes += size
+
+            while self.size_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_route(self, route: str):
+        """Удаляет все записи агента (вызывается при изменении его промпта)"""
+        with self._lock:
+            stale = [row for row, entry in self._entries.items() if entry.route == route]
+            for row in stale:
+                self._remove(row)
+        if stale:
+            logger.debug(f"Invalidated {len(stale)} semantic cache entries for {route}")
+
+    def clear(self):
+        with self._lock:
+            self._vectors[:self._rows] = 0
+            self._rows = 0
+            self._free.clear()
+            self._entries.clear()
+            self.size_bytes = 0
+
+    @property
+    def matrix_bytes(self) -> int:
+        """Память, занятая матрицей векторов"""
+        return self._vectors.nbytes
+
+    def _allocate_row(self) -> int:
+        if len(self._entries) >= self.max_entries:
+            self._remove(next(iter(self._entries)))
+        if self._free:
+            return self._free.pop()
+        if self._rows == len(self._vectors):
+            grown = np.zeros((min(len(self._vectors) * 2, self.max_entries), self.dim), dtype=np.float32)
+            grown[:self._rows] = self._vectors[:self._rows]
+            self._vectors = grown
+        self._rows += 1
+        return self._rows - 1
+
+    def _remove(self, row: int):
+        entry = self._entries.pop(row)
+        self.size_bytes -= entry.size
+        # Нулевая строка даёт близость 0 и никогда не проходит порог
+        self._vectors[row] = 0
+        self._free.append(row)
+
+
+# Глобальный инстанс (None — слой выключен)
+_cache: Optional[SemanticCache] = None
+_cache_initialized = False
+
+
+def _route_thresholds() -> Dict[str, float]:
+    raw = json.loads(os.getenv("SEMANTIC_CACHE_THRESHOLDS") or "{}")
+    return {route: float(value) for route, value in raw.items()}
+
+
+def get_semantic_cache() -> Optional[SemanticCache]:
+    """
+    Возвращает семантический кэш, если он включён через SEMANTIC_CACHE_ENABLED.
+
+    Настройки: SEMANTIC_CACHE_THRESHOLD (порог по умолчанию),
+    SEMANTIC_CACHE_THRESHOLDS (JSON с порогами по агентам),
+    SEMANTIC_CACHE_MAX_ENTRIES, SEMANTIC_CACHE_MAX_BYTES,
+    SEMANTIC_CACHE_TTL_SECONDS, SEMANTIC_CACHE_DIM.
+    """
+    global _cache, _cache_initialized
+    if not _cache_initialized:
+        _cache_initialized = True
+        if os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() in ("1", "true", "yes"):
+            _cache = SemanticCache(
+                threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", DEFAULT_THRESHOLD)),
+                route_thresholds=_route_thresholds(),
+                max_entries=int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)),
+                max_bytes=int(os.getenv("SEMANTIC_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)),
+                ttl_seconds=float(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", DEFAULT_TTL_SECONDS)),
+                dim=int(os.getenv("SEMANTIC_CACHE_DIM", DEFAULT_DIM)),
+            )
+            get_storage().subscribe_prompt_changes(_cache.invalidate_route)
+            logger.info("✅ Semantic response cache enabled")
+    return _cache
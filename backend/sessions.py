@@ -0,0 +1,296 @@
+"""
+Сессии диалога: история запросов хранится на сервере.
+
+Клиент передаёт session_id вместо того, чтобы пересылать прошлые ответы.
+Агент получает сжатую историю: последние ходы целиком в пределах бюджета
+токенов (SESSION_WINDOW_TOKENS) и накопительную сводку более старых ходов
+(SESSION_SUMMARY_TOKENS). Сводка строится инкрементально: при добавлении хода
+вытесненные из окна ходы дописываются в неё одной строкой, без пересчёта
+всей истории и без дополнительных вызовов LLM.
+
+Сессии хранятся в SQLite (WAL) и доступны всем процессам сервера.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import List, Optional
+
+from loguru import logger
+
+DEFAULT_WINDOW_TOKENS = 1500
+DEFAULT_SUMMARY_TOKENS = 500
+DEFAULT_TTL_SECONDS = 24 * 3600
+
+# Сколько символов хода попадает в строку сводки
+SUMMARY_QUERY_CHARS = 150
+SUMMARY_RESPONSE_CHARS = 250
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов (~4 символа на токен)"""
+    return len(text) // 4 + 1
+
+
+def _shorten(text: str, limit: int) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+def summary_line(turn: dict) -> str:
+    """Строка сводки для хода, вытесненного из окна"""
+    return (
+        f"- Запрос: {_shorten(turn['query'], SUMMARY_QUERY_CHARS)} → "
+        f"{turn['route']}: {_shorten(turn['response'], SUMMARY_RESPONSE_CHARS)}"
+    )
+
+
+def render_history(summary: str, turns: List[dict]) -> str:
+    """Сжатая история для промпта агента"""
+    parts = []
+    if summary:
+        parts.append(f"Краткое содержание начала диалога:\n{summary}")
+    for turn in turns:
+        parts.append(f"Пользователь: {turn['query']}\nОтвет ({turn['route']}): {turn['response']}")
+    return "\n\n".join(parts)
+
+
+class SessionNotFoundError(Exception):
+    """Сессия не существует или истекла"""
+
+
+class SessionStore:
+    """Сессии и ходы диалога в SQLite"""
+
+    def __init__(
+        self,
+        db_path: str,
+        window_tokens: int = DEFAULT_WINDOW_TOKENS,
+        summary_tokens: int = DEFAULT_SUMMARY_TOKENS,
+        ttl_seconds: float = DEFAULT_TTL_SECONDS,
+        busy_timeout_ms: int = 5000
+    ):
+        self.db_path = str(db_path)
+        self.window_tokens = window_tokens
+        self.summary_tokens = summary_tokens
+        self.ttl_seconds = ttl_seconds
+        self.busy_timeout_ms = busy_timeout_ms
+        self._connection: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # После fork соединение родителя использовать нельзя — открываем своё
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(
+                self.db_path, isolation_level=None, check_same_thread=False
+            )
+            connection.row_factory = sqlite3.Row
+            connection.execute(f"PRAGMA busy_timeout = {self.busy_timeout_ms}")
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            connection.execute(
+                """CREATE TABLE IF NOT EXISTS sessions (
+                    id TEXT PRIMARY KEY,
+                    routes TEXT,
+                    summary TEXT NOT NULL DEFAULT '',
+                    summary_tokens INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )"""
+            )
+            connection.execute(
+                """CREATE TABLE IF NOT EXISTS session_turns (
+                    session_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    query TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    route TEXT NOT NULL,
+                    tokens INTEGER NOT NULL,
+                    in_window INTEGER NOT NULL DEFAULT 1,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (session_id, seq)
+                )"""
+            )
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    def _execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._connect().execute(sql, params)
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def create(self) -> dict:
+        self.purge(time.time() - self.ttl_seconds)
+        session_id = uuid.uuid4().hex
+        now = time.time()
+        self._execute(
+            "INSERT INTO sessions (id, created_at, updated_at) VALUES (?, ?, ?)",
+            (session_id, now, now),
+        )
+        return self.get(session_id)
+
+    def get(self, session_id: str) -> Optional[dict]:
+        """Сессия с маршрутом и сводкой или None (в том числе истёкшая)"""
+        row = self._execute("SELECT * FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        if row is None or row["updated_at"] < time.time() - self.ttl_seconds:
+            return None
+        session = dict(row)
+        session["routes"] = json.loads(session["routes"]) if session["routes"] else None
+        return session
+
+    def turns(self, session_id: str, window_only: bool = False) -> List[dict]:
+        sql = "SELECT * FROM session_turns WHERE session_id = ?"
+        if window_only:
+            sql += " AND in_window = 1"
+        rows = self._execute(sql + " ORDER BY seq", (session_id,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def history(self, session_id: str) -> str:
+        """Сжатая история сессии (сводка + окно последних ходов)"""
+        session = self.get(session_id)
+        if session is None:
+            raise SessionNotFoundError(f"Сессия {session_id} не найдена")
+        return render_history(session["summary"], self.turns(session_id, window_only=True))
+
+    def append(self, session_id: str, query: str, response: str, routes: List[str]):
+        """
+        Добавляет ход и сжимает историю: пока окно больше бюджета, самый
+        старый ход уходит в сводку; сводка обрезается с начала по своему бюджету.
+        Последний ход остаётся в окне всегда.
+        """
+        now = time.time()
+        tokens = estimate_tokens(query) + estimate_tokens(response)
+        with self._transaction() as connection:
+            session = connection.execute(
+                "SELECT summary, summary_tokens FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+            if session is None:
+                raise SessionNotFoundError(f"Сессия {session_id} не найдена")
+
+            seq = connection.execute(
+                "SELECT COALESCE(MAX(seq), 0) + 1 FROM session_turns WHERE session_id = ?",
+                (session_id,),
+            ).fetchone()[0]
+            connection.execute(
+                "INSERT INTO session_turns (session_id, seq, query, response, route, tokens, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (session_id, seq, query, response, ", ".join(routes), tokens, now),
+            )
+
+            window = connection.execute(
+                "SELECT seq, query, response, route, tokens FROM session_turns "
+                "WHERE session_id = ? AND in_window = 1 ORDER BY seq",
+                (session_id,),
+            ).fetchall()
+            window_tokens = sum(turn["tokens"] for turn in window)
+            lines = session["summary"].splitlines() if session["summary"] else []
+            summary_tokens = session["summary_tokens"]
+
+            evicted = []
+            while window_tokens > self.window_tokens and len(window) - len(evicted) > 1:
+                turn = window[len(evicted)]
+                evicted.append(turn["seq"])
+                window_tokens -= turn["tokens"]
+                line = summary_line(dict(turn))
+                lines.append(line)
+                summary_tokens += estimate_tokens(line)
+
+            while summary_tokens > self.summary_tokens and len(lines) > 1:
+                summary_tokens -= estimate_tokens(lines.pop(0))
+
+            if evicted:
+                connection.executemany(
+                    "UPDATE session_turns SET in_window = 0 WHERE session_id = ? AND seq = ?",
+                    [(session_id, seq) for seq in evicted],
+                )
+            connection.execute(
+                "UPDATE sessions SET routes = ?, summary = ?, summary_tokens = ?, updated_at = ? "
+                "WHERE id = ?",
+                (json.dumps(routes), "\n".join(lines), summary_tokens, now, session_id),
+            )
+
+    def delete(self, session_id: str) -> bool:
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM session_turns WHERE session_id = ?", (session_id,))
+            cursor = connection.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+        return cursor.rowcount == 1
+
+    def purge(self, older_than: float) -> int:
+        """Удаляет сессии без активности с момента older_than"""
+        with self._transaction() as connection:
+            connection.execute(
+                "DELETE FROM session_turns WHERE session_id IN "
+                "(SELECT id FROM sessions WHERE updated_at < ?)",
+                (older_than,),
+            )
+            cursor = connection.execute("DELETE FROM sessions WHERE updated_at < ?", (older_than,))
+        if cursor.rowcount:
+            logger.info(f"Purged {cursor.rowcount} expired sessions")
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None and self._pid == os.getpid():
+                self._connection.close()
+            self._connection = None
+
+
+def _iso(timestamp: Optional[float]) -> Optional[str]:
+    return datetime.fromtimestamp(timestamp).isoformat() if timestamp else None
+
+
+def session_view(store: SessionStore, session: dict) -> dict:
+    """Представление сессии для API"""
+    turns = store.turns(session["id"])
+    return {
+        "session_id": session["id"],
+        "routes": session["routes"],
+        "summary": session["summary"],
+        "turns": [
+            {
+                "seq": turn["seq"],
+                "query": turn["query"],
+                "response": turn["response"],
+                "route": turn["route"],
+                "in_window": bool(turn["in_window"]),
+                "created_at": _iso(turn["created_at"]),
+            }
+            for turn in turns
+        ],
+        "created_at": _iso(session["created_at"]),
+        "updated_at": _iso(session["updated_at"]),
+    }
+
+
+_store: Optional[SessionStore] = None
+
+
+def get_session_store() -> SessionStore:
+    """Глобальное хранилище сессий (SESSIONS_DB_PATH)"""
+    global _store
+    if _store is None:
+        _store = SessionStore(
+            os.getenv("SESSIONS_DB_PATH", "sessions.db"),
+            window_tokens=int(os.getenv("SESSION_WINDOW_TOKENS", DEFAULT_WINDOW_TOKENS)),
+            summary_tokens=int(os.getenv("SESSION_SUMMARY_TOKENS", DEFAULT_SUMMARY_TOKENS)),
+            ttl_seconds=float(os.getenv("SESSION_TTL_SECONDS", DEFAULT_TTL_SECONDS)),
+        )
+    return _store
@@ -0,0 +1,164 @@
+"""
+Объединение одинаковых запросов и ключи идемпотентности.
+
+- SingleFlight: одинаковые запросы, выполняющиеся одновременно (тот же
+  нормализованный текст, модель и версии промптов агентов), разделяют один
+  прогон графа, результат получает каждый.
+- IdempotencyStore: повтор запроса с тем же заголовком Idempotency-Key
+  присоединяется к выполняющемуся прогону или получает его готовый
+  результат. Записи живут IDEMPOTENCY_TTL_SECONDS, их не больше
+  IDEMPOTENCY_MAX_KEYS (вытесняется самая старая). Неудачный прогон записи
+  не оставляет: повтор выполнит запрос заново.
+
+Общий прогон не отменяется, если клиент, который его запустил, отключился:
+его ждут остальные. Состояние хранится в памяти процесса, поэтому воркеры
+gunicorn объединяют только свои запросы.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, Mapping, Optional, Tuple
+
+from response_cache import normalize_query
+
+DEFAULT_IDEMPOTENCY_TTL_SECONDS = 3600
+DEFAULT_IDEMPOTENCY_MAX_KEYS = 1000
+# Как в черновике IETF httpapi-idempotency-key-header
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+_ENV_VARS = ("IDEMPOTENCY_TTL_SECONDS", "IDEMPOTENCY_MAX_KEYS")
+
+
+class IdempotencyKeyReused(Exception):
+    """Ключ идемпотентности уже использован для запроса с другим телом"""
+
+
+def coalescing_key(query: str, model: str, prompt_versions: Mapping[str, str]) -> str:
+    """Ключ объединения: нормализованный запрос, модель и версии промптов всех агентов"""
+    raw = json.dumps([normalize_query(query), model, sorted(prompt_versions.items())], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def request_fingerprint(*fields: Any) -> str:
+    """Отпечаток тела запроса: у повтора с тем же ключом он должен совпадать"""
+    return hashlib.sha256(json.dumps(fields, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def _retrieve_exception(future: asyncio.Future):
+    # Ошибку общего прогона забирают ожидающие; если их не осталось, asyncio
+    # не должен писать "exception was never retrieved"
+    if not future.cancelled():
+        future.exception()
+
+
+class SingleFlight:
+    """Один выполняющийся вызов на ключ; остальные вызовы с тем же ключом ждут его результата"""
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: str, run: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Результат run() и признак, что он получен от уже выполнявшегося вызова"""
+        future = self._calls.get(key)
+        shared = future is not None
+        if future is None:
+            future = asyncio.ensure_future(run())
+            self._calls[key] = future
+            future.add_done_callback(partial(self._forget, key))
+        # Отмена одного ожидающего (обрыв соединения) не отменяет общий прогон
+        return await asyncio.shield(future), shared
+
+    def _forget(self, key: str, future: asyncio.Future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+        _retrieve_exception(future)
+
+
+@dataclass
+class IdempotencyRecord:
+    fingerprint: str
+    future: asyncio.Future
+    expires_at: float
+
+
+class IdempotencyStore:
+    """Выполняющиеся и завершённые прогоны по ключу идемпотентности (TTL и лимит ключей)"""
+
+    def __init__(
+        self,
+        ttl_seconds: float = DEFAULT_IDEMPOTENCY_TTL_SECONDS,
+        max_keys: int = DEFAULT_IDEMPOTENCY_MAX_KEYS,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.max_keys = max_keys
+        self._clock = clock
+        self._records: "OrderedDict[str, IdempotencyRecord]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def _evict(self):
+        now = self._clock()
+        # Записи упорядочены по времени создания, срок у всех одинаковый
+        while self._records and next(iter(self._records.values())).expires_at <= now:
+            self._records.popitem(last=False)
+        while len(self._records) > self.max_keys:
+            self._records.popitem(last=False)
+
+    async def run(self, key: str, fingerprint: str, run: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Результат прогона для ключа и признак повтора (прогон уже выполнялся
+        или выполнен). Ключ с другим отпечатком тела — IdempotencyKeyReused.
+        """
+        self._evict()
+        record = self._records.get(key)
+        if record is not None and record.fingerprint != fingerprint:
+            raise IdempotencyKeyReused("Ключ идемпотентности уже использован для другого запроса")
+
+        replayed = record is not None
+        if record is None:
+            record = IdempotencyRecord(
+                fingerprint, asyncio.ensure_future(run()), self._clock() + self.ttl_seconds
+            )
+            self._records[key] = record
+            record.future.add_done_callback(partial(self._finished, key, record))
+            self._evict()
+        return await asyncio.shield(record.future), replayed
+
+    def _finished(self, key: str, record: IdempotencyRecord, future: asyncio.Future):
+        _retrieve_exception(future)
+        if (future.cancelled() or future.exception() is not None) and self._records.get(key) is record:
+            del self._records[key]
+
+
+_single_flight = SingleFlight()
+_idempotency_store: Optional[IdempotencyStore] = None
+_idempotency_store_key: Optional[tuple] = None
+
+
+def get_single_flight() -> SingleFlight:
+    return _single_flight
+
+
+def get_idempotency_store() -> IdempotencyStore:
+    """Хранилище ключей идемпотентности; пересоздаётся при изменении настроек"""
+    global _idempotency_store, _idempotency_store_key
+
+    key = tuple(os.getenv(name) for name in _ENV_VARS)
+    if _idempotency_store is None or key != _idempotency_store_key:
+        _idempotency_store = IdempotencyStore(
+            ttl_seconds=float(os.getenv("IDEMPOTENCY_TTL_SECONDS", DEFAULT_IDEMPOTENCY_TTL_SECONDS)),
+            max_keys=int(os.getenv("IDEMPOTENCY_MAX_KEYS", DEFAULT_IDEMPOTENCY_MAX_KEYS)),
+        )
+        _idempotency_store_key = key
+    return _idempotency_store
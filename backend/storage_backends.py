@@ -0,0 +1,246 @@
+"""
+Бэкенды персистентности для AgentsStorage.
+
+- JsonAgentsBackend: JSON-файл; запись через временный файл + fsync + rename
+  под межпроцессной блокировкой (fcntl), обновление одного агента сливается
+  с актуальным содержимым файла
+- SqliteAgentsBackend: SQLite в режиме WAL, построчные обновления
+
+Оба бэкенда поддерживают оптимистичную блокировку по updated_at и дешёвую
+проверку изменений другими процессами (change_token).
+"""
+
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Hashable, Optional
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+AGENT_FIELDS = ("id", "name", "description", "prompt", "color", "created_at", "updated_at")
+
+
+class StorageConflictError(Exception):
+    """Агент был изменён другим запросом после того, как клиент его прочитал"""
+
+
+class AgentsBackend:
+    """Интерфейс бэкенда хранилища агентов (данные — словари Agent.to_dict())"""
+
+    def load_all(self) -> Optional[Dict[str, dict]]:
+        """Все агенты или None, если хранилище ещё не инициализировано"""
+        raise NotImplementedError
+
+    def save_all(self, agents: Dict[str, dict]):
+        """Полностью перезаписывает набор агентов"""
+        raise NotImplementedError
+
+    def save_agent(self, agent: dict, expected_updated_at: Optional[str] = None):
+        """
+        Сохраняет одного агента.
+
+        Если передан expected_updated_at и сохранённая версия агента другая,
+        бросает StorageConflictError.
+        """
+        raise NotImplementedError
+
+    def change_token(self) -> Hashable:
+        """Значение, которое меняется при записи хранилища другим процессом"""
+        raise NotImplementedError
+
+    def close(self):
+        """Освобождает ресурсы бэкенда (соединения); по умолчанию ничего не делает"""
+
+
+class JsonAgentsBackend(AgentsBackend):
+    """Хранение в JSON-файле с атомарной записью"""
+
+    def __init__(self, file_path: str):
+        self.file_path = Path(file_path)
+        self.lock_path = self.file_path.with_name(self.file_path.name + ".lock")
+
+    @contextmanager
+    def _locked(self):
+        """Эксклюзивная межпроцессная блокировка на время чтения-изменения-записи"""
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self) -> Optional[Dict[str, dict]]:
+        if not self.file_path.exists():
+            return None
+        with open(self.file_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _write(self, agents: Dict[str, dict]):
+        """Пишет во временный файл рядом и атомарно подменяет исходный"""
+        directory = self.file_path.parent
+        fd, temp_path = tempfile.mkstemp(
+            dir=directory, prefix=f".{self.file_path.name}.", suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(agents, f, indent=2, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.file_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+        # fsync каталога, чтобы rename пережил сбой питания
+        if hasattr(os, "O_DIRECTORY"):
+            dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    def load_all(self) -> Optional[Dict[str, dict]]:
+        return self._read()
+
+    def save_all(self, agents: Dict[str, dict]):
+        with self._locked():
+            self._write(agents)
+
+    def save_agent(self, agent: dict, expected_updated_at: Optional[str] = None):
+        with self._locked():
+            # Сливаем с актуальным файлом, чтобы не затереть правки других процессов
+            agents = self._read() or {}
+            current = agents.get(agent["id"])
+            if current is None:
+                raise ValueError(f"Агент {agent['id']} не найден")
+            if expected_updated_at is not None and current["updated_at"] != expected_updated_at:
+                raise StorageConflictError(
+                    f"Агент {agent['id']} был изменён ({current['updated_at']})"
+                )
+            agents[agent["id"]] = agent
+            self._write(agents)
+
+    def change_token(self) -> Hashable:
+        try:
+            stat = os.stat(self.file_path)
+        except FileNotFoundError:
+            return None
+        # rename создаёт новый inode, поэтому подмена файла всегда заметна
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+class SqliteAgentsBackend(AgentsBackend):
+    """Хранение в SQLite (WAL): построчные обновления и PRAGMA data_version"""
+
+    def __init__(self, db_path: str, busy_timeout_ms: int = 5000):
+        self.db_path = str(db_path)
+        self.busy_timeout_ms = busy_timeout_ms
+        self._connection: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # После fork соединение родителя использовать нельзя — открываем своё
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(
+                self.db_path, isolation_level=None, check_same_thread=False
+            )
+            connection.execute(f"PRAGMA busy_timeout = {self.busy_timeout_ms}")
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            connection.execute(
+                """CREATE TABLE IF NOT EXISTS agents (
+                    id TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    description TEXT NOT NULL,
+                    prompt TEXT NOT NULL,
+                    color TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
+                    updated_at TEXT NOT NULL
+                )"""
+            )
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def load_all(self) -> Optional[Dict[str, dict]]:
+        with self._lock:
+            rows = self._connect().execute(
+                f"SELECT {', '.join(AGENT_FIELDS)} FROM agents ORDER BY rowid"
+            ).fetchall()
+        if not rows:
+            return None
+        return {row[0]: dict(zip(AGENT_FIELDS, row)) for row in rows}
+
+    def save_all(self, agents: Dict[str, dict]):
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM agents")
+            connection.executemany(
+                f"INSERT INTO agents ({', '.join(AGENT_FIELDS)}) "
+                f"VALUES ({', '.join('?' for _ in AGENT_FIELDS)})",
+                [tuple(agent[field] for field in AGENT_FIELDS) for agent in agents.values()],
+            )
+
+    def save_agent(self, agent: dict, expected_updated_at: Optional[str] = None):
+        with self._transaction() as connection:
+            row = connection.execute(
+                "SELECT updated_at FROM agents WHERE id = ?", (agent["id"],)
+            ).fetchone()
+            if row is None:
+                raise ValueError(f"Агент {agent['id']} не найден")
+            if expected_updated_at is not None and row[0] != expected_updated_at:
+                raise StorageConflictError(f"Агент {agent['id']} был изменён ({row[0]})")
+            connection.execute(
+                "UPDATE agents SET name = ?, description = ?, prompt = ?, color = ?, "
+                "updated_at = ? WHERE id = ?",
+                (agent["name"], agent["description"], agent["prompt"], agent["color"],
+                 agent["updated_at"], agent["id"]),
+            )
+
+    def change_token(self) -> Hashable:
+        # data_version меняется, когда базу изменило другое соединение
+        with self._lock:
+            return self._connect().execute("PRAGMA data_version").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None and self._pid == os.getpid():
+                self._connection.close()
+            self._connection = None
+
+
+def create_backend(path: str, kind: Optional[str] = None) -> AgentsBackend:
+    """
+    Создаёт бэкенд по явному типу ("json" / "sqlite") или по расширению файла:
+    .db, .sqlite, .sqlite3 — SQLite, остальное — JSON.
+    """
+    if kind is None:
+        kind = "sqlite" if Path(path).suffix in (".db", ".sqlite", ".sqlite3") else "json"
+    if kind == "sqlite":
+        return SqliteAgentsBackend(path)
+    if kind == "json":
+        return JsonAgentsBackend(path)
+    raise ValueError(f"Unknown agents storage backend: {kind}")
@@ -1,11 +1,249 @@
 """
 Pytest configuration and shared fixtures
 """
+import asyncio
+import json
 import pytest
 import os
 import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from typing import Dict, List, Optional
 from fastapi.testclient import TestClient
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import Field
+
+# Без файлового синка: по умолчанию LOG_FILE=logs/app.log, и каждый прогон
+# тестов писал бы лог в дерево исходников (main настраивает логи при импорте)
+os.environ["LOG_FILE"] = ""
+
+
+class ScriptedChatModel(BaseChatModel):
+    """
+    Фейковая LLM для тестов пайплайна: отвечает по системному промпту
+    (маршрутизатор / ревьюер / агент) и умеет имитировать задержку сети.
+    """
+
+    delay: float = 0.0
+    route: str = "agent2"
+    reviews: List[str] = Field(default_factory=lambda: ["approved"])
+    answer: str = "Ответ агента"
+    # Задержка и ответ конкретного агента по его системному промпту
+    agent_delays: Dict[str, float] = Field(default_factory=dict)
+    agent_answers: Dict[str, str] = Field(default_factory=dict)
+    calls: List[str] = Field(default_factory=list)
+    # Последнее сообщение пользователя каждого вызова (в порядке calls)
+    inputs: List[str] = Field(default_factory=list)
+    # usage_metadata ответов (input_tokens / output_tokens), если задано
+    usage: Dict[str, int] = Field(default_factory=dict)
+    # max_tokens каждого вызова (в порядке calls)
+    max_tokens: List[Optional[int]] = Field(default_factory=list)
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def _reply(self, messages) -> str:
+        system = messages[0].content
+        self.inputs.append(messages[-1].content)
+        if "маршрутизатор" in system:
+            self.calls.append("route")
+            return self.route
+        if "ревьюер" in system:
+            self.calls.append("review")
+            # Последний вердикт повторяется, если ревью вызывается чаще
+            index = min(self.calls.count("review") - 1, len(self.reviews) - 1)
+            return self.reviews[index]
+        self.calls.append("agent")
+        return self.agent_answers.get(system, self.answer)
+
+    def _delay(self, messages) -> float:
+        return self.agent_delays.get(messages[0].content, self.delay)
+
+    def _message(self, content: str) -> AIMessage:
+        if not self.usage:
+            return AIMessage(content=content)
+        usage = dict(self.usage, total_tokens=sum(self.usage.values()))
+        return AIMessage(content=content, usage_metadata=usage)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self._delay(messages))
+        content = self._reply(messages)
+        return ChatResult(generations=[ChatGeneration(message=self._message(content))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        self.max_tokens.append(kwargs.get("max_tokens"))
+        await asyncio.sleep(self._delay(messages))
+        content = self._reply(messages)
+        return ChatResult(generations=[ChatGeneration(message=self._message(content))])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        # Отдаём ответ по словам, чтобы проверять потоковую выдачу токенов
+        self.max_tokens.append(kwargs.get("max_tokens"))
+        await asyncio.sleep(self._delay(messages))
+        words = self._reply(messages).split(" ")
+        for index, word in enumerate(words):
+            token = word if index == 0 else f" {word}"
+            # usage, как у OpenAI со stream_usage, приходит в последнем фрагменте
+            usage = None
+            if self.usage and index == len(words) - 1:
+                usage = dict(self.usage, total_tokens=sum(self.usage.values()))
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token, usage_metadata=usage))
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+
+class StubOpenAIServer:
+    """
+    Локальный OpenAI-совместимый сервер для тестов HTTP-слоя.
+
+    Отвечает на POST /v1/chat/completions по системному промпту (как
+    ScriptedChatModel) и считает открытые TCP-соединения.
+    """
+
+    def __init__(self):
+        self.connections = 0
+        self.requests = 0
+        self.delay = 0.0
+        self.token_delay = 0.0
+        self.route = "agent2"
+        self.review = "approved"
+        self.answer = "Ответ агента"
+        # Сколько следующих запросов завершить ошибкой fail_status
+        self.fail_next = 0
+        self.fail_status = 500
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/v1"
+
+    def reply_for(self, payload: dict) -> str:
+        system = payload["messages"][0]["content"]
+        if "маршрутизатор" in system:
+            return self.route
+        if "ревьюер" in system:
+            return self.review
+        return self.answer
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                with stub._lock:
+                    stub.connections += 1
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length))
+                with stub._lock:
+                    stub.requests += 1
+                    failing = stub.fail_next > 0
+                    if failing:
+                        stub.fail_next -= 1
+                time.sleep(stub.delay)
+                if failing:
+                    body = json.dumps({"error": {"message": "stub failure"}}).encode("utf-8")
+                    self.send_response(stub.fail_status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+                if payload.get("stream"):
+                    self._send_stream(payload)
+                    return
+                body = json.dumps({
+                    "id": "chatcmpl-stub",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": payload.get("model", "stub"),
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": stub.reply_for(payload)},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+                }).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _send_stream(self, payload):
+                """Ответ в формате SSE (stream=true) с chunked-кодированием"""
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+
+                def write_chunk(data: str):
+                    raw = data.encode("utf-8")
+                    self.wfile.write(f"{len(raw):x}\r\n".encode() + raw + b"\r\n")
+                    self.wfile.flush()
+
+                for index, word in enumerate(stub.reply_for(payload).split(" ")):
+                    event = {
+                        "id": "chatcmpl-stub",
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": payload.get("model", "stub"),
+                        "choices": [{
+                            "index": 0,
+                            "delta": {"content": word if index == 0 else f" {word}"},
+                            "finish_reason": None,
+                        }],
+                    }
+                    write_chunk(f"data: {json.dumps(event)}\n\n")
+                    time.sleep(stub.token_delay)
+                write_chunk("data: [DONE]\n\n")
+                self.wfile.write(b"0\r\n\r\n")
+
+        return Handler
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@pytest.fixture
+def stub_openai_server():
+    """Запускает локальный OpenAI-совместимый сервер на свободном порту"""
+    server = StubOpenAIServer()
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+async def llm_factory(monkeypatch):
+    """Свежая фабрика LLM-клиентов на тест (пул привязан к event loop теста)"""
+    import llm_client
+
+    factory = llm_client.LLMClientFactory(pool_size=4)
+    monkeypatch.setattr(llm_client, "_factory", factory)
+    yield factory
+    await factory.aclose()
 
 
 @pytest.fixture
@@ -16,9 +254,10 @@ def temp_config_file():
 
     yield temp_path
 
-    # Cleanup
-    if os.path.exists(temp_path):
-        os.unlink(temp_path)
+    # Cleanup (включая файл межпроцессной блокировки JSON-бэкенда)
+    for path in (temp_path, temp_path + ".lock"):
+        if os.path.exists(path):
+            os.unlink(path)
 
 
 @pytest.fixture
@@ -28,6 +267,65 @@ def mock_env_vars(monkeypatch):
     monkeypatch.setenv("MODEL_NAME", "openai/gpt-4o")
 
 
+@pytest.fixture
+def temp_storage(monkeypatch, temp_config_file):
+    """Подменяет глобальное хранилище агентов на временное"""
+    import agents_storage
+
+    storage = agents_storage.AgentsStorage(temp_config_file)
+    monkeypatch.setattr(agents_storage, "_storage", storage)
+    return storage
+
+
+@pytest.fixture
+def scripted_llm(monkeypatch, mock_env_vars, temp_storage):
+    """Подменяет get_llm в оркестраторе на ScriptedChatModel"""
+    import orchestrator
+
+    model = ScriptedChatModel()
+    monkeypatch.setattr(orchestrator, "get_llm", lambda *args, **kwargs: model)
+    return model
+
+
+@pytest.fixture
+def job_queue(monkeypatch, tmp_path):
+    """Подменяет глобальную очередь задач на очередь с временной БД"""
+    import job_queue
+
+    queue = job_queue.JobQueue(job_queue.JobStore(tmp_path / "jobs.db"), workers=2)
+    monkeypatch.setattr(job_queue, "_queue", queue)
+    yield queue
+    queue.store.close()
+
+
+@pytest.fixture(autouse=True)
+def tokenizer(monkeypatch):
+    """Оценка токенов по символам: кодировку tiktoken тесты не скачивают"""
+    monkeypatch.setenv("TOKENIZER_ENCODING", "heuristic")
+
+
+@pytest.fixture(autouse=True)
+def rate_limiter(monkeypatch, tmp_path):
+    """Лимиты и квоты каждого теста — в своей временной БД"""
+    import rate_limits
+
+    limiter = rate_limits.RateLimiter(rate_limits.RateLimitStore(tmp_path / "rate_limits.db"))
+    monkeypatch.setattr(rate_limits, "_limiter", limiter)
+    yield limiter
+    limiter.store.close()
+
+
+@pytest.fixture
+def session_store(monkeypatch, tmp_path):
+    """Подменяет глобальное хранилище сессий на временную БД"""
+    import sessions
+
+    store = sessions.SessionStore(tmp_path / "sessions.db")
+    monkeypatch.setattr(sessions, "_store", store)
+    yield store
+    store.close()
+
+
 @pytest.fixture
 def test_client(mock_env_vars):
     """Создаёт тестовый клиент для FastAPI"""
@@ -1,9 +1,13 @@
 """
 Тесты для модуля agents_storage
 """
+import multiprocessing
+import threading
+
 import pytest
 import json
-from agents_storage import Agent, AgentsStorage
+from agents_storage import Agent, AgentsSnapshot, AgentsStorage, StorageConflictError
+from storage_backends import JsonAgentsBackend, SqliteAgentsBackend, create_backend
 
 
 class TestAgent:
@@ -184,3 +188,229 @@ class TestAgentsStorage:
         # Проверяем, что изменения сохранились
         assert agent["name"] == "Persistent Name"
         assert agent["description"] == "Persistent Description"
+
+
+class TestAgentsSnapshot:
+    """Тесты версионированного среза хранилища"""
+
+    def test_snapshot_reused_until_change(self, temp_config_file):
+        storage = AgentsStorage(temp_config_file)
+        snapshot = storage.snapshot()
+
+        assert isinstance(snapshot, AgentsSnapshot)
+        assert storage.snapshot() is snapshot
+        assert snapshot.agent_ids == tuple(storage.agents)
+        assert snapshot.prompts["agent2"] == storage.agents["agent2"].prompt
+        assert snapshot.prompt_versions["agent2"] == storage.agents["agent2"].prompt_version
+        assert "- agent2: Агент требований - " in snapshot.routing_menu
+
+    def test_snapshot_rebuilt_on_update(self, temp_config_file):
+        storage = AgentsStorage(temp_config_file)
+        before = storage.snapshot()
+
+        storage.update("agent2", "Name", "Desc", "New prompt", "bg-green-500")
+        after = storage.snapshot()
+
+        assert after is not before
+        assert after.version > before.version
+        assert after.prompts["agent2"] == "New prompt"
+        assert before.prompts["agent2"] != "New prompt"
+
+    def test_snapshot_rebuilt_when_agent_added(self, temp_config_file):
+        storage = AgentsStorage(temp_config_file)
+        before = storage.snapshot()
+
+        storage.agents["agent6"] = Agent(id="agent6", name="N", description="D", prompt="P")
+
+        assert storage.snapshot().agent_ids[-1] == "agent6"
+        assert storage.snapshot().version > before.version
+
+    def test_snapshot_rebuilt_on_change_from_other_instance(self, temp_config_file):
+        reader = AgentsStorage(temp_config_file)
+        before = reader.snapshot()
+
+        AgentsStorage(temp_config_file).update("agent3", "Docs", "Desc", "Other prompt", "bg-yellow-500")
+
+        assert reader.snapshot() is not before
+        assert reader.snapshot().prompts["agent3"] == "Other prompt"
+
+    def test_snapshot_is_immutable(self, temp_config_file):
+        snapshot = AgentsStorage(temp_config_file).snapshot()
+
+        with pytest.raises(TypeError):
+            snapshot.prompts["agent1"] = "changed"
+        with pytest.raises(TypeError):
+            snapshot.agents[0]["name"] = "changed"
+        with pytest.raises(AttributeError):
+            snapshot.version = 0
+
+
+def _update_own_agent(path, agent_id, iterations):
+    """Процесс стресс-теста: многократно обновляет «своего» агента"""
+    storage = AgentsStorage(path)
+    for i in range(iterations):
+        storage.update(
+            agent_id=agent_id,
+            name=f"{agent_id} #{i}",
+            description=str(i),
+            prompt=f"Prompt {agent_id} {i}",
+            color="bg-blue-500"
+        )
+
+
+def _increment_shared_agent(path, iterations):
+    """Процесс стресс-теста: инкремент счётчика в описании agent1 с повтором при конфликте"""
+    storage = AgentsStorage(path)
+    for _ in range(iterations):
+        while True:
+            agent = storage.get_by_id("agent1")
+            try:
+                storage.update(
+                    agent_id="agent1",
+                    name=agent["name"],
+                    description=str(int(agent["description"]) + 1),
+                    prompt=agent["prompt"],
+                    color=agent["color"],
+                    expected_updated_at=agent["updated_at"]
+                )
+                break
+            except StorageConflictError:
+                continue
+
+
+@pytest.fixture(params=["agents.json", "agents.db"], ids=["json", "sqlite"])
+def storage_path(request, tmp_path):
+    """Путь к хранилищу для каждого бэкенда"""
+    return str(tmp_path / request.param)
+
+
+class TestStorageBackends:
+    """Тесты бэкендов хранилища и межпроцессной согласованности"""
+
+    def test_backend_selected_by_extension(self, tmp_path):
+        assert isinstance(create_backend(str(tmp_path / "a.json")), JsonAgentsBackend)
+        assert isinstance(create_backend(str(tmp_path / "a.db")), SqliteAgentsBackend)
+        assert isinstance(create_backend(str(tmp_path / "a.txt"), "sqlite"), SqliteAgentsBackend)
+        with pytest.raises(ValueError):
+            create_backend(str(tmp_path / "a.json"), "redis")
+
+    def test_defaults_created_and_persisted(self, storage_path):
+        storage = AgentsStorage(storage_path)
+        assert len(storage.agents) == 5
+
+        reloaded = AgentsStorage(storage_path)
+        assert [a["id"] for a in reloaded.get_all()] == [a["id"] for a in storage.get_all()]
+
+    def test_json_write_is_atomic_and_leaves_no_temp_files(self, tmp_path):
+        path = tmp_path / "agents.json"
+        storage = AgentsStorage(str(path))
+        storage.update("agent2", "Name", "Desc", "New prompt", "bg-green-500")
+
+        with open(path, encoding="utf-8") as f:
+            assert json.load(f)["agent2"]["prompt"] == "New prompt"
+        assert sorted(p.name for p in tmp_path.iterdir()) == ["agents.json", "agents.json.lock"]
+
+    def test_sees_changes_from_other_instance(self, storage_path):
+        """Правка в другом процессе (инстансе) видна без перезапуска"""
+        reader = AgentsStorage(storage_path)
+        writer = AgentsStorage(storage_path)
+        changed = []
+        reader.subscribe_prompt_changes(changed.append)
+
+        writer.update("agent3", "Docs", "Desc", "Updated prompt", "bg-yellow-500")
+
+        assert reader.get_by_id("agent3")["prompt"] == "Updated prompt"
+        assert changed == ["agent3"]
+
+    def test_cached_lookup_after_other_instance_edit_does_not_deadlock(self, tmp_path):
+        """Подписчик не вызывается из get_prompt_version, который кэш зовёт под своей блокировкой"""
+        from response_cache import ResponseCache
+
+        path = str(tmp_path / "agents.json")
+        reader = AgentsStorage(path)
+        writer = AgentsStorage(path)
+        cache = ResponseCache()
+        reader.subscribe_prompt_changes(cache.invalidate_route)
+        cache.put("Запрос", "agent1", reader.get_prompt_version("agent1"), "model", {"route": "agent1"})
+
+        writer.update("agent1", "One", "Desc", "New prompt", "bg-blue-500")
+        results = []
+        lookup = threading.Thread(
+            target=lambda: results.append(cache.get("Запрос", "model", reader.get_prompt_version)), daemon=True
+        )
+        lookup.start()
+        lookup.join(5)
+
+        assert not lookup.is_alive(), "ResponseCache.get deadlocked"
+        assert results == [None]
+        # Уведомление доходит на верхнем уровне
+        assert len(cache) == 1
+        reader.refresh()
+        assert len(cache) == 0
+
+    def test_update_does_not_overwrite_other_agents(self, storage_path):
+        first = AgentsStorage(storage_path)
+        second = AgentsStorage(storage_path)
+
+        first.update("agent1", "One", "Desc", "Prompt one", "bg-blue-500")
+        second.update("agent2", "Two", "Desc", "Prompt two", "bg-green-500")
+
+        fresh = AgentsStorage(storage_path)
+        assert fresh.get_by_id("agent1")["name"] == "One"
+        assert fresh.get_by_id("agent2")["name"] == "Two"
+        # Второй инстанс при записи подхватил правку первого
+        assert second.get_by_id("agent1")["name"] == "One"
+
+    def test_optimistic_conflict(self, storage_path):
+        first = AgentsStorage(storage_path)
+        second = AgentsStorage(storage_path)
+        seen = second.get_by_id("agent4")["updated_at"]
+
+        first.update("agent4", "First", "Desc", "Prompt first", "bg-orange-500")
+
+        with pytest.raises(StorageConflictError):
+            second.update(
+                "agent4", "Second", "Desc", "Prompt second", "bg-orange-500",
+                expected_updated_at=seen
+            )
+        assert AgentsStorage(storage_path).get_by_id("agent4")["name"] == "First"
+
+    def test_multiprocess_updates_are_not_lost(self, storage_path):
+        """Несколько процессов пишут разных агентов — ни одна правка не теряется"""
+        AgentsStorage(storage_path)
+        ctx = multiprocessing.get_context("spawn")
+        agent_ids = ["agent1", "agent2", "agent3", "agent4"]
+        iterations = 15
+        processes = [
+            ctx.Process(target=_update_own_agent, args=(storage_path, agent_id, iterations))
+            for agent_id in agent_ids
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(timeout=120)
+            assert process.exitcode == 0
+
+        storage = AgentsStorage(storage_path)
+        for agent_id in agent_ids:
+            assert storage.get_by_id(agent_id)["description"] == str(iterations - 1)
+        assert storage.get_by_id("agent5")["name"] == "Бизнес-аналитик"
+
+    def test_multiprocess_increments_with_optimistic_locking(self, storage_path):
+        """Конкурентные read-modify-write одного агента с повтором при конфликте"""
+        storage = AgentsStorage(storage_path)
+        agent = storage.get_by_id("agent1")
+        storage.update("agent1", agent["name"], "0", agent["prompt"], agent["color"])
+
+        ctx = multiprocessing.get_context("spawn")
+        processes = [
+            ctx.Process(target=_increment_shared_agent, args=(storage_path, 10))
+            for _ in range(4)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(timeout=120)
+            assert process.exitcode == 0
+
+        assert AgentsStorage(storage_path).get_by_id("agent1")["description"] == "40"
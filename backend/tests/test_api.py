@@ -3,6 +3,7 @@
 """
 import pytest
 from unittest.mock import Mock, patch, AsyncMock
+from router import LocalRouter
 
 
 class TestHealthEndpoint:
@@ -79,6 +80,23 @@ class TestAgentsEndpoints:
 
         assert response.status_code == 404
 
+    def test_update_agent_conflict(self, test_client, temp_storage):
+        """Устаревший expected_updated_at приводит к 409"""
+        agent = test_client.get("/agents/agent2").json()
+        update_data = {
+            "name": "Updated Agent",
+            "description": "Updated description",
+            "prompt": "Updated prompt",
+            "color": "bg-purple-500",
+            "expected_updated_at": agent["updated_at"]
+        }
+
+        first = test_client.put("/agents/agent2", json=update_data)
+        second = test_client.put("/agents/agent2", json=update_data)
+
+        assert first.status_code == 200
+        assert second.status_code == 409
+
 
 class TestQueryEndpoint:
     """Тесты для endpoint обработки запросов"""
@@ -105,6 +123,27 @@ class TestQueryEndpoint:
         assert data["route"] == "agent1"
         assert data["agent_response"] == "test response"
 
+    def test_fanout_routes_in_response(self, test_client, scripted_llm, monkeypatch):
+        """В режиме fan-out ответ /query перечисляет всех агентов"""
+        monkeypatch.setenv("ROUTER_MAX_AGENTS", "3")
+        scripted_llm.route = "agent2, agent4"
+
+        response = test_client.post("/query", json={"query": "Собери требования и опиши процесс"})
+
+        assert response.status_code == 200
+        assert response.json()["route"] == "agent2"
+        assert response.json()["routes"] == ["agent2", "agent4"]
+
+    def test_empty_catalog_in_local_mode(self, test_client, scripted_llm, monkeypatch):
+        """Без агентов в режиме local — 503 с причиной"""
+        monkeypatch.setenv("ROUTER_MODE", "local")
+        monkeypatch.setattr("orchestrator.get_router", lambda: LocalRouter([]))
+
+        response = test_client.post("/query", json={"query": "Собери требования"})
+
+        assert response.status_code == 503
+        assert "Каталог агентов пуст" in response.json()["detail"]
+
     def test_query_with_empty_input(self, test_client):
         """Тест с пустым запросом"""
         response = test_client.post("/query", json={"query": ""})
@@ -152,3 +191,311 @@ class TestCORS:
 
         # CORS middleware должен добавлять заголовки
         assert "access-control-allow-origin" in response.headers
+
+
+class TestQueryStreamEndpoint:
+    """Тесты для потокового endpoint /query/stream"""
+
+    def test_stream_returns_ndjson_events(self, test_client, scripted_llm):
+        """Ответ приходит построчно в формате NDJSON"""
+        import json
+
+        with test_client.stream("POST", "/query/stream", json={"query": "test query"}) as response:
+            assert response.status_code == 200
+            assert response.headers["content-type"].startswith("application/x-ndjson")
+            events = [json.loads(line) for line in response.iter_lines() if line]
+
+        assert events[0] == {"event": "route", "route": "agent2"}
+        assert events[-1]["event"] == "final"
+        assert events[-1]["result"]["agent_response"] == "Ответ агента"
+
+    def test_stream_reports_errors_as_event(self, test_client, monkeypatch):
+        """Ошибка пайплайна приходит событием error в потоке"""
+        import json
+
+        async def failing_stream(user_input, session_id=None):
+            raise RuntimeError("LLM недоступна")
+            yield  # pragma: no cover
+
+        monkeypatch.setattr("main.stream_query", failing_stream)
+
+        with test_client.stream("POST", "/query/stream", json={"query": "test query"}) as response:
+            events = [json.loads(line) for line in response.iter_lines() if line]
+
+        assert events == [{"event": "error", "detail": "Error processing query: LLM недоступна"}]
+
+
+class TestQueryVerbosity:
+    """Тесты параметра verbosity в /query"""
+
+    @patch('main.process_query')
+    def test_compact_response(self, mock_process_query, test_client):
+        """compact возвращает ответ без лога, контекста и трассы"""
+        mock_process_query.return_value = {
+            "input": "test query",
+            "route": "agent1",
+            "agent_response": "test response",
+            "review_result": "approved",
+            "context": "test context",
+            "iteration_count": 0,
+            "log": ["test log"],
+            "trace": [{"node": "final"}],
+        }
+
+        response = test_client.post("/query", json={"query": "test query", "verbosity": "compact"})
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data["agent_response"] == "test response"
+        assert data["log"] == []
+        assert data["context"] == ""
+        assert data["trace"] is None
+
+    def test_invalid_verbosity(self, test_client):
+        """Неизвестный уровень подробности отклоняется валидацией"""
+        response = test_client.post("/query", json={"query": "test query", "verbosity": "everything"})
+
+        assert response.status_code == 422
+
+
+class TestJobsEndpoints:
+    """Тесты фоновой очереди: POST/GET/DELETE /jobs"""
+
+    @pytest.fixture
+    def client(self, mock_env_vars, scripted_llm, job_queue):
+        from fastapi.testclient import TestClient
+        from main import app
+
+        # Контекстный менеджер запускает lifespan, а с ним и воркеры очереди
+        with TestClient(app) as client:
+            yield client
+
+    def wait_for(self, client, job_id, statuses=("done", "failed", "cancelled")):
+        import time
+
+        for _ in range(200):
+            job = client.get(f"/jobs/{job_id}").json()
+            if job["status"] in statuses:
+                return job
+            time.sleep(0.02)
+        raise AssertionError(f"Job {job_id} not finished: {job}")
+
+    def test_submit_and_poll(self, client):
+        response = client.post("/jobs", json={"query": "Собери требования", "verbosity": "compact"})
+
+        assert response.status_code == 202
+        job_id = response.json()["job_id"]
+
+        job = self.wait_for(client, job_id)
+        assert job["status"] == "done"
+        assert job["result"]["route"] == "agent2"
+        assert job["result"]["agent_response"] == "Ответ агента"
+        assert job["result"]["log"] == []
+        assert job["run_ms"] is not None
+
+    def test_stats(self, client):
+        job_id = client.post("/jobs", json={"query": "test query"}).json()["job_id"]
+        self.wait_for(client, job_id)
+
+        stats = client.get("/jobs").json()
+
+        assert stats["workers"] == 2
+        assert stats["queue_depth"] == 0
+        assert stats["jobs"]["done"] == 1
+
+    def test_cancel_running_job(self, client, scripted_llm):
+        scripted_llm.delay = 2
+        job_id = client.post("/jobs", json={"query": "test query"}).json()["job_id"]
+        self.wait_for(client, job_id, ("running",))
+
+        response = client.delete(f"/jobs/{job_id}")
+
+        assert response.status_code == 200
+        assert response.json()["status"] == "cancelled"
+        assert client.delete(f"/jobs/{job_id}").status_code == 409
+
+    def test_unknown_job(self, client):
+        assert client.get("/jobs/missing").status_code == 404
+
+    def test_job_in_session(self, client, session_store):
+        session_id = client.post("/sessions").json()["session_id"]
+
+        job_id = client.post("/jobs", json={"query": "Собери требования", "session_id": session_id}).json()["job_id"]
+        job = self.wait_for(client, job_id)
+
+        assert job["status"] == "done" and job["session_id"] == session_id
+        session = client.get(f"/sessions/{session_id}").json()
+        assert [turn["query"] for turn in session["turns"]] == ["Собери требования"]
+        assert client.post("/jobs", json={"query": "test", "session_id": "missing"}).status_code == 404
+
+    def test_job_tokens_charged_to_client(self, client, scripted_llm, rate_limiter):
+        import time
+
+        scripted_llm.usage = {"input_tokens": 30, "output_tokens": 10}
+        headers = {"X-Forwarded-For": "10.3.3.3"}
+
+        job_id = client.post("/jobs", json={"query": "test query"}, headers=headers).json()["job_id"]
+        self.wait_for(client, job_id)
+
+        # route + agent + review — по 40 токенов; списание идёт после смены статуса
+        for _ in range(100):
+            if rate_limiter.store.usage("ip:10.3.3.3") == 120:
+                break
+            time.sleep(0.01)
+        assert rate_limiter.store.usage("ip:10.3.3.3") == 120
+        assert client.delete("/jobs/missing").status_code == 404
+
+
+class TestQueryBatchEndpoint:
+    """Тесты пакетного endpoint /query/batch"""
+
+    def test_results_streamed_as_ndjson(self, test_client, scripted_llm):
+        import json
+
+        scripted_llm.route = "1: agent3\n2: agent1"
+        payload = {"queries": ["Документация", "Анализ"], "concurrency": 2}
+
+        with test_client.stream("POST", "/query/batch", json=payload) as response:
+            assert response.status_code == 200
+            assert response.headers["content-type"].startswith("application/x-ndjson")
+            events = [json.loads(line) for line in response.iter_lines() if line]
+
+        results = {e["index"]: e["result"] for e in events if e["event"] == "result"}
+        assert results[0]["route"] == "agent3"
+        assert results[1]["route"] == "agent1"
+        # По умолчанию результаты компактные
+        assert results[0]["log"] == []
+        assert events[-1]["event"] == "done"
+        assert events[-1]["total"] == 2
+        assert events[-1]["failed"] == 0
+        assert scripted_llm.calls.count("route") == 1
+
+    def test_failed_item_reported_with_index(self, test_client, monkeypatch):
+        import json
+
+        async def flaky_batch(queries, concurrency=None):
+            yield {"index": 1, "error": "LLM недоступна"}
+            yield {"index": 0, "result": {"input": queries[0], "route": "agent1", "log": ["x"]}}
+
+        monkeypatch.setattr("main.process_batch", flaky_batch)
+
+        with test_client.stream("POST", "/query/batch", json={"queries": ["a", "b"]}) as response:
+            events = [json.loads(line) for line in response.iter_lines() if line]
+
+        assert events[0] == {"event": "error", "index": 1, "detail": "Error processing query: LLM недоступна"}
+        assert events[1]["index"] == 0
+        assert events[-1]["failed"] == 1
+
+    @pytest.mark.parametrize("payload", [
+        {"queries": []},
+        {"queries": ["ok", "   "]},
+        {"queries": ["ok"], "concurrency": 0},
+    ])
+    def test_invalid_batch(self, test_client, payload):
+        response = test_client.post("/query/batch", json=payload)
+
+        assert response.status_code == 422
+
+
+class TestSessionsEndpoints:
+    """Тесты сессий диалога: /sessions и session_id в /query"""
+
+    def test_query_in_session(self, test_client, scripted_llm, session_store):
+        session_id = test_client.post("/sessions").json()["session_id"]
+
+        first = test_client.post("/query", json={"query": "Собери требования", "session_id": session_id})
+        second = test_client.post("/query", json={"query": "Сделай короче", "session_id": session_id})
+
+        assert first.status_code == 200
+        assert second.json()["session_id"] == session_id
+        assert second.json()["route"] == "agent2"
+
+        session = test_client.get(f"/sessions/{session_id}").json()
+        assert session["routes"] == ["agent2"]
+        assert [turn["query"] for turn in session["turns"]] == ["Собери требования", "Сделай короче"]
+
+    def test_unknown_session(self, test_client, scripted_llm, session_store):
+        response = test_client.post("/query/stream", json={"query": "test", "session_id": "missing"})
+
+        assert response.status_code == 404
+        assert test_client.get("/sessions/missing").status_code == 404
+
+    def test_delete_session(self, test_client, session_store):
+        session_id = test_client.post("/sessions").json()["session_id"]
+
+        assert test_client.delete(f"/sessions/{session_id}").status_code == 204
+        assert test_client.delete(f"/sessions/{session_id}").status_code == 404
+
+
+class TestRateLimits:
+    """Тесты лимитов запросов и суточного бюджета токенов"""
+
+    def test_limit_returns_429_with_retry_after(self, test_client, monkeypatch):
+        monkeypatch.setattr("main.process_query", AsyncMock(return_value={"input": "q"}))
+        headers = {"X-Forwarded-For": "10.1.1.1"}
+
+        codes = [
+            test_client.post("/query", json={"query": "test"}, headers=headers).status_code
+            for _ in range(11)
+        ]
+
+        assert codes[:10] == [200] * 10
+        assert codes[10] == 429
+        response = test_client.post("/query", json={"query": "test"}, headers=headers)
+        assert int(response.headers["Retry-After"]) > 0
+        # Другой клиент не затронут
+        other = test_client.post("/query", json={"query": "test"}, headers={"X-Forwarded-For": "10.1.1.2"})
+        assert other.status_code == 200
+
+    def test_tokens_charged_and_budget_enforced(self, test_client, scripted_llm, rate_limiter):
+        scripted_llm.usage = {"input_tokens": 30, "output_tokens": 10}
+        rate_limiter.daily_token_budget = 200
+        headers = {"X-Forwarded-For": "10.2.2.2"}
+
+        first = test_client.post("/query", json={"query": "test"}, headers=headers)
+        # route + agent + review — по 40 токенов
+        assert first.status_code == 200
+        assert rate_limiter.store.usage("ip:10.2.2.2") == 120
+
+        test_client.post("/query/stream", json={"query": "test"}, headers=headers).read()
+        assert rate_limiter.store.usage("ip:10.2.2.2") >= 200
+
+        response = test_client.post("/query", json={"query": "test"}, headers=headers)
+        assert response.status_code == 429
+        assert "budget" in response.json()["detail"]
+
+    def test_batch_charged_per_query(self, test_client, monkeypatch):
+        async def instant_batch(queries, concurrency=None):
+            for index, query in enumerate(queries):
+                yield {"index": index, "result": {"input": query, "route": "agent1", "log": []}}
+
+        monkeypatch.setattr("main.process_batch", instant_batch)
+        monkeypatch.setattr("main.RATE_LIMIT_BATCH", "5/hour")
+        headers = {"X-Forwarded-For": "10.4.4.4"}
+
+        first = test_client.post("/query/batch", json={"queries": ["a", "b", "c"]}, headers=headers)
+        assert first.status_code == 200
+        # В корзине осталось 2 запроса из 5 — пачка из трёх не проходит
+        second = test_client.post("/query/batch", json={"queries": ["a", "b", "c"]}, headers=headers)
+        assert second.status_code == 429
+        assert int(second.headers["Retry-After"]) > 0
+        assert test_client.post("/query/batch", json={"queries": ["a", "b"]}, headers=headers).status_code == 200
+
+    def test_batch_stopped_when_budget_exhausted(self, test_client, scripted_llm, rate_limiter):
+        import json
+
+        scripted_llm.usage = {"input_tokens": 30, "output_tokens": 10}
+        rate_limiter.daily_token_budget = 100
+        headers = {"X-Forwarded-For": "10.5.5.5"}
+        payload = {"queries": [f"Запрос {i}" for i in range(6)], "concurrency": 1}
+
+        with test_client.stream("POST", "/query/batch", json=payload, headers=headers) as response:
+            assert response.status_code == 200
+            events = [json.loads(line) for line in response.iter_lines() if line]
+
+        results = [e for e in events if e["event"] == "result"]
+        # Бюджет (100) исчерпан уже первым запросом (route + agent + review = 120)
+        assert len(results) < 6
+        assert events[-1]["event"] == "error"
+        assert "budget" in events[-1]["detail"]
+        assert rate_limiter.store.usage("ip:10.5.5.5") < 6 * 120
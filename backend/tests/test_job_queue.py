@@ -0,0 +1,222 @@
+"""
+Тесты фоновой очереди задач
+"""
+import asyncio
+import sqlite3
+import time
+
+import pytest
+
+from job_queue import JobQueue, JobStore, QueueFullError, job_view
+
+
+class ScriptedRunner:
+    """Исполнитель задач с задержкой; считает одновременно выполняемые задачи"""
+
+    def __init__(self, delay: float = 0.05, fail_on: str = None):
+        self.delay = delay
+        self.fail_on = fail_on
+        self.active = 0
+        self.max_active = 0
+        self.queries = []
+
+    async def __call__(self, query: str, verbosity: str, session_id: str = None) -> dict:
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+            if query == self.fail_on:
+                raise RuntimeError("LLM недоступна")
+            self.queries.append(query)
+            return {"input": query, "verbosity": verbosity}
+        finally:
+            self.active -= 1
+
+
+async def wait_for_status(queue, job_id, statuses, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = queue.get(job_id)
+        if job["status"] in statuses:
+            return job
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"Job {job_id} stuck in {queue.get(job_id)['status']}")
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = JobStore(tmp_path / "jobs.db")
+    yield store
+    store.close()
+
+
+@pytest.fixture
+async def make_queue(store):
+    queues = []
+
+    def factory(runner, **kwargs):
+        queue = JobQueue(store, runner=runner, **kwargs)
+        queues.append(queue)
+        return queue
+
+    yield factory
+    for queue in queues:
+        await queue.stop()
+
+
+class TestJobQueue:
+    """Тесты выполнения задач воркерами"""
+
+    async def test_job_completes_with_timings(self, make_queue):
+        queue = make_queue(ScriptedRunner(delay=0.05))
+
+        job = await queue.submit("Собери требования", "compact")
+        assert job["status"] == "queued"
+
+        done = job_view(await wait_for_status(queue, job["id"], ("done",)))
+        assert done["result"] == {"input": "Собери требования", "verbosity": "compact"}
+        assert done["run_ms"] >= 50
+        assert done["queue_ms"] is not None
+        assert done["finished_at"] is not None
+
+    async def test_worker_pool_is_bounded(self, make_queue):
+        runner = ScriptedRunner(delay=0.05)
+        queue = make_queue(runner, workers=3)
+
+        jobs = [await queue.submit(f"Запрос {i}") for i in range(9)]
+        for job in jobs:
+            await wait_for_status(queue, job["id"], ("done",))
+
+        assert runner.max_active == 3
+        assert queue.stats()["jobs"]["done"] == 9
+
+    async def test_queue_full(self, make_queue):
+        queue = make_queue(ScriptedRunner(delay=0.5), workers=1, max_queue=2)
+
+        first = await queue.submit("Запрос 0")
+        await wait_for_status(queue, first["id"], ("running",))
+        await queue.submit("Запрос 1")
+        await queue.submit("Запрос 2")
+
+        assert queue.stats()["queue_depth"] == 2
+        with pytest.raises(QueueFullError):
+            await queue.submit("Запрос 3")
+
+    async def test_failed_job_records_error(self, make_queue):
+        queue = make_queue(ScriptedRunner(fail_on="сломай"))
+
+        job = await queue.submit("сломай")
+        failed = await wait_for_status(queue, job["id"], ("failed",))
+
+        assert failed["error"] == "LLM недоступна"
+
+    async def test_cancel_queued_job(self, make_queue):
+        runner = ScriptedRunner(delay=0.2)
+        queue = make_queue(runner, workers=1)
+
+        first = await queue.submit("Первый")
+        second = await queue.submit("Второй")
+        assert queue.cancel(second["id"])
+
+        await wait_for_status(queue, first["id"], ("done",))
+        await asyncio.sleep(0.05)
+        assert queue.get(second["id"])["status"] == "cancelled"
+        assert runner.queries == ["Первый"]
+
+    async def test_cancel_running_job(self, make_queue):
+        runner = ScriptedRunner(delay=5)
+        queue = make_queue(runner, workers=1)
+
+        job = await queue.submit("Долгий запрос")
+        await wait_for_status(queue, job["id"], ("running",))
+
+        assert queue.cancel(job["id"])
+        await asyncio.sleep(0.05)
+
+        assert queue.get(job["id"])["status"] == "cancelled"
+        assert queue.stats()["running"] == 0
+        assert not queue.cancel(job["id"])
+
+
+class TestJobPersistence:
+    """Задачи переживают перезапуск воркеров"""
+
+    async def test_unfinished_jobs_resume_after_restart(self, make_queue, store):
+        first = make_queue(ScriptedRunner(delay=5), workers=1)
+        running = await first.submit("Прерванный")
+        queued = await first.submit("Ожидающий")
+        await wait_for_status(first, running["id"], ("running",))
+        await first.stop()
+
+        assert store.get(running["id"])["status"] == "queued"
+
+        runner = ScriptedRunner(delay=0.01)
+        second = make_queue(runner, workers=1)
+        await second.start()
+        await wait_for_status(second, queued["id"], ("done",))
+
+        assert store.get(running["id"])["status"] == "done"
+        assert runner.queries == ["Прерванный", "Ожидающий"]
+
+    async def test_stop_drains_running_jobs(self, make_queue, store):
+        queue = make_queue(ScriptedRunner(delay=0.3), workers=1)
+        running = await queue.submit("Выполняющийся")
+        queued = await queue.submit("Ожидающий")
+        await wait_for_status(queue, running["id"], ("running",))
+
+        await queue.stop(drain_timeout=5)
+
+        # Выполняющаяся задача успела завершиться, новая не начиналась
+        assert store.get(running["id"])["status"] == "done"
+        assert store.get(queued["id"])["status"] == "queued"
+
+    async def test_stop_requeues_jobs_after_drain_timeout(self, make_queue, store):
+        queue = make_queue(ScriptedRunner(delay=5), workers=1)
+        job = await queue.submit("Долгий")
+        await wait_for_status(queue, job["id"], ("running",))
+
+        await queue.stop(drain_timeout=0.1)
+
+        assert store.get(job["id"])["status"] == "queued"
+
+    async def test_result_readable_from_new_store(self, make_queue, tmp_path):
+        queue = make_queue(ScriptedRunner(delay=0.01))
+        job = await queue.submit("Запрос")
+        await wait_for_status(queue, job["id"], ("done",))
+
+        reopened = JobStore(tmp_path / "jobs.db")
+        assert reopened.get(job["id"])["status"] == "done"
+        reopened.close()
+
+    def test_orphaned_job_from_dead_process_requeued(self, store):
+        job = store.create("Запрос", "full")
+        assert store.claim(job["id"], "otherhost:1")
+        store._execute("UPDATE jobs SET owner = ? WHERE id = ?", ("myhost:999999999", job["id"]))
+
+        # Процесс на другом хосте не трогаем, умерший процесс этого хоста — да
+        assert store.recover("otherhost:1") == []
+        assert store.recover("myhost:1") == [job["id"]]
+
+    def test_purge_removes_old_finished_jobs(self, store):
+        old = store.create("Старый", "full")
+        store.claim(old["id"], "host:1")
+        store.finish(old["id"], {})
+        pending = store.create("Новый", "full")
+
+        assert store.purge(time.time() + 1) == 1
+        assert store.get(old["id"]) is None
+        assert store.get(pending["id"]) is not None
+
+    def test_old_schema_migrated(self, tmp_path):
+        path = tmp_path / "old.db"
+        connection = sqlite3.connect(path)
+        connection.execute(
+            "CREATE TABLE jobs (id TEXT PRIMARY KEY, status TEXT NOT NULL, query TEXT NOT NULL, "
+            "verbosity TEXT NOT NULL, result TEXT, error TEXT, owner TEXT, created_at REAL NOT NULL, "
+            "started_at REAL, finished_at REAL)"
+        )
+        connection.close()
+
+        store = JobStore(path)
+        assert store.create("Запрос", "full", "ip:1")["client"] == "ip:1"
+        store.close()
@@ -0,0 +1,254 @@
+"""
+Тесты жизненного цикла сервера: учёт выполняющихся запросов, корректная
+остановка, ленивая загрузка LLM-стека и продакшен-профиль gunicorn
+"""
+import asyncio
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import httpx
+import pytest
+from fastapi import FastAPI
+
+import lifecycle
+from lifecycle import InFlightMiddleware, InFlightTracker
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture
+def tracker(monkeypatch):
+    tracker = InFlightTracker()
+    monkeypatch.setattr(lifecycle, "_tracker", tracker)
+    return tracker
+
+
+class TestInFlightTracker:
+    """Тесты счётчика выполняющихся запросов"""
+
+    async def test_wait_idle_returns_when_requests_finish(self, tracker):
+        async def request():
+            with tracker.track():
+                await asyncio.sleep(0.1)
+
+        task = asyncio.create_task(request())
+        await asyncio.sleep(0.01)
+        assert tracker.count == 1
+
+        assert await tracker.wait_idle(2)
+        assert tracker.count == 0
+        await task
+
+    async def test_wait_idle_times_out(self, tracker):
+        with tracker.track():
+            started = time.monotonic()
+            assert not await tracker.wait_idle(0.1)
+            assert time.monotonic() - started < 1
+
+    def test_remaining_budget_counts_from_drain_start(self, tracker):
+        assert tracker.remaining(10) == 10
+
+        tracker.begin_drain()
+        first = tracker.draining_since
+        tracker.begin_drain()
+
+        assert tracker.draining
+        assert tracker.draining_since == first
+        assert 9 < tracker.remaining(10) <= 10
+        tracker.draining_since -= 20
+        assert tracker.remaining(10) == 0
+
+
+class TestInFlightMiddleware:
+    """Middleware учитывает запросы к LLM до конца ответа"""
+
+    async def test_counts_only_query_paths(self, tracker):
+        app = FastAPI()
+        app.add_middleware(InFlightMiddleware, prefixes=("/query",))
+        seen = {}
+
+        @app.post("/query")
+        async def query():
+            seen["query"] = tracker.count
+            return {}
+
+        @app.get("/health")
+        async def health():
+            seen["health"] = tracker.count
+            return {}
+
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            await client.post("/query")
+            await client.get("/health")
+
+        assert seen == {"query": 1, "health": 0}
+        assert tracker.count == 0
+
+
+class TestShutdown:
+    """Тесты корректной остановки воркера"""
+
+    async def test_shutdown_waits_for_inflight_queries(self, tracker, job_queue):
+        finished = []
+
+        async def request():
+            with tracker.track():
+                await asyncio.sleep(0.2)
+                finished.append(True)
+
+        await job_queue.start()
+        task = asyncio.create_task(request())
+        await asyncio.sleep(0.01)
+
+        await lifecycle.shutdown(drain_timeout=5)
+
+        assert finished == [True]
+        assert not job_queue.started
+        # Соединение с БД задач закрыто
+        assert job_queue.store._connection is None
+        await task
+
+    async def test_shutdown_gives_up_after_drain_timeout(self, tracker, job_queue):
+        with tracker.track():
+            started = time.monotonic()
+            await lifecycle.shutdown(drain_timeout=0.2)
+
+        assert time.monotonic() - started < 2
+
+    async def test_startup_resets_drain_state(self, tracker, job_queue, mock_env_vars, temp_storage):
+        tracker.begin_drain()
+
+        await lifecycle.startup()
+        try:
+            assert not tracker.draining
+            assert job_queue.started
+        finally:
+            await job_queue.stop()
+
+
+LAZY_CHECK = """
+import sys
+from fastapi.testclient import TestClient
+from main import app
+
+with TestClient(app) as client:
+    assert client.get("/health").status_code == 200
+    assert client.get("/agents").status_code == 200
+print(",".join(m for m in ("langchain_core", "langgraph", "langchain_openai", "openai") if m in sys.modules))
+"""
+
+
+class TestLazyImports:
+    """LLM-стек загружается при первом запросе или прогреве, а не при импорте"""
+
+    def run_app(self, tmp_path, **env) -> set:
+        env = dict(
+            os.environ,
+            AGENTS_STORAGE_PATH=str(tmp_path / "agents.json"),
+            JOBS_DB_PATH=str(tmp_path / "jobs.db"),
+            API_KEY="",
+            **env,
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", LAZY_CHECK], cwd=BACKEND_DIR, env=env,
+            capture_output=True, text=True, timeout=60,
+        )
+        assert result.returncode == 0, result.stderr
+        loaded = result.stdout.strip().splitlines()[-1] if result.stdout.strip() else ""
+        return set(filter(None, loaded.split(",")))
+
+    def test_health_and_agents_do_not_load_llm_stack(self, tmp_path):
+        assert self.run_app(tmp_path, LLM_WARMUP="false") == set()
+
+    def test_warmup_loads_llm_stack_in_lifespan(self, tmp_path):
+        loaded = self.run_app(tmp_path, LLM_WARMUP="true")
+        assert {"langchain_core", "langgraph", "langchain_openai"} <= loaded
+
+    def test_api_key_is_not_logged(self, tmp_path):
+        env = dict(
+            os.environ, AGENTS_STORAGE_PATH=str(tmp_path / "agents.json"),
+            OPENROUTER_API_KEY="sk-or-secret-key-value",
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", "import orchestrator; orchestrator.check_llm_config()"],
+            cwd=BACKEND_DIR, env=env, capture_output=True, text=True, timeout=60,
+        )
+        assert result.returncode == 0, result.stderr
+        assert "configured" in result.stderr
+        assert "sk-or" not in result.stderr
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.mark.skipif(
+    shutil.which("gunicorn") is None or sys.platform == "win32",
+    reason="gunicorn is not installed"
+)
+class TestGunicornProfile:
+    """SIGTERM при деплое не обрывает выполняющийся запрос"""
+
+    def test_sigterm_drains_inflight_query(self, tmp_path, stub_openai_server):
+        stub_openai_server.delay = 0.5
+        port = free_port()
+        url = f"http://127.0.0.1:{port}"
+        env = dict(
+            os.environ,
+            BIND=f"127.0.0.1:{port}",
+            WEB_CONCURRENCY="1",
+            DRAIN_TIMEOUT="20",
+            OPENROUTER_BASE_URL=stub_openai_server.base_url,
+            OPENROUTER_API_KEY="test_api_key",
+            API_KEY="",
+            AGENTS_STORAGE_PATH=str(tmp_path / "agents.json"),
+            JOBS_DB_PATH=str(tmp_path / "jobs.db"),
+            SESSIONS_DB_PATH=str(tmp_path / "sessions.db"),
+            RATE_LIMIT_DB_PATH=str(tmp_path / "rate_limits.db"),
+        )
+        server = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "main:app"],
+            cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            deadline = time.monotonic() + 60
+            while True:
+                try:
+                    if httpx.get(f"{url}/health", timeout=1).status_code == 200:
+                        break
+                except httpx.HTTPError:
+                    pass
+                assert time.monotonic() < deadline, "gunicorn did not start"
+                time.sleep(0.2)
+
+            response = {}
+
+            def query():
+                response["value"] = httpx.post(
+                    f"{url}/query", json={"query": "Долгий запрос"}, timeout=30
+                )
+
+            thread = threading.Thread(target=query)
+            thread.start()
+            while stub_openai_server.requests == 0:
+                time.sleep(0.05)
+            server.send_signal(signal.SIGTERM)
+            thread.join(timeout=30)
+
+            assert response["value"].status_code == 200
+            assert response["value"].json()["agent_response"] == "Ответ агента"
+            assert server.wait(timeout=30) == 0
+        finally:
+            if server.poll() is None:
+                server.kill()
+                server.wait()
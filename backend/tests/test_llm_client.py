@@ -0,0 +1,74 @@
+"""
+Тесты для фабрики LLM-клиентов с пулом соединений
+"""
+import pytest
+
+import orchestrator
+from llm_client import LLMClientFactory
+
+
+class TestLLMClientFactory:
+    """Тесты кэширования клиентов"""
+
+    async def test_same_key_returns_same_client(self, llm_factory, mock_env_vars):
+        """Один и тот же ключ возвращает один клиент"""
+        first = llm_factory.get("openai/gpt-4o", 0.7, "http://localhost/v1")
+        second = llm_factory.get("openai/gpt-4o", 0.7, "http://localhost/v1")
+
+        assert first is second
+
+    async def test_different_keys_share_pool(self, llm_factory, mock_env_vars):
+        """Разные ключи дают разные клиенты поверх одного пула"""
+        first = llm_factory.get("openai/gpt-4o", 0.7, "http://localhost/v1")
+        second = llm_factory.get("openai/gpt-4o", 0.0, "http://localhost/v1")
+        third = llm_factory.get("openai/gpt-4o-mini", 0.7, "http://other/v1")
+
+        assert len({id(first), id(second), id(third)}) == 3
+        assert first.http_async_client is second.http_async_client is third.http_async_client
+
+    async def test_aclose_resets_clients(self, mock_env_vars):
+        """После aclose пул закрыт, а клиенты создаются заново"""
+        factory = LLMClientFactory(pool_size=2)
+        client = factory.get("openai/gpt-4o", 0.7, "http://localhost/v1")
+        pool = client.http_async_client
+
+        await factory.aclose()
+
+        assert pool.is_closed
+        assert factory.get("openai/gpt-4o", 0.7, "http://localhost/v1") is not client
+        await factory.aclose()
+
+
+class TestConnectionReuse:
+    """Тесты переиспользования соединений на локальном stub-сервере"""
+
+    @pytest.fixture
+    def stub_env(self, monkeypatch, mock_env_vars, temp_storage, stub_openai_server):
+        monkeypatch.setenv("OPENROUTER_BASE_URL", stub_openai_server.base_url)
+        return stub_openai_server
+
+    async def test_query_uses_single_connection(self, stub_env, llm_factory):
+        """Все вызовы LLM в одном запросе идут через одно keep-alive соединение"""
+        result = await orchestrator.process_query("Собери требования")
+
+        assert result["route"] == "agent2"
+        assert stub_env.requests == 3
+        assert stub_env.connections == 1
+
+    async def test_sequential_queries_reuse_connection(self, stub_env, llm_factory):
+        """Последовательные запросы не открывают новых соединений"""
+        for _ in range(3):
+            await orchestrator.process_query("Собери требования")
+
+        assert stub_env.requests == 9
+        assert stub_env.connections == 1
+
+    async def test_pool_size_bounds_connections(self, stub_env, llm_factory):
+        """Параллельные запросы не открывают больше соединений, чем размер пула"""
+        import asyncio
+
+        stub_env.delay = 0.05
+        await asyncio.gather(*(orchestrator.process_query(f"Запрос {i}") for i in range(8)))
+
+        assert stub_env.requests == 24
+        assert stub_env.connections <= llm_factory.pool_size
@@ -0,0 +1,306 @@
+"""
+Тесты цепочки LLM-провайдеров: повторы, переключение на резервные модели,
+таймауты узлов и hedged-запросы на локальных stub-серверах
+"""
+import asyncio
+import json
+import time
+
+import pytest
+from unittest.mock import AsyncMock
+
+import orchestrator
+from llm_providers import (
+    LLMUnavailableError, Provider, ProviderChain, ProviderSettings, get_provider_settings, is_retryable,
+    retry_delay
+)
+from tests.conftest import StubOpenAIServer
+
+
+@pytest.fixture
+def backup_server():
+    """Второй stub-сервер — резервный провайдер"""
+    server = StubOpenAIServer()
+    server.answer = "Ответ резервной модели"
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def providers(monkeypatch, mock_env_vars, temp_storage, stub_openai_server, backup_server, llm_factory):
+    """Основной провайдер — stub_openai_server, резервный — backup_server"""
+    monkeypatch.setenv("OPENROUTER_BASE_URL", stub_openai_server.base_url)
+    monkeypatch.setenv("LLM_FALLBACKS", json.dumps([
+        {"model": "backup/model", "base_url": backup_server.base_url}
+    ]))
+    monkeypatch.setenv("LLM_MAX_RETRIES", "1")
+    monkeypatch.setenv("LLM_RETRY_BACKOFF", "0.01")
+    return stub_openai_server, backup_server
+
+
+async def ask(node: str = "agent"):
+    from langchain_core.messages import HumanMessage, SystemMessage
+
+    llm = orchestrator.get_llm(node=node)
+    response = await llm.ainvoke([SystemMessage(content="Агент"), HumanMessage(content="Запрос")])
+    return llm, response
+
+
+class TestSettings:
+    """Тесты настроек цепочки"""
+
+    def test_defaults_single_provider(self, monkeypatch):
+        monkeypatch.delenv("LLM_FALLBACKS", raising=False)
+        monkeypatch.setenv("MODEL_NAME", "openai/gpt-4o")
+
+        settings = ProviderSettings.from_env()
+
+        assert [p.model for p in settings.providers] == ["openai/gpt-4o"]
+        assert settings.timeout_for("orchestrator") == 30
+        assert settings.hedge_delay is None
+
+    def test_fallbacks_and_timeouts_from_env(self, monkeypatch):
+        monkeypatch.setenv("OPENROUTER_BASE_URL", "http://primary/v1")
+        monkeypatch.setenv("LLM_FALLBACKS", json.dumps([
+            "anthropic/claude-3.5-haiku",
+            {"model": "llama3", "base_url": "http://local/v1", "api_key_env": "LOCAL_KEY"},
+        ]))
+        monkeypatch.setenv("LLM_TIMEOUTS", '{"agent": 45}')
+        monkeypatch.setenv("LLM_HEDGE_DELAY_MS", "800")
+
+        settings = get_provider_settings()
+
+        assert [(p.model, p.base_url) for p in settings.providers[1:]] == [
+            ("anthropic/claude-3.5-haiku", "http://primary/v1"), ("llama3", "http://local/v1")
+        ]
+        assert settings.providers[2].api_key_env == "LOCAL_KEY"
+        assert settings.timeout_for("agent") == 45
+        assert settings.timeout_for("review") == 60
+        assert settings.hedge_delay == 0.8
+
+    def test_model_override_replaces_primary_only(self, monkeypatch, mock_env_vars):
+        monkeypatch.setenv("LLM_FALLBACKS", '["backup/model"]')
+
+        llm = orchestrator.get_llm(model="openai/gpt-4o-mini", node="review")
+
+        assert [p.model for p in llm.providers] == ["openai/gpt-4o-mini", "backup/model"]
+        assert llm.timeout == 60
+
+
+class TestRetryPolicy:
+    """Тесты классификации ошибок и пауз"""
+
+    def test_retryable_statuses(self):
+        class StatusError(Exception):
+            def __init__(self, status_code):
+                self.status_code = status_code
+
+        assert is_retryable(StatusError(503))
+        assert is_retryable(StatusError(429))
+        assert not is_retryable(StatusError(400))
+        assert not is_retryable(ValueError("bad"))
+        assert is_retryable(TimeoutError())
+
+    def test_full_jitter_bounds(self):
+        assert retry_delay(0, 0.5, rng=lambda: 0.0) == 0
+        assert retry_delay(2, 0.5, rng=lambda: 1.0) == 2.0
+        # Пауза ограничена сверху
+        assert retry_delay(10, 0.5, rng=lambda: 1.0) == 8.0
+
+
+class TestFailover:
+    """Тесты повторов и резервных провайдеров"""
+
+    async def test_retry_on_same_provider(self, providers):
+        primary, backup = providers
+        primary.fail_next = 1
+
+        llm, response = await ask()
+
+        assert response.content == "Ответ агента"
+        assert primary.requests == 2
+        assert backup.requests == 0
+        assert llm.last_provider.base_url == primary.base_url
+
+    async def test_failover_after_retries(self, providers):
+        primary, backup = providers
+        primary.fail_next = 10
+
+        llm, response = await ask()
+
+        assert response.content == "Ответ резервной модели"
+        # Первая попытка + LLM_MAX_RETRIES=1 повтор
+        assert primary.requests == 2
+        assert backup.requests == 1
+        assert llm.last_provider.model == "backup/model"
+
+    async def test_non_retryable_error_fails_over_immediately(self, providers):
+        primary, backup = providers
+        primary.fail_next = 10
+        primary.fail_status = 404
+
+        _, response = await ask()
+
+        assert response.content == "Ответ резервной модели"
+        assert primary.requests == 1
+
+    async def test_slow_primary_gives_way_to_fallback(self, providers, monkeypatch):
+        """Зависший основной провайдер получает только свою долю бюджета узла"""
+        primary, backup = providers
+        primary.delay = 3
+        monkeypatch.setenv("LLM_TIMEOUTS", '{"agent": 1}')
+        monkeypatch.setenv("LLM_MAX_RETRIES", "0")
+
+        started = time.perf_counter()
+        _, response = await ask()
+
+        assert response.content == "Ответ резервной модели"
+        assert time.perf_counter() - started < 1.5
+
+    async def test_node_timeout_bounds_call(self, monkeypatch, mock_env_vars, stub_openai_server, llm_factory):
+        monkeypatch.setenv("OPENROUTER_BASE_URL", stub_openai_server.base_url)
+        monkeypatch.setenv("LLM_TIMEOUTS", '{"orchestrator": 0.3}')
+        stub_openai_server.delay = 2
+
+        started = time.perf_counter()
+        with pytest.raises(LLMUnavailableError, match="timed out"):
+            await ask(node="orchestrator")
+
+        assert time.perf_counter() - started < 1
+
+    async def test_all_providers_failing(self, providers):
+        primary, backup = providers
+        primary.fail_next = backup.fail_next = 10
+
+        with pytest.raises(LLMUnavailableError, match="stub failure"):
+            await ask()
+
+        assert (primary.requests, backup.requests) == (2, 2)
+
+
+class TestHedgedRequests:
+    """Тесты hedged-запросов по времени до первого токена"""
+
+    async def test_hedge_fires_when_primary_is_slow(self, providers, monkeypatch):
+        primary, backup = providers
+        primary.delay = 1.5
+        monkeypatch.setenv("LLM_HEDGE_DELAY_MS", "100")
+
+        started = time.perf_counter()
+        llm, response = await ask()
+
+        assert response.content == "Ответ резервной модели"
+        assert time.perf_counter() - started < 1
+        assert (primary.requests, backup.requests) == (1, 1)
+        assert llm.last_provider.model == "backup/model"
+
+    async def test_no_hedge_when_primary_streams_in_time(self, providers, monkeypatch):
+        primary, backup = providers
+        monkeypatch.setenv("LLM_HEDGE_DELAY_MS", "500")
+
+        _, response = await ask()
+
+        assert response.content == "Ответ агента"
+        assert backup.requests == 0
+
+    async def test_primary_error_hedges_immediately(self, providers, monkeypatch):
+        primary, backup = providers
+        primary.fail_next = 10
+        primary.fail_status = 400
+        monkeypatch.setenv("LLM_HEDGE_DELAY_MS", "5000")
+
+        started = time.perf_counter()
+        _, response = await ask()
+
+        assert response.content == "Ответ резервной модели"
+        assert time.perf_counter() - started < 1
+
+
+class FakeStreamingClient:
+    """Потоковый клиент: первый токен через first_delay, чанки записываются в emitted до отдачи"""
+
+    def __init__(self, chunks, first_delay):
+        self.chunks = chunks
+        self.first_delay = first_delay
+        self.configs = []
+        self.emitted = []
+
+    async def astream(self, messages, config=None, **kwargs):
+        from langchain_core.messages import AIMessageChunk
+
+        self.configs.append(config)
+        await asyncio.sleep(self.first_delay)
+        for text in self.chunks:
+            # Как callbacks chat-модели: токен уходит в поток до того, как его получит вызывающий
+            self.emitted.append(text)
+            yield AIMessageChunk(content=text)
+            await asyncio.sleep(0.01)
+
+
+class TestHedgedStreamIsolation:
+    """Токены проигравшего hedged-запроса не попадают в поток ответа"""
+
+    def chain(self, primary, backup):
+        settings = ProviderSettings(
+            providers=(Provider("primary/model", "http://primary"), Provider("backup/model", "http://backup")),
+            hedge_delay=0.05,
+        )
+        clients = {"primary/model": primary, "backup/model": backup}
+        return ProviderChain(settings, lambda provider: clients[provider.model])
+
+    async def test_hedged_fallback_runs_without_stream_callbacks(self):
+        primary = FakeStreamingClient(["Ответ ", "основной"], first_delay=0.12)
+        backup = FakeStreamingClient(["Ответ ", "резервной"], first_delay=0.05)
+        config = {"callbacks": ["поток"], "metadata": {"agent": "agent1"}}
+
+        response = await self.chain(primary, backup).ainvoke([], config=config)
+
+        assert response.content == "Ответ резервной"
+        assert primary.configs == [config]
+        assert backup.configs == [{"callbacks": [], "metadata": {"agent": "agent1"}}]
+        # Основной отменён в момент первого токена резервного
+        assert primary.emitted == []
+
+    async def test_fallback_streams_when_primary_failed(self):
+        class FailingClient(FakeStreamingClient):
+            async def astream(self, messages, config=None, **kwargs):
+                self.configs.append(config)
+                raise RuntimeError("сбой")
+                yield
+
+        primary = FailingClient([], first_delay=0)
+        backup = FakeStreamingClient(["Ответ"], first_delay=0)
+        config = {"callbacks": ["поток"]}
+
+        response = await self.chain(primary, backup).ainvoke([], config=config)
+
+        assert response.content == "Ответ"
+        assert backup.configs == [config]
+
+
+class TestPipelineFailover:
+    """Переключение провайдеров в пайплайне и API"""
+
+    async def test_pipeline_served_by_fallback(self, providers):
+        primary, backup = providers
+        primary.fail_next = 100
+        primary.fail_status = 503
+        backup.route = "agent2"
+
+        result = await orchestrator.process_query("Собери требования")
+
+        assert result["route"] == "agent2"
+        assert result["agent_response"] == "Ответ резервной модели"
+        assert backup.requests == 3
+
+    def test_query_endpoint_returns_503(self, test_client, monkeypatch):
+        monkeypatch.setattr(
+            "main.process_query",
+            AsyncMock(side_effect=LLMUnavailableError("LLM providers unavailable for agent")),
+        )
+
+        response = test_client.post("/query", json={"query": "Собери требования"})
+
+        assert response.status_code == 503
+        assert "LLM недоступна" in response.json()["detail"]
@@ -0,0 +1,162 @@
+"""
+Тесты транспорта LLM: запись в кассету, воспроизведение и заглушки
+"""
+import json
+import time
+
+import pytest
+
+import orchestrator
+from llm_providers import LLMUnavailableError
+from llm_transport import CassetteStore, Transport, get_transport, prompt_key
+
+
+class Message:
+    def __init__(self, type, content):
+        self.type = type
+        self.content = content
+
+
+PROMPT = [Message("system", "Агент"), Message("human", "Запрос")]
+
+
+@pytest.fixture
+def cassette(tmp_path, monkeypatch):
+    path = tmp_path / "cassette.jsonl"
+    monkeypatch.setenv("LLM_CASSETTE", str(path))
+    return path
+
+
+@pytest.fixture
+def live(monkeypatch, mock_env_vars, temp_storage, stub_openai_server, llm_factory):
+    """Живые вызовы идут на локальный stub-сервер"""
+    monkeypatch.setenv("OPENROUTER_BASE_URL", stub_openai_server.base_url)
+    return stub_openai_server
+
+
+class TestPromptKey:
+    """Тесты ключа кассеты"""
+
+    def test_stable(self):
+        assert prompt_key("gpt", 0.7, PROMPT) == prompt_key("gpt", 0.7, list(PROMPT))
+
+    def test_depends_on_prompt_model_and_params(self):
+        key = prompt_key("gpt", 0.7, PROMPT, {"max_tokens": 64})
+
+        assert key != prompt_key("gpt", 0.7, PROMPT)
+        assert key != prompt_key("claude", 0.7, PROMPT, {"max_tokens": 64})
+        assert key != prompt_key("gpt", 0.7, PROMPT[:1], {"max_tokens": 64})
+        # Параметры, не влияющие на ответ, в ключ не входят
+        assert key == prompt_key("gpt", 0.7, PROMPT, {"max_tokens": 64, "config": {"x": 1}})
+
+
+class TestCassetteStore:
+    """Тесты хранилища кассеты"""
+
+    def test_replays_recordings_in_order(self, tmp_path):
+        store = CassetteStore(tmp_path / "c.jsonl")
+        store.record({"key": "k", "content": "первый"})
+        store.record({"key": "k", "content": "второй"})
+
+        replay = CassetteStore(tmp_path / "c.jsonl")
+
+        assert [replay.replay("k")["content"] for _ in range(3)] == ["первый", "второй", "первый"]
+        assert replay.replay("other") is None
+        assert len(replay) == 2
+
+    def test_skips_malformed_lines(self, tmp_path):
+        path = tmp_path / "c.jsonl"
+        path.write_text('{"key": "k", "content": "ok"}\nоборванная строка\n', encoding="utf-8")
+
+        assert CassetteStore(path).replay("k")["content"] == "ok"
+
+    def test_unknown_mode_rejected(self):
+        with pytest.raises(ValueError, match="LLM_TRANSPORT"):
+            Transport(mode="offline")
+
+
+class TestRecordReplay:
+    """Запись реального графа и воспроизведение без сети"""
+
+    async def test_record_then_replay_pipeline(self, live, cassette, monkeypatch):
+        live.delay = 0.05
+        monkeypatch.setenv("LLM_TRANSPORT", "record")
+        recorded = await orchestrator.process_query("Собери требования к CRM")
+        requests = live.requests
+
+        entries = [json.loads(line) for line in cassette.read_text(encoding="utf-8").splitlines()]
+        assert len(entries) == requests == 3
+        assert all(entry["latency_ms"] >= 50 for entry in entries)
+        # Промпты в кассету не попадают
+        assert "Собери" not in cassette.read_text(encoding="utf-8")
+
+        monkeypatch.setenv("LLM_TRANSPORT", "replay")
+        monkeypatch.setenv("OPENROUTER_BASE_URL", "http://127.0.0.1:9/v1")
+        replayed = await orchestrator.process_query("Собери требования к CRM")
+
+        assert live.requests == requests
+        assert replayed["route"] == recorded["route"]
+        assert replayed["agent_response"] == recorded["agent_response"]
+        assert replayed["review_result"] == "approved"
+
+    async def test_replay_simulates_latency(self, live, cassette, monkeypatch):
+        live.delay = 0.2
+        monkeypatch.setenv("LLM_TRANSPORT", "record")
+        from langchain_core.messages import HumanMessage, SystemMessage
+
+        messages = [SystemMessage(content="Агент"), HumanMessage(content="Запрос")]
+        await orchestrator.get_llm().ainvoke(messages)
+
+        monkeypatch.setenv("LLM_TRANSPORT", "replay")
+        started = time.perf_counter()
+        await orchestrator.get_llm().ainvoke(messages)
+        instant = time.perf_counter() - started
+
+        monkeypatch.setenv("LLM_REPLAY_LATENCY", "1")
+        started = time.perf_counter()
+        response = await orchestrator.get_llm().ainvoke(messages)
+
+        assert response.content == "Ответ агента"
+        assert instant < 0.1
+        assert time.perf_counter() - started >= 0.2
+
+    async def test_replay_miss_is_unavailable(self, mock_env_vars, temp_storage, cassette, monkeypatch):
+        monkeypatch.setenv("LLM_TRANSPORT", "replay")
+
+        with pytest.raises(LLMUnavailableError, match="No recorded response"):
+            await orchestrator.process_query("Запрос, которого нет в кассете")
+
+
+class TestStub:
+    """Заглушки по узлам графа"""
+
+    async def test_stub_pipeline(self, mock_env_vars, temp_storage, monkeypatch):
+        monkeypatch.setenv("LLM_TRANSPORT", "stub")
+        monkeypatch.setenv("LLM_STUB_RESPONSES", json.dumps({
+            "orchestrator": "agent2", "agent": "Ответ-заглушка", "review": ["needs_revision|Уточни сроки", "approved"],
+        }))
+
+        result = await orchestrator.process_query("Собери требования к CRM")
+
+        assert result["route"] == "agent2"
+        assert result["agent_response"] == "Ответ-заглушка"
+        assert result["iteration_count"] == 1
+        assert result["review_result"] == "approved"
+
+    async def test_stub_streams_tokens(self, mock_env_vars, temp_storage, monkeypatch):
+        monkeypatch.setenv("LLM_TRANSPORT", "stub")
+        monkeypatch.setenv("LLM_STUB_RESPONSES", '{"orchestrator": "agent1", "agent": "раз два три"}')
+
+        tokens = [
+            event["content"] async for event in orchestrator.stream_query("Собери требования")
+            if event["event"] == "token"
+        ]
+
+        assert "".join(tokens) == "раз два три"
+
+    def test_stub_latency(self, monkeypatch):
+        monkeypatch.setenv("LLM_TRANSPORT", "stub")
+        monkeypatch.setenv("LLM_STUB_LATENCY_MS", "250")
+
+        assert get_transport().stub_latency == 0.25
+        assert get_transport() is get_transport()
@@ -0,0 +1,186 @@
+"""
+Тесты настройки логирования: ID запроса, выборка и формат JSON
+"""
+import asyncio
+import json
+
+import pytest
+from loguru import logger
+
+import logging_setup
+from logging_setup import LogSettings, current_request_id, json_format, log_payload, request_context
+
+
+@pytest.fixture
+def records():
+    """Записи loguru уровня DEBUG и выше (с патчером ID запроса, как в main)"""
+    captured = []
+    logger.configure(patcher=logging_setup._add_request_id)
+    sink_id = logger.add(lambda message: captured.append(message.record), level="DEBUG")
+    yield captured
+    logger.remove(sink_id)
+
+
+@pytest.fixture
+def log_settings(monkeypatch):
+    def apply(**kwargs):
+        monkeypatch.setattr(logging_setup, "_settings", LogSettings(**kwargs))
+    return apply
+
+
+class TestRequestContext:
+    """Тесты ID запроса в контексте"""
+
+    def test_outside_request(self, records):
+        logger.info("вне запроса")
+
+        assert current_request_id() == "-"
+        assert records[-1]["extra"]["request_id"] == "-"
+
+    async def test_inherited_by_tasks_and_threads(self, records):
+        async def in_task():
+            logger.info("из задачи")
+
+        def in_thread():
+            logger.info("из потока")
+
+        with request_context("req-42"):
+            task = asyncio.create_task(in_task())
+        await task
+        with request_context("req-42"):
+            await asyncio.to_thread(in_thread)
+
+        assert [r["extra"]["request_id"] for r in records] == ["req-42", "req-42"]
+        assert current_request_id() == "-"
+
+    def test_bind_overrides_context(self, records):
+        with request_context("req-1"):
+            logger.bind(request_id="job-7").info("задача")
+
+        assert records[-1]["extra"]["request_id"] == "job-7"
+
+
+class TestPayloads:
+    """Тесты выборки и обрезки крупных текстов"""
+
+    def test_truncated_to_limit(self, records, log_settings):
+        log_settings(payload_limit=10)
+
+        with request_context():
+            log_payload("Ответ", "x" * 100)
+
+        assert records[-1]["message"] == "Ответ: " + "x" * 10 + "… [+90 симв.]"
+        assert records[-1]["level"].name == "DEBUG"
+
+    def test_not_sampled(self, records, log_settings):
+        log_settings(payload_sample_rate=0.0)
+
+        with request_context():
+            log_payload("Ответ", "текст")
+
+        assert records == []
+
+    def test_not_logged_outside_request(self, records):
+        log_payload("Ответ", "текст")
+
+        assert records == []
+
+
+class TestJsonFormat:
+    """Тесты формата JSON lines"""
+
+    def test_one_json_line_per_record(self, tmp_path):
+        path = tmp_path / "app.log"
+        logger.configure(patcher=logging_setup._add_request_id)
+        sink_id = logger.add(path, format=json_format, level="DEBUG")
+        try:
+            with request_context("req-9"):
+                logger.bind(route="agent1").info("Запрос {обработан}")
+                try:
+                    raise ValueError("сбой")
+                except ValueError as e:
+                    logger.opt(exception=e).error("Ошибка")
+        finally:
+            logger.remove(sink_id)
+
+        lines = [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+        assert len(lines) == 2
+        assert lines[0]["message"] == "Запрос {обработан}"
+        assert lines[0]["request_id"] == "req-9"
+        assert lines[0]["route"] == "agent1"
+        assert "ValueError: сбой" in lines[1]["exception"]
+
+    def test_settings_from_env(self, monkeypatch):
+        monkeypatch.setenv("LOG_FORMAT", "json")
+        monkeypatch.setenv("LOG_FILE", "")
+        monkeypatch.setenv("LOG_PAYLOAD_SAMPLE_RATE", "0.1")
+
+        settings = LogSettings.from_env()
+
+        assert settings.json and settings.file is None
+        assert settings.payload_sample_rate == 0.1
+        assert settings.enqueue
+
+
+class TestBackgroundSink:
+    """Тесты записи в фоновом потоке"""
+
+    @pytest.fixture
+    def configured(self, tmp_path):
+        def configure(**kwargs):
+            path = tmp_path / "app.log"
+            logging_setup.configure_logging(LogSettings(level="CRITICAL", file=str(path), **kwargs))
+            return path
+        yield configure
+        logging_setup.configure_logging()
+
+    def test_written_by_background_thread(self, configured):
+        path = configured()
+
+        with request_context("req-5"):
+            logger.info("в фоне")
+        logging_setup.flush_logs()
+
+        line = path.read_text(encoding="utf-8").splitlines()[-1]
+        assert "| req-5 |" in line and line.endswith("в фоне")
+
+    def test_thread_restarted_after_fork(self, configured, monkeypatch):
+        """В дочернем процессе (другой pid) запускается свой поток записи"""
+        path = configured()
+        logger.info("до fork")
+        logging_setup.flush_logs()
+
+        monkeypatch.setattr(logging_setup.os, "getpid", lambda: -1)
+        logger.info("после fork")
+        logging_setup.flush_logs()
+
+        messages = [line.rsplit(" - ", 1)[-1] for line in path.read_text(encoding="utf-8").splitlines()]
+        assert messages == ["до fork", "после fork"]
+
+    async def test_complete_drains_queue(self, configured):
+        path = configured(json=True)
+
+        logger.info("последняя запись")
+        await logger.complete()
+
+        assert json.loads(path.read_text(encoding="utf-8").splitlines()[-1])["message"] == "последняя запись"
+
+
+class TestRequestIdMiddleware:
+    """ID запроса в API и в логах узлов графа"""
+
+    def test_client_id_echoed_and_used_in_graph_logs(self, test_client, scripted_llm, records):
+        response = test_client.post(
+            "/query", json={"query": "Собери требования"}, headers={"X-Request-ID": "client-123"}
+        )
+
+        assert response.headers["X-Request-ID"] == "client-123"
+        payloads = [r for r in records if r["message"].startswith("Agent ")]
+        assert payloads and all(r["extra"]["request_id"] == "client-123" for r in payloads)
+
+    def test_generated_when_missing_or_invalid(self, test_client):
+        generated = test_client.get("/health").headers["X-Request-ID"]
+        replaced = test_client.get("/health", headers={"X-Request-ID": "bad id\n"}).headers["X-Request-ID"]
+
+        assert len(generated) == 16
+        assert replaced != "bad id\n" and len(replaced) == 16
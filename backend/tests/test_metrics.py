@@ -0,0 +1,143 @@
+"""
+Тесты метрик пайплайна и /metrics
+"""
+import pytest
+
+import metrics
+import orchestrator
+from metrics import Counter, Histogram, MetricsRegistry
+
+
+@pytest.fixture(autouse=True)
+def clean_metrics():
+    metrics.registry.clear()
+    yield
+    metrics.registry.clear()
+
+
+class TestRegistry:
+    """Тесты формата Prometheus"""
+
+    def test_histogram_buckets_are_cumulative(self):
+        registry = MetricsRegistry()
+        histogram = registry.histogram("latency_seconds", "Latency", ("node",), buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.7, 3.0):
+            histogram.observe(value, node="review")
+
+        lines = registry.render().splitlines()
+
+        assert lines[:2] == ["# HELP latency_seconds Latency", "# TYPE latency_seconds histogram"]
+        assert 'latency_seconds_bucket{node="review",le="0.1"} 1' in lines
+        assert 'latency_seconds_bucket{node="review",le="1.0"} 3' in lines
+        assert 'latency_seconds_bucket{node="review",le="+Inf"} 4' in lines
+        assert 'latency_seconds_sum{node="review"} 4.25' in lines
+        assert 'latency_seconds_count{node="review"} 4' in lines
+
+    def test_counter_and_label_escaping(self):
+        registry = MetricsRegistry()
+        counter = registry.counter("errors_total", "Errors", ("agent",))
+        counter.inc(agent='a"b\\c')
+        counter.inc(2, agent='a"b\\c')
+
+        assert 'errors_total{agent="a\\"b\\\\c"} 3' in registry.render()
+
+    def test_gauge_evaluated_on_render(self):
+        registry = MetricsRegistry()
+        depth = [0]
+        registry.gauge("queue_depth", "Depth", lambda: depth[0])
+        depth[0] = 7
+
+        assert "queue_depth 7" in registry.render().splitlines()
+
+    def test_series_created_per_label_values(self):
+        histogram = Histogram("h", "h", ("node",))
+        histogram.observe(0.1, node="a")
+        histogram.observe(0.2, node="b")
+        histogram.observe(0.3, node="b")
+
+        assert histogram.snapshot(node="a")[0] == 1
+        assert histogram.snapshot(node="b")[0] == 2
+        assert histogram.snapshot(node="c") is None
+        assert Counter("c", "c").value() == 0
+
+
+class TestPipelineInstrumentation:
+    """Замеры узлов графа и вызовов LLM"""
+
+    async def test_every_node_timed(self, scripted_llm):
+        scripted_llm.reviews = ["needs_revision|Добавь метрики", "approved"]
+
+        await orchestrator.process_query("Собери требования")
+
+        def count(node):
+            return metrics.NODE_DURATION.snapshot(node=node)[0]
+
+        assert count("orchestrator") == 1
+        assert count("agent2") == 2
+        assert count("review") == 2
+        assert count("revise") == 1
+        assert count("final") == 1
+        assert metrics.LLM_DURATION.snapshot(node="agent", agent="agent2")[0] == 2
+        assert metrics.LLM_DURATION.snapshot(node="orchestrator", agent="")[0] == 1
+        assert metrics.QUERY_DURATION.snapshot(cached="false")[0] == 1
+
+    async def test_tokens_and_retries_from_provider(
+        self, monkeypatch, mock_env_vars, temp_storage, stub_openai_server, llm_factory
+    ):
+        monkeypatch.setenv("OPENROUTER_BASE_URL", stub_openai_server.base_url)
+        # Первый запрос (маршрутизатор) получит 500, openai-клиент повторит его
+        stub_openai_server.fail_next = 1
+
+        await orchestrator.process_query("Собери требования")
+
+        assert metrics.LLM_PROMPT_TOKENS.snapshot(node="agent", agent="agent2") == (1, 10)
+        assert metrics.LLM_COMPLETION_TOKENS.snapshot(node="review", agent="") == (1, 5)
+        assert metrics.LLM_RETRIES.value(node="orchestrator", agent="") == 1
+        assert metrics.LLM_RETRIES.value(node="agent", agent="agent2") == 0
+
+    async def test_llm_errors_counted(self, scripted_llm, monkeypatch):
+        async def failing_ainvoke(*args, **kwargs):
+            raise RuntimeError("LLM недоступна")
+
+        monkeypatch.setattr(type(scripted_llm), "ainvoke", failing_ainvoke)
+
+        with pytest.raises(RuntimeError):
+            await orchestrator.process_query("Собери требования")
+
+        assert metrics.LLM_ERRORS.value(node="orchestrator", agent="") == 1
+
+    async def test_cache_hits_counted(self, monkeypatch, scripted_llm):
+        from response_cache import ResponseCache
+
+        monkeypatch.setattr(orchestrator, "get_response_cache", lambda: cache)
+        cache = ResponseCache()
+
+        await orchestrator.process_query("Собери требования")
+        await orchestrator.process_query("Собери требования")
+
+        assert metrics.CACHE_LOOKUPS.value(result="miss") == 1
+        assert metrics.CACHE_LOOKUPS.value(result="hit") == 1
+        assert metrics.QUERY_DURATION.snapshot(cached="true")[0] == 1
+
+    async def test_disabled(self, monkeypatch, scripted_llm):
+        monkeypatch.setenv("METRICS_ENABLED", "false")
+        monkeypatch.setattr(orchestrator, "_compiled_workflow", None)
+
+        await orchestrator.process_query("Собери требования")
+
+        assert metrics.NODE_DURATION.snapshot(node="orchestrator") is None
+        assert metrics.LLM_DURATION.snapshot(node="agent", agent="agent2") is None
+
+
+class TestMetricsEndpoint:
+    """Тесты /metrics"""
+
+    def test_prometheus_text(self, test_client, scripted_llm):
+        test_client.post("/query", json={"query": "Собери требования"})
+
+        response = test_client.get("/metrics")
+
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+        assert 'orchestra_node_duration_seconds_count{node="agent2"} 1' in response.text
+        assert "# TYPE orchestra_jobs_queue_depth gauge" in response.text
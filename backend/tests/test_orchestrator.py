@@ -0,0 +1,467 @@
+"""
+Тесты для пайплайна оркестратора (LangGraph)
+"""
+import asyncio
+import time
+
+import pytest
+
+import orchestrator
+
+
+class TestProcessQuery:
+    """Тесты полного прогона графа на фейковой LLM"""
+
+    async def test_process_query_approved(self, scripted_llm):
+        """Тест прогона без доработок"""
+        result = await orchestrator.process_query("Собери требования к CRM")
+
+        assert result["route"] == "agent2"
+        assert result["agent_response"] == "Ответ агента"
+        assert result["review_result"] == "approved"
+        assert result["iteration_count"] == 0
+        assert scripted_llm.calls == ["route", "agent", "review"]
+
+    async def test_process_query_with_revision(self, scripted_llm):
+        """Тест цикла доработки после замечаний ревьюера"""
+        scripted_llm.reviews = ["needs_revision|Добавь метрики", "approved"]
+
+        result = await orchestrator.process_query("Собери требования к CRM")
+
+        assert result["iteration_count"] == 1
+        assert result["review_result"] == "approved"
+        assert scripted_llm.calls == ["route", "agent", "review", "agent", "review"]
+
+    async def test_unknown_route_falls_back_to_existing_agent(self, scripted_llm):
+        """Тест fallback при невалидном ответе маршрутизатора"""
+        scripted_llm.route = "agent42"
+
+        result = await orchestrator.process_query("Что-то непонятное")
+
+        assert result["route"] == "agent1"
+
+
+class TestAsyncExecution:
+    """Тесты неблокирующего выполнения пайплайна"""
+
+    async def test_concurrent_queries_overlap(self, scripted_llm):
+        """N запросов с медленной LLM выполняются за время ~одного запроса"""
+        scripted_llm.delay = 0.2
+        n_queries = 5
+        # Каждый запрос — три последовательных вызова LLM: route, agent, review
+        single_query_latency = 3 * scripted_llm.delay
+
+        started = time.perf_counter()
+        results = await asyncio.gather(
+            *(orchestrator.process_query(f"Запрос {i}") for i in range(n_queries))
+        )
+        elapsed = time.perf_counter() - started
+
+        assert len(results) == n_queries
+        assert all(r["review_result"] == "approved" for r in results)
+        assert elapsed < 2 * single_query_latency
+        assert elapsed < n_queries * single_query_latency / 2
+
+    async def test_event_loop_not_blocked(self, scripted_llm):
+        """Во время ожидания LLM event loop продолжает обслуживать другие задачи"""
+        scripted_llm.delay = 0.2
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker_task = asyncio.create_task(ticker())
+        try:
+            await orchestrator.process_query("Запрос")
+        finally:
+            ticker_task.cancel()
+
+        # За ~0.6 с ожидания тикер должен успеть отработать десятки раз
+        assert ticks > 20
+
+    async def test_snapshot_built_once_per_version(self, monkeypatch, scripted_llm):
+        """Узлы графа не пересобирают срез агентов на каждом вызове"""
+        from agents_storage import AgentsSnapshot
+
+        builds = []
+        original = AgentsSnapshot.build.__func__
+
+        def counting_build(cls, version, agents):
+            builds.append(version)
+            return original(cls, version, agents)
+
+        monkeypatch.setattr(AgentsSnapshot, "build", classmethod(counting_build))
+
+        await orchestrator.process_query("Первый запрос")
+        await orchestrator.process_query("Второй запрос")
+
+        assert len(builds) == 1
+
+
+class TestWorkflowCache:
+    """Тесты кэширования скомпилированного графа"""
+
+    def test_workflow_compiled_once(self, temp_storage):
+        """Повторные вызовы возвращают один и тот же граф"""
+        assert orchestrator.get_workflow() is orchestrator.get_workflow()
+
+    def test_prompt_update_does_not_rebuild(self, temp_storage):
+        """Правка промпта не пересобирает граф"""
+        app = orchestrator.get_workflow()
+
+        temp_storage.update(
+            agent_id="agent1",
+            name="Новое имя",
+            description="Новое описание",
+            prompt="Новый промпт",
+            color="bg-blue-500"
+        )
+
+        assert orchestrator.get_workflow() is app
+
+    def test_agent_set_change_rebuilds(self, temp_storage):
+        """Добавление и удаление агента пересобирает граф"""
+        from agents_storage import Agent
+
+        app = orchestrator.get_workflow()
+        temp_storage.agents["agent6"] = Agent(
+            id="agent6", name="Новый агент", description="Описание", prompt="Промпт"
+        )
+
+        rebuilt = orchestrator.get_workflow()
+        assert rebuilt is not app
+        assert "agent6" in rebuilt.get_graph().nodes
+
+        del temp_storage.agents["agent6"]
+        assert "agent6" not in orchestrator.get_workflow().get_graph().nodes
+
+    async def test_new_agent_is_routable(self, scripted_llm, temp_storage):
+        """Запрос может быть направлен к агенту, добавленному после старта"""
+        from agents_storage import Agent
+
+        temp_storage.agents["agent6"] = Agent(
+            id="agent6", name="Новый агент", description="Описание", prompt="Промпт"
+        )
+        scripted_llm.route = "agent6"
+
+        result = await orchestrator.process_query("Запрос")
+
+        assert result["route"] == "agent6"
+
+
+class TestStreamQuery:
+    """Тесты потокового прогона пайплайна"""
+
+    async def collect(self, user_input):
+        return [event async for event in orchestrator.stream_query(user_input)]
+
+    async def test_stream_events_order(self, scripted_llm):
+        """Маршрут, токены агента, вердикт ревьюера и финальный результат"""
+        scripted_llm.answer = "Список вопросов к стейкхолдерам"
+
+        events = await self.collect("Собери требования")
+        kinds = [event["event"] for event in events]
+
+        assert kinds[0] == "route"
+        assert events[0]["route"] == "agent2"
+        assert kinds.count("token") == 4
+        assert "".join(e["content"] for e in events if e["event"] == "token") == scripted_llm.answer
+        assert kinds[-2:] == ["review", "final"]
+        assert events[-1]["result"]["agent_response"] == scripted_llm.answer
+
+    async def test_stream_revision_event(self, scripted_llm):
+        """При доработке приходит событие revision и токены нового ответа"""
+        scripted_llm.reviews = ["needs_revision|Добавь метрики", "approved"]
+
+        events = await self.collect("Собери требования")
+        kinds = [event["event"] for event in events]
+
+        review = next(e for e in events if e["event"] == "review")
+        assert review["review_result"] == "needs_revision"
+        assert review["revised_instructions"] == "Добавь метрики"
+        assert kinds.count("revision") == 1
+        assert kinds.index("revision") < len(kinds) - kinds[::-1].index("token") - 1
+        assert events[-1]["result"]["iteration_count"] == 1
+
+    async def test_stream_tokens_from_openai_api(
+        self, monkeypatch, mock_env_vars, temp_storage, stub_openai_server, llm_factory
+    ):
+        """Токены ChatOpenAI приходят до завершения пайплайна (stub-сервер со stream=true)"""
+        monkeypatch.setenv("OPENROUTER_BASE_URL", stub_openai_server.base_url)
+        stub_openai_server.answer = "Первый второй третий"
+
+        events = await self.collect("Собери требования")
+        tokens = [e["content"] for e in events if e["event"] == "token"]
+
+        assert len(tokens) == 3
+        assert "".join(tokens) == "Первый второй третий"
+        assert events[-1]["event"] == "final"
+
+
+class TestFanOut:
+    """Тесты режима fan-out: несколько агентов параллельно и объединение ответов"""
+
+    @pytest.fixture
+    def fanout_llm(self, monkeypatch, scripted_llm, temp_storage):
+        monkeypatch.setenv("ROUTER_MAX_AGENTS", "3")
+        scripted_llm.route = "agent2, agent4"
+        requirements = temp_storage.agents["agent2"].prompt
+        modelling = temp_storage.agents["agent4"].prompt
+        scripted_llm.agent_answers = {requirements: "Требования готовы", modelling: "Схема процесса"}
+        scripted_llm.agent_delays = {requirements: 0.3, modelling: 0.5}
+        return scripted_llm
+
+    async def test_responses_merged_before_review(self, fanout_llm):
+        result = await orchestrator.process_query("Собери требования и опиши процесс")
+
+        assert result["route"] == "agent2"
+        assert result["routes"] == ["agent2", "agent4"]
+        assert "Агент требований (agent2)" in result["agent_response"]
+        assert "Требования готовы" in result["agent_response"]
+        assert "Схема процесса" in result["agent_response"]
+        assert fanout_llm.calls == ["route", "agent", "agent", "review"]
+        assert [e["node"] for e in result["trace"]] == [
+            "input", "orchestrator", "agent2", "agent4", "merge", "review", "final"
+        ]
+
+    async def test_wall_clock_is_slowest_agent(self, fanout_llm):
+        """Агенты работают параллельно: время ≈ самый медленный, а не сумма"""
+        started = time.perf_counter()
+        await orchestrator.process_query("Собери требования и опиши процесс")
+        elapsed = time.perf_counter() - started
+
+        assert elapsed >= 0.5
+        assert elapsed < 0.3 + 0.5
+
+    async def test_revision_reruns_all_agents(self, fanout_llm):
+        fanout_llm.reviews = ["needs_revision|Добавь метрики", "approved"]
+
+        result = await orchestrator.process_query("Собери требования и опиши процесс")
+
+        assert result["iteration_count"] == 1
+        assert fanout_llm.calls.count("agent") == 4
+
+    async def test_max_agents_limits_routes(self, monkeypatch, fanout_llm):
+        monkeypatch.setenv("ROUTER_MAX_AGENTS", "1")
+
+        result = await orchestrator.process_query("Собери требования и опиши процесс")
+
+        assert result["routes"] == ["agent2"]
+        assert result["agent_response"] == "Требования готовы"
+
+    async def test_stream_tokens_tagged_by_agent(self, fanout_llm):
+        events = [e async for e in orchestrator.stream_query("Собери требования и опиши процесс")]
+
+        assert events[0] == {"event": "route", "route": "agent2", "routes": ["agent2", "agent4"]}
+        tokens = {}
+        for event in events:
+            if event["event"] == "token":
+                tokens[event["agent"]] = tokens.get(event["agent"], "") + event["content"]
+        assert tokens == {"agent2": "Требования готовы", "agent4": "Схема процесса"}
+
+
+class TestProcessBatch:
+    """Тесты пакетного прогона: маршрутизация пачками и ограниченный параллелизм"""
+
+    async def collect(self, queries, **kwargs):
+        return [item async for item in orchestrator.process_batch(queries, **kwargs)]
+
+    async def test_one_routing_call_per_chunk(self, scripted_llm):
+        scripted_llm.route = "1: agent3\n2: agent1\n3: agent4"
+        queries = [f"Запрос {i}" for i in range(5)]
+
+        items = await self.collect(queries, concurrency=5, chunk_size=3)
+
+        assert sorted(item["index"] for item in items) == list(range(5))
+        routes = {item["index"]: item["result"]["route"] for item in items}
+        # Вторая пачка из двух запросов получила тот же ответ маршрутизатора
+        assert routes == {0: "agent3", 1: "agent1", 2: "agent4", 3: "agent3", 4: "agent1"}
+        assert scripted_llm.calls.count("route") == 2
+        assert scripted_llm.calls.count("agent") == 5
+
+    async def test_batched_route_recorded_in_trace(self, scripted_llm):
+        scripted_llm.route = "1: agent3\n2: agent1"
+
+        items = await self.collect(["Запрос A", "Запрос B"])
+
+        result = next(item["result"] for item in items if item["index"] == 0)
+        route_event = next(e for e in result["trace"] if e["node"] == "orchestrator")
+        assert route_event["payload"]["batched"] is True
+        assert result["routes"] == ["agent3"]
+
+    async def test_concurrency_is_bounded(self, monkeypatch, scripted_llm):
+        running = 0
+        peak = 0
+
+        async def fake_pipeline(user_input, route_decision=None):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.05)
+            running -= 1
+            return {"input": user_input, "route": route_decision.route}
+
+        monkeypatch.setattr(orchestrator, "run_pipeline", fake_pipeline)
+
+        items = await self.collect([f"Запрос {i}" for i in range(8)], concurrency=3)
+
+        assert len(items) == 8
+        assert peak == 3
+
+    async def test_failed_item_does_not_stop_batch(self, monkeypatch, scripted_llm):
+        async def flaky_pipeline(user_input, route_decision=None):
+            if user_input == "плохой":
+                raise RuntimeError("LLM недоступна")
+            return {"input": user_input}
+
+        monkeypatch.setattr(orchestrator, "run_pipeline", flaky_pipeline)
+
+        items = await self.collect(["хороший", "плохой", "ещё один"])
+
+        errors = [item for item in items if "error" in item]
+        assert errors == [{"index": 1, "error": "LLM недоступна"}]
+        assert len(items) == 3
+
+    async def test_routing_failure_falls_back_to_per_item_routing(self, monkeypatch, scripted_llm):
+        router = orchestrator.get_router()
+
+        async def broken_route_batch(queries):
+            raise RuntimeError("timeout")
+
+        monkeypatch.setattr(router, "route_batch", broken_route_batch)
+
+        items = await self.collect(["Запрос A", "Запрос B"])
+
+        assert all(item["result"]["route"] == "agent2" for item in items)
+        assert scripted_llm.calls.count("route") == 2
+
+
+class TestSessions:
+    """Тесты ходов в сессии диалога"""
+
+    async def test_follow_up_reuses_route_and_gets_history(self, scripted_llm, session_store):
+        session_id = session_store.create()["id"]
+        scripted_llm.route = "agent3"
+
+        first = await orchestrator.process_query("Напиши техническую документацию к API", session_id)
+        scripted_llm.calls.clear()
+        scripted_llm.inputs.clear()
+        second = await orchestrator.process_query("Сделай короче", session_id)
+
+        assert first["route"] == "agent3"
+        assert second["route"] == "agent3"
+        assert second["session_id"] == session_id
+        # Маршрутизатор не вызывался, агент получил историю
+        assert scripted_llm.calls == ["agent", "review"]
+        assert "Пользователь: Напиши техническую документацию к API" in scripted_llm.inputs[0]
+        assert scripted_llm.inputs[0].endswith("Текущий запрос: Сделай короче")
+        assert any("маршрут сессии сохранён" in entry for entry in second["log"])
+        assert [turn["seq"] for turn in session_store.turns(session_id)] == [1, 2]
+
+    async def test_topic_shift_routes_again(self, scripted_llm, session_store):
+        session_id = session_store.create()["id"]
+        scripted_llm.route = "agent3"
+        await orchestrator.process_query("Напиши техническую документацию к API", session_id)
+
+        scripted_llm.route = "agent4"
+        scripted_llm.calls.clear()
+        result = await orchestrator.process_query("Нарисуй BPMN диаграмму процесса", session_id)
+
+        assert result["route"] == "agent4"
+        assert scripted_llm.calls[0] == "route"
+        assert session_store.get(session_id)["routes"] == ["agent4"]
+
+    async def test_session_answers_not_cached(self, monkeypatch, scripted_llm, session_store):
+        from response_cache import ResponseCache
+
+        cache = ResponseCache(max_bytes=1_000_000, ttl_seconds=60)
+        monkeypatch.setattr(orchestrator, "get_response_cache", lambda: cache)
+        session_id = session_store.create()["id"]
+        await orchestrator.process_query("Собери требования", session_id)
+
+        result = await orchestrator.process_query("Собери требования", session_id)
+
+        assert result["cached"] is False
+        assert scripted_llm.calls.count("agent") == 2
+        assert len(cache) == 1
+
+    async def test_unknown_session(self, scripted_llm, session_store):
+        with pytest.raises(orchestrator.SessionNotFoundError):
+            await orchestrator.process_query("Запрос", "missing")
+
+    async def test_stream_in_session(self, scripted_llm, session_store):
+        session_id = session_store.create()["id"]
+        await orchestrator.process_query("Собери требования к CRM", session_id)
+        scripted_llm.calls.clear()
+
+        events = [e async for e in orchestrator.stream_query("А теперь короче", session_id)]
+
+        assert events[-1]["result"]["session_id"] == session_id
+        assert scripted_llm.calls == ["agent", "review"]
+        assert len(session_store.turns(session_id)) == 2
+
+
+class TestReviewPolicy:
+    """Тесты политики ревью в пайплайне"""
+
+    async def test_skipped_agent_not_reviewed(self, monkeypatch, scripted_llm):
+        monkeypatch.setenv("REVIEW_SKIP_AGENTS", "agent2")
+
+        result = await orchestrator.process_query("Собери требования к CRM")
+
+        assert result["review_result"] == "approved"
+        assert scripted_llm.calls == ["route", "agent"]
+
+    async def test_heuristic_revision_without_llm(self, monkeypatch, scripted_llm):
+        monkeypatch.setenv("REVIEW_REQUIRED_SECTIONS", '{"agent2": ["## Требования"]}')
+        prompt = orchestrator.get_storage().agents["agent2"].prompt
+        scripted_llm.agent_answers = {prompt: "Черновик без разделов"}
+
+        result = await orchestrator.process_query("Собери требования к CRM")
+
+        # Обе итерации отклонены проверкой, затем лимит итераций
+        assert result["iteration_count"] == 2
+        assert "review" not in scripted_llm.calls
+        assert any("нет обязательных разделов" in entry for entry in result["log"])
+
+    async def test_delta_revision_sends_previous_draft(self, scripted_llm):
+        scripted_llm.reviews = ["needs_revision|Добавь метрики", "approved"]
+
+        await orchestrator.process_query("Собери требования к CRM")
+
+        agent_inputs = [text for call, text in zip(scripted_llm.calls, scripted_llm.inputs) if call == "agent"]
+        assert "Ваш предыдущий ответ:\nОтвет агента" in agent_inputs[1]
+        assert agent_inputs[1].endswith("Добавь метрики")
+        assert "предыдущий ответ" not in agent_inputs[0]
+
+    async def test_full_revision_mode(self, monkeypatch, scripted_llm):
+        monkeypatch.setenv("REVIEW_REVISION_MODE", "full")
+        scripted_llm.reviews = ["needs_revision|Добавь метрики", "approved"]
+
+        await orchestrator.process_query("Собери требования к CRM")
+
+        agent_inputs = [text for call, text in zip(scripted_llm.calls, scripted_llm.inputs) if call == "agent"]
+        assert agent_inputs[1] == (
+            "Собери требования к CRM\n\nДополнительные инструкции от ревьюера: Добавь метрики"
+        )
+
+    async def test_reviewer_model_and_max_iterations(self, monkeypatch, scripted_llm):
+        models = []
+
+        def get_llm(temperature=0.7, model=None, **kwargs):
+            models.append(model)
+            return scripted_llm
+
+        monkeypatch.setattr(orchestrator, "get_llm", get_llm)
+        monkeypatch.setenv("REVIEW_MODEL_NAME", "openai/gpt-4o-mini")
+        monkeypatch.setenv("REVIEW_MAX_ITERATIONS", "3")
+        scripted_llm.reviews = ["needs_revision|Ещё"]
+
+        result = await orchestrator.process_query("Собери требования к CRM")
+
+        assert result["iteration_count"] == 3
+        assert scripted_llm.calls.count("review") == 3
+        assert models.count("openai/gpt-4o-mini") == 3
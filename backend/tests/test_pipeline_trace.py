@@ -0,0 +1,105 @@
+"""
+Тесты для структурированной трассы пайплайна
+"""
+import json
+
+import orchestrator
+import pipeline_trace as trace
+
+
+class TestTraceHelpers:
+    """Тесты вспомогательных функций трассы"""
+
+    def test_truncate_keeps_short_text(self):
+        """Короткий текст не меняется"""
+        assert trace.truncate("коротко", limit=10) == "коротко"
+
+    def test_truncate_long_text(self):
+        """Длинный текст обрезается с пометкой о длине хвоста"""
+        assert trace.truncate("a" * 15, limit=10) == "a" * 10 + "… [+5 симв.]"
+
+    def test_truncate_limit_from_env(self, monkeypatch):
+        """Лимит по умолчанию берётся из TRACE_PAYLOAD_LIMIT"""
+        monkeypatch.setenv("TRACE_PAYLOAD_LIMIT", "3")
+
+        assert trace.truncate("abcdef") == "abc… [+3 симв.]"
+
+    def test_ref_records_size(self):
+        """Ссылка хранит цель и размер, но не сам текст"""
+        assert trace.ref("input", "текст", version="v1") == {"ref": "input", "version": "v1", "chars": 5}
+
+    def test_event_drops_empty_payload(self):
+        """None-поля payload не попадают в событие"""
+        trace_event = trace.event("review", "review", "msg", duration_ms=12.345, verdict="approved", comment=None)
+
+        assert trace_event["duration_ms"] == 12.3
+        assert trace_event["payload"] == {"verdict": "approved"}
+
+    def test_render_log(self):
+        """Лог строится из событий: сообщение, длительность, токены и payload"""
+        lines = trace.render_log([
+            trace.event(
+                "agent1", "agent", "✅ Агент",
+                duration_ms=1500, usage={"prompt_tokens": 10, "completion_tokens": 5},
+                system_prompt=trace.ref("agents/agent1/prompt", "x" * 42),
+            )
+        ])
+
+        assert lines == ["✅ Агент (1500 мс, токены 10→5)\n   system_prompt: <agents/agent1/prompt: chars=42>"]
+
+    def test_apply_verbosity(self):
+        """compact убирает лог, контекст и трассу; full — только трассу"""
+        result = {"agent_response": "ответ", "log": ["шаг"], "context": "ctx", "trace": [{}]}
+
+        compact = trace.apply_verbosity(result, "compact")
+        full = trace.apply_verbosity(result, "full")
+
+        assert (compact["log"], compact["context"], compact["trace"]) == ([], "", None)
+        assert full["log"] == ["шаг"] and full["trace"] is None
+        assert trace.apply_verbosity(result, "trace")["trace"] == [{}]
+
+
+class TestPipelineTrace:
+    """Тесты трассы, формируемой пайплайном"""
+
+    async def test_trace_events(self, scripted_llm):
+        """Каждый узел добавляет типизированное событие"""
+        result = await orchestrator.process_query("Собери требования")
+
+        kinds = [(e["node"], e["kind"]) for e in result["trace"]]
+        assert kinds == [
+            ("input", "received"),
+            ("orchestrator", "route"),
+            ("agent2", "agent"),
+            ("review", "review"),
+            ("final", "final"),
+        ]
+        assert all("ts" in e for e in result["trace"])
+        assert all("duration_ms" in e for e in result["trace"][1:4])
+
+    async def test_large_payloads_not_copied(self, scripted_llm, temp_storage):
+        """Системный промпт и полный ответ не копируются в трассу и лог"""
+        scripted_llm.answer = "ответ " * 2000
+        scripted_llm.reviews = ["needs_revision|Добавь метрики", "approved"]
+        prompt = temp_storage.agents["agent2"].prompt = "Промпт агента требований. " * 200
+
+        result = await orchestrator.process_query("Собери требования")
+        payload = json.dumps(result["trace"], ensure_ascii=False) + "".join(result["log"])
+
+        assert prompt not in payload
+        assert scripted_llm.answer not in payload
+        # Ответ агента попадает в ответ API один раз — в agent_response
+        assert result["context"].count("ответ ответ") == 0
+        assert len(payload) < len(scripted_llm.answer)
+
+    async def test_token_usage_recorded(
+        self, monkeypatch, mock_env_vars, temp_storage, stub_openai_server, llm_factory
+    ):
+        """Токены берутся из usage в ответе провайдера"""
+        monkeypatch.setenv("OPENROUTER_BASE_URL", stub_openai_server.base_url)
+
+        result = await orchestrator.process_query("Собери требования")
+
+        agent_event = next(e for e in result["trace"] if e["kind"] == "agent")
+        assert agent_event["prompt_tokens"] == 10
+        assert agent_event["completion_tokens"] == 5
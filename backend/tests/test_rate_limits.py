@@ -0,0 +1,149 @@
+"""
+Тесты лимитов запросов и суточных квот токенов (общее SQLite-хранилище)
+"""
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+from rate_limits import (
+    RateLimitExceeded,
+    RateLimiter,
+    RateLimitStore,
+    client_key,
+    parse_rate,
+    utc_day,
+)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = RateLimitStore(tmp_path / "rate_limits.db")
+    yield store
+    store.close()
+
+
+class TestTokenBucket:
+    """Тесты token bucket"""
+
+    @pytest.mark.parametrize("rate, expected", [
+        ("10/minute", (10, 60)),
+        ("1/second", (1, 1)),
+        ("100 / 5 minutes", (100, 300)),
+        ("5000/day", (5000, 86400)),
+    ])
+    def test_parse_rate(self, rate, expected):
+        assert parse_rate(rate) == expected
+
+    def test_invalid_rate(self):
+        with pytest.raises(ValueError):
+            parse_rate("10 per minute")
+
+    def test_capacity_then_rejected(self, store):
+        results = [store.take("ip:1", capacity=3, period=60) for _ in range(4)]
+
+        assert results[:3] == [0, 0, 0]
+        assert 19 < results[3] <= 20
+
+    def test_refill_over_time(self, store):
+        for _ in range(2):
+            store.take("ip:1", capacity=2, period=0.2)
+        assert store.take("ip:1", capacity=2, period=0.2) > 0
+
+        time.sleep(0.15)
+
+        assert store.take("ip:1", capacity=2, period=0.2) == 0
+
+    def test_keys_and_scopes_are_independent(self, store):
+        limiter = RateLimiter(store)
+        limiter.hit("query", "ip:1", "1/minute")
+
+        limiter.hit("query", "ip:2", "1/minute")
+        limiter.hit("jobs", "ip:1", "1/minute")
+        with pytest.raises(RateLimitExceeded) as error:
+            limiter.hit("query", "ip:1", "1/minute")
+        assert error.value.detail == "Rate limit exceeded: 1/minute"
+
+    def test_client_key(self):
+        assert client_key("secret", "10.0.0.1") == "ip:10.0.0.1"
+        key = client_key("secret", "10.0.0.1", key_by="api_key")
+        assert key.startswith("key:") and "secret" not in key
+        assert client_key(None, "10.0.0.1", key_by="api_key") == "ip:10.0.0.1"
+
+
+class TestTokenBudget:
+    """Тесты суточного бюджета LLM-токенов"""
+
+    def test_budget_exhausted(self, store):
+        limiter = RateLimiter(store, daily_token_budget=100)
+        limiter.check_budget("ip:1")
+
+        assert limiter.charge("ip:1", 60) == 60
+        limiter.check_budget("ip:1")
+        assert limiter.charge("ip:1", 60) == 120
+
+        with pytest.raises(RateLimitExceeded) as error:
+            limiter.check_budget("ip:1")
+        assert "120/100" in error.value.detail
+        assert 0 < error.value.retry_after <= 86400
+
+    def test_usage_counted_per_day(self, store):
+        store.add_usage("ip:1", 50, day="2024-01-01")
+        store.add_usage("ip:1", 5)
+
+        assert store.usage("ip:1", day="2024-01-01") == 50
+        assert store.usage("ip:1") == 5
+        assert store.purge(utc_day()) == 1
+
+    def test_unlimited_budget(self, store):
+        limiter = RateLimiter(store)
+        limiter.charge("ip:1", 10 ** 9)
+
+        limiter.check_budget("ip:1")
+
+    async def test_async_charge_off_event_loop(self, store, monkeypatch):
+        limiter = RateLimiter(store)
+        threads = []
+        charge = limiter.charge
+        monkeypatch.setattr(limiter, "charge", lambda *args: threads.append(threading.get_ident()) or charge(*args))
+
+        await limiter.acharge("ip:1", 40)
+        await limiter.acharge("ip:1", 0)
+
+        assert store.usage("ip:1") == 40
+        assert len(threads) == 1 and threads[0] != threading.get_ident()
+
+
+def _hammer(db_path, attempts, results):
+    """Процесс нагрузочного теста: запросы одного клиента к общему лимиту"""
+    limiter = RateLimiter(RateLimitStore(db_path))
+    allowed = 0
+    for _ in range(attempts):
+        try:
+            limiter.hit("query", "ip:1", "20/day")
+            allowed += 1
+        except RateLimitExceeded:
+            pass
+    limiter.charge("ip:1", 10 * attempts)
+    results.put(allowed)
+
+
+class TestMultiProcess:
+    """Лимит общий для всех воркеров, а не N × лимит"""
+
+    def test_limit_shared_across_processes(self, tmp_path):
+        db_path = str(tmp_path / "rate_limits.db")
+        RateLimitStore(db_path).usage("ip:1")
+        ctx = multiprocessing.get_context("spawn")
+        results = ctx.Queue()
+        processes = [ctx.Process(target=_hammer, args=(db_path, 15, results)) for _ in range(4)]
+        for process in processes:
+            process.start()
+        allowed = [results.get(timeout=120) for _ in processes]
+        for process in processes:
+            process.join(timeout=120)
+            assert process.exitcode == 0
+
+        assert sum(allowed) == 20
+        assert RateLimitStore(db_path).usage("ip:1") == 4 * 15 * 10
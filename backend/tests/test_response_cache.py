@@ -0,0 +1,204 @@
+"""
+Тесты для кэша ответов пайплайна
+"""
+import threading
+import time
+
+import pytest
+
+import orchestrator
+import response_cache
+from response_cache import ResponseCache, normalize_query
+
+
+RESULT = {"input": "q", "route": "agent1", "agent_response": "ответ", "review_result": "approved"}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def versions(**mapping):
+    return lambda route: mapping.get(route)
+
+
+class TestNormalizeQuery:
+    """Тесты нормализации текста запроса"""
+
+    def test_case_and_whitespace(self):
+        """Регистр и пробелы не влияют на ключ"""
+        assert normalize_query("  Собери   ТРЕБОВАНИЯ\n к CRM ") == "собери требования к crm"
+
+
+class TestResponseCache:
+    """Тесты для класса ResponseCache"""
+
+    def test_hit_after_put(self):
+        """Сохранённый ответ находится по эквивалентному запросу"""
+        cache = ResponseCache()
+        cache.put("Собери требования", "agent1", "v1", "gpt", RESULT)
+
+        assert cache.get("собери  требования", "gpt", versions(agent1="v1")) == RESULT
+        assert cache.hits == 1
+
+    def test_miss_on_other_model(self):
+        """Другая модель — другой ключ"""
+        cache = ResponseCache()
+        cache.put("Запрос", "agent1", "v1", "gpt", RESULT)
+
+        assert cache.get("Запрос", "claude", versions(agent1="v1")) is None
+
+    def test_miss_on_prompt_version_change(self):
+        """Изменение версии промпта делает запись недостижимой"""
+        cache = ResponseCache()
+        cache.put("Запрос", "agent1", "v1", "gpt", RESULT)
+
+        assert cache.get("Запрос", "gpt", versions(agent1="v2")) is None
+
+    def test_ttl_expiry(self):
+        """Запись истекает по TTL"""
+        clock = FakeClock()
+        cache = ResponseCache(ttl_seconds=10, clock=clock)
+        cache.put("Запрос", "agent1", "v1", "gpt", RESULT)
+
+        clock.now = 9.9
+        assert cache.get("Запрос", "gpt", versions(agent1="v1")) is not None
+        clock.now = 10.0
+        assert cache.get("Запрос", "gpt", versions(agent1="v1")) is None
+        assert len(cache) == 0
+
+    def test_lru_eviction_by_bytes(self):
+        """При превышении лимита байт вытесняется давно не использованная запись"""
+        entry_size = len(response_cache.json.dumps(RESULT, ensure_ascii=False).encode("utf-8"))
+        cache = ResponseCache(max_bytes=entry_size * 2)
+        cache.put("первый", "agent1", "v1", "gpt", RESULT)
+        cache.put("второй", "agent1", "v1", "gpt", RESULT)
+        # Обращение делает "первый" самым свежим
+        cache.get("первый", "gpt", versions(agent1="v1"))
+        cache.put("третий", "agent1", "v1", "gpt", RESULT)
+
+        assert len(cache) == 2
+        assert cache.size_bytes <= cache.max_bytes
+        assert cache.get("второй", "gpt", versions(agent1="v1")) is None
+        assert cache.get("первый", "gpt", versions(agent1="v1")) is not None
+
+    def test_oversized_entry_not_stored(self):
+        """Ответ крупнее лимита не кэшируется"""
+        cache = ResponseCache(max_bytes=10)
+        cache.put("Запрос", "agent1", "v1", "gpt", RESULT)
+
+        assert len(cache) == 0
+
+    def test_invalidate_route(self):
+        """Инвалидация удаляет только записи указанного агента"""
+        cache = ResponseCache()
+        cache.put("первый", "agent1", "v1", "gpt", RESULT)
+        cache.put("второй", "agent2", "v1", "gpt", RESULT)
+
+        cache.invalidate_route("agent1")
+
+        assert len(cache) == 1
+        assert cache.get("второй", "gpt", versions(agent2="v1")) is not None
+
+    def test_prompt_version_resolved_outside_lock(self):
+        """Колбэк версии может инвалидировать кэш (правка промпта другим процессом)"""
+        cache = ResponseCache()
+        cache.put("Запрос", "agent1", "v1", "gpt", RESULT)
+
+        def edited_elsewhere(route):
+            cache.invalidate_route(route)
+            return "v2"
+
+        results = []
+        lookup = threading.Thread(
+            target=lambda: results.append(cache.get("Запрос", "gpt", edited_elsewhere)), daemon=True
+        )
+        lookup.start()
+        lookup.join(5)
+
+        assert not lookup.is_alive(), "ResponseCache.get deadlocked"
+        assert results == [None] and len(cache) == 0
+
+
+class TestCachedPipeline:
+    """Тесты кэша в process_query"""
+
+    @pytest.fixture
+    def cache(self, monkeypatch, temp_storage):
+        cache = ResponseCache()
+        temp_storage.subscribe_prompt_changes(cache.invalidate_route)
+        monkeypatch.setattr(response_cache, "_cache", cache)
+        monkeypatch.setattr(response_cache, "_cache_initialized", True)
+        return cache
+
+    async def test_second_query_served_from_cache(self, scripted_llm, cache):
+        """Повторный запрос отдаётся из кэша без вызовов LLM"""
+        first = await orchestrator.process_query("Собери требования к CRM")
+        calls_after_first = len(scripted_llm.calls)
+
+        started = time.perf_counter()
+        second = await orchestrator.process_query("собери требования  к crm")
+        elapsed = time.perf_counter() - started
+
+        assert first["cached"] is False
+        assert second["cached"] is True
+        assert second["agent_response"] == first["agent_response"]
+        assert len(scripted_llm.calls) == calls_after_first
+        assert elapsed < 0.05
+
+    async def test_prompt_update_invalidates(self, scripted_llm, cache, temp_storage):
+        """Правка промпта агента сбрасывает его записи в кэше"""
+        await orchestrator.process_query("Собери требования к CRM")
+        agent = temp_storage.get_by_id("agent2")
+
+        temp_storage.update(
+            agent_id="agent2",
+            name=agent["name"],
+            description=agent["description"],
+            prompt="Новый промпт агента требований",
+            color=agent["color"]
+        )
+
+        assert len(cache) == 0
+        result = await orchestrator.process_query("Собери требования к CRM")
+        assert result["cached"] is False
+
+    async def test_name_update_keeps_entries(self, scripted_llm, cache, temp_storage):
+        """Правка имени без изменения промпта кэш не сбрасывает"""
+        await orchestrator.process_query("Собери требования к CRM")
+        agent = temp_storage.get_by_id("agent2")
+
+        temp_storage.update(
+            agent_id="agent2",
+            name="Новое имя",
+            description=agent["description"],
+            prompt=agent["prompt"],
+            color=agent["color"]
+        )
+
+        result = await orchestrator.process_query("Собери требования к CRM")
+        assert result["cached"] is True
+
+    async def test_revision_not_approved_not_cached(self, scripted_llm, cache):
+        """Не одобренный ревьюером ответ не кэшируется"""
+        scripted_llm.reviews = ["rejected"]
+
+        await orchestrator.process_query("Собери требования к CRM")
+
+        assert len(cache) == 0
+
+    async def test_cache_disabled_by_default(self, scripted_llm, monkeypatch):
+        """Без RESPONSE_CACHE_ENABLED кэш не используется"""
+        monkeypatch.setattr(response_cache, "_cache", None)
+        monkeypatch.setattr(response_cache, "_cache_initialized", False)
+        monkeypatch.delenv("RESPONSE_CACHE_ENABLED", raising=False)
+
+        await orchestrator.process_query("Запрос")
+        result = await orchestrator.process_query("Запрос")
+
+        assert result["cached"] is False
+        assert response_cache.get_response_cache() is None
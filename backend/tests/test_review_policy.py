@@ -0,0 +1,86 @@
+"""
+Тесты политики ревью: проверки до вызова LLM и настройки из окружения
+"""
+import pytest
+
+from review_policy import ReviewPolicy, get_review_policy
+
+
+class TestPrecheck:
+    """Тесты решений без вызова LLM"""
+
+    def test_default_policy_always_asks_llm(self):
+        assert ReviewPolicy().precheck("Запрос", ["agent2"], "Ответ") is None
+
+    def test_skip_agents(self):
+        policy = ReviewPolicy(skip_agents=frozenset({"agent1"}))
+
+        assert policy.precheck("Запрос", ["agent1"], "Ответ").reason == "skip"
+        # Fan-out пропускается, только если все агенты в списке
+        assert policy.precheck("Запрос", ["agent1", "agent2"], "Ответ") is None
+
+    def test_too_short(self):
+        verdict = ReviewPolicy(min_chars=20).precheck("Запрос", ["agent2"], "  Кратко  ")
+
+        assert verdict.review_result == "needs_revision"
+        assert verdict.reason == "too_short"
+        assert "20" in verdict.revised_instructions
+
+    def test_missing_sections(self):
+        policy = ReviewPolicy(required_sections={"agent3": ("## Цель", "## Требования")})
+
+        verdict = policy.precheck("Запрос", ["agent3"], "## Цель\nСделать CRM")
+
+        assert verdict.reason == "missing_sections"
+        assert verdict.revised_instructions == "Добавьте обязательные разделы: ## Требования"
+        assert policy.precheck("Запрос", ["agent3"], "## Цель\n## Требования") is None
+
+    def test_short_answer_auto_approved(self):
+        policy = ReviewPolicy(auto_approve_chars=10)
+
+        assert policy.precheck("Запрос", ["agent2"], "Да, верно").reason == "short_answer"
+        assert policy.precheck("Запрос", ["agent2"], "Развёрнутый ответ агента") is None
+
+    def test_sampling_is_deterministic(self):
+        policy = ReviewPolicy(sample_rate=0.5)
+        queries = [f"Запрос {i}" for i in range(200)]
+
+        sampled = [policy.sampled(query) for query in queries]
+
+        assert sampled == [policy.sampled(query) for query in queries]
+        assert 60 < sum(sampled) < 140
+        assert ReviewPolicy(sample_rate=0).precheck("Запрос", ["agent2"], "Ответ").reason == "sampled_out"
+
+
+class TestPolicyFromEnv:
+    """Тесты чтения политики из переменных окружения"""
+
+    def test_from_env(self, monkeypatch):
+        monkeypatch.setenv("REVIEW_MAX_ITERATIONS", "0")
+        monkeypatch.setenv("REVIEW_SKIP_AGENTS", "agent1, agent5")
+        monkeypatch.setenv("REVIEW_REQUIRED_SECTIONS", '{"agent3": ["## Цель"]}')
+        monkeypatch.setenv("REVIEW_MODEL_NAME", "openai/gpt-4o-mini")
+        monkeypatch.setenv("REVIEW_REVISION_MODE", "full")
+
+        policy = get_review_policy()
+
+        assert policy.max_iterations == 0
+        assert policy.skip_agents == {"agent1", "agent5"}
+        assert policy.required_sections == {"agent3": ("## Цель",)}
+        assert policy.model == "openai/gpt-4o-mini"
+        assert policy.revision_mode == "full"
+
+    def test_rebuilt_on_env_change(self, monkeypatch):
+        monkeypatch.delenv("REVIEW_MIN_CHARS", raising=False)
+        policy = get_review_policy()
+        assert get_review_policy() is policy
+
+        monkeypatch.setenv("REVIEW_MIN_CHARS", "50")
+
+        assert get_review_policy().min_chars == 50
+
+    def test_unknown_revision_mode(self, monkeypatch):
+        monkeypatch.setenv("REVIEW_REVISION_MODE", "rewrite")
+
+        with pytest.raises(ValueError):
+            ReviewPolicy.from_env()
@@ -0,0 +1,360 @@
+"""
+Тесты для маршрутизаторов запросов
+"""
+import json
+
+import pytest
+
+import orchestrator
+from router import (
+    HybridRouter, LLMRouter, LocalRouter, NoRouteError, ShortlistRouter, char_ngrams, load_examples
+)
+
+
+@pytest.fixture
+def local_router(temp_storage):
+    return LocalRouter(temp_storage.get_all())
+
+
+def menu_ids(prompt: str) -> list:
+    """ID агентов из меню промпта маршрутизатора (строки "- agentN: ...")"""
+    return [line[2:].split(":")[0] for line in prompt.splitlines() if line.startswith("- agent")]
+
+
+class TestLocalRouter:
+    """Тесты локального классификатора"""
+
+    def test_char_ngrams_with_boundaries(self):
+        """n-граммы строятся внутри слов с пробелами-границами"""
+        grams = char_ngrams("Да", ngram_range=(3, 3))
+
+        assert grams == [" да", "да "]
+
+    @pytest.mark.parametrize("query, expected", [
+        ("Собери требования к новой CRM", "agent2"),
+        ("Подготовь вопросы для стейкхолдеров по авторизации", "agent1"),
+        ("Напиши техническую документацию к API", "agent3"),
+        ("Смоделируй процесс согласования заявки", "agent4"),
+        ("Проведи бизнес-анализ рынка", "agent5"),
+    ])
+    def test_classify_by_description(self, local_router, query, expected):
+        """Запрос относится к агенту с наиболее близким описанием"""
+        decision = local_router.classify(query)
+
+        assert decision.route == expected
+        assert decision.source == "local"
+        assert decision.margin > 0.2
+
+    def test_unrelated_query_has_low_margin(self, local_router):
+        """Запрос без пересечений с описаниями не даёт уверенного решения"""
+        assert local_router.classify("Привет").margin < 0.2
+
+    def test_examples_improve_classification(self, temp_storage):
+        """Размеченные примеры сдвигают решение к нужному агенту"""
+        query = "Нарисуй диаграмму BPMN для онбординга"
+        examples = {"agent4": ["Нарисуй диаграмму BPMN", "диаграмма последовательности"]}
+
+        assert LocalRouter(temp_storage.get_all()).classify(query).margin < 0.2
+        decision = LocalRouter(temp_storage.get_all(), examples=examples).classify(query)
+        assert decision.route == "agent4"
+        assert decision.margin > 0.2
+
+    def test_load_examples(self, tmp_path):
+        """Загрузка примеров из JSONL"""
+        path = tmp_path / "examples.jsonl"
+        path.write_text(
+            '{"query": "Нарисуй BPMN", "route": "agent4"}\n'
+            '\n'
+            '{"query": "Составь ТЗ", "route": "agent3"}\n',
+            encoding="utf-8"
+        )
+
+        assert load_examples(str(path)) == {"agent4": ["Нарисуй BPMN"], "agent3": ["Составь ТЗ"]}
+        assert load_examples(str(tmp_path / "missing.jsonl")) == {}
+
+    def test_empty_catalog_zero_confidence(self):
+        router = LocalRouter([])
+
+        decision = router.classify("Любой запрос")
+
+        assert decision.route is None
+        assert decision.routes == []
+        assert decision.margin == 0.0
+        assert decision.scores == {}
+        assert router.shortlist("Любой запрос", 3) == {}
+
+
+class TestHybridRouter:
+    """Тесты гибридной маршрутизации"""
+
+    @pytest.fixture
+    def hybrid(self, local_router, temp_storage, scripted_llm):
+        llm_router = LLMRouter(llm_factory=lambda: scripted_llm, agents_provider=temp_storage.get_all)
+        return HybridRouter(local_router, llm_router, margin_threshold=0.2)
+
+    async def test_confident_query_skips_llm(self, hybrid, scripted_llm):
+        """Уверенное решение локального классификатора не вызывает LLM"""
+        decision = await hybrid.route("Напиши техническую документацию к API")
+
+        assert decision.route == "agent3"
+        assert decision.source == "local"
+        assert scripted_llm.calls == []
+
+    async def test_ambiguous_query_falls_back_to_llm(self, hybrid, scripted_llm):
+        """При малом отрыве решение принимает LLM"""
+        decision = await hybrid.route("Привет")
+
+        assert decision.route == "agent2"
+        assert decision.source == "llm"
+        assert decision.margin < 0.2
+        assert scripted_llm.calls == ["route"]
+
+    async def test_empty_catalog_falls_back_to_llm(self, temp_storage, scripted_llm):
+        """Без агентов локальный классификатор не решает даже при нулевом пороге"""
+        llm_router = LLMRouter(llm_factory=lambda: scripted_llm, agents_provider=temp_storage.get_all)
+        hybrid = HybridRouter(LocalRouter([]), llm_router, margin_threshold=0.0)
+
+        decision = await hybrid.route("Привет")
+
+        assert decision.source == "llm"
+        assert scripted_llm.calls == ["route"]
+
+
+class TestLLMRouter:
+    """Тесты разбора ответа LLM-маршрутизатора"""
+
+    @pytest.mark.parametrize("raw, max_agents, expected", [
+        ("agent3", 1, ["agent3"]),
+        ("Agent3.", 1, ["agent3"]),
+        ("agent2, agent4", 1, ["agent2"]),
+        ("agent2, agent4", 3, ["agent2", "agent4"]),
+        ("agent4; agent4 agent9 agent1", 3, ["agent4", "agent1"]),
+        ("agent1, agent2, agent3, agent4", 2, ["agent1", "agent2"]),
+        ("не знаю", 3, ["agent1"]),
+    ])
+    async def test_routes_parsed_and_validated(self, temp_storage, scripted_llm, raw, max_agents, expected):
+        scripted_llm.route = raw
+        router = LLMRouter(
+            llm_factory=lambda: scripted_llm,
+            agents_provider=temp_storage.snapshot,
+            max_agents=max_agents
+        )
+
+        decision = await router.route("Запрос")
+
+        assert decision.routes == expected
+        assert decision.route == expected[0]
+
+
+class TestShortlistRouter:
+    """Тесты двухэтапной маршрутизации: шорт-лист локального классификатора, выбор LLM"""
+
+    @pytest.fixture
+    def router(self, local_router, temp_storage, scripted_llm):
+        llm_router = LLMRouter(llm_factory=lambda: scripted_llm, agents_provider=temp_storage.snapshot)
+        return ShortlistRouter(local_router, llm_router, k=2)
+
+    async def test_llm_sees_only_shortlist(self, router, scripted_llm):
+        scripted_llm.route = "agent3"
+
+        decision = await router.route("Напиши техническую документацию к API")
+
+        assert decision.route == "agent3"
+        assert decision.shortlist[0] == "agent3" and len(decision.shortlist) == 2
+        assert menu_ids(scripted_llm.inputs[-1]) == decision.shortlist
+
+    async def test_answer_outside_shortlist_falls_back_to_best(self, router, scripted_llm):
+        scripted_llm.route = "agent5"
+
+        decision = await router.route("Напиши техническую документацию к API")
+
+        assert "agent5" not in decision.shortlist
+        assert decision.route == decision.shortlist[0]
+
+    async def test_batch_menu_is_union_of_shortlists(self, router, scripted_llm):
+        scripted_llm.route = "1: agent3\n2: agent4"
+
+        decisions = await router.route_batch(
+            ["Напиши техническую документацию к API", "Нарисуй диаграмму BPMN"]
+        )
+
+        assert [d.route for d in decisions] == ["agent3", "agent4"]
+        assert scripted_llm.calls == ["route"]
+        assert set(menu_ids(scripted_llm.inputs[-1])) == set(decisions[0].shortlist) | set(decisions[1].shortlist)
+
+
+class TestLargeCatalog:
+    """Граф и маршрутизация по каталогу из десятков агентов"""
+
+    @pytest.fixture
+    def catalog(self, monkeypatch, scripted_llm, tmp_path):
+        import agents_storage
+
+        topics = ["платежей", "склада", "логистики", "кадров", "бухгалтерии", "маркетинга"]
+        roles = [
+            ("Аналитик требований", "Сбор и анализ требований"),
+            ("Архитектор", "Проектирование архитектуры"),
+            ("Тестировщик", "Планирование тестирования"),
+            ("Технический писатель", "Техническая документация"),
+            ("Специалист по процессам", "Моделирование бизнес-процессов"),
+            ("Специалист по данным", "Отчёты и аналитика данных"),
+            ("Специалист по безопасности", "Аудит информационной безопасности"),
+            ("Специалист по интеграциям", "Интеграции и API"),
+            ("Специалист по UX", "Пользовательские сценарии и интерфейсы"),
+            ("Специалист по внедрению", "Внедрение и обучение пользователей"),
+        ]
+        agents = {}
+        for topic in topics:
+            for name, description in roles:
+                agent_id = f"agent{len(agents) + 1}"
+                agents[agent_id] = agents_storage.Agent(
+                    id=agent_id, name=f"{name} ({topic})", description=f"{description} для системы {topic}",
+                    prompt=f"Вы {name.lower()} системы {topic}.",
+                ).to_dict()
+        path = tmp_path / "agents.json"
+        path.write_text(json.dumps(agents, ensure_ascii=False), encoding="utf-8")
+        storage = agents_storage.AgentsStorage(str(path))
+        monkeypatch.setattr(agents_storage, "_storage", storage)
+        return storage
+
+    async def test_llm_picks_among_shortlist(self, catalog, scripted_llm, monkeypatch):
+        monkeypatch.delenv("ROUTER_MODE", raising=False)
+        monkeypatch.delenv("ROUTER_SHORTLIST_K", raising=False)
+        scripted_llm.route = "agent33"
+
+        result = await orchestrator.process_query("Составь план тестирования системы кадров")
+
+        assert len(catalog.snapshot().agent_ids) == 60
+        assert result["route"] == "agent33"
+        route_event = next(e for e in result["trace"] if e["kind"] == "route")
+        assert len(route_event["payload"]["shortlist"]) == 8
+        assert route_event["payload"]["shortlist"][0] == "agent33"
+        assert len(menu_ids(scripted_llm.inputs[0])) == 8
+
+    async def test_batch_menu_bounded_for_diverse_queries(self, catalog, scripted_llm):
+        snapshot = catalog.snapshot()
+        llm_router = LLMRouter(llm_factory=lambda: scripted_llm, agents_provider=catalog.snapshot)
+        router = ShortlistRouter(LocalRouter(snapshot.agents), llm_router, k=4)
+        queries = [
+            "Составь план тестирования системы кадров",
+            "Спроектируй архитектуру системы платежей",
+            "Проверь безопасность системы склада",
+            "Напиши документацию системы маркетинга",
+            "Составь план тестирования системы кадров и бухгалтерии",
+        ]
+
+        decisions = await router.route_batch(queries)
+
+        assert len(decisions) == len(queries)
+        assert all(len(decision.shortlist) == 4 for decision in decisions)
+        assert len(scripted_llm.inputs) > 1
+        assert all(len(menu_ids(prompt)) <= 8 for prompt in scripted_llm.inputs)
+
+    async def test_shortlist_disabled(self, catalog, scripted_llm, monkeypatch):
+        monkeypatch.delenv("ROUTER_MODE", raising=False)
+        monkeypatch.setenv("ROUTER_SHORTLIST_K", "0")
+        scripted_llm.route = "agent60"
+
+        result = await orchestrator.process_query("Составь план тестирования системы кадров")
+
+        assert result["route"] == "agent60"
+        assert len(menu_ids(scripted_llm.inputs[0])) == 60
+
+
+class TestRouterInPipeline:
+    """Тесты выбора маршрутизатора в оркестраторе"""
+
+    async def test_hybrid_mode_skips_routing_call(self, monkeypatch, scripted_llm):
+        """В режиме hybrid уверенный запрос проходит без вызова маршрутизатора"""
+        monkeypatch.setenv("ROUTER_MODE", "hybrid")
+
+        result = await orchestrator.process_query("Напиши техническую документацию к API")
+
+        assert result["route"] == "agent3"
+        assert scripted_llm.calls == ["agent", "review"]
+        assert any("Локальный классификатор" in entry for entry in result["log"])
+
+    async def test_llm_mode_is_default(self, monkeypatch, scripted_llm):
+        """По умолчанию маршрут выбирает LLM"""
+        monkeypatch.delenv("ROUTER_MODE", raising=False)
+
+        await orchestrator.process_query("Напиши техническую документацию к API")
+
+        assert scripted_llm.calls[0] == "route"
+
+    def test_router_rebuilt_on_description_change(self, monkeypatch, temp_storage):
+        """Локальный классификатор пересобирается при изменении описания агента"""
+        monkeypatch.setenv("ROUTER_MODE", "local")
+        router = orchestrator.get_router()
+        assert orchestrator.get_router() is router
+
+        agent = temp_storage.get_by_id("agent4")
+        temp_storage.update(
+            agent_id="agent4",
+            name=agent["name"],
+            description="Диаграммы BPMN и UML",
+            prompt=agent["prompt"],
+            color=agent["color"]
+        )
+
+        assert orchestrator.get_router() is not router
+
+    async def test_local_mode_with_empty_catalog(self, monkeypatch, tmp_path, scripted_llm):
+        """В режиме local пустой каталог — понятная ошибка, а не выдуманный agent1"""
+        import agents_storage
+
+        path = tmp_path / "agents.json"
+        path.write_text("{}", encoding="utf-8")
+        monkeypatch.setattr(agents_storage, "_storage", agents_storage.AgentsStorage(str(path)))
+        monkeypatch.setenv("ROUTER_MODE", "local")
+
+        with pytest.raises(NoRouteError, match="Каталог агентов пуст"):
+            await orchestrator.process_query("Напиши техническую документацию к API")
+
+        assert scripted_llm.calls == []
+
+
+class TestBatchRouting:
+    """Тесты пакетной маршрутизации: один вызов LLM на пачку запросов"""
+
+    @pytest.fixture
+    def router(self, temp_storage, scripted_llm):
+        return LLMRouter(llm_factory=lambda: scripted_llm, agents_provider=temp_storage.snapshot)
+
+    async def test_lines_mapped_to_queries(self, router, scripted_llm):
+        scripted_llm.route = "1: agent3\n2. Agent4\n3) agent9"
+
+        decisions = await router.route_batch(["Документация", "BPMN", "Непонятно"])
+
+        assert [d.route for d in decisions] == ["agent3", "agent4", "agent1"]
+        assert scripted_llm.calls == ["route"]
+
+    async def test_missing_line_gets_fallback(self, router, scripted_llm):
+        scripted_llm.route = "2: agent5"
+
+        decisions = await router.route_batch(["Первый", "Второй"])
+
+        assert [d.route for d in decisions] == ["agent1", "agent5"]
+
+    async def test_fanout_in_batch(self, temp_storage, scripted_llm):
+        scripted_llm.route = "1: agent2, agent4\n2: agent3"
+        router = LLMRouter(
+            llm_factory=lambda: scripted_llm, agents_provider=temp_storage.snapshot, max_agents=2
+        )
+
+        decisions = await router.route_batch(["Требования и процесс", "Документация"])
+
+        assert decisions[0].routes == ["agent2", "agent4"]
+        assert decisions[1].routes == ["agent3"]
+
+    async def test_hybrid_batches_only_uncertain(self, local_router, temp_storage, scripted_llm):
+        scripted_llm.route = "1: agent5"
+        fallback = LLMRouter(llm_factory=lambda: scripted_llm, agents_provider=temp_storage.snapshot)
+        hybrid = HybridRouter(local_router, fallback, margin_threshold=0.2)
+
+        decisions = await hybrid.route_batch(["Напиши техническую документацию к API", "Привет"])
+
+        assert decisions[0].source == "local"
+        assert decisions[1].source == "llm"
+        assert decisions[1].route == "agent5"
+        assert scripted_llm.calls == ["route"]
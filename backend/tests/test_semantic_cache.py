@@ -0,0 +1,256 @@
+"""
+Тесты для семантического кэша ответов
+"""
+import threading
+
+import numpy as np
+import pytest
+
+import orchestrator
+import semantic_cache
+from semantic_cache import SemanticCache, embed, same_request, terms
+
+
+RESULT = {"input": "q", "route": "agent1", "agent_response": "ответ", "review_result": "approved"}
+
+QUERY = "Собери требования к CRM для отдела продаж"
+PARAPHRASE = "Собери требования к CRM-системе для отдела продаж"
+OTHER_DEPARTMENT = "Собери требования к CRM для отдела закупок"
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def versions(**mapping):
+    return lambda route: mapping.get(route)
+
+
+def similarity(a: str, b: str) -> float:
+    return float(embed(a) @ embed(b))
+
+
+class TestEmbed:
+    """Тесты векторизации запроса"""
+
+    def test_unit_norm(self):
+        assert np.linalg.norm(embed(QUERY)) == pytest.approx(1.0, abs=1e-5)
+
+    def test_empty_text_is_zero_vector(self):
+        assert not embed("").any()
+
+    def test_paraphrase_closer_than_other_request(self):
+        """Перефразированный запрос ближе, чем запрос о другом"""
+        assert similarity(QUERY, PARAPHRASE) >= semantic_cache.DEFAULT_THRESHOLD
+        assert similarity(QUERY, OTHER_DEPARTMENT) < semantic_cache.DEFAULT_THRESHOLD
+        assert similarity(QUERY, "Спроектируй архитектуру микросервисов") < 0.3
+
+
+class TestSameRequest:
+    """Тесты проверки запроса по словам"""
+
+    def test_added_or_removed_words_allowed(self):
+        assert same_request(terms(PARAPHRASE), terms(QUERY))
+        assert same_request(terms(QUERY), terms(PARAPHRASE))
+
+    def test_word_forms_allowed(self):
+        assert same_request(terms("Собрать требования к CRM"), terms("Собери требования к CRM"))
+
+    def test_substitution_rejected(self):
+        assert not same_request(terms(OTHER_DEPARTMENT), terms(QUERY))
+        assert not same_request(terms("Собери требования к CRM 2"), terms("Собери требования к CRM 3"))
+
+
+class TestSemanticCache:
+    """Тесты для класса SemanticCache"""
+
+    def test_hit_on_paraphrase(self):
+        """Близкий запрос получает сохранённый ответ с оценкой близости"""
+        cache = SemanticCache()
+        cache.put(QUERY, "agent1", "v1", "gpt", RESULT)
+
+        result = cache.get(PARAPHRASE, "gpt", versions(agent1="v1"))
+
+        assert result["agent_response"] == "ответ"
+        assert result["similarity"] >= cache.threshold
+        assert cache.hits == 1
+
+    def test_miss_below_threshold(self):
+        cache = SemanticCache()
+        cache.put(QUERY, "agent1", "v1", "gpt", RESULT)
+
+        assert cache.get(OTHER_DEPARTMENT, "gpt", versions(agent1="v1")) is None
+        assert cache.misses == 1
+
+    def test_miss_on_substituted_word_despite_similarity(self):
+        """Замена слова — промах даже при низком пороге"""
+        cache = SemanticCache(threshold=0.5)
+        cache.put(QUERY, "agent1", "v1", "gpt", RESULT)
+
+        assert cache.get(OTHER_DEPARTMENT, "gpt", versions(agent1="v1")) is None
+
+    def test_route_threshold_overrides_default(self):
+        """Порог агента строже общего — перефраз уже не совпадает"""
+        cache = SemanticCache(route_thresholds={"agent1": 0.99})
+        cache.put(QUERY, "agent1", "v1", "gpt", RESULT)
+
+        assert cache.threshold_for("agent2") == cache.threshold
+        assert cache.get(PARAPHRASE, "gpt", versions(agent1="v1")) is None
+        assert cache.get(QUERY, "gpt", versions(agent1="v1")) is not None
+
+    def test_miss_on_other_model(self):
+        cache = SemanticCache()
+        cache.put(QUERY, "agent1", "v1", "gpt", RESULT)
+
+        assert cache.get(QUERY, "claude", versions(agent1="v1")) is None
+
+    def test_miss_on_prompt_version_change(self):
+        cache = SemanticCache()
+        cache.put(QUERY, "agent1", "v1", "gpt", RESULT)
+
+        assert cache.get(QUERY, "gpt", versions(agent1="v2")) is None
+
+    def test_falls_back_to_next_candidate(self):
+        """Если ближайшая запись устарела по версии, берётся следующая подходящая"""
+        cache = SemanticCache()
+        cache.put(QUERY, "agent1", "v1", "gpt", RESULT)
+        cache.put(PARAPHRASE, "agent2", "v1", "gpt", dict(RESULT, route="agent2"))
+
+        result = cache.get(QUERY, "gpt", versions(agent1="v2", agent2="v1"))
+
+        assert result["route"] == "agent2"
+
+    def test_ttl_expiry(self):
+        clock = FakeClock()
+        cache = SemanticCache(ttl_seconds=10, clock=clock)
+        cache.put(QUERY, "agent1", "v1", "gpt", RESULT)
+
+        clock.now = 9.9
+        assert cache.get(PARAPHRASE, "gpt", versions(agent1="v1")) is not None
+        clock.now = 10.0
+        assert cache.get(PARAPHRASE, "gpt", versions(agent1="v1")) is None
+        assert len(cache) == 0
+
+    def test_lru_eviction_by_entries(self):
+        """При max_entries вытесняется давно не использованная запись, строка переиспользуется"""
+        cache = SemanticCache(max_entries=2)
+        cache.put("первый запрос про CRM", "agent1", "v1", "gpt", RESULT)
+        cache.put("второй запрос про склад", "agent1", "v1", "gpt", RESULT)
+        cache.get("первый запрос про CRM", "gpt", versions(agent1="v1"))
+
+        cache.put("третий запрос про бухгалтерию", "agent1", "v1", "gpt", RESULT)
+
+        assert len(cache) == 2
+        assert cache.matrix_bytes == 2 * cache.dim * 4
+        assert cache.get("первый запрос про CRM", "gpt", versions(agent1="v1")) is not None
+        assert cache.get("второй запрос про склад", "gpt", versions(agent1="v1")) is None
+
+    def test_lru_eviction_by_bytes(self):
+        entry_size = (
+            len(semantic_cache.json.dumps(RESULT, ensure_ascii=False).encode("utf-8"))
+            + semantic_cache.DEFAULT_DIM * 4
+        )
+        cache = SemanticCache(max_bytes=entry_size * 2)
+        for query in ("первый запрос про CRM", "второй запрос про склад", "третий про бухгалтерию"):
+            cache.put(query, "agent1", "v1", "gpt", RESULT)
+
+        assert len(cache) == 2
+        assert cache.size_bytes == entry_size * 2
+        assert cache.get("первый запрос про CRM", "gpt", versions(agent1="v1")) is None
+
+    def test_oversized_entry_not_stored(self):
+        cache = SemanticCache(max_bytes=100)
+        cache.put(QUERY, "agent1", "v1", "gpt", RESULT)
+
+        assert len(cache) == 0
+
+    def test_matrix_grows_to_max_entries(self):
+        cache = SemanticCache(max_entries=3000, dim=16)
+        for i in range(2000):
+            cache.put(f"запрос номер {i}", "agent1", "v1", "gpt", RESULT)
+
+        assert len(cache) == 2000
+        assert cache.matrix_bytes == 2048 * 16 * 4
+        assert cache.get("запрос номер 1999", "gpt", versions(agent1="v1")) is not None
+
+    def test_invalidate_route(self):
+        cache = SemanticCache()
+        cache.put(QUERY, "agent1", "v1", "gpt", RESULT)
+        cache.put("Спроектируй архитектуру", "agent2", "v1", "gpt", RESULT)
+
+        cache.invalidate_route("agent1")
+
+        assert len(cache) == 1
+        assert cache.get(QUERY, "gpt", versions(agent1="v1")) is None
+
+    def test_prompt_version_resolved_outside_lock(self):
+        """Колбэк версии может инвалидировать кэш (правка промпта другим процессом)"""
+        cache = SemanticCache()
+        cache.put(QUERY, "agent1", "v1", "gpt", RESULT)
+
+        def edited_elsewhere(route):
+            cache.invalidate_route(route)
+            return "v2"
+
+        results = []
+        lookup = threading.Thread(target=lambda: results.append(cache.get(QUERY, "gpt", edited_elsewhere)), daemon=True)
+        lookup.start()
+        lookup.join(5)
+
+        assert not lookup.is_alive(), "SemanticCache.get deadlocked"
+        assert results == [None] and len(cache) == 0
+
+    def test_entry_removed_while_unlocked_is_skipped(self):
+        cache = SemanticCache()
+        cache.put(QUERY, "agent1", "v1", "gpt", RESULT)
+
+        def removed_meanwhile(route):
+            cache.clear()
+            return "v1"
+
+        assert cache.get(QUERY, "gpt", removed_meanwhile) is None
+
+
+class TestSemanticPipeline:
+    """Тесты семантического кэша в process_query"""
+
+    @pytest.fixture
+    def cache(self, monkeypatch, temp_storage):
+        cache = SemanticCache()
+        temp_storage.subscribe_prompt_changes(cache.invalidate_route)
+        monkeypatch.setattr(semantic_cache, "_cache", cache)
+        monkeypatch.setattr(semantic_cache, "_cache_initialized", True)
+        return cache
+
+    async def test_paraphrase_served_without_llm(self, scripted_llm, cache):
+        """Перефразированный запрос отдаётся из кэша без вызовов LLM"""
+        first = await orchestrator.process_query(QUERY)
+        calls_after_first = len(scripted_llm.calls)
+
+        second = await orchestrator.process_query(PARAPHRASE)
+
+        assert first["cached"] is False
+        assert second["cached"] is True
+        assert second["input"] == PARAPHRASE
+        assert second["agent_response"] == first["agent_response"]
+        assert "similarity" not in second
+        assert len(scripted_llm.calls) == calls_after_first
+
+    async def test_prompt_update_invalidates(self, scripted_llm, cache, temp_storage):
+        result = await orchestrator.process_query(QUERY)
+        agent = temp_storage.get_by_id(result["route"])
+
+        temp_storage.update(
+            agent_id=agent["id"],
+            name=agent["name"],
+            description=agent["description"],
+            prompt="Новый промпт агента",
+            color=agent["color"]
+        )
+
+        assert len(cache) == 0
+        assert (await orchestrator.process_query(PARAPHRASE))["cached"] is False
@@ -0,0 +1,90 @@
+"""
+Тесты сессий диалога: хранение ходов и инкрементальное сжатие истории
+"""
+import time
+
+import pytest
+
+from sessions import SessionNotFoundError, SessionStore, estimate_tokens, render_history
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SessionStore(tmp_path / "sessions.db", window_tokens=100, summary_tokens=150)
+    yield store
+    store.close()
+
+
+class TestSessionStore:
+    """Тесты хранилища сессий"""
+
+    def test_turns_kept_in_window_within_budget(self, store):
+        session_id = store.create()["id"]
+
+        store.append(session_id, "Собери требования", "Требования: A, B", ["agent2"])
+        store.append(session_id, "Сделай короче", "A, B", ["agent2"])
+
+        session = store.get(session_id)
+        assert session["routes"] == ["agent2"]
+        assert session["summary"] == ""
+        history = store.history(session_id)
+        assert "Пользователь: Собери требования" in history
+        assert "Ответ (agent2): A, B" in history
+
+    def test_old_turns_folded_into_summary(self, store):
+        session_id = store.create()["id"]
+
+        for i in range(4):
+            store.append(session_id, f"Запрос {i}", "ответ " * 40, ["agent2"])
+
+        window = store.turns(session_id, window_only=True)
+        assert [turn["seq"] for turn in window] == [4]
+        summary = store.get(session_id)["summary"]
+        assert summary.startswith("- Запрос:")
+        # Бюджет сводки: самые старые строки отброшены
+        assert sum(estimate_tokens(line) for line in summary.splitlines()) <= 150
+        assert "Запрос 0" not in summary
+        assert "Запрос 1" in summary and "Запрос 2" in summary
+
+    def test_latest_turn_always_in_window(self, store):
+        session_id = store.create()["id"]
+
+        store.append(session_id, "Большой запрос", "x" * 2000, ["agent3"])
+
+        assert len(store.turns(session_id, window_only=True)) == 1
+
+    def test_routes_updated_on_each_turn(self, store):
+        session_id = store.create()["id"]
+
+        store.append(session_id, "q1", "r1", ["agent2"])
+        store.append(session_id, "q2", "r2", ["agent3", "agent4"])
+
+        assert store.get(session_id)["routes"] == ["agent3", "agent4"]
+        assert store.turns(session_id)[1]["route"] == "agent3, agent4"
+
+    def test_expired_session_is_gone(self, tmp_path):
+        store = SessionStore(tmp_path / "sessions.db", ttl_seconds=0.05)
+        session_id = store.create()["id"]
+        time.sleep(0.1)
+
+        assert store.get(session_id) is None
+        store.create()
+        assert store.turns(session_id) == []
+        store.close()
+
+    def test_unknown_session(self, store):
+        with pytest.raises(SessionNotFoundError):
+            store.append("missing", "q", "r", ["agent1"])
+        with pytest.raises(SessionNotFoundError):
+            store.history("missing")
+        assert store.delete("missing") is False
+
+    def test_render_history(self):
+        history = render_history("- Запрос: a → agent1: b", [
+            {"query": "q", "response": "r", "route": "agent2"},
+        ])
+
+        assert history == (
+            "Краткое содержание начала диалога:\n- Запрос: a → agent1: b\n\n"
+            "Пользователь: q\nОтвет (agent2): r"
+        )
@@ -0,0 +1,218 @@
+"""
+Тесты объединения одинаковых запросов и ключей идемпотентности
+"""
+import asyncio
+
+import httpx
+import pytest
+
+import orchestrator
+from single_flight import IdempotencyKeyReused, IdempotencyStore, SingleFlight, coalescing_key
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def counted(result="результат", delay=0.05, error=None):
+    """Корутина-функция, считающая свои запуски"""
+    calls = []
+
+    async def run():
+        calls.append(True)
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        return result
+
+    return run, calls
+
+
+@pytest.fixture
+def idempotency_store(monkeypatch):
+    store = IdempotencyStore()
+    monkeypatch.setattr("main.get_idempotency_store", lambda: store)
+    return store
+
+
+class TestSingleFlight:
+    """Тесты объединения одновременных вызовов"""
+
+    async def test_concurrent_calls_share_one_run(self):
+        flight = SingleFlight()
+        run, calls = counted()
+
+        results = await asyncio.gather(*(flight.do("key", run) for _ in range(5)))
+
+        assert len(calls) == 1
+        assert [shared for _, shared in results] == [False, True, True, True, True]
+        assert all(result == "результат" for result, _ in results)
+        assert len(flight) == 0
+
+    async def test_error_propagates_and_key_released(self):
+        flight = SingleFlight()
+        run, calls = counted(error=RuntimeError("сбой"))
+
+        results = await asyncio.gather(flight.do("key", run), flight.do("key", run), return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+
+        with pytest.raises(RuntimeError):
+            await flight.do("key", run)
+        assert len(calls) == 2
+
+    async def test_cancelled_waiter_does_not_cancel_run(self):
+        flight = SingleFlight()
+        run, calls = counted(delay=0.1)
+
+        first = asyncio.create_task(flight.do("key", run))
+        await asyncio.sleep(0.01)
+        second = asyncio.create_task(flight.do("key", run))
+        await asyncio.sleep(0.01)
+        first.cancel()
+
+        assert await second == ("результат", True)
+        assert len(calls) == 1
+
+
+class TestIdempotencyStore:
+    """Тесты хранения прогонов по ключу идемпотентности"""
+
+    async def test_retry_attaches_and_replays(self):
+        store = IdempotencyStore()
+        run, calls = counted()
+
+        running = await asyncio.gather(store.run("k", "body", run), store.run("k", "body", run))
+        finished = await store.run("k", "body", run)
+
+        assert running == [("результат", False), ("результат", True)]
+        assert finished == ("результат", True)
+        assert len(calls) == 1
+
+    async def test_different_body_rejected(self):
+        store = IdempotencyStore()
+        run, _ = counted()
+        await store.run("k", "body", run)
+
+        with pytest.raises(IdempotencyKeyReused):
+            await store.run("k", "другое тело", run)
+
+    async def test_failed_run_not_stored(self):
+        store = IdempotencyStore()
+        failing, _ = counted(error=RuntimeError("сбой"))
+        run, calls = counted()
+
+        with pytest.raises(RuntimeError):
+            await store.run("k", "body", failing)
+
+        assert await store.run("k", "body", run) == ("результат", False)
+        assert len(calls) == 1
+
+    async def test_bounded_by_ttl_and_max_keys(self):
+        clock = FakeClock()
+        store = IdempotencyStore(ttl_seconds=60, max_keys=2, clock=clock)
+        run, calls = counted(delay=0)
+
+        for key in ("a", "b", "c"):
+            await store.run(key, "body", run)
+        assert len(store) == 2
+        assert (await store.run("a", "body", run))[1] is False
+
+        clock.now = 61
+        assert (await store.run("b", "body", run))[1] is False
+        assert len(store) == 1
+        assert len(calls) == 5
+
+
+class TestCoalescedQueries:
+    """Одинаковые запросы в оркестраторе"""
+
+    async def test_identical_queries_share_pipeline(self, scripted_llm):
+        scripted_llm.delay = 0.05
+
+        first, second = await asyncio.gather(
+            orchestrator.process_query("Собери требования к CRM"),
+            orchestrator.process_query("  собери требования   к CRM "),
+        )
+
+        assert scripted_llm.calls == ["route", "agent", "review"]
+        assert second["coalesced"] and "coalesced" not in first
+        assert second["input"] == "  собери требования   к CRM "
+        assert second["agent_response"] == first["agent_response"]
+
+    async def test_different_queries_run_separately(self, scripted_llm):
+        scripted_llm.delay = 0.05
+
+        await asyncio.gather(
+            orchestrator.process_query("Собери требования к CRM"),
+            orchestrator.process_query("Собери требования к ERP"),
+        )
+
+        assert scripted_llm.calls.count("agent") == 2
+
+    async def test_disabled(self, scripted_llm, monkeypatch):
+        monkeypatch.setenv("QUERY_COALESCING_ENABLED", "false")
+        scripted_llm.delay = 0.05
+
+        await asyncio.gather(*(orchestrator.process_query("Собери требования к CRM") for _ in range(2)))
+
+        assert scripted_llm.calls.count("agent") == 2
+
+    def test_key_changes_with_prompt_version(self, temp_storage):
+        before = coalescing_key("Запрос", "model", temp_storage.snapshot().prompt_versions)
+        agent = temp_storage.get_by_id("agent2")
+        temp_storage.update(
+            agent_id="agent2", name=agent["name"], description=agent["description"],
+            prompt="Новый промпт аналитика требований", color=agent["color"],
+        )
+
+        after = temp_storage.snapshot().prompt_versions
+        assert coalescing_key("Запрос", "model", after) != before
+        assert coalescing_key(" запрос ", "model", after) == coalescing_key("Запрос", "model", after)
+
+
+class TestIdempotencyKeyApi:
+    """Повторы /query с заголовком Idempotency-Key от параллельных клиентов"""
+
+    @pytest.fixture
+    async def client(self, mock_env_vars):
+        from main import app
+
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            yield client
+
+    async def test_retries_attach_to_one_execution(self, client, scripted_llm, idempotency_store):
+        scripted_llm.delay = 0.05
+        request = {"json": {"query": "Собери требования к CRM"}, "headers": {"Idempotency-Key": "retry-1"}}
+
+        responses = await asyncio.gather(*(client.post("/query", **request) for _ in range(3)))
+        later = await client.post("/query", **request)
+
+        assert [r.status_code for r in responses] == [200, 200, 200]
+        assert scripted_llm.calls == ["route", "agent", "review"]
+        assert sorted(r.headers.get("Idempotent-Replayed", "") for r in responses) == ["", "true", "true"]
+        assert later.headers["Idempotent-Replayed"] == "true"
+        assert later.json() == responses[0].json()
+
+    async def test_key_reused_with_other_body(self, client, scripted_llm, idempotency_store):
+        headers = {"Idempotency-Key": "retry-2"}
+        await client.post("/query", json={"query": "Собери требования к CRM"}, headers=headers)
+
+        response = await client.post("/query", json={"query": "Собери требования к ERP"}, headers=headers)
+
+        assert response.status_code == 422
+        assert scripted_llm.calls.count("agent") == 1
+
+    async def test_concurrent_clients_without_key_coalesced(self, client, scripted_llm):
+        scripted_llm.delay = 0.05
+
+        responses = await asyncio.gather(
+            *(client.post("/query", json={"query": "Собери требования к CRM"}) for _ in range(2))
+        )
+
+        assert scripted_llm.calls == ["route", "agent", "review"]
+        assert sorted(r.json()["coalesced"] for r in responses) == [False, True]
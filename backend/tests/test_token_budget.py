@@ -0,0 +1,234 @@
+"""
+Тесты подсчёта токенов и бюджетов вызовов LLM
+"""
+import sys
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import orchestrator
+import token_budget
+from token_budget import (
+    MESSAGE_OVERHEAD, REPLY_OVERHEAD, TRIM_MARKER, TokenBudget, TokenBudgetExceeded,
+    TokenCounter, get_token_budget, shrink
+)
+
+
+class FakeEncoding:
+    """Кодировка «одно слово — один токен» вместо скачиваемой tiktoken"""
+
+    def encode(self, text, disallowed_special=()):
+        return text.split(" ")
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+
+@pytest.fixture
+def counter():
+    return TokenCounter(token_budget.HEURISTIC)
+
+
+def build(parts):
+    return ["Системный промпт", f"Запрос: {parts['input']}\nИстория:\n{parts.get('history', '')}"]
+
+
+class TestTokenCounter:
+    """Тесты подсчёта и обрезки текста"""
+
+    def test_heuristic_count(self, counter):
+        assert counter.name == "heuristic"
+        assert counter.count("") == 0
+        assert counter.count("abcd" * 10) == 10
+        # Кириллица — 2 символа на токен
+        assert counter.count("абвг") == 2
+
+    def test_count_messages_adds_overhead(self, counter):
+        assert counter.count_messages(["abcd", "abcdabcd"]) == 3 + 2 * MESSAGE_OVERHEAD + REPLY_OVERHEAD
+
+    def test_head_and_tail(self, counter):
+        text = "начало середина конец"
+
+        assert counter.head(text, 3) == "начало"
+        assert counter.tail(text, 2) == "онец"
+        assert counter.count(counter.head(text, 5)) <= 5
+        assert counter.head(text, 0) == ""
+
+    def test_tiktoken_encoding(self, monkeypatch):
+        counter = TokenCounter("o200k_base")
+        counter._encoding, counter._loaded = FakeEncoding(), True
+
+        assert counter.name == "tiktoken:o200k_base"
+        assert counter.count("один два три") == 3
+        assert counter.head("один два три", 2) == "один два"
+        assert counter.tail("один два три", 1) == "три"
+
+    def test_unknown_encoding_falls_back_to_heuristic(self):
+        counter = TokenCounter("no-such-encoding")
+
+        assert counter.name == "heuristic"
+        assert counter.count("abcd") == 1
+
+
+class TestTokenizerLoading:
+    """Загрузка кодировки tiktoken не блокирует цикл событий"""
+
+    @pytest.fixture
+    def download(self, monkeypatch):
+        """Подменяет tiktoken: get_encoding ждёт, пока тест не «докачает» файл"""
+        finished = threading.Event()
+
+        def get_encoding(name):
+            finished.wait(5)
+            return FakeEncoding()
+
+        monkeypatch.setitem(sys.modules, "tiktoken", SimpleNamespace(get_encoding=get_encoding))
+        monkeypatch.setenv("TOKENIZER_ENCODING", "o200k_base")
+        monkeypatch.setattr(token_budget, "_counters", {})
+        return finished
+
+    async def test_event_loop_uses_heuristic_until_loaded(self, download):
+        counter = token_budget.get_counter()
+
+        assert counter.encoding is None
+        assert counter.count("один два три") == 6
+
+        download.set()
+        counter.load_in_background().join(5)
+        assert counter.count("один два три") == 3
+
+    async def test_preload_bounded_by_timeout(self, download):
+        assert await token_budget.preload_tokenizer(timeout=0.05) is False
+
+        download.set()
+        assert await token_budget.preload_tokenizer(timeout=5) is True
+        assert token_budget.get_counter().name == "tiktoken:o200k_base"
+
+
+class TestShrink:
+    """Тесты способов сокращения"""
+
+    def test_oldest_lines(self, counter):
+        text = "\n".join(f"line {i:03d}" for i in range(10))
+
+        result = shrink(counter, text, 10, "oldest_lines")
+
+        assert result.splitlines()[-1] == "line 009"
+        assert "line 000" not in result
+        assert counter.count(result) <= 10
+
+    def test_middle_keeps_both_ends(self, counter):
+        text = "НАЧАЛО " + "x" * 400 + " КОНЕЦ"
+
+        result = shrink(counter, text, 30, "middle")
+
+        assert result.startswith("НАЧАЛО")
+        assert result.endswith("КОНЕЦ")
+        assert TRIM_MARKER in result
+        assert counter.count(result) <= 31
+
+    def test_end(self, counter):
+        result = shrink(counter, "a" * 400, 10, "end")
+
+        assert result.endswith("…")
+        assert counter.count(result) <= 10
+
+    def test_text_within_budget_unchanged(self, counter):
+        assert shrink(counter, "короткий текст", 100, "middle") == "короткий текст"
+
+
+class TestTokenBudget:
+    """Тесты укладывания промпта в бюджет узла"""
+
+    def test_fits_without_trimming(self, counter):
+        budget = TokenBudget(counter, {"agent": 1000}, {"agent": 256})
+
+        prompt = budget.fit("agent", build, {"input": "вопрос"}, (("input", "end"),))
+
+        assert prompt.trimmed == []
+        assert prompt.prompt_tokens == counter.count_messages(prompt.texts)
+        assert prompt.llm_kwargs == {"max_tokens": 256}
+        assert prompt.estimate == {"prompt_tokens": prompt.prompt_tokens, "max_tokens": 256}
+
+    def test_trims_in_order(self, counter):
+        """Сначала сокращается история; запрос — только если её не хватило"""
+        budget = TokenBudget(counter, {"agent": 100}, {})
+        parts = {"input": "вопрос", "history": "\n".join("реплика " * 5 for _ in range(20))}
+
+        prompt = budget.fit("agent", build, parts, (("history", "oldest_lines"), ("input", "end")))
+
+        assert prompt.trimmed == ["history"]
+        assert prompt.parts["input"] == "вопрос"
+        assert prompt.prompt_tokens <= 100
+        assert prompt.llm_kwargs == {}
+
+    def test_trimming_is_deterministic(self, counter):
+        budget = TokenBudget(counter, {"agent": 60}, {})
+        parts = {"input": "z" * 500, "history": "старое\n" * 50}
+        order = (("history", "oldest_lines"), ("input", "end"))
+
+        first = budget.fit("agent", build, parts, order)
+        second = budget.fit("agent", build, parts, order)
+
+        assert first.texts == second.texts
+        assert first.trimmed == ["history", "input"]
+
+    def test_fixed_part_over_budget_raises(self, counter):
+        budget = TokenBudget(counter, {"agent": 5}, {})
+
+        with pytest.raises(TokenBudgetExceeded, match="input budget is 5"):
+            budget.fit("agent", build, {"input": "вопрос"}, (("input", "end"),))
+
+    def test_budgets_from_env(self, monkeypatch):
+        monkeypatch.setenv("LLM_INPUT_BUDGETS", '{"agent": 2000}')
+        monkeypatch.setenv("LLM_OUTPUT_BUDGETS", '{"review": null}')
+
+        budget = get_token_budget()
+
+        assert budget.input_budget("agent") == 2000
+        assert budget.input_budget("review") == token_budget.DEFAULT_INPUT_BUDGETS["review"]
+        assert budget.max_tokens("review") is None
+        assert budget.max_tokens("orchestrator") == token_budget.DEFAULT_OUTPUT_BUDGETS["orchestrator"]
+
+
+class TestPipelineBudgets:
+    """Бюджеты в пайплайне process_query"""
+
+    async def test_estimates_in_result_and_max_tokens_passed(self, scripted_llm):
+        result = await orchestrator.process_query("Собери требования к CRM")
+
+        estimates = result["token_estimates"]
+        assert [(e["node"], e["kind"]) for e in estimates] == [
+            ("orchestrator", "route"), ("agent2", "agent"), ("review", "review")
+        ]
+        assert all(e["prompt_tokens"] > 0 for e in estimates)
+        defaults = token_budget.DEFAULT_OUTPUT_BUDGETS
+        assert scripted_llm.max_tokens == [defaults["orchestrator"], defaults["agent"], defaults["review"]]
+
+    async def test_oversized_query_trimmed(self, scripted_llm, monkeypatch):
+        monkeypatch.setenv("LLM_INPUT_BUDGETS", '{"agent": 600}')
+
+        result = await orchestrator.process_query("Собери требования к CRM. " + "Подробности. " * 500)
+
+        agent = next(e for e in result["token_estimates"] if e["kind"] == "agent")
+        assert agent["trimmed"] == ["input"]
+        assert agent["prompt_tokens"] <= 600
+        agent_input = scripted_llm.inputs[scripted_llm.calls.index("agent")]
+        assert agent_input.rstrip().endswith("…")
+
+    def test_query_endpoint_returns_estimates(self, test_client, scripted_llm):
+        response = test_client.post("/query", json={"query": "Собери требования к CRM"})
+
+        assert response.status_code == 200
+        estimates = response.json()["token_estimates"]
+        assert {e["node"] for e in estimates} >= {"orchestrator", "review"}
+
+    def test_query_endpoint_rejects_prompt_over_budget(self, test_client, scripted_llm, monkeypatch):
+        """Меню агентов больше бюджета маршрутизатора — 413, а не вызов LLM"""
+        monkeypatch.setenv("LLM_INPUT_BUDGETS", '{"orchestrator": 10}')
+
+        response = test_client.post("/query", json={"query": "Собери требования к CRM"})
+
+        assert response.status_code == 413
+        assert scripted_llm.calls == []
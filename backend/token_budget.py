@@ -0,0 +1,314 @@
+"""
+Бюджеты токенов для вызовов LLM.
+
+Перед каждым вызовом узел графа считает токены промпта локальным
+токенизатором и укладывает промпт во входной бюджет узла
+(LLM_INPUT_BUDGETS), а ответ ограничивает выходным (LLM_OUTPUT_BUDGETS,
+передаётся провайдеру как max_tokens).
+
+Токенизатор — tiktoken с кодировкой TOKENIZER_ENCODING (по умолчанию
+o200k_base, как у gpt-4o). Файл кодировки tiktoken скачивает при первом
+использовании (без таймаута), поэтому в цикле событий кодировка загружается
+в фоновом потоке, а lifecycle.startup ждёт её не дольше
+TOKENIZER_LOAD_TIMEOUT секунд. Пока кодировка не загружена, если загрузка не
+удалась (нет сети) или TOKENIZER_ENCODING=heuristic, используется
+консервативная оценка по символам: 4 символа ASCII или 2 остальных символа
+на токен.
+
+Если промпт не влезает в бюджет, части сокращаются в порядке, который задаёт
+узел, и каждая — своим способом:
+
+- oldest_lines — удаляются самые старые строки (сводка истории сессии);
+- middle — середина заменяется пометкой, начало и конец сохраняются
+  (черновик и ответ агента);
+- end — обрезается конец (инструкции ревьюера, запрос пользователя).
+
+Системный промпт и шаблон не сокращаются: если без них не уложиться,
+вызов не выполняется (TokenBudgetExceeded).
+"""
+
+import asyncio
+import json
+import math
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from loguru import logger
+
+DEFAULT_ENCODING = "o200k_base"
+HEURISTIC = "heuristic"
+DEFAULT_INPUT_BUDGETS = {"orchestrator": 4000, "agent": 12000, "review": 8000}
+DEFAULT_OUTPUT_BUDGETS = {"orchestrator": 64, "agent": 4096, "review": 512}
+DEFAULT_INPUT_BUDGET = 12000
+DEFAULT_TOKENIZER_LOAD_TIMEOUT = 10
+
+# Служебные токены chat-формата OpenAI: на сообщение и на начало ответа
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD = 3
+
+TRIM_MARKER = "\n[… фрагмент сокращён …]\n"
+TRIM_STRATEGIES = ("oldest_lines", "middle", "end")
+
+_ENV_VARS = ("TOKENIZER_ENCODING", "LLM_INPUT_BUDGETS", "LLM_OUTPUT_BUDGETS")
+
+
+class TokenBudgetExceeded(ValueError):
+    """Несокращаемая часть промпта больше входного бюджета узла"""
+
+
+def _char_weight(char: str) -> float:
+    return 0.25 if char.isascii() else 0.5
+
+
+class TokenCounter:
+    """Подсчёт и обрезка текста в токенах (tiktoken или оценка по символам)"""
+
+    def __init__(self, encoding: str = DEFAULT_ENCODING):
+        self.encoding_name = encoding
+        self._encoding = None
+        self._loaded = encoding == HEURISTIC
+        self._lock = threading.Lock()
+        self._loader: Optional[threading.Thread] = None
+
+    def load(self):
+        """Загружает кодировку tiktoken; блокирует, пока файл кодировки скачивается"""
+        with self._lock:
+            if not self._loaded:
+                try:
+                    import tiktoken
+
+                    self._encoding = tiktoken.get_encoding(self.encoding_name)
+                except Exception as e:
+                    logger.warning(
+                        f"Tokenizer {self.encoding_name} unavailable ({type(e).__name__}), "
+                        f"using character-based token estimate"
+                    )
+                self._loaded = True
+        return self._encoding
+
+    def load_in_background(self) -> threading.Thread:
+        """Поток загрузки кодировки (запускается один раз)"""
+        if self._loader is None:
+            self._loader = threading.Thread(target=self.load, name="tokenizer-load", daemon=True)
+            self._loader.start()
+        return self._loader
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    @property
+    def encoding(self):
+        """
+        Кодировка tiktoken; None — оценка по символам. В цикле событий не
+        ждёт загрузки: до её завершения используется оценка по символам.
+        """
+        if self._loaded:
+            return self._encoding
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return self.load()
+        self.load_in_background()
+        return None
+
+    @property
+    def name(self) -> str:
+        return f"tiktoken:{self.encoding_name}" if self.encoding is not None else HEURISTIC
+
+    def _encode(self, text: str) -> List[int]:
+        # Спецтокены в пользовательском тексте считаются обычным текстом
+        return self.encoding.encode(text, disallowed_special=())
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        if self.encoding is not None:
+            return len(self._encode(text))
+        return math.ceil(sum(_char_weight(char) for char in text))
+
+    def count_messages(self, texts: Sequence[str]) -> int:
+        """Токены промпта из сообщений с учётом служебных токенов chat-формата"""
+        return sum(self.count(text) + MESSAGE_OVERHEAD for text in texts) + REPLY_OVERHEAD
+
+    def head(self, text: str, tokens: int) -> str:
+        """Начало текста не длиннее tokens токенов"""
+        if tokens <= 0:
+            return ""
+        if self.encoding is not None:
+            return self.encoding.decode(self._encode(text)[:tokens])
+        used = 0.0
+        for index, char in enumerate(text):
+            used += _char_weight(char)
+            if used > tokens:
+                return text[:index]
+        return text
+
+    def tail(self, text: str, tokens: int) -> str:
+        """Конец текста не длиннее tokens токенов"""
+        if tokens <= 0:
+            return ""
+        if self.encoding is not None:
+            return self.encoding.decode(self._encode(text)[-tokens:])
+        return self.head(text[::-1], tokens)[::-1]
+
+
+def shrink(counter: TokenCounter, text: str, tokens: int, strategy: str) -> str:
+    """Сокращает текст до tokens токенов способом strategy (см. TRIM_STRATEGIES)"""
+    if counter.count(text) <= tokens:
+        return text
+    if strategy == "oldest_lines":
+        lines = text.splitlines()
+        while lines and counter.count("\n".join(lines)) > tokens:
+            lines.pop(0)
+        return "\n".join(lines)
+    if strategy == "middle":
+        keep = tokens - counter.count(TRIM_MARKER)
+        if keep < 2:
+            return counter.head(text, tokens)
+        return counter.head(text, keep - keep // 2) + TRIM_MARKER + counter.tail(text, keep // 2)
+    return counter.head(text, tokens - 1) + "…" if tokens > 1 else ""
+
+
+@dataclass
+class BudgetedPrompt:
+    """Промпт, уложенный во входной бюджет узла"""
+    texts: List[str]
+    parts: Dict[str, str]
+    prompt_tokens: int
+    max_tokens: Optional[int]
+    # Сокращённые части в порядке сокращения
+    trimmed: List[str] = field(default_factory=list)
+
+    @property
+    def llm_kwargs(self) -> Dict[str, Any]:
+        """Параметры вызова LLM: ограничение длины ответа"""
+        return {"max_tokens": self.max_tokens} if self.max_tokens else {}
+
+    @property
+    def estimate(self) -> Dict[str, Any]:
+        """Оценка вызова для трассы и ответа API"""
+        estimate: Dict[str, Any] = {"prompt_tokens": self.prompt_tokens, "max_tokens": self.max_tokens}
+        if self.trimmed:
+            estimate["trimmed"] = list(self.trimmed)
+        return estimate
+
+
+class TokenBudget:
+    """Входные и выходные бюджеты токенов по узлам графа"""
+
+    def __init__(
+        self,
+        counter: TokenCounter,
+        input_budgets: Optional[Dict[str, int]] = None,
+        output_budgets: Optional[Dict[str, Optional[int]]] = None
+    ):
+        self.counter = counter
+        self.input_budgets = dict(DEFAULT_INPUT_BUDGETS if input_budgets is None else input_budgets)
+        self.output_budgets = dict(DEFAULT_OUTPUT_BUDGETS if output_budgets is None else output_budgets)
+
+    def input_budget(self, node: str) -> int:
+        return int(self.input_budgets.get(node, DEFAULT_INPUT_BUDGET))
+
+    def max_tokens(self, node: str) -> Optional[int]:
+        value = self.output_budgets.get(node)
+        return int(value) if value else None
+
+    def fit(
+        self,
+        node: str,
+        build: Callable[[Dict[str, str]], List[str]],
+        parts: Dict[str, str],
+        order: Sequence[Tuple[str, str]],
+        max_tokens: Optional[int] = None
+    ) -> BudgetedPrompt:
+        """
+        Собирает промпт build(parts) и, если он больше бюджета узла, сокращает
+        части в порядке order ((часть, способ), ...), пока он не уложится.
+        """
+        parts = dict(parts)
+        budget = self.input_budget(node)
+        texts = build(parts)
+        tokens = self.counter.count_messages(texts)
+        trimmed: List[str] = []
+
+        for name, strategy in order:
+            # Несколько проходов: на стыках при обрезке токены могут склеиться
+            for _ in range(3):
+                if tokens <= budget or not parts.get(name):
+                    break
+                size = self.counter.count(parts[name])
+                parts[name] = shrink(self.counter, parts[name], size - (tokens - budget), strategy)
+                if name not in trimmed:
+                    trimmed.append(name)
+                texts = build(parts)
+                tokens = self.counter.count_messages(texts)
+
+        if tokens > budget:
+            raise TokenBudgetExceeded(
+                f"Prompt for {node} needs {tokens} tokens after trimming, input budget is {budget}"
+            )
+        if trimmed:
+            logger.info(f"Trimmed {', '.join(trimmed)} to fit {node} prompt into {budget} tokens")
+        return BudgetedPrompt(
+            texts=texts,
+            parts=parts,
+            prompt_tokens=tokens,
+            max_tokens=self.max_tokens(node) if max_tokens is None else max_tokens,
+            trimmed=trimmed,
+        )
+
+
+# Токенизаторы по кодировкам: загрузка кодировки — сотни миллисекунд
+_counters: Dict[str, TokenCounter] = {}
+_budget: Optional[TokenBudget] = None
+_budget_key: Optional[tuple] = None
+
+
+def get_counter(encoding: Optional[str] = None) -> TokenCounter:
+    encoding = encoding or os.getenv("TOKENIZER_ENCODING") or DEFAULT_ENCODING
+    counter = _counters.get(encoding)
+    if counter is None:
+        counter = _counters[encoding] = TokenCounter(encoding)
+    return counter
+
+
+async def preload_tokenizer(timeout: Optional[float] = None) -> bool:
+    """
+    Загружает кодировку текущего токенизатора вне цикла событий и ждёт её
+    не дольше timeout (TOKENIZER_LOAD_TIMEOUT) секунд; False — загрузка
+    продолжается в фоне.
+    """
+    if timeout is None:
+        timeout = float(os.getenv("TOKENIZER_LOAD_TIMEOUT", DEFAULT_TOKENIZER_LOAD_TIMEOUT))
+    counter = get_counter()
+    if not counter.loaded:
+        await asyncio.to_thread(counter.load_in_background().join, timeout)
+    if not counter.loaded:
+        logger.warning(
+            f"Tokenizer {counter.encoding_name} not loaded in {timeout:g} s, "
+            f"using character-based token estimate until it is"
+        )
+    return counter.loaded
+
+
+def count_tokens(text: str) -> int:
+    """Число токенов текста текущим токенизатором"""
+    return get_counter().count(text)
+
+
+def get_token_budget() -> TokenBudget:
+    """Бюджеты из переменных окружения; пересобираются при их изменении"""
+    global _budget, _budget_key
+
+    key = tuple(os.getenv(name) for name in _ENV_VARS)
+    if _budget is None or key != _budget_key:
+        _budget = TokenBudget(
+            get_counter(),
+            input_budgets={**DEFAULT_INPUT_BUDGETS, **json.loads(os.getenv("LLM_INPUT_BUDGETS") or "{}")},
+            output_budgets={**DEFAULT_OUTPUT_BUDGETS, **json.loads(os.getenv("LLM_OUTPUT_BUDGETS") or "{}")},
+        )
+        _budget_key = key
+    return _budget
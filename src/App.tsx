@@ -8,8 +8,8 @@ import { ResponseSkeleton } from './components/Skeleton';
 import { ThemeProvider } from './contexts/ThemeContext';
 import { ThemeToggle } from './components/ThemeToggle';
 import { SearchInput } from './components/SearchInput';
-import { queryOrchestrator, checkHealth, getAgents, getAgent, updateAgent } from './services/api';
-import type { QueryResponse, QueryHistoryItem, Agent } from './types';
+import { queryOrchestratorStream, checkHealth, getAgents, getAgent, updateAgent } from './services/api';
+import type { QueryResponse, QueryHistoryItem, QueryStreamEvent, Agent } from './types';
 import { MessageSquare, Plus, Menu, X, Trash2 } from 'lucide-react';
 
 const MAX_HISTORY_ITEMS = 50;
@@ -23,6 +23,8 @@ const getInitialSidebarState = () => {
 function AppContent() {
   const { showToast } = useToast();
   const [result, setResult] = useState<QueryResponse | null>(null);
+  // Частичный ответ, собираемый из событий /query/stream до прихода "final"
+  const [streamingResult, setStreamingResult] = useState<QueryResponse | null>(null);
   const [isLoading, setIsLoading] = useState(false);
   const [error, setError] = useState<string | null>(null);
   const [backendStatus, setBackendStatus] = useState<'checking' | 'online' | 'offline'>('checking');
@@ -70,9 +72,57 @@ function AppContent() {
     setIsLoading(true);
     setError(null);
     setResult(null);
+    setStreamingResult(null);
+
+    // Токены каждого агента копятся отдельно: в режиме fan-out агенты
+    // отвечают одновременно, и их токены приходят вперемешку
+    let buffers: Record<string, string> = {};
+    const agentNames = Object.fromEntries(agents.map((agent) => [agent.id, agent.name]));
+    // Как merge_responses на сервере: раздел на каждого агента
+    const renderBuffers = () => {
+      const entries = Object.entries(buffers);
+      if (entries.length === 1) return entries[0][1];
+      return entries
+        .map(([agentId, content]) => `## ${agentNames[agentId] ?? agentId} (${agentId})\n\n${content}`)
+        .join('\n\n');
+    };
+
+    const handleStreamEvent = (event: QueryStreamEvent) => {
+      if (event.event === 'token') {
+        buffers = { ...buffers, [event.agent]: (buffers[event.agent] ?? '') + event.content };
+      } else if (event.event === 'revision') {
+        buffers = {};
+      }
+      const agentResponse = renderBuffers();
+
+      setStreamingResult((prev) => {
+        const partial: QueryResponse = prev ?? {
+          input: query,
+          route: '',
+          agent_response: '',
+          review_result: '',
+          context: '',
+          iteration_count: 0,
+          log: [],
+        };
+        switch (event.event) {
+          case 'route':
+            return { ...partial, route: event.route };
+          case 'token':
+            return { ...partial, agent_response: agentResponse };
+          case 'review':
+            return { ...partial, review_result: event.review_result };
+          case 'revision':
+            // Агент генерирует ответ заново с учётом замечаний ревьюера
+            return { ...partial, agent_response: '', iteration_count: event.iteration_count };
+          default:
+            return partial;
+        }
+      });
+    };
 
     try {
-      const response = await queryOrchestrator(query);
+      const response = await queryOrchestratorStream(query, handleStreamEvent);
       setResult(response);
       setBackendStatus('online');
 
@@ -95,6 +145,7 @@ function AppContent() {
       setBackendStatus('offline');
     } finally {
       setIsLoading(false);
+      setStreamingResult(null);
     }
   };
 
@@ -331,7 +382,11 @@ function AppContent() {
                 </div>
               )}
 
-              {isLoading && (
+              {isLoading && streamingResult?.agent_response && (
+                <ResultDisplay result={streamingResult} isStreaming />
+              )}
+
+              {isLoading && !streamingResult?.agent_response && (
                 <div className="mb-8">
                   <ResponseSkeleton />
                 </div>
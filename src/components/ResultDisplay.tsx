@@ -7,9 +7,11 @@ import { CodeBlock } from './CodeBlock';
 
 interface ResultDisplayProps {
   result: QueryResponse;
+  // Ответ ещё дописывается из потока /query/stream
+  isStreaming?: boolean;
 }
 
-export const ResultDisplay = ({ result }: ResultDisplayProps) => {
+export const ResultDisplay = ({ result, isStreaming = false }: ResultDisplayProps) => {
   const [showDetails, setShowDetails] = useState(false);
 
   return (
@@ -64,21 +66,33 @@ export const ResultDisplay = ({ result }: ResultDisplayProps) => {
             </ReactMarkdown>
           </div>
 
+          {isStreaming && (
+            <div className="mt-4 flex items-center gap-2 text-sm text-neutral-500 dark:text-neutral-400">
+              <span className="w-2 h-2 rounded-full bg-primary-500 animate-pulse" />
+              <span>
+                {result.iteration_count > 0 ? `Доработка #${result.iteration_count}` : 'Агент отвечает'}
+                {result.route && ` · ${result.route}`}
+              </span>
+            </div>
+          )}
+
           {/* Details toggle button */}
-          <button
-            onClick={() => setShowDetails(!showDetails)}
-            className="mt-6 flex items-center gap-2 text-sm text-neutral-600 dark:text-neutral-400 hover:text-neutral-900 dark:hover:text-white transition-smooth px-3 py-2 rounded-lg hover:bg-neutral-100 dark:hover:bg-neutral-800 focus-ring"
-            aria-expanded={showDetails}
-          >
-            {showDetails ? (
-              <ChevronUp className="w-4 h-4" />
-            ) : (
-              <ChevronDown className="w-4 h-4" />
-            )}
-            <span className="font-medium">
-              {showDetails ? 'Скрыть детали' : 'Показать детали выполнения'}
-            </span>
-          </button>
+          {!isStreaming && (
+            <button
+              onClick={() => setShowDetails(!showDetails)}
+              className="mt-6 flex items-center gap-2 text-sm text-neutral-600 dark:text-neutral-400 hover:text-neutral-900 dark:hover:text-white transition-smooth px-3 py-2 rounded-lg hover:bg-neutral-100 dark:hover:bg-neutral-800 focus-ring"
+              aria-expanded={showDetails}
+            >
+              {showDetails ? (
+                <ChevronUp className="w-4 h-4" />
+              ) : (
+                <ChevronDown className="w-4 h-4" />
+              )}
+              <span className="font-medium">
+                {showDetails ? 'Скрыть детали' : 'Показать детали выполнения'}
+              </span>
+            </button>
+          )}
 
           {/* Expanded details */}
           {showDetails && (
@@ -1,4 +1,4 @@
-import { QueryRequest, QueryResponse, Agent } from '../types';
+import { QueryRequest, QueryResponse, QueryStreamEvent, Agent } from '../types';
 
 const API_BASE_URL = import.meta.env.VITE_API_BASE_URL || 'http://localhost:8000';
 const API_KEY = import.meta.env.VITE_API_KEY || '';
@@ -32,6 +32,59 @@ export const queryOrchestrator = async (query: string): Promise<QueryResponse> =
   return response.json();
 };
 
+// Потоковый вариант queryOrchestrator: вызывает onEvent на каждое событие
+// пайплайна и возвращает итоговый результат из события "final"
+export const queryOrchestratorStream = async (
+  query: string,
+  onEvent: (event: QueryStreamEvent) => void
+): Promise<QueryResponse> => {
+  const response = await fetch(`${API_BASE_URL}/query/stream`, {
+    method: 'POST',
+    headers: getHeaders(),
+    body: JSON.stringify({ query } as QueryRequest),
+  });
+
+  if (!response.ok || !response.body) {
+    const error = await response.json().catch(() => ({ detail: 'Unknown error' }));
+    throw new Error(error.detail || 'Failed to process query');
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  let result: QueryResponse | null = null;
+
+  const parseLine = (line: string): QueryStreamEvent | null => {
+    if (!line.trim()) return null;
+    const event = JSON.parse(line) as QueryStreamEvent;
+    if (event.event === 'error') {
+      throw new Error(event.detail);
+    }
+    onEvent(event);
+    return event;
+  };
+
+  for (;;) {
+    const { done, value } = await reader.read();
+    buffer += done ? decoder.decode() : decoder.decode(value, { stream: true });
+    const lines = buffer.split('\n');
+    // Последняя строка может быть неполной — дочитаем её со следующим чанком
+    buffer = done ? '' : lines.pop() ?? '';
+    for (const line of lines) {
+      const event = parseLine(line);
+      if (event?.event === 'final') {
+        result = event.result;
+      }
+    }
+    if (done) break;
+  }
+
+  if (!result) {
+    throw new Error('Stream ended without final result');
+  }
+  return result;
+};
+
 export const checkHealth = async (): Promise<{ status: string }> => {
   const response = await fetch(`${API_BASE_URL}/health`);
   if (!response.ok) {
@@ -1,18 +1,51 @@
 export interface QueryRequest {
   query: string;
+  // compact — без лога и контекста, trace — со структурированной трассой
+  verbosity?: 'compact' | 'full' | 'trace';
+  // Сессия диалога (POST /sessions): прошлые ходы хранятся на сервере
+  session_id?: string;
+}
+
+// Событие структурированной трассы выполнения
+export interface TraceEvent {
+  ts: number;
+  node: string;
+  kind: string;
+  message: string;
+  duration_ms?: number;
+  prompt_tokens?: number;
+  completion_tokens?: number;
+  payload?: Record<string, unknown>;
 }
 
 export interface QueryResponse {
   input: string;
   route: string;
+  // Все агенты, обработавшие запрос (режим fan-out)
+  routes?: string[] | null;
   agent_response: string;
   review_result: string;
   context: string;
   iteration_count: number;
   // Подробный человекочитаемый лог шагов пайплайна
   log: string[];
+  // Ответ взят из кэша на сервере
+  cached?: boolean;
+  // Только при verbosity = 'trace'
+  trace?: TraceEvent[] | null;
+  // Сессия, в которую записан ход
+  session_id?: string | null;
 }
 
+// События потокового endpoint /query/stream (одна JSON-строка NDJSON на событие)
+export type QueryStreamEvent =
+  | { event: 'route'; route: string; routes?: string[] }
+  | { event: 'token'; agent: string; content: string }
+  | { event: 'review'; review_result: string; revised_instructions: string | null }
+  | { event: 'revision'; iteration_count: number }
+  | { event: 'final'; result: QueryResponse }
+  | { event: 'error'; detail: string };
+
 export interface Agent {
   id: string;
   name: string;